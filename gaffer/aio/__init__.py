@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -
+#
+# This file is part of gaffer. See the NOTICE for more information.
+
+"""
+asyncio client for gaffer and lookupd (Python 3.5 or sup). It mirrors the
+API of `gaffer.httpclient` and `gaffer.lookupd.client` but all calls are
+coroutines and connections to a node are kept alive and reused, so one
+process can supervise many nodes concurrently.
+
+Example of usage::
+
+    import asyncio
+
+    from gaffer.aio import Server
+
+    async def main():
+        s = Server("http://localhost:5000")
+
+        job = await s.get_job("dummy")
+        await job.scale(2)
+
+        # listen on the events of the node
+        sock = await s.socket()
+        events = await sock.subscribe("EVENTS")
+        async for event in events:
+            print(event)
+
+    asyncio.get_event_loop().run_until_complete(main())
+
+"""
+
+from ..httpclient.base import (GafferNotFound, GafferConflict,
+        GafferUnauthorized, GafferForbidden)
+from .base import BaseClient, HTTPError, HTTPResponse
+from .lookup import LookupServer, LookupChannel
+from .server import Server, Job, Process
+from .websocket import (WebSocket, GafferSocket, Subscription,
+        SubscriptionError)
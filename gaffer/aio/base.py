@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -
+#
+# This file is part of gaffer. See the NOTICE for more information.
+
+import asyncio
+from collections import deque
+import json
+import ssl as _ssl
+
+from ..httpclient.base import (GafferNotFound, GafferConflict,
+        GafferUnauthorized, GafferForbidden)
+from ..httpclient.util import make_uri
+from ..util import urlparse, unquote
+
+DEFAULT_PORTS = {"http": 80, "https": 443, "ws": 80, "wss": 443}
+
+# methods that can be safely sent again
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+
+
+class HTTPError(Exception):
+    """ exception raised when the node returns an unexpected HTTP status """
+
+    def __init__(self, code, response=None):
+        self.code = code
+        self.response = response
+
+    def __str__(self):
+        return "HTTP %s" % self.code
+
+
+class HTTPResponse(object):
+    """ response returned by the node """
+
+    def __init__(self, code, headers, body):
+        self.code = code
+        self.headers = headers
+        self.body = body
+
+    def header(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+    def json(self):
+        body = self.body.decode("utf-8")
+        try:
+            return json.loads(body)
+        except ValueError:
+            return body
+
+
+def make_ssl_context(ssl=None):
+    if ssl is None or ssl is True:
+        return _ssl.create_default_context()
+    return ssl
+
+
+async def open_connection(url, ssl=None):
+    """ open a stream to the host of the url """
+    url = urlparse(url)
+    if url.scheme in ("http+unix", "ws+unix"):
+        # the host is the quoted path of the unix socket
+        return await asyncio.open_unix_connection(unquote(url.netloc))
+
+    port = url.port or DEFAULT_PORTS.get(url.scheme, 80)
+
+    ssl_context = None
+    if url.scheme in ("https", "wss"):
+        ssl_context = make_ssl_context(ssl)
+
+    return await asyncio.open_connection(url.hostname, port, ssl=ssl_context)
+
+
+def host_header(url):
+    url = urlparse(url)
+    if url.scheme in ("http+unix", "ws+unix"):
+        return "localhost"
+    return url.netloc
+
+
+async def read_headers(reader):
+    """ read the status line and the headers of a response """
+    data = await reader.readuntil(b"\r\n\r\n")
+    lines = data.decode("latin1").split("\r\n")
+
+    parts = lines[0].split(None, 2)
+    version, code = parts[0], int(parts[1])
+
+    headers = {}
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    return version, code, headers
+
+
+class HTTPConnection(object):
+    """ keep-alive connection to a node. Requests are sent one after the
+    other. """
+
+    def __init__(self, reader, writer, host):
+        self.reader = reader
+        self.writer = writer
+        self.host = host
+        self.closed = False
+        self.reused = False
+
+    async def fetch(self, method, url, headers=None, body=None):
+        url = urlparse(url)
+        path = url.path or "/"
+        if url.query:
+            path += "?%s" % url.query
+
+        headers = dict(headers or {})
+        headers.setdefault("Host", self.host)
+        headers["Connection"] = "keep-alive"
+
+        if body is not None:
+            if not isinstance(body, bytes):
+                body = body.encode("utf-8")
+            headers["Content-Length"] = str(len(body))
+
+        lines = ["%s %s HTTP/1.1" % (method, path)]
+        lines.extend(["%s: %s" % (k, v) for k, v in headers.items()])
+        data = ("\r\n".join(lines) + "\r\n\r\n").encode("latin1")
+        if body:
+            data += body
+
+        self.writer.write(data)
+        await self.writer.drain()
+
+        version, code, resp_headers = await read_headers(self.reader)
+        body = await self._read_body(method, code, resp_headers)
+
+        # can we keep the connection alive?
+        connection = resp_headers.get("connection", "").lower()
+        if version == "HTTP/1.0":
+            keep_alive = connection == "keep-alive"
+        else:
+            keep_alive = connection != "close"
+
+        if not keep_alive:
+            self.close()
+        return HTTPResponse(code, resp_headers, body)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.writer.close()
+
+    async def _read_body(self, method, code, headers):
+        if method == "HEAD" or code in (204, 304) or 100 <= code < 200:
+            return b""
+
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                line = await self.reader.readuntil(b"\r\n")
+                length = int(line.strip().split(b";")[0], 16)
+                if not length:
+                    # we ignore the trailers
+                    await self.reader.readuntil(b"\r\n")
+                    break
+                chunk = await self.reader.readexactly(length + 2)
+                chunks.append(chunk[:-2])
+            return b"".join(chunks)
+        elif "content-length" in headers:
+            return await self.reader.readexactly(
+                    int(headers["content-length"]))
+
+        # no length, the body ends with the connection
+        headers["connection"] = "close"
+        return await self.reader.read()
+
+
+class ConnectionPool(object):
+    """ pool of keep-alive connections to a node. At most
+    ``max_connections`` are opened, other requests wait for a free
+    connection. """
+
+    def __init__(self, max_connections=10, ssl=None):
+        self.max_connections = max_connections
+        self.ssl = ssl
+        self._idle = deque()
+        self._semaphore = asyncio.Semaphore(max_connections)
+
+    async def fetch(self, method, url, headers=None, body=None):
+        async with self._semaphore:
+            conn = await self._get_connection(url)
+            try:
+                resp = await conn.fetch(method, url, headers=headers,
+                        body=body)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                conn.close()
+                if not conn.reused or method not in IDEMPOTENT_METHODS:
+                    raise
+
+                # the idle connection has been closed by the node, retry
+                # once on a new connection
+                conn = await self._connect(url)
+                try:
+                    resp = await conn.fetch(method, url, headers=headers,
+                            body=body)
+                except BaseException:
+                    # a cancelled request leaves the connection in an
+                    # unknown state
+                    conn.close()
+                    raise
+            except BaseException:
+                conn.close()
+                raise
+
+            if not conn.closed:
+                self._idle.append(conn)
+            return resp
+
+    def close(self):
+        while self._idle:
+            self._idle.popleft().close()
+
+    async def _get_connection(self, url):
+        while self._idle:
+            conn = self._idle.pop()
+            if conn.closed or conn.reader.at_eof():
+                conn.close()
+                continue
+            conn.reused = True
+            return conn
+        return await self._connect(url)
+
+    async def _connect(self, url):
+        reader, writer = await open_connection(url, ssl=self.ssl)
+        return HTTPConnection(reader, writer, host_header(url))
+
+
+class BaseClient(object):
+    """ base resource object used to abstract request call and response
+    retrieving.
+
+    Connections are kept alive and reused between requests. At most
+    ``max_connections`` connections are opened on the node. """
+
+    def __init__(self, uri, max_connections=10, ssl=None, timeout=None):
+        self.uri = uri
+        self.ssl = ssl
+        self.timeout = timeout
+        self.pool = ConnectionPool(max_connections=max_connections, ssl=ssl)
+
+    def close(self):
+        """ close all the connections opened to the node """
+        self.pool.close()
+
+    async def request(self, method, path, headers=None, body=None, **params):
+        headers = headers or {}
+        headers.update({"Accept": "application/json"})
+        url = make_uri(self.uri, path, **params)
+        method = method.upper()
+        if (body is None) and method in ("POST", "PATCH", "PUT"):
+            body = ""
+
+        fetch = self.pool.fetch(method, url, headers=headers, body=body)
+        if self.timeout:
+            resp = await asyncio.wait_for(fetch, self.timeout)
+        else:
+            resp = await fetch
+
+        if resp.code >= 400 and method != "HEAD":
+            # only raise on non head method since we are using head to
+            # check status and so on.
+            if resp.code == 404:
+                raise GafferNotFound(resp.json())
+            elif resp.code == 409:
+                raise GafferConflict(resp.json())
+            elif resp.code == 401:
+                raise GafferUnauthorized(resp.json())
+            elif resp.code == 403:
+                raise GafferForbidden(resp.json())
+            raise HTTPError(resp.code, resp)
+        return resp
+
+    def json_body(self, resp):
+        return resp.json()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -
+#
+# This file is part of gaffer. See the NOTICE for more information.
+
+import asyncio
+import json
+
+from ..httpclient.util import make_uri
+from .base import BaseClient
+from .websocket import WebSocket
+
+
+class LookupChannel(WebSocket):
+    """ websocket connection to the lookupd events. Events are retrieved by
+    iterating asynchronously the channel::
+
+        async for event in channel:
+            print(event['event'])
+    """
+
+    def __init__(self, url, heartbeat=15.0, ssl=None):
+        super(LookupChannel, self).__init__(url, ssl=ssl)
+        self.heartbeat_timeout = heartbeat
+        self._heartbeat_task = None
+
+    async def connect(self):
+        await super(LookupChannel, self).connect()
+        if self.heartbeat_timeout:
+            self._heartbeat_task = asyncio.get_event_loop().create_task(
+                    self._heartbeat())
+        return self
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while True:
+            message = await self.recv()
+            if message is None:
+                raise StopAsyncIteration
+
+            try:
+                event = json.loads(message)
+            except ValueError:
+                continue
+
+            if "event" in event:
+                return event
+
+    def close(self):
+        if self._heartbeat_task is not None and \
+                not self._heartbeat_task.done():
+            self._heartbeat_task.cancel()
+        super(LookupChannel, self).close()
+
+    async def _heartbeat(self):
+        while not self.closed:
+            await asyncio.sleep(self.heartbeat_timeout)
+            self.ping()
+
+
+class LookupServer(BaseClient):
+    """ asyncio client of a lookupd server """
+
+    async def version(self):
+        """ get the lookupd server version """
+        resp = await self.request("get", "/")
+        return self.json_body(resp)['version']
+
+    async def ping(self):
+        """ ping the lookupd server """
+        resp = await self.request("get", "/ping")
+        return resp.body == b'OK'
+
+    async def nodes(self):
+        """ get the list of nodes registered to this lookupd server """
+        resp = await self.request("get", "/nodes")
+        return self.json_body(resp)
+
+    async def sessions(self, by_node='*'):
+        """ get all sessions registered to this lookupd server """
+        path = "/sessions"
+        if by_node != '*':
+            path = "%s/%s" % (path, by_node)
+        resp = await self.request("get", path)
+        return self.json_body(resp)
+
+    async def jobs(self):
+        """ get all jobs registered to this lookupd server """
+        resp = await self.request("get", "/jobs")
+        return self.json_body(resp)
+
+    async def find_job(self, job_name, strategy=None, limit=None):
+        """ find a job on this lookupd server. The sources can be ranked
+        by ``strategy`` (least_loaded, p2c or round_robin) and limited to
+        ``limit`` sources. """
+        params = {"name": job_name}
+        if strategy is not None:
+            params["strategy"] = strategy
+        if limit:
+            params["limit"] = limit
+        resp = await self.request("get", "/findJob", **params)
+        return self.json_body(resp)
+
+    async def find_session(self, sessionid):
+        """ find all jobs for a session on this lookupd server """
+        resp = await self.request("get", "/findSession", sessionid=sessionid)
+        return self.json_body(resp)
+
+    async def lookup(self, heartbeat=15.0, sessions=None, prefixes=None):
+        """ return a connected `LookupChannel` to listen on the lookupd
+        events (add_node, remove_node, add_job, remove_job, add_process,
+        remove_process). The job events can be limited to some
+        ``sessions`` or to the jobs starting with one of the
+        ``prefixes``. """
+        params = {}
+        if sessions:
+            params["session"] = list(sessions)
+        if prefixes:
+            params["prefix"] = list(prefixes)
+
+        url = make_uri(self.uri, "/lookup/websocket", **params)
+        url = "ws%s" % url.split("http", 1)[1]
+        channel = LookupChannel(url, heartbeat=heartbeat, ssl=self.ssl)
+        return await channel.connect()
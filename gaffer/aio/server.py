@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -
+#
+# This file is part of gaffer. See the NOTICE for more information.
+
+import asyncio
+import base64
+import json
+
+from ..httpclient.util import make_batch, make_uri
+from ..process import ProcessConfig
+from ..util import parse_signal_value
+from .base import BaseClient
+from .websocket import GafferSocket
+
+
+def _ws_url(uri, path, **params):
+    url = make_uri(uri, path, **params)
+    return "ws%s" % url.split("http", 1)[1]
+
+
+class Server(BaseClient):
+    """ Server, main object to connect to a gaffer node from asyncio. All
+    the calls are coroutines and connections to the node are reused. """
+
+    def __init__(self, uri, api_key=None, **options):
+        super(Server, self).__init__(uri, **options)
+        self.api_key = api_key
+        self.auth_token = None
+
+    async def request(self, method, path, headers=None, body=None,
+            **params):
+        headers = headers or {}
+        # if we have an api key, pass it to the headers
+        if self.api_key is not None:
+            headers['X-Api-Key'] = self.api_key
+
+        # continue the request
+        return await super(Server, self).request(method, path,
+                headers=headers, body=body, **params)
+
+    async def authenticate(self, username, password):
+        """ authenticate against a gafferd node to retrieve an api key """
+        # set the basic auth header
+        auth_hdr = "%s:%s" % (username, password)
+        auth_hdr = b"Basic " + base64.b64encode(auth_hdr.encode("utf-8"))
+        headers = {"Authorization": auth_hdr.decode("utf-8")}
+
+        # make the request
+        resp = await self.request("get", "/auth", headers=headers)
+
+        # set the server api key. The signed token can be passed in the
+        # X-Auth-Token header until it expires.
+        obj = self.json_body(resp)
+        self.api_key = obj["api_key"]
+        self.auth_token = obj.get("token")
+        return self.api_key
+
+    async def version(self):
+        """ get gaffer version """
+        resp = await self.request("get", "/")
+        return self.json_body(resp)['version']
+
+    async def running(self):
+        resp = await self.request("get", "/pids")
+        return self.json_body(resp)['pids']
+
+    pids = running
+
+    async def ping(self):
+        resp = await self.request("get", "/ping")
+        return resp.body == b'OK'
+
+    async def sessions(self):
+        """ get list of current sessions """
+        resp = await self.request("get", "/sessions")
+        return self.json_body(resp)['sessions']
+
+    async def jobs(self, sessionid=None):
+        if sessionid is None:
+            resp = await self.request("get", "/jobs")
+        else:
+            resp = await self.request("get", "/jobs/%s" % sessionid)
+        return self.json_body(resp)["jobs"]
+
+    async def snapshot(self):
+        """ get all sessions, jobs, pids and their counts at once """
+        resp = await self.request("get", "/snapshot")
+        return self.json_body(resp)
+
+    async def jobs_info(self, sessionid=None):
+        """ get the info of all jobs. Requests are done concurrently """
+        jobs = await self.jobs(sessionid)
+        resps = await asyncio.gather(*[self.request("get",
+            "/jobs/%s/%s" % self._parse_name(job)) for job in jobs])
+        return [self.json_body(resp) for resp in resps]
+
+    async def job_exists(self, name):
+        sessionid, name = self._parse_name(name)
+        resp = await self.request("head", "/jobs/%s/%s" % (sessionid, name))
+        return resp.code == 200
+
+    async def load(self, config, sessionid=None, start=True, force=False):
+        """  load a process config object. See
+        `gaffer.httpclient.Server.load` """
+        sessionid = self._sessionid(sessionid)
+        headers = {"Content-Type": "application/json" }
+
+        # build config body
+        config_dict = config.to_dict()
+        config_dict.update({'start': start})
+        body = json.dumps(config_dict)
+
+        name = "%s.%s" % (sessionid, config.name)
+        if force and (await self.job_exists(name)):
+            await self.request("put", "/jobs/%s/%s" % (sessionid,
+                config.name), body=body, headers=headers)
+        else:
+            await self.request("post", "/jobs/%s" % sessionid, body=body,
+                    headers=headers)
+
+        return Job(server=self, config=config, sessionid=sessionid)
+
+    async def unload(self, name, sessionid=None):
+        sessionid = self._sessionid(sessionid)
+        await self.request("delete", "/jobs/%s/%s" % (sessionid, name))
+        return True
+
+    async def reload(self, name, sessionid=None):
+        sessionid = self._sessionid(sessionid)
+        await self.request("post", "/jobs/%s/%s/state" % (sessionid, name),
+                body="2")
+        return True
+
+    async def get_job(self, name):
+        sessionid, name = self._parse_name(name)
+        resp = await self.request("get", "/jobs/%s/%s" % (sessionid, name))
+        config_dict = self.json_body(resp)['config']
+        return Job(server=self, config=ProcessConfig.from_dict(config_dict),
+                sessionid=sessionid)
+
+    async def get_process(self, pid):
+        resp = await self.request("get", "/%s" % pid)
+        return Process(server=self, pid=pid, info=self.json_body(resp))
+
+    async def batch(self, commands):
+        """ execute a list of commands in one request. See
+        `gaffer.httpclient.Server.batch` """
+        headers = {"Content-Type": "application/json" }
+        body = json.dumps({"commands": make_batch(commands)})
+        resp = await self.request("post", "/batch", body=body,
+                headers=headers)
+        return self.json_body(resp)['results']
+
+    async def socket(self, heartbeat=15.0):
+        """ return a connected websocket to the gaffer channel """
+        sock = GafferSocket(_ws_url(self.uri, '/channel/websocket'),
+                api_key=self.api_key, heartbeat=heartbeat, ssl=self.ssl)
+        return await sock.connect()
+
+    def _parse_name(self, name):
+        if "." in name:
+            sessionid, name = name.split(".", 1)
+        elif "/" in name:
+            sessionid, name = name.split("/", 1)
+        else:
+            sessionid = "default"
+
+        return sessionid, name
+
+    def _sessionid(self, session=None):
+        if not session:
+            return "default"
+        return session
+
+
+class Job(object):
+    """ Job object. Represent a remote job """
+
+    def __init__(self, server, config=None, sessionid=None):
+        self.server = server
+        self.sessionid = sessionid or 'default'
+        if not isinstance(config, ProcessConfig):
+            self.name = config
+            self._config = None
+        else:
+            self.name = config['name']
+            self._config = config
+
+    def __str__(self):
+        return self.name
+
+    async def config(self):
+        if not self._config:
+            info = await self.info()
+            self._config = ProcessConfig.from_dict(info['config'])
+        return self._config
+
+    async def info(self):
+        """ return the process info dict """
+        resp = await self.server.request("get", "/jobs/%s/%s" % (
+            self.sessionid, self.name))
+        return self.server.json_body(resp)
+
+    async def active(self):
+        """ return True if the process is active """
+        resp = await self.server.request("get", "/jobs/%s/%s/state" % (
+            self.sessionid, self.name))
+        return resp.body == b'1'
+
+    async def running(self):
+        """ return the number of processes running for this template """
+        return (await self.info())['running']
+
+    async def numprocesses(self):
+        """ return the maximum number of processes that can be launched
+        for this template """
+        return (await self.info())['max_processes']
+
+    async def pids(self):
+        """ return a list of running pids """
+        resp = await self.server.request("get", "/jobs/%s/%s/pids" % (
+            self.sessionid, self.name))
+        return self.server.json_body(resp)['pids']
+
+    async def stats(self):
+        """ Return the template stats """
+        resp = await self.server.request("get", "/jobs/%s/%s/stats" %
+                (self.sessionid, self.name))
+        return self.server.json_body(resp)
+
+    async def start(self):
+        """ start the process if not started, spawn new processes """
+        await self.server.request("post", "/jobs/%s/%s/state" % (
+            self.sessionid, self.name), body="1")
+        return True
+
+    async def stop(self):
+        """ stop the process """
+        await self.server.request("post", "/jobs/%s/%s/state" % (
+            self.sessionid, self.name), body="0")
+        return True
+
+    async def restart(self):
+        """ restart the process """
+        await self.server.request("post", "/jobs/%s/%s/state" % (
+            self.sessionid, self.name), body="2")
+        return True
+
+    async def scale(self, num=1):
+        body = json.dumps({"scale": num})
+        resp = await self.server.request("post", "/jobs/%s/%s/numprocesses" % (
+            self.sessionid, self.name), body=body)
+        return self.server.json_body(resp)['numprocesses']
+
+    async def commit(self, graceful_timeout=10.0, env=None):
+        """ Like ``scale(1) but the process won't be kept alived at the end.
+        It is also not handled uring scaling or reaping. """
+        env = env or {}
+        body = json.dumps({"graceful_timeout": graceful_timeout, "env": env})
+        resp = await self.server.request("post", "/jobs/%s/%s/commit" % (
+            self.sessionid, self.name), body=body)
+        return self.server.json_body(resp)['pid']
+
+    async def kill(self, sig):
+        """ send a signal to all processes of this template """
+        body = json.dumps({"signal": parse_signal_value(sig)})
+        await self.server.request("post", "/jobs/%s/%s/signal" % (
+            self.sessionid, self.name), body=body)
+        return True
+
+
+class Process(object):
+    """ Process Id object. It represent a pid. Use
+    `Server.get_process` to get it. """
+
+    def __init__(self, server, pid, info=None):
+        self.server = server
+        self.pid = pid
+        self.info = info or {}
+
+    def __str__(self):
+        return str(self.pid)
+
+    def __getattr__(self, key):
+        if key in self.info:
+            return self.info[key]
+
+        return object.__getattribute__(self, key)
+
+    async def active(self):
+        """ return True if the process is active """
+        resp = await self.server.request("head", "/%s" % self.pid)
+        return resp.code == 200
+
+    async def stats(self):
+        resp = await self.server.request("get", "/%s/stats" % self.pid)
+        return self.server.json_body(resp)['stats']
+
+    async def stop(self):
+        """ stop the process """
+        await self.server.request("delete", "/%s" % self.pid)
+        return True
+
+    async def kill(self, sig):
+        """ Send a signal to the pid """
+        body = json.dumps({"signal": parse_signal_value(sig)})
+        headers = {"Content-Type": "application/json"}
+        await self.server.request("post", "/%s/signal" % self.pid, body=body,
+                headers=headers)
+        return True
@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -
+#
+# This file is part of gaffer. See the NOTICE for more information.
+
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import os
+import struct
+import uuid
+
+from ..error import ProcessError
+from ..httpclient.util import make_batch
+from ..util import urlparse
+from .base import open_connection, read_headers, host_header
+
+# Magic string defined in the spec for calculating keys.
+WS_MAGIC = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+LOGGER = logging.getLogger("gaffer")
+
+
+class SubscriptionError(Exception):
+    """ exception raised when a subscription is refused by the node """
+
+
+def frame(data, opcode=0x01):
+    """Encode data in a masked websocket frame."""
+    header = struct.pack('B', 0x80 | opcode)
+
+    length = len(data)
+    if length < 126:
+        header += struct.pack('B', 0x80 | length)
+    elif length <= 0xFFFF:
+        header += struct.pack('!BH', 0x80 | 126, length)
+    else:
+        header += struct.pack('!BQ', 0x80 | 127, length)
+
+    # Clients must apply a 32-bit mask to all data sent.
+    mask = os.urandom(4)
+    masked = bytes(b ^ mask[i % 4] for i, b in enumerate(data))
+    return header + mask + masked
+
+
+class WebSocket(object):
+    """ Websocket client for protocol version 13 using asyncio streams. """
+
+    def __init__(self, url, ssl=None):
+        self.url = url
+        self.ssl = ssl
+        self.reader = None
+        self.writer = None
+        self.closed = False
+
+    async def connect(self):
+        url = urlparse(self.url)
+        path = url.path or "/"
+        if url.query:
+            path += "?%s" % url.query
+
+        self.reader, self.writer = await open_connection(self.url,
+                ssl=self.ssl)
+
+        key = base64.b64encode(os.urandom(16))
+        request = "\r\n".join(["GET %s HTTP/1.1" % path,
+            "Host: %s" % host_header(self.url),
+            "Upgrade: websocket",
+            "Connection: Upgrade",
+            "Sec-Websocket-Key: %s" % key.decode("latin1"),
+            "Sec-Websocket-Version: 13"]) + "\r\n\r\n"
+        self.writer.write(request.encode("latin1"))
+
+        _, code, headers = await read_headers(self.reader)
+        accept = base64.b64encode(hashlib.sha1(key + WS_MAGIC).digest())
+        accept = accept.decode("latin1")
+        if (code != 101 or
+                headers.get("upgrade", "").lower() != "websocket" or
+                headers.get("sec-websocket-accept") != accept):
+            self.close()
+            raise IOError("websocket handshake failed: %s" % code)
+
+    def send(self, message, binary=False):
+        """ send a message """
+        if isinstance(message, str):
+            message = message.encode("utf-8")
+        self.writer.write(frame(message, 0x2 if binary else 0x1))
+
+    def ping(self):
+        self.writer.write(frame(b'', 0x9))
+
+    async def recv(self):
+        """ return the next message received or None once the connection is
+        closed """
+        fragments = []
+        fragments_opcode = None
+        while not self.closed:
+            try:
+                fin, opcode, data = await self._read_frame()
+            except (asyncio.IncompleteReadError, ConnectionError):
+                self.close()
+                break
+
+            if opcode == 0x8:
+                # close
+                self.close()
+                break
+            elif opcode == 0x9:
+                # ping
+                self.writer.write(frame(data, 0xA))
+                continue
+            elif opcode == 0xA:
+                # pong
+                continue
+            elif opcode == 0x0:
+                # continuation frame
+                fragments.append(data)
+                if not fin:
+                    continue
+                opcode, data = fragments_opcode, b"".join(fragments)
+                fragments = []
+            elif not fin:
+                fragments_opcode = opcode
+                fragments.append(data)
+                continue
+
+            if opcode == 0x1:
+                return data.decode("utf-8")
+            return data
+        return None
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+
+        if self.writer is not None:
+            try:
+                self.writer.write(frame(b'', 0x8))
+            except Exception:
+                pass
+            self.writer.close()
+
+    async def _read_frame(self):
+        header, payloadlen = struct.unpack("BB",
+                await self.reader.readexactly(2))
+        fin = header & 0x80
+        opcode = header & 0xf
+
+        # the server never mask its frames
+        payloadlen = payloadlen & 0x7f
+        if payloadlen == 126:
+            payloadlen = struct.unpack("!H",
+                    await self.reader.readexactly(2))[0]
+        elif payloadlen == 127:
+            payloadlen = struct.unpack("!Q",
+                    await self.reader.readexactly(8))[0]
+
+        data = await self.reader.readexactly(payloadlen)
+        return fin, opcode, data
+
+
+class Subscription(object):
+    """ subscription to a topic. Events are retrieved by iterating
+    asynchronously the subscription::
+
+        async for event in subscription:
+            print(event)
+
+    The iteration stops once the subscription is closed. """
+
+    def __init__(self, sock, topic):
+        self.sock = sock
+        self.topic = topic
+        self.closed = False
+        self._queue = asyncio.Queue()
+
+    def __str__(self):
+        return "subscription: %s" % self.topic
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.closed and self._queue.empty():
+            raise StopAsyncIteration
+
+        event = await self._queue.get()
+        if event is None:
+            raise StopAsyncIteration
+        return event
+
+    async def get(self):
+        """ return the next event or None if the subscription is closed """
+        try:
+            return await self.__anext__()
+        except StopAsyncIteration:
+            return None
+
+    async def close(self):
+        """ unsubscribe from the topic """
+        await self.sock.unsubscribe(self.topic)
+
+    def _put(self, event):
+        self._queue.put_nowait(event)
+
+    def _close(self):
+        if not self.closed:
+            self.closed = True
+            self._queue.put_nowait(None)
+
+
+class GafferSocket(WebSocket):
+    """ websocket connection to the gaffer channel. Commands are awaitable
+    and subscriptions to the ``EVENTS``, ``STATS`` and ``STREAM`` topics are
+    async iterators. """
+
+    def __init__(self, url, api_key=None, heartbeat=15.0, ssl=None):
+        super(GafferSocket, self).__init__(url, ssl=ssl)
+        self.api_key = api_key
+        self.heartbeat_timeout = heartbeat
+
+        # subscriptions and commands waiting for their result
+        self.subscriptions = {}
+        self.commands = {}
+
+        # (topic, future) of the subscriptions waiting for the answer of
+        # the node, in the order they have been sent
+        self._pending_subs = []
+
+        self._reader_task = None
+        self._heartbeat_task = None
+
+    async def connect(self):
+        await super(GafferSocket, self).connect()
+
+        # make sure we authenticate first
+        if self.api_key is not None:
+            self.send("AUTH:%s" % self.api_key)
+
+        loop = asyncio.get_event_loop()
+        self._reader_task = loop.create_task(self._read_messages())
+        if self.heartbeat_timeout:
+            self._heartbeat_task = loop.create_task(self._heartbeat())
+        return self
+
+    async def subscribe(self, topic):
+        """ subscribe to a topic and return a `Subscription` """
+        if topic in self.subscriptions:
+            return self.subscriptions[topic]
+
+        sub = self.subscriptions[topic] = Subscription(self, topic)
+        try:
+            await self._send_subscription("SUB", topic)
+        except Exception:
+            self.subscriptions.pop(topic, None)
+            sub._close()
+            raise
+        return sub
+
+    async def unsubscribe(self, topic):
+        if topic not in self.subscriptions:
+            return
+
+        sub = self.subscriptions.pop(topic)
+        sub._close()
+        await self._send_subscription("UNSUB", topic)
+
+    async def command(self, name, *args, **kwargs):
+        """ execute a command on the node and return its result. Errors are
+        raised as `gaffer.error.ProcessError`. """
+        identity = uuid.uuid4().hex
+        data = {"identity": identity, "name": name, "args": args,
+                "kwargs": kwargs}
+        return await self._send_command("CMD", identity, data)
+
+    async def batch(self, commands):
+        """ execute a list of commands in one message. Return the list of
+        results. Each result is a dict containing either a `result` or an
+        `error` key. """
+        identity = uuid.uuid4().hex
+        data = {"identity": identity, "commands": make_batch(commands)}
+        return await self._send_command("CMD_BATCH", identity, data)
+
+    def close(self):
+        if self.closed:
+            return
+
+        super(GafferSocket, self).close()
+
+        for task in (self._reader_task, self._heartbeat_task):
+            if task is not None and not task.done():
+                task.cancel()
+
+        # stop the subscriptions and the commands in progress
+        for sub in list(self.subscriptions.values()):
+            sub._close()
+        self.subscriptions = {}
+
+        self._fail_pending(ProcessError(503, "connection_closed"))
+
+    async def _send_subscription(self, event, topic):
+        fut = asyncio.get_event_loop().create_future()
+        self._pending_subs.append((topic, fut))
+        self.send(json.dumps({"event": event, "data": {"topic": topic}}))
+        await fut
+
+    async def _send_command(self, event, identity, data):
+        fut = self.commands[identity] = \
+                asyncio.get_event_loop().create_future()
+        self.send(json.dumps({"event": event, "data": data}))
+        return await fut
+
+    async def _heartbeat(self):
+        # send a nop message to maintain the connection open
+        while not self.closed:
+            await asyncio.sleep(self.heartbeat_timeout)
+            self.send(json.dumps({"event": "NOP"}))
+
+    async def _read_messages(self):
+        try:
+            while True:
+                raw = await self.recv()
+                if raw is None:
+                    break
+
+                try:
+                    self._handle_message(json.loads(raw))
+                except Exception:
+                    LOGGER.error("invalid message %r" % raw, exc_info=True)
+        finally:
+            self.close()
+
+    def _handle_message(self, msg):
+        event = msg.get("event")
+
+        if event == "gaffer:subscription_success":
+            self._resolve_subscription(msg.get("topic"))
+        elif event in ("subscription_error", "gaffer:subscription_error"):
+            data = msg.get("data", {})
+            reason = data.get("reason", "subscription_error")
+            self._resolve_subscription(data.get("topic"),
+                    SubscriptionError(reason))
+        elif event == "gaffer:error":
+            # the message can't be identified, fail all the requests
+            # waiting for an answer
+            data = msg.get("data", {})
+            self._fail_pending(ProcessError(400, data.get("error",
+                "invalid_msg")))
+        elif event == "gaffer:command_success":
+            fut = self.commands.pop(msg['data']['id'], None)
+            if fut is not None and not fut.done():
+                fut.set_result(msg['data']['result'])
+        elif event == "gaffer:command_error":
+            fut = self.commands.pop(msg['data']['id'], None)
+            if fut is not None and not fut.done():
+                error = msg['data']['error']
+                fut.set_exception(ProcessError(error.get("errno", 400),
+                    error.get("reason", "bad_request")))
+        elif event == "gaffer:event":
+            data = msg['data']
+            sub = self.subscriptions.get(data['topic'])
+            if sub is not None:
+                sub._put(data)
+
+    def _resolve_subscription(self, topic=None, error=None):
+        # the answer is for the oldest subscription sent for this topic,
+        # or the oldest one when the node doesn't give the topic
+        for i, (pending_topic, fut) in enumerate(self._pending_subs):
+            if topic is None or pending_topic == topic:
+                del self._pending_subs[i]
+                break
+        else:
+            return
+
+        if fut.done():
+            return
+
+        if error is not None:
+            fut.set_exception(error)
+        else:
+            fut.set_result(True)
+
+    def _fail_pending(self, error):
+        futures = list(self.commands.values())
+        futures.extend(fut for _, fut in self._pending_subs)
+        self.commands = {}
+        self._pending_subs = []
+
+        for fut in futures:
+            if not fut.done():
+                fut.set_exception(error)
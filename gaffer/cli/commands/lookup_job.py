@@ -13,9 +13,14 @@ import pyuv
 class LookupJob(Command):
     """
     usage: gaffer lookup:job <job> (-L ADDR|--lookupd-address=ADDR)...
+                             [--strategy=STRATEGY] [--limit=N]
 
       -h, --help
       -L ADDR --lookupd-address=ADDR  lookupd HTTP address
+      --strategy=STRATEGY             order of the sources: least_loaded,
+                                      p2c or round_robin
+      --limit=N                       maximum number of sources returned
+                                      by each lookupd
     """
 
     name = "lookup:job"
@@ -25,12 +30,16 @@ class LookupJob(Command):
     def run(self, config, args):
         lookupd_addresses = set(args['--lookupd-address'])
         job_name = args['<job>']
+        strategy = args['--strategy']
+        limit = args['--limit']
+        if limit is not None:
+            limit = int(limit)
 
         sources = []
         loop = pyuv.Loop.default_loop()
         for addr in lookupd_addresses:
             s = LookupServer(addr, loop=loop, **config.client_options)
-            resp = s.find_job(job_name)
+            resp = s.find_job(job_name, strategy=strategy, limit=limit)
             new_sources = resp.get('sources', [])
             if not new_sources:
                 continue
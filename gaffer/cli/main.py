@@ -18,6 +18,7 @@ Options
                                         containing the Procfile [default: .]
     -e path,--env path                  Specify one or more .env files to load
     -g url --gafferd-http-address url   gafferd node HTTP address to connect
+                                        or unix:/path for a unix socket
                                         [default: http://127.0.0.1:5000]
     --api-key API_KEY                   API Key to access to gaffer
     --certfile=CERTFILE                 SSL certificate file
@@ -38,6 +39,7 @@ from .. import __version__
 from ..docopt import docopt, printable_usage
 from ..gafferd.util import user_path, default_user_path
 from ..httpclient import Server, GafferUnauthorized, GafferForbidden
+from ..httpclient.util import unix_uri
 from ..procfile import Procfile, get_env
 from ..util import is_ssl
 
@@ -83,8 +85,12 @@ class Config(object):
                 self.user_config.has_option(node_section, "key")):
             api_key = self.user_config.get(node_section, "key")
 
-        self.server = Server(self.args["--gafferd-http-address"],
-                api_key=api_key, **self.client_options)
+        # local nodes can be reached on their unix socket
+        uri = self.args["--gafferd-http-address"]
+        if uri.startswith("unix:"):
+            uri = unix_uri(uri.split("unix:", 1)[1])
+
+        self.server = Server(uri, api_key=api_key, **self.client_options)
 
     def get(self, *attrs):
         ret = []
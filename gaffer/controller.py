@@ -45,6 +45,40 @@ class Command(object):
     def reply_error(self, error):
         raise NotImplementedError
 
+
+class BatchCommand(Command):
+    """ a command collecting its result so it can be returned with the
+    other results of a batch """
+
+    def __init__(self, name, args=None, kwargs=None):
+        super(BatchCommand, self).__init__(name, args=args, kwargs=kwargs)
+        self.result = None
+        self.error = None
+
+    @classmethod
+    def from_dict(cls, obj):
+        if not isinstance(obj, dict) or "name" not in obj:
+            raise CommandError("invalid_batch_command")
+
+        args = obj.get('args') or ()
+        kwargs = obj.get('kwargs') or {}
+        if not isinstance(args, (list, tuple)) or not isinstance(kwargs, dict):
+            raise CommandError("invalid_batch_command")
+
+        return cls(obj['name'], args, kwargs)
+
+    def reply(self, result):
+        self.result = result
+
+    def reply_error(self, error):
+        self.error = error
+
+    def to_dict(self):
+        if self.error is not None:
+            return {"error": self.error}
+        return {"result": self.result}
+
+
 class Controller(object):
     """ a controller is class that allows a client to pass commands to the
     manager asynchronously. It should be the main object used by plugins and
@@ -73,6 +107,14 @@ class Controller(object):
         except Exception as e:
             cmd.reply_error({"errno": 500, "reason": str(e)})
 
+    def process_batch(self, cmds):
+        """ process a list of commands in order while holding the manager
+        lock so the batch is executed at once. Each command get its own
+        result or error. """
+        with self.manager._lock:
+            for cmd in cmds:
+                self.process_command(cmd)
+
     def sessions(self, cmd):
         cmd.reply({"sessions": self.manager.sessions})
 
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -
+#
+# This file is part of gaffer. See the NOTICE for more information.
+"""
+Helper process keeping our ends of the stdio pipes of the processes, so
+they stay open when gafferd exits and can be given back to the next
+gafferd adopting the processes.
+
+The holder listens on an unix socket. File descriptors are passed with
+``SCM_RIGHTS`` and each request is a JSON message:
+
+- ``{"op": "put", "key": key}`` with the file descriptors to keep
+- ``{"op": "get", "key": key}``, the file descriptors are returned
+- ``{"op": "del", "key": key}``
+- ``{"op": "keys"}`` returns the keys kept
+
+Run it with ``python -m gaffer.fdholder <path>``.
+"""
+
+import array
+import json
+import logging
+import os
+import select
+import socket
+import subprocess
+import sys
+import time
+
+LOGGER = logging.getLogger("gaffer")
+
+# passing file descriptors needs sendmsg (python 3.3 and later)
+HAS_SCM_RIGHTS = (hasattr(socket.socket, "sendmsg") and
+        hasattr(socket, "SOCK_SEQPACKET"))
+
+# maximum number of file descriptors passed in one message
+MAX_FDS = 253
+
+MAX_MESSAGE = 65536
+
+# received file descriptors are closed on exec so they don't leak to the
+# processes
+RECV_FLAGS = getattr(socket, "MSG_CMSG_CLOEXEC", 0)
+
+
+def send_fds(sock, data, fds):
+    """ send a message with some file descriptors """
+    ancdata = []
+    if fds:
+        ancdata = [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+            array.array("i", fds).tobytes())]
+    return sock.sendmsg([data], ancdata)
+
+
+def recv_fds(sock, size=MAX_MESSAGE, maxfds=MAX_FDS):
+    """ receive a message and the file descriptors passed with it """
+    fds = array.array("i")
+    data, ancdata, flags, addr = sock.recvmsg(size,
+            socket.CMSG_LEN(maxfds * fds.itemsize), RECV_FLAGS)
+    for level, type_, cdata in ancdata:
+        if level == socket.SOL_SOCKET and type_ == socket.SCM_RIGHTS:
+            cdata = cdata[:len(cdata) - (len(cdata) % fds.itemsize)]
+            fds.frombytes(cdata)
+    return data, list(fds)
+
+
+class FdHolder(object):
+    """ the holder process """
+
+    def __init__(self, path):
+        self.path = path
+        # key -> list of file descriptors
+        self.fds = {}
+
+    def run(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        sock.bind(self.path)
+        os.chmod(self.path, 0o600)
+        sock.listen(8)
+
+        # two gafferd are connected during a re-exec
+        conns = []
+        while True:
+            readable, _, _ = select.select([sock] + conns, [], [])
+            for conn in readable:
+                if conn is sock:
+                    conns.append(sock.accept()[0])
+                elif not self.serve(conn):
+                    conns.remove(conn)
+                    conn.close()
+
+    def serve(self, conn):
+        """ handle a request, return False when the connection is closed """
+        try:
+            data, fds = recv_fds(conn)
+        except socket.error:
+            return False
+
+        if not data:
+            # gafferd exited
+            return False
+
+        try:
+            msg = json.loads(data.decode("utf-8"))
+        except ValueError:
+            self._close_fds(fds)
+            return True
+
+        reply_fds = []
+        op = msg.get("op")
+        key = msg.get("key")
+        if op == "put":
+            self._close_fds(self.fds.pop(key, []))
+            self.fds[key] = fds
+            reply = {"ok": True}
+        elif op == "get":
+            reply_fds = self.fds.get(key, [])
+            reply = {"ok": key in self.fds}
+        elif op == "del":
+            self._close_fds(self.fds.pop(key, []))
+            reply = {"ok": True}
+        elif op == "keys":
+            reply = {"ok": True, "keys": list(self.fds)}
+        else:
+            self._close_fds(fds)
+            reply = {"ok": False}
+
+        try:
+            send_fds(conn, json.dumps(reply).encode("utf-8"), reply_fds)
+        except socket.error:
+            return False
+        return True
+
+    def _close_fds(self, fds):
+        for fd in fds:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+class FdHolderClient(object):
+    """ blocking client of the holder, the holder is started if it isn't
+    running """
+
+    def __init__(self, path, timeout=5.0):
+        self.path = path
+        self.timeout = timeout
+        self._sock = None
+        self._spawned_at = None
+
+    def connect(self, wait=True):
+        """ connect to the holder. If it isn't running it is spawned and we
+        wait until it listens, unless ``wait`` is False. Then
+        `socket.error` is raised and the next call connects to it. """
+        if self._sock is not None:
+            return
+
+        try:
+            self._sock = self._connect()
+            return
+        except socket.error:
+            if not wait and self._spawning():
+                # the holder spawned before is still starting
+                raise
+            self._spawn()
+            if not wait:
+                raise
+
+        deadline = time.time() + self.timeout
+        while True:
+            try:
+                self._sock = self._connect()
+                break
+            except socket.error:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def put(self, key, fds):
+        """ keep the file descriptors of ``key`` """
+        self._request({"op": "put", "key": str(key)}, fds)
+
+    def get(self, key):
+        """ return a copy of the file descriptors kept for ``key`` """
+        reply, fds = self._request({"op": "get", "key": str(key)})
+        return fds
+
+    def remove(self, key):
+        self._request({"op": "del", "key": str(key)})
+
+    def keys(self):
+        reply, fds = self._request({"op": "keys"})
+        return reply.get("keys", [])
+
+    def _request(self, msg, fds=None):
+        # the requests are done from the loop of the manager, don't wait
+        # for the holder to start
+        self.connect(wait=False)
+        try:
+            send_fds(self._sock, json.dumps(msg).encode("utf-8"), fds)
+            data, fds = recv_fds(self._sock)
+        except socket.error:
+            # the holder exited, reconnect on the next request
+            self.close()
+            raise
+        return json.loads(data.decode("utf-8")), fds
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        try:
+            sock.connect(self.path)
+        except socket.error:
+            sock.close()
+            raise
+        sock.settimeout(self.timeout)
+        return sock
+
+    def _spawning(self):
+        return (self._spawned_at is not None and
+                time.time() < self._spawned_at + self.timeout)
+
+    def _spawn(self):
+        self._spawned_at = time.time()
+
+        # the holder runs in its own session so it survives gafferd
+        with open(os.devnull, "r+b") as devnull:
+            subprocess.Popen([sys.executable, "-m", "gaffer.fdholder",
+                self.path], stdin=devnull, stdout=devnull, stderr=devnull,
+                close_fds=True, preexec_fn=os.setsid)
+
+
+def run():
+    if len(sys.argv) != 2:
+        print("usage: python -m gaffer.fdholder <path>")
+        sys.exit(1)
+
+    try:
+        FdHolder(sys.argv[1]).run()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    run()
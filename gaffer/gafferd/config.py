@@ -48,6 +48,11 @@ class DefaultConfigParser(configparser.ConfigParser):
             return default
         return self.getint(section, option)
 
+    def dgetfloat(self, section, option, default=None):
+        if not self.has_option(section, option):
+            return default
+        return self.getfloat(section, option)
+
     def dgetboolean(self, section, option, default=None):
         if not self.has_option(section, option):
             return default
@@ -80,8 +85,9 @@ class Config(object):
             else:
                 self.plugin_dir = os.path.join(self.config_dir, "plugins")
 
-        # bind address
-        self.bind = self.args['--bind'] or self.bind
+        # bind addresses
+        if self.args['--bind']:
+            self.bind = self.args['--bind']
 
         #lookupd address
         if self.args['--lookupd-address'] is not None:
@@ -103,6 +109,9 @@ class Config(object):
             except ValueError:
                 raise ConfigError("backlog should be an integer")
 
+        if self.args.get("--reuseport"):
+            self.reuseport = True
+
         # parse SSL options
         self.parse_ssl_options()
 
@@ -146,16 +155,30 @@ class Config(object):
         self.plugin_dir = self.args["--plugin-dir"]
         self.webhooks = []
         self.processes = []
+        self.sockets = []
         self.ssl_options = {}
         self.client_ssl_options = {}
         self.bind = "0.0.0.0:5000"
         self.lookupd_addresses = []
+        self.lookupd_batch_window = 0.05
         self.broadcast_address = None
         self.backlog = 128
+        self.reuseport = False
+        self.unix_socket_mode = 0o600
         self.daemonize = False
         self.pidfile = None
         self.logfile = None
         self.loglevel = "info"
+        self.stats_interval = 5.0
+        self.stats_restart_window = 300.0
+        self.webhooks_batch_interval = 0
+        self.webhooks_max_retries = 3
+        self.webhooks_max_queue = 1000
+        self.webhooks_timeout = 10.0
+        self.webhooks_outbox = None
+        self.webhooks_outbox_max_size = 256
+        self.state_journal = None
+        self.fd_holder = None
 
         # auth(z) API
         self.require_key = False
@@ -163,6 +186,11 @@ class Config(object):
         self.keys_backend = "default"
         self.auth_dbname = None
         self.keys_dbname = None
+        self.keys_cache_size = 1000
+        self.keys_cache_ttl = 300.0
+        self.password_iterations = 100000
+        self.token_secret = None
+        self.token_ttl = 300.0
 
     def parse_ssl_options(self):
         ssl_options = {}
@@ -223,11 +251,47 @@ class Config(object):
         self.bind = cfg.dget('gaffer', 'bind', "0.0.0.0:5000")
         self.broadcast_address = cfg.dget('gaffer', 'broadcast_address')
         self.backlog = cfg.dgetint('gaffer', 'backlog', 128)
+        self.reuseport = cfg.dgetboolean('gaffer', 'reuseport', False)
+        try:
+            self.unix_socket_mode = int(cfg.dget('gaffer', 'unix_socket_mode',
+                '600'), 8)
+        except ValueError:
+            raise ConfigError("unix_socket_mode should be an octal mode")
         self.daemonize = cfg.dgetboolean('gaffer', 'daemonize', False)
         self.pidfile = cfg.dget('gaffer', 'pidfile')
         self.logfile =  cfg.dget('gaffer', 'error_log', self.logfile)
         self.loglevel = cfg.dget('gaffer', 'log_level', self.loglevel)
 
+        # stats collected in the background for the /stats endpoint
+        self.stats_interval = cfg.dgetfloat('gaffer', 'stats_interval', 5.0)
+        self.stats_restart_window = cfg.dgetfloat('gaffer',
+                'stats_restart_window', 300.0)
+
+        # delivery of the webhooks
+        self.webhooks_batch_interval = cfg.dgetfloat('gaffer',
+                'webhooks_batch_interval', 0)
+        self.webhooks_max_retries = cfg.dgetint('gaffer',
+                'webhooks_max_retries', 3)
+        self.webhooks_max_queue = cfg.dgetint('gaffer', 'webhooks_max_queue',
+                1000)
+        self.webhooks_timeout = cfg.dgetfloat('gaffer', 'webhooks_timeout',
+                10.0)
+
+        # durable outbox of the webhooks, its maximum size is in MB
+        self.webhooks_outbox = None
+        if cfg.dgetboolean('gaffer', 'webhooks_outbox', False):
+            self.webhooks_outbox = os.path.join(self.config_dir,
+                    "webhooks_outbox")
+        self.webhooks_outbox_max_size = cfg.dgetint('gaffer',
+                'webhooks_outbox_max_size', 256)
+
+        # journal of the processes adopted when gafferd restarts
+        self.state_journal = None
+        self.fd_holder = None
+        if cfg.dgetboolean('gaffer', 'state_journal', False):
+            self.state_journal = os.path.join(self.config_dir, "state.json")
+            self.fd_holder = os.path.join(self.config_dir, "fdholder.sock")
+
         # Collect lookupd addresses
         # they are put in the gaffer section undert the form:
         #
@@ -238,15 +302,26 @@ class Config(object):
             if k.startswith('lookupd_address'):
                 self.lookupd_addresses.append(v)
 
+        # registrations sent to lookupd are batched over this window
+        self.lookupd_batch_window = cfg.dgetfloat('gaffer',
+                'lookupd_batch_window', 0.05)
+
         # parse AUTH api
         self.require_key = cfg.dgetboolean('gaffer', 'require_key', True)
         self.auth_backend = cfg.dget('auth', 'auth_backend', 'default')
         self.keys_backend = cfg.dget('auth', 'keys_backend', 'default')
         self.auth_dbname = cfg.dget('auth', 'auth_dbname', None)
         self.keys_dbname = cfg.dget('auth', 'keys_dbname', None)
+        self.keys_cache_size = cfg.dgetint('auth', 'keys_cache_size', 1000)
+        self.keys_cache_ttl = cfg.dgetfloat('auth', 'keys_cache_ttl', 300.0)
+        self.password_iterations = cfg.dgetint('auth', 'password_iterations',
+                100000)
+        self.token_secret = cfg.dget('auth', 'token_secret', None)
+        self.token_ttl = cfg.dgetfloat('auth', 'token_ttl', 300.0)
 
         processes = []
         webhooks = []
+        sockets = []
         envs = {}
         for section in cfg.sections():
             if section.startswith('process:') or section.startswith('job:'):
@@ -297,6 +372,18 @@ class Config(object):
                                 pass
                         elif key == "redirect_output":
                             params[key] = [v.strip() for v in val.split(",")]
+                        elif key == "sockets":
+                            params[key] = [v.strip() for v in val.split(",")
+                                    if v.strip()]
+                        elif key == "spawn_mode":
+                            val = val.strip("\"'")
+                            if val not in ("exec", "zygote"):
+                                raise ConfigError("spawn_mode should be "
+                                        "exec or zygote")
+                            params[key] = val
+                        elif key == "preload":
+                            params[key] = [v.strip() for v in val.split(",")
+                                    if v.strip()]
                         elif key == "redirect_input":
                             params[key] = cfg.dgetboolean(section, key,
                                     False)
@@ -307,6 +394,21 @@ class Config(object):
                                     six.MAXSIZE)
 
                     processes.append((name, sessionid, cmd, params))
+            elif section.startswith('socket:'):
+                name = section.split("socket:", 1)[1]
+                addr = cfg.dget(section, 'bind', '')
+                if not addr:
+                    raise ConfigError("socket %r has no bind address" % name)
+
+                try:
+                    unix_mode = int(cfg.dget(section, 'unix_mode', '600'), 8)
+                except ValueError:
+                    raise ConfigError("unix_mode should be an octal mode")
+
+                sockets.append((name, dict(addr=addr,
+                    backlog=cfg.dgetint(section, 'backlog', 128),
+                    reuse_port=cfg.dgetboolean(section, 'reuseport', False),
+                    unix_mode=unix_mode)))
             elif section == "webhooks":
                 for key, val in cfg.items(section):
                     webhooks.append((key, val))
@@ -332,6 +434,7 @@ class Config(object):
 
         self.webhooks = webhooks
         self.processes = processes
+        self.sockets = sockets
 
     def _split_name(self, name):
         if "/" in name:
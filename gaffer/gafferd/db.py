@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -
+#
+# This file is part of gaffer. See the NOTICE for more information.
+"""
+Executor used by the sqlite backends to run the queries outside of the loop
+thread.
+
+All the queries are executed by a dedicated thread owning the connection.
+Results are either waited (``call``, ``call_write``) or passed to a
+callback run in the loop thread (``submit``, ``submit_write``). Writes
+queued together are committed in one transaction.
+"""
+
+from collections import deque
+import logging
+import sqlite3
+import sys
+import threading
+
+import pyuv
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+LOGGER = logging.getLogger("gaffer")
+
+# maximum number of writes committed in one transaction
+MAX_BATCH = 100
+
+
+class _Job(object):
+
+    def __init__(self, fn, args, write=False, callback=None):
+        self.fn = fn
+        self.args = args
+        self.write = write
+        self.callback = callback
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def run(self, conn):
+        try:
+            self.result = self.fn(conn, *self.args)
+        except Exception:
+            self.error = sys.exc_info()[1]
+
+
+class SqliteExecutor(object):
+    """ run the queries on a sqlite database in a dedicated thread
+
+    Args:
+
+    - **loop**: the pyuv loop in which the callbacks are run
+    - **dbname**: path of the database or ``:memory:``
+    - **setup**: function called with the connection once it is opened,
+      used to create the tables.
+
+    File databases use the WAL journal so reads are not blocked by writes.
+    Statements are prepared once and cached by the connection.
+    """
+
+    def __init__(self, loop, dbname, setup=None, cached_statements=128):
+        self.loop = loop
+        self.dbname = dbname
+        self.setup = setup
+        self.cached_statements = cached_statements
+
+        self._queue = queue.Queue()
+        self._results = deque()
+        self._thread = None
+        self._async = None
+        self.closed = True
+
+    def open(self):
+        if not self.closed:
+            return
+
+        self._async = pyuv.Async(self.loop, self._on_results)
+        self._async.unref()
+
+        started = _Job(None, ())
+        self._thread = threading.Thread(target=self._run, args=(started,))
+        self._thread.daemon = True
+        self._thread.start()
+
+        # wait until the connection is opened
+        started.done.wait()
+        if started.error is not None:
+            self._thread.join()
+            self._async.close()
+            raise started.error
+
+        self.closed = False
+
+    def close(self):
+        if self.closed:
+            return
+
+        self.closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+        # run the pending callbacks
+        self._on_results(self._async)
+        self._async.close()
+
+    def call(self, fn, *args):
+        """ run ``fn(conn, *args)`` in the db thread and return its
+        result """
+        return self._wait(self._put(_Job(fn, args)))
+
+    def call_write(self, fn, *args):
+        """ like ``call`` but the function is committed in a transaction,
+        eventually with other writes """
+        return self._wait(self._put(_Job(fn, args, write=True)))
+
+    def submit(self, callback, fn, *args):
+        """ run ``fn(conn, *args)`` in the db thread then
+        ``callback(result, error)`` in the loop thread """
+        self._put(_Job(fn, args, callback=callback))
+
+    def submit_write(self, callback, fn, *args):
+        """ like ``submit`` but the function is committed in a transaction,
+        eventually with other writes """
+        self._put(_Job(fn, args, write=True, callback=callback))
+
+    def _put(self, job):
+        if self.closed:
+            raise RuntimeError("the database is closed")
+        self._queue.put(job)
+        return job
+
+    def _wait(self, job):
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def _run(self, started):
+        # open the connection in this thread, it will be only used here.
+        # Transactions are handled explicitly
+        try:
+            conn = sqlite3.connect(self.dbname, isolation_level=None,
+                    cached_statements=self.cached_statements)
+            if self.dbname != ":memory:":
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+
+            if self.setup is not None:
+                self.setup(conn)
+        except Exception:
+            started.error = sys.exc_info()[1]
+            started.done.set()
+            return
+        started.done.set()
+
+        pending = None
+        while True:
+            job = pending or self._queue.get()
+            pending = None
+            if job is None:
+                # the executor is closed
+                break
+
+            if not job.write:
+                job.run(conn)
+                self._done(job)
+                continue
+
+            # collect the writes queued after this one
+            writes = [job]
+            while len(writes) < MAX_BATCH:
+                try:
+                    job = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+
+                if job is None or not job.write:
+                    pending = job
+                    break
+                writes.append(job)
+
+            self._run_writes(conn, writes)
+
+        conn.close()
+
+    def _run_writes(self, conn, writes):
+        try:
+            conn.execute("BEGIN")
+            for job in writes:
+                # a failing write doesn't cancel the others
+                conn.execute("SAVEPOINT job")
+                job.run(conn)
+                if job.error is not None:
+                    conn.execute("ROLLBACK TO job")
+                conn.execute("RELEASE job")
+            conn.execute("COMMIT")
+        except Exception:
+            error = sys.exc_info()[1]
+            LOGGER.error("error while committing writes", exc_info=True)
+            try:
+                conn.execute("ROLLBACK")
+            except sqlite3.Error:
+                pass
+
+            for job in writes:
+                if job.error is None:
+                    job.error = error
+
+        for job in writes:
+            self._done(job)
+
+    def _done(self, job):
+        if job.callback is not None:
+            self._results.append(job)
+            self._async.send()
+        job.done.set()
+
+    def _on_results(self, handle):
+        while True:
+            try:
+                job = self._results.popleft()
+            except IndexError:
+                break
+
+            try:
+                job.callback(job.result, job.error)
+            except Exception:
+                LOGGER.error("uncaught exception in db callback",
+                        exc_info=True)
+
+
+def run_callback(callback, fn, *args):
+    """ call ``fn(*args)`` then ``callback(result, error)``. Used by the
+    backends to implement the async methods with the sync ones. """
+    try:
+        result = fn(*args)
+    except Exception:
+        return callback(None, sys.exc_info()[1])
+    callback(result, None)
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -
+#
+# This file is part of gaffer. See the NOTICE for more information.
+"""
+Handover of a running gafferd to a new gafferd started on SIGUSR2.
+
+The new gafferd is started with one end of an unix socket pair, its file
+descriptor is given in the ``GAFFERD_HANDOVER_FD`` environment variable.
+The old gafferd sends the state of the manager, then the listening sockets
+and the stdio pipes of the processes with ``SCM_RIGHTS``. The sockets of the
+manager are passed with the pipes under ``socket:<name>`` keys. The new gafferd
+adopts the processes, starts to serve the HTTP API on the sockets received
+then replies ``ready``. Only then the old gafferd exits, leaving the
+processes running. If the new gafferd fails to start, the old one continues
+to run.
+"""
+
+from collections import OrderedDict
+import json
+import os
+import socket
+
+from ..fdholder import send_fds, recv_fds, MAX_FDS
+
+HANDOVER_ENV = "GAFFERD_HANDOVER_FD"
+
+# time in seconds the old gafferd waits for the new one
+HANDOVER_TIMEOUT = 30.0
+
+# the state is sent in chunks of this size
+CHUNK_SIZE = 32768
+
+
+class HandoverError(Exception):
+    """ raised when the handover failed """
+
+
+def send_handover(sock, state, listeners, pipes):
+    """ send the state of the manager, the listening sockets by address and
+    the stdio pipes of the processes by OS pid """
+    fds = []
+    header_listeners = []
+    for addr, sockets in listeners.items():
+        header_listeners.append([addr, [[s.family, s.type, s.proto]
+            for s in sockets]])
+        fds.extend(s.fileno() for s in sockets)
+
+    header_pipes = []
+    for os_pid, pipe_fds in pipes.items():
+        header_pipes.append([os_pid, len(pipe_fds)])
+        fds.extend(pipe_fds)
+
+    data = json.dumps({"state": state, "listeners": header_listeners,
+        "pipes": header_pipes, "nfds": len(fds)}).encode("utf-8")
+
+    # the header, then the file descriptors
+    send_fds(sock, str(len(data)).encode("utf-8"), None)
+    for i in range(0, len(data), CHUNK_SIZE):
+        send_fds(sock, data[i:i + CHUNK_SIZE], None)
+
+    for i in range(0, len(fds), MAX_FDS):
+        send_fds(sock, b"fds", fds[i:i + MAX_FDS])
+
+
+class Handover(object):
+    """ what the new gafferd received from the old one
+
+    - **state**: the state of the manager
+    - **listeners**: dict of the listening sockets by address
+    - **pipes**: dict of the stdio pipes of the processes by OS pid
+    """
+
+    def __init__(self, sock, state, listeners, pipes):
+        self.sock = sock
+        self.state = state
+        self.listeners = listeners
+        self.pipes = pipes
+
+    @classmethod
+    def receive(cls, fd):
+        """ receive the handover on the socket ``fd`` """
+        sock = socket.fromfd(fd, socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        os.close(fd)
+        sock.settimeout(HANDOVER_TIMEOUT)
+
+        try:
+            size = int(recv_fds(sock)[0])
+            data = b""
+            while len(data) < size:
+                chunk, _ = recv_fds(sock, CHUNK_SIZE)
+                if not chunk:
+                    raise HandoverError("connection closed")
+                data += chunk
+            header = json.loads(data.decode("utf-8"))
+
+            fds = []
+            while len(fds) < header["nfds"]:
+                msg, received = recv_fds(sock)
+                if not msg:
+                    raise HandoverError("connection closed")
+                fds.extend(received)
+        except (socket.error, ValueError) as e:
+            sock.close()
+            raise HandoverError(str(e))
+
+        fds.reverse()
+        listeners = OrderedDict()
+        for addr, families in header["listeners"]:
+            sockets = listeners[addr] = []
+            for family, type_, proto in families:
+                fd = fds.pop()
+                s = socket.fromfd(fd, family, type_, proto)
+                os.close(fd)
+                s.setblocking(0)
+                sockets.append(s)
+
+        pipes = {}
+        for os_pid, count in header["pipes"]:
+            pipes[os_pid] = [fds.pop() for _ in range(count)]
+
+        return cls(sock, header["state"], listeners, pipes)
+
+    def ready(self):
+        """ tell the old gafferd we took over """
+        try:
+            send_fds(self.sock, b"ready", None)
+        finally:
+            self.sock.close()
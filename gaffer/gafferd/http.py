@@ -2,11 +2,17 @@
 #
 # This file is part of gaffer. See the NOTICE for more information.
 
+from collections import OrderedDict
 import copy
 import logging
+import os
+import socket
 import ssl
 import sys
 
+import pyuv
+import six
+
 # patch tornado IOLoop
 from ..tornado_pyuv import IOLoop, install
 install()
@@ -16,16 +22,21 @@ from tornado.httpserver import HTTPServer
 
 from ..httpclient.util import make_uri
 from .. import sockjs
-from ..util import (bind_sockets, hostname, is_ssl)
+from ..util import (backoff_delay, bind_addresses, hostname, is_ssl)
 from . import http_handlers
 from .keys import KeyManager
 from .lookup import LookupClient
+from .stats import StatsCollector
 from .users import AuthManager
 
 LOGGER = logging.getLogger("gaffer")
 PROTOCOL_VERSION = "0.1"
 LOOKUP_EVENTS = ("load", "unload", "spawn", "stop_process", "exit")
 
+# delays (in seconds) between the reconnections to a lookupd server
+LOOKUP_BACKOFF_MIN = 0.5
+LOOKUP_BACKOFF_MAX = 30.0
+
 DEFAULT_HANDLERS = [
         (r'/', http_handlers.WelcomeHandler),
         (r'/ping', http_handlers.PingHandler),
@@ -46,8 +57,12 @@ DEFAULT_HANDLERS = [
         (r'/jobs/([^/]+)/([^/]+)/state$', http_handlers.StateJobHandler),
         (r'/jobs/([^/]+)/([^/]+)/pids$', http_handlers.PidsJobHandler),
         (r'/jobs/([^/]+)/([^/]+)/commit$', http_handlers.CommitJobHandler),
+        (r'/batch', http_handlers.BatchHandler),
+        (r'/snapshot', http_handlers.SnapshotHandler),
+        (r'/stats', http_handlers.StatsHandler),
         (r'/auth', http_handlers.AuthHandler),
         (r'/keys', http_handlers.KeysHandler),
+        (r'/keys/_cache$', http_handlers.KeysCacheHandler),
         (r'/keys/([^/]+)$', http_handlers.KeyHandler),
         (r'/users', http_handlers.UsersHandler),
         (r'/users/([^/]+)', http_handlers.UserHandler),
@@ -60,11 +75,20 @@ class HttpHandler(object):
     """ simple gaffer application that gives an HTTP API access to gaffer.
     """
 
-    def __init__(self, config, plugin_manager=None, **settings):
+    def __init__(self, config, plugin_manager=None, listeners=None,
+            **settings):
         self.config = config
         self.plugin_manager = plugin_manager
         self.key_mgr = None
         self.auth_mgr = None
+        self.stats_collector = None
+        self.sockets = []
+        # listening sockets by address
+        self.listeners = OrderedDict()
+        # sockets received from the previous gafferd by address
+        self._inherited = listeners or {}
+        self.unix_paths = []
+        self.port = None
 
         # custom settings
         if 'manager' in settings:
@@ -73,6 +97,10 @@ class HttpHandler(object):
 
         self.clients = dict()
 
+        # reconnection timers and attempts by lookupd address
+        self._lookup_timers = dict()
+        self._lookup_attempts = dict()
+
         # intialize the config
         self.init_config()
 
@@ -83,6 +111,10 @@ class HttpHandler(object):
         self.broadcast_address = self.config.broadcast_address
         self.lookupd_addresses = self.config.lookupd_addresses
         self.backlog = self.config.backlog
+        self.reuseport = self.config.reuseport
+        self.unix_socket_mode = self.config.unix_socket_mode
+        self.stats_interval = self.config.stats_interval
+        self.stats_restart_window = self.config.stats_restart_window
 
         # initialize ssl options
         self.ssl_options = self.config.ssl_options
@@ -105,7 +137,8 @@ class HttpHandler(object):
 
     def init_app(self):
         # add channel routes
-        user_settings = { "manager": self.manager }
+        user_settings = { "manager": self.manager,
+                "response_cache": http_handlers.ResponseCache() }
 
         # start the key api if needed
         if self.config.require_key:
@@ -117,6 +150,12 @@ class HttpHandler(object):
             self.key_mgr = None
             self.auth_mgr = None
 
+        # the stats collector sample processes stats in the background
+        self.stats_collector = StatsCollector(self.loop, self.manager,
+                interval=self.stats_interval,
+                restart_window=self.stats_restart_window)
+        user_settings["stats_collector"] = self.stats_collector
+
         channel_router = sockjs.SockJSRouter(http_handlers.ChannelConnection,
                 "/channel", io_loop=self.io_loop, user_settings=user_settings)
 
@@ -146,6 +185,10 @@ class HttpHandler(object):
     def stop(self):
         # stop the server
         self.server.stop()
+        self._close_sockets()
+
+        # stop collecting stats
+        self.stats_collector.close()
 
         # close the api key managers
         if self.config.require_key:
@@ -157,12 +200,7 @@ class HttpHandler(object):
 
 
         # close all lookups clients
-        addresses = list(self.clients)
-        for addr in addresses:
-            client = self.clients.pop(addr)
-            if not client.closed:
-                client.close()
-        self.clients = {}
+        self._close_lookup()
 
         # finally close the tornado loop
         self.io_loop.close()
@@ -170,6 +208,10 @@ class HttpHandler(object):
     def restart(self):
         # stop the server
         self.server.stop()
+        self._close_sockets()
+
+        # stop collecting stats
+        self.stats_collector.close()
 
         # close the api key managers
         if self.config.require_key:
@@ -178,12 +220,7 @@ class HttpHandler(object):
 
 
         # close all lookups clients
-        addresses = list(self.clients)
-        for addr in addresses:
-            client = self.clients.pop(addr)
-            if not client.closed:
-                client.close()
-        self.clients = {}
+        self._close_lookup()
 
         # reinit the config
         self.init_config()
@@ -194,14 +231,10 @@ class HttpHandler(object):
         # start the server
         self._start_server()
 
-        # restart lookup clients
+        # restart lookup clients. The jobs are registered with the snapshot
+        # sent once the client is connected.
         self._start_lookup()
 
-        # notify all jobs
-        jobs = self.manager.jobs()
-        for _, client in self.clients:
-            [client.add_job(job_name) for job_name in jobs]
-
     def _start_server(self):
         # open API keys managers
         if self.config.require_key:
@@ -211,24 +244,93 @@ class HttpHandler(object):
         self.server = HTTPServer(self.app, io_loop=self.io_loop,
                 ssl_options=self.ssl_options)
 
-        # initialize the socket
-        sock = bind_sockets(self.address, backlog=self.backlog)
-        self.server.add_sockets(sock)
-        self.port = sock[0].getsockname()[1]
+        # start collecting stats
+        self.stats_collector.start()
+
+        # initialize the sockets. we can listen on multiple addresses
+        # including unix sockets
+        self._bind()
+        self.server.add_sockets(self.sockets)
+
+        # the port of the first TCP socket is the one announced to lookupd
+        self.port = None
+        self.unix_paths = []
+        for sock in self.sockets:
+            if sock.family == socket.AF_UNIX:
+                self.unix_paths.append(sock.getsockname())
+            elif self.port is None:
+                self.port = sock.getsockname()[1]
 
         # start the server
         self.server.start()
 
+    def detach_listeners(self):
+        """ the listening sockets have been handed to a new gafferd, keep
+        the unix sockets files when stopping """
+        self.unix_paths = []
+
+    def _bind(self):
+        addresses = self.address
+        if isinstance(addresses, six.string_types):
+            addresses = addresses.replace(",", " ").split()
+
+        self.listeners = OrderedDict()
+        try:
+            for addr in addresses:
+                # reuse the sockets of the previous gafferd
+                sockets = self._inherited.pop(addr, None)
+                if sockets is None:
+                    sockets = bind_addresses([addr], backlog=self.backlog,
+                            reuse_port=self.reuseport,
+                            unix_mode=self.unix_socket_mode)
+                self.listeners[addr] = sockets
+        except Exception:
+            for sockets in self.listeners.values():
+                for sock in sockets:
+                    sock.close()
+            raise
+        finally:
+            # the addresses removed from the config
+            for sockets in self._inherited.values():
+                for sock in sockets:
+                    sock.close()
+            self._inherited = {}
+
+        self.sockets = [sock for sockets in self.listeners.values()
+                for sock in sockets]
+
+    def _close_sockets(self):
+        # remove the unix sockets files
+        for path in self.unix_paths:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        self.unix_paths = []
+        self.sockets = []
+        self.listeners = OrderedDict()
+
     def _start_lookup(self):
+        if not self.lookupd_addresses:
+            return
+
         if not self.broadcast_address:
+            if self.port is None:
+                LOGGER.warning("LOOKUP: no TCP binding, set a broadcast "
+                        "address to register the node")
+                return
+
             if self.ssl_options:
                 scheme = "https"
             else:
                 scheme = "http"
 
-            origin = "%s://%s:%s" % (scheme, self.hostname, self.port)
+            self.origin = "%s://%s:%s" % (scheme, self.hostname, self.port)
         else:
-            origin = self.broadcast_address
+            self.origin = self.broadcast_address
+
+        for event in LOOKUP_EVENTS:
+            self.manager.events.subscribe(event, self._on_event)
 
         for addr in self.lookupd_addresses:
             if addr.startswith("http"):
@@ -236,26 +338,57 @@ class HttpHandler(object):
 
             addr = make_uri(addr, "/ws")
             if addr in self.clients:
-                return
+                continue
+
+            self._connect_lookup(addr)
+
+    def _connect_lookup(self, addr):
+        self._lookup_timers.pop(addr, None)
 
-            # initialize the client
-            options = {}
-            if is_ssl(addr):
-                options["ssl_options"] = self.client_options
-            client = LookupClient(self.loop, addr, **options)
+        # initialize the client
+        options = {"batch_window": self.config.lookupd_batch_window,
+                "load_cb": self.stats_collector.load_summary}
+        if is_ssl(addr):
+            options["ssl_options"] = self.client_options
+        client = LookupClient(self.loop, addr, **options)
 
-            # register the client
-            self.clients[addr] = client
+        # register the client
+        self.clients[addr] = client
 
-            # start the client
-            client.start(on_exit_cb=self._on_exit_lookup)
+        # start the client
+        client.start(on_exit_cb=self._on_exit_lookup)
 
-            # identify the client
-            # node name is its hostname for now
-            client.identify(self.hostname, origin, PROTOCOL_VERSION)
+        def on_identified(result):
+            if "ok" in result:
+                self._lookup_attempts.pop(addr, None)
+            else:
+                LOGGER.error("LOOKUP: %r refused the node: %s" % (addr,
+                    result.get("reason")))
+
+        # identify the client. node name is its hostname for now. If
+        # lookupd still knows the node (the connection dropped without
+        # lookupd noticing) it resumes it.
+        client.identify(self.hostname, self.origin, PROTOCOL_VERSION,
+                resume=True, callback=on_identified)
+
+        # then send all the jobs and their pids in one message. lookupd
+        # diffs it against what it knows of the node.
+        jobs = self.manager.snapshot()["jobs"]
+        client.snapshot(dict((name, job["pids"]) for name, job in
+            jobs.items()))
+
+    def _close_lookup(self):
+        for timer in self._lookup_timers.values():
+            timer.close()
+        self._lookup_timers = {}
+        self._lookup_attempts = {}
 
-            for event in LOOKUP_EVENTS:
-                self.manager.events.subscribe(event, self._on_event)
+        addresses = list(self.clients)
+        for addr in addresses:
+            client = self.clients.pop(addr)
+            if not client.closed:
+                client.close()
+        self.clients = {}
 
     def _on_event(self, event, msg):
         if not self.clients:
@@ -281,11 +414,25 @@ class HttpHandler(object):
             fun(*args)
 
     def _on_exit_lookup(self, client):
-        if client.url not in self.clients:
+        addr = client.address
+        if self.clients.get(addr) is not client:
             return
 
-        LOGGER.info("LOOKUP: %r exited" % client.url)
-        try:
-            del self.clients[client.url]
-        except KeyError:
-            pass
+        del self.clients[addr]
+
+        # reconnect with an exponential backoff. The delay is randomized so
+        # all the nodes don't reconnect at the same time when lookupd
+        # restarts.
+        attempt = self._lookup_attempts.get(addr, 0)
+        self._lookup_attempts[addr] = attempt + 1
+        delay = backoff_delay(attempt, LOOKUP_BACKOFF_MIN, LOOKUP_BACKOFF_MAX)
+
+        LOGGER.info("LOOKUP: %r exited, reconnecting in %.2fs" % (addr,
+            delay))
+
+        timer = self._lookup_timers[addr] = pyuv.Timer(self.loop)
+        def reconnect(h):
+            h.close()
+            if self._lookup_timers.get(addr) is h:
+                self._connect_lookup(addr)
+        timer.start(reconnect, delay, 0.0)
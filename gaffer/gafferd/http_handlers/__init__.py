@@ -3,13 +3,17 @@
 # This file is part of gaffer. See the NOTICE for more information.
 
 from .channels import ChannelConnection
+from .util import ResponseCache
 from .misc import WelcomeHandler, PingHandler, VersionHandler
 from .pid import (AllProcessIdsHandler, ProcessIdHandler,
         ProcessIdSignalHandler, ProcessIdStatsHandler, PidChannel)
 from .jobs import (SessionsHandler, AllJobsHandler, JobsHandler,
         JobHandler, JobStatsHandler, ScaleJobHandler,
         PidsJobHandler, SignalJobHandler, StateJobHandler, CommitJobHandler)
+from .batch import BatchHandler
+from .snapshot import SnapshotHandler
+from .stats import StatsHandler
 from .auth import AuthHandler
-from .keys import KeysHandler, KeyHandler
+from .keys import KeysHandler, KeysCacheHandler, KeyHandler
 from .user import (UsersHandler, UserHandler, UserPasswordHandler,
         UserKeydHandler)
@@ -5,15 +5,22 @@
 import base64
 import json
 
-from tornado.web import HTTPError
+from tornado.web import HTTPError, asynchronous
 
+from ..keys import KeyNotFound
 from .util import CorsHandler
 
 class AuthHandler(CorsHandler):
+    """ /auth
+
+    authenticate a user with the basic auth and return its API key and a
+    short-lived signed token that can be passed in the ``X-Auth-Token``
+    header instead of the key. """
 
     def prepare(self):
         require_key = self.settings.get('require_key', False)
-        auth_mgr = self.settings.get("auth_mgr")
+        self.auth_mgr = self.settings.get("auth_mgr")
+        self.key_mgr = self.settings.get("key_mgr")
 
         if not require_key:
             raise HTTPError(404)
@@ -24,21 +31,52 @@ class AuthHandler(CorsHandler):
             raise HTTPError(401)
 
         # decode the auth header
-        auth_decoded = base64.decodestring(auth_hdr[6:])
-        username, password = auth_decoded.split(b':', 2)
-
-        # authenticate the user
-        self.user = auth_mgr.authenticate(username.decode('utf-8'),
-                password.decode('utf-8'))
-
-        if not self.user.is_authenticated():
+        try:
+            auth_decoded = base64.b64decode(auth_hdr[6:])
+            username, password = auth_decoded.split(b':', 1)
+        except (TypeError, ValueError):
             raise HTTPError(401)
 
-        self.set_header("Content-Type", "application/json")
-        self.set_header("X-Api-Key", self.user.key or "")
+        self.username = username.decode('utf-8')
+        self.password = password.decode('utf-8')
 
+    @asynchronous
     def head(self):
-        self.set_status(200)
+        self.authenticate(lambda user, key: self.finish())
 
+    @asynchronous
     def get(self, *args):
-        self.write({"api_key": self.user.key})
+        def on_key(user, key):
+            token, expires = self.auth_mgr.make_token(user, key)
+            self.write({"api_key": user.key, "token": token,
+                "expires": expires})
+            self.finish()
+
+        self.authenticate(on_key)
+
+    def authenticate(self, callback):
+        """ authenticate the user without blocking the loop then call
+        ``callback(user, key)`` with the user and its key object """
+
+        def on_key(key, error):
+            if error is not None and not isinstance(error, KeyNotFound):
+                return self.send_error(500)
+            callback(self.user, key)
+
+        def on_user(user, error):
+            if error is not None:
+                return self.send_error(500)
+            elif not user.is_authenticated():
+                return self.send_error(401)
+
+            self.user = user
+            self.set_header("Content-Type", "application/json")
+            self.set_header("X-Api-Key", user.key or "")
+
+            if not user.key:
+                return callback(user, None)
+            self.key_mgr.get_key_async(user.key, on_key)
+
+        # the password is checked in the thread pool
+        self.auth_mgr.authenticate_async(self.username, self.password,
+                on_user)
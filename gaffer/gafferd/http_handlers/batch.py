@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -
+#
+# This file is part of gaffer. See the NOTICE for more information.
+
+import json
+
+from ...controller import BatchCommand, Controller
+from ...error import ProcessError
+from .util import CorsHandlerWithAuth, check_command_authz
+
+
+class BatchHandler(CorsHandlerWithAuth):
+    """ /batch
+
+    Execute a list of controller commands at once. The body is a JSON object
+    containing the list of commands::
+
+        {"commands": [{"name": "scale", "args": ["default.dummy", 2]},
+                      {"name": "info", "args": ["default.dummy"]}]}
+
+    Commands are executed in order under the same manager lock and the
+    result or the error of each command is returned in the same order.
+    """
+
+    def post(self, *args):
+        self.preflight()
+        self.set_header('Content-Type', 'application/json')
+        m = self.settings.get('manager')
+
+        try:
+            commands = self.fetch_commands()
+        except ValueError:
+            self.set_status(400)
+            return self.write({"error": "bad_request"})
+        except ProcessError as e:
+            self.set_status(e.errno)
+            return self.write(e.to_dict())
+
+        # check the permissions for each commands, only the ones we are
+        # authorized to execute are passed to the controller.
+        allowed = []
+        for cmd in commands:
+            try:
+                check_command_authz(m, self.api_key, cmd)
+            except ProcessError as pe:
+                cmd.reply_error({"errno": pe.errno, "reason": pe.reason})
+            except Exception as e:
+                # invalid arguments, e.g. a pid that isn't a number
+                cmd.reply_error({"errno": 400, "reason": str(e)})
+            else:
+                allowed.append(cmd)
+
+        ctl = Controller(m)
+        ctl.process_batch(allowed)
+
+        self.write(json.dumps({"results": [cmd.to_dict() for cmd in
+            commands]}))
+
+    def fetch_commands(self):
+        obj = json.loads(self.request.body.decode('utf-8'))
+        if not isinstance(obj, dict) or "commands" not in obj:
+            raise ValueError("commands missing")
+
+        if not isinstance(obj['commands'], list):
+            raise ValueError("invalid commands")
+
+        return [BatchCommand.from_dict(cmd) for cmd in obj['commands']]
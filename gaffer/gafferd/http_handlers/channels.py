@@ -5,11 +5,12 @@
 from functools import partial
 import json
 
-from ...controller import Command, Controller
-from ...error import ProcessError
+from ...controller import BatchCommand, Command, Controller
+from ...error import ProcessError, CommandError
 from ...sockjs import SockJSConnection
 from ...sync import increment, decrement
-from ..keys import Key, DummyKey, KeyNotFound
+from ..keys import DummyKey, KeyNotFound
+from .util import check_command_authz
 
 class MessageError(Exception):
     """ raised on message error """
@@ -64,6 +65,32 @@ class WSCommand(Command):
         self.ws.write_message(msg)
 
 
+class WSBatch(object):
+    """ a list of commands received in one CMD_BATCH message. Results are
+    sent back at once using the batch identity """
+
+    def __init__(self, ws, msg):
+        self.ws = ws
+        self.identity = msg.identity
+        self.raw_commands = msg.commands
+        self.commands = []
+
+    def parse(self):
+        self.commands = [BatchCommand.from_dict(obj) for obj in
+                self.raw_commands]
+
+    def reply(self):
+        result = [cmd.to_dict() for cmd in self.commands]
+        data = {"id": self.identity, "result": result}
+        msg = {"event": "gaffer:command_success", "data": data}
+        self.ws.write_message(msg)
+
+    def reply_error(self, error):
+        data = {"id": self.identity, "error": error}
+        msg = {"event": "gaffer:command_error", "data": data}
+        self.ws.write_message(msg)
+
+
 class Message(object):
 
     def __init__(self, msg):
@@ -108,6 +135,19 @@ class Message(object):
             self.name = self.data['name']
             self.args = self.data.get('args', ())
             self.kwargs = self.data.get('kwargs', {})
+
+        elif self.event == "CMD_BATCH":
+            if "commands" not in self.data:
+                raise MessageError("batch_commands_missing")
+
+            if "identity" not in self.data:
+                raise MessageError("cmd_identity_missing")
+
+            if not isinstance(self.data['commands'], list):
+                raise MessageError("invalid_batch")
+
+            self.identity = self.data['identity']
+            self.commands = self.data['commands']
         else:
             raise MessageError("unknown_cmd")
 
@@ -131,6 +171,9 @@ class ChannelConnection(SockJSConnection):
         self.key_mgr = self.settings.get('key_mgr')
         self.api_key = None
 
+        # messages received while the key is fetched
+        self._pending = None
+
         self.ctl = Controller(self.manager)
         self._subscriptions = {}
 
@@ -141,27 +184,52 @@ class ChannelConnection(SockJSConnection):
 
             self._subscriptions = []
 
-    def authenticate(self, body):
-        if body.startswith("AUTH:"):
-            key = body.split("AUTH:")[1]
-            try:
-                self.api_key = Key.load(self.key_mgr.get_key(key))
-            except KeyNotFound:
-                raise ProcessError(403, "forbidden")
-        else:
-            raise ProcessError(401, "unauthorized")
+    def authenticate(self, body, callback):
+        """ fetch the key given in the AUTH message without blocking the
+        loop then call ``callback(error)`` """
+        if not body.startswith("AUTH:"):
+            return callback(ProcessError(401, "unauthorized"))
+
+        def on_key(key_obj, error):
+            if isinstance(error, KeyNotFound):
+                error = ProcessError(403, "forbidden")
+            elif error is not None:
+                error = ProcessError(500, str(error))
+            else:
+                self.api_key = key_obj
+            callback(error)
+
+        self.key_mgr.get_key_object_async(body.split("AUTH:")[1], on_key)
 
     def on_message(self, raw):
-        if not self.api_key and self.require_key:
-            try:
-                self.authenticate(raw)
-            except ProcessError as e:
-                self.write_message(_error_msg(error="AUTH_REQUIRED",
-                    reason=e.to_json()))
-                return self.close()
-        else:
-            self.api_key = DummyKey()
+        if self.api_key is None:
+            if not self.require_key:
+                self.api_key = DummyKey()
+            elif self._pending is not None:
+                # the key is still fetched, the message is handled once
+                # the connection is authenticated
+                return self._pending.append(raw)
+            else:
+                self._pending = [raw]
+                return self.authenticate(raw, self._on_authenticated)
+
+        self.handle_message(raw)
+
+    def _on_authenticated(self, error):
+        pending, self._pending = self._pending, None
+        if self.is_closed:
+            return
 
+        if error is not None:
+            self.write_message(_error_msg(error="AUTH_REQUIRED",
+                reason=error.to_json()))
+            return self.close()
+
+        # the first message is the AUTH message
+        for raw in pending[1:]:
+            self.handle_message(raw)
+
+    def handle_message(self, raw):
         try:
             msg = Message(raw)
         except MessageError as e:
@@ -180,9 +248,11 @@ class ChannelConnection(SockJSConnection):
                 command = WSCommand(self, msg)
                 self._check_command_authz(command)
                 self.ctl.process_command(command)
+            elif msg.event == "CMD_BATCH":
+                self.process_batch(msg)
         except SubscriptionError as e:
             return self.write_message(_error_msg(event="subscription_error",
-                reason=str(e)))
+                reason=str(e), topic=msg.topic))
 
         if msg.event == "SUB":
             self.write_message({"event": "gaffer:subscription_success",
@@ -191,6 +261,29 @@ class ChannelConnection(SockJSConnection):
             self.write_message({"event": "gaffer:subscription_success",
                 "topic": msg.topic })
 
+    def process_batch(self, msg):
+        batch = WSBatch(self, msg)
+        try:
+            batch.parse()
+        except CommandError as ce:
+            return batch.reply_error({"errno": ce.errno, "reason": ce.reason})
+
+        # only pass the commands we are authorized to execute to the
+        # controller, others are returning an error.
+        commands = []
+        for cmd in batch.commands:
+            try:
+                self._do_check_command_authz(cmd)
+            except ProcessError as pe:
+                cmd.reply_error({"errno": pe.errno, "reason": pe.reason})
+            except Exception as e:
+                cmd.reply_error({"errno": 500, "reason": str(e)})
+            else:
+                commands.append(cmd)
+
+        self.ctl.process_batch(commands)
+        batch.reply()
+
     def add_subscription(self, topic):
         if topic in self._subscriptions:
             sub = self._subscriptions[topic]
@@ -332,40 +425,7 @@ class ChannelConnection(SockJSConnection):
             command.reply_error({"errno": 500, "reason": str(e)})
 
     def _do_check_command_authz(self, command):
-        if (command.name in ("process_info", "process_stats", "stop_process",
-            "send", "kill",)):
-
-            # if not pid given return and handle the command error later
-            if not command.args:
-                return
-
-            # get the process instance
-            p = self.manager.get_process(command.args[0])
-
-            # we need write permission for 'send'
-            if command.name == "send" and self.api_key.can_write(p.name):
-                return
-
-            # else we need manage rights tp execute commands.
-            if self.api_key.can_manage(p.name):
-                return
-        elif command.name in ("sessions", "jobs", "pids",):
-            # we need manage_all permission for such commands
-            if self.api_key.can_manage_all():
-                return
-        elif command.name in ("load", "unload", "reload", "update",):
-            # we need to be an admin
-            if self.api_key.is_admin():
-                return
-        else:
-            if not command.args:
-                return
-
-            # only manager permission are needed.
-            if self.api_key.can_manage(command.args[0]):
-                return
-
-        raise ProcessError(403, "forbidden")
+        check_command_authz(self.manager, self.api_key, command)
 
     def _check_read(self, pname):
         if not self.api_key.can_read(pname):
@@ -22,7 +22,7 @@ class SessionsHandler(CorsHandlerWithAuth):
 
         m = self.settings.get('manager')
         self.set_header('Content-Type', 'application/json')
-        self.write(json.dumps({"sessions": m.sessions}))
+        self.write_cached("sessions", lambda: {"sessions": m.sessions})
 
 
 class AllJobsHandler(CorsHandlerWithAuth):
@@ -37,7 +37,7 @@ class AllJobsHandler(CorsHandlerWithAuth):
 
         m = self.settings.get('manager')
         self.set_header('Content-Type', 'application/json')
-        self.write(json.dumps({"jobs": m.jobs()}))
+        self.write_cached("jobs", lambda: {"jobs": m.jobs()})
 
 class JobsHandler(CorsHandlerWithAuth):
     """ /jobs/<sessionid> """
@@ -50,18 +50,17 @@ class JobsHandler(CorsHandlerWithAuth):
         if not self.api_key.can_manage(sessionid):
             raise HTTPError(403)
 
+        def get_jobs():
+            return {"sessionid": sessionid, "jobs": list(m.jobs(sessionid))}
+
+        # send response
+        self.set_header('Content-Type', 'application/json')
         try:
-            jobs = list(m.jobs(sessionid))
+            self.write_cached("jobs:%s" % sessionid, get_jobs)
         except ProcessError as e:
             self.set_status(e.errno)
             return self.write(e.to_dict())
 
-
-        # send response
-        self.set_header('Content-Type', 'application/json')
-        self.write(json.dumps({"sessionid": sessionid,
-                               "jobs": jobs}))
-
     def post(self, *args, **kwargs):
         self.preflight()
 
@@ -136,13 +135,11 @@ class JobHandler(CorsHandlerWithAuth):
             raise HTTPError(403)
 
         try:
-            info = m.info(pname)
+            self.write_cached("info:%s" % pname, lambda: m.info(pname))
         except ProcessError:
             self.set_status(404)
             return self.write({"error": "not_found"})
 
-        self.write(info)
-
     def delete(self, *args):
         self.preflight()
         self.set_header('Content-Type', 'application/json')
@@ -5,7 +5,7 @@
 import json
 import uuid
 
-from tornado.web import HTTPError
+from tornado.web import HTTPError, asynchronous
 
 from .util import CorsHandlerWithAuth
 from ..keys import KeyConflict, KeyNotFound
@@ -22,6 +22,7 @@ class KeysHandler(CorsHandlerWithAuth):
             include_key = False
         self.write({"keys": self.key_mgr.all_keys(include_key)})
 
+    @asynchronous
     def post(self, *args):
         if not self.api_key.can_create_key():
             raise HTTPError(403)
@@ -35,18 +36,23 @@ class KeysHandler(CorsHandlerWithAuth):
         if permissions.get('admin') == True and not self.api_key.is_admin():
             raise HTTPError(403)
 
-        try:
-            self.key_mgr.set_key(api_key, data, parent=parent)
-        except KeyConflict:
-            raise HTTPError(409)
+        def on_set(result, error):
+            if isinstance(error, KeyConflict):
+                return self.send_error(409)
+            elif error is not None:
+                return self.send_error(500)
+
+            location = '%s://%s/keys/%s' % (self.request.protocol,
+                    self.request.host, api_key)
 
-        location = '%s://%s/keys/%s' % (self.request.protocol,
-                self.request.host, api_key)
+            self.set_header("Content-Type", "application/json")
+            self.set_header("X-Api-Key", api_key)
+            self.set_header("Location", location)
+            self.write(json.dumps({"ok": True, "api_key": api_key}))
+            self.finish()
 
-        self.set_header("Content-Type", "application/json")
-        self.set_header("X-Api-Key", api_key)
-        self.set_header("Location", location)
-        self.write(json.dumps({"ok": True, "api_key": api_key}))
+        # the key is stored without blocking the loop
+        self.key_mgr.set_key_async(api_key, data, on_set, parent=parent)
 
     def fetch_key(self):
         obj = json.loads(self.request.body.decode('utf-8'))
@@ -64,6 +70,18 @@ class KeysHandler(CorsHandlerWithAuth):
         return key, obj, parent
 
 
+class KeysCacheHandler(CorsHandlerWithAuth):
+    """ /keys/_cache
+
+    return the size and the hit/miss counters of the keys cache """
+
+    def get(self, *args):
+        if not self.api_key.is_admin():
+            raise HTTPError(403)
+
+        self.write(self.key_mgr.cache_stats())
+
+
 class KeyHandler(CorsHandlerWithAuth):
 
     def head(self, *args):
@@ -93,12 +111,15 @@ class KeyHandler(CorsHandlerWithAuth):
             raise HTTPError(404)
 
         if self.get_argument("include_keys", "false").lower() == "true":
-            # include subkeys
+            # include subkeys. the key object is shared with the cache, so
+            # don't modify it.
+            key_obj = key_obj.copy()
             subkeys = self.key_mgr.all_subkeys(args[0])
             key_obj['keys'] = subkeys
 
         self.write(key_obj)
 
+    @asynchronous
     def delete(self, *args):
         if (not self.api_key.can_create_key() and
                 self.api_key.api_key != args[0]):
@@ -106,9 +127,13 @@ class KeyHandler(CorsHandlerWithAuth):
             # object
             raise HTTPError(403)
 
-        try:
-            key_obj = self.key_mgr.delete_key(args[0])
-        except KeyNotFound:
-            raise HTTPError(404)
+        def on_delete(result, error):
+            if isinstance(error, KeyNotFound):
+                return self.send_error(404)
+            elif error is not None:
+                return self.send_error(500)
+
+            self.write({"ok": True})
+            self.finish()
 
-        self.write({"ok": True})
+        self.key_mgr.delete_key_async(args[0], on_delete)
@@ -8,7 +8,7 @@ from tornado.web import HTTPError
 
 from ...message import Message, decode_frame, make_response
 from ...error import ProcessError
-from ..keys import Key, DummyKey, KeyNotFound
+from ..keys import DummyKey, KeyNotFound
 from .util import CorsHandler, CorsHandlerWithAuth
 
 class AllProcessIdsHandler(CorsHandlerWithAuth):
@@ -22,7 +22,7 @@ class AllProcessIdsHandler(CorsHandlerWithAuth):
                 not self.api_key.can_manage_all()):
             raise HTTPError(403)
 
-        self.write({"pids": list(m.running)})
+        self.write_cached("pids", lambda: {"pids": list(m.running)})
 
 class ProcessIdHandler(CorsHandlerWithAuth):
 
@@ -185,6 +185,9 @@ class PidChannel(websocket.WebSocketHandler):
         self.key_mgr = self.settings.get('key_mgr')
         self.api_key = None
 
+        # frames received while the key is fetched
+        self._pending = None
+
         try:
             process = self.process = self.manager.get_process(int(args[0]))
         except ProcessError as e:
@@ -263,39 +266,63 @@ class PidChannel(websocket.WebSocketHandler):
 
         self.opened = True
 
-    def authenticate(self, body):
-        if body.startswith(b"AUTH:"):
-            key = body.split(b"AUTH:")[1].decode('utf-8')
-            try:
-                self.api_key = Key.load(self.key_mgr.get_key(key))
-            except KeyNotFound:
-                raise ProcessError(403, "AUTH_REQUIRED")
-        else:
-            raise ProcessError(403, "AUTH_REQUIRED")
+    def authenticate(self, body, callback):
+        """ fetch the key given in the AUTH message without blocking the
+        loop then call ``callback(error)`` """
+        if not body.startswith(b"AUTH:"):
+            return callback(ProcessError(403, "AUTH_REQUIRED"))
+
+        def on_key(key_obj, error):
+            if error is not None:
+                error = ProcessError(403, "AUTH_REQUIRED")
+            else:
+                self.api_key = key_obj
+            callback(error)
+
+        key = body.split(b"AUTH:")[1].decode('utf-8')
+        self.key_mgr.get_key_object_async(key, on_key)
 
     def close(self):
         self._close_subscriptions()
         super(PidChannel, self).close()
 
     def on_message(self, frame):
+        if self.api_key is None and self.require_key:
+            if self._pending is not None:
+                # the key is still fetched, the frame is handled once the
+                # connection is authenticated
+                return self._pending.append(frame)
+
+            self._pending = [frame]
+            return self.authenticate(decode_frame(frame).body,
+                    self._on_authenticated)
+
+        self.handle_message(frame)
+
+    def _on_authenticated(self, error):
+        pending, self._pending = self._pending, None
+        if pending is None:
+            # the connection has been closed
+            return
+
+        if error is not None:
+            self.write_error(error.to_json())
+            return self.close()
+
+        for frame in pending:
+            self.handle_message(frame)
+
+    def handle_message(self, frame):
         # decode the coming msg frame
         msg = decode_frame(frame)
 
         is_auth = msg.body.startswith(b"AUTH:") == True
-        if not self.api_key and self.require_key:
-            try:
-                self.authenticate(msg.body)
-            except ProcessError as e:
-                self.write_error(e.to_json())
-                self.close()
-
         if not self.opened:
             try:
                 self.open_stream(self.process, self.args)
             except ProcessError as e:
                 self.write_error(e.to_json())
-                self.close()
-
+                return self.close()
 
         if not is_auth:
             # we can write on this stream, return an error
@@ -320,6 +347,7 @@ class PidChannel(websocket.WebSocketHandler):
         self.write_message(msg.encode())
 
     def on_close(self):
+        self._pending = None
         self.manager.events.unsubscribe("proc.%s.exit" % self.process.pid,
                 self.on_exit)
 
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -
+#
+# This file is part of gaffer. See the NOTICE for more information.
+
+from tornado.web import HTTPError
+
+from .util import CorsHandlerWithAuth
+
+
+class SnapshotHandler(CorsHandlerWithAuth):
+    """ /snapshot
+
+    return all sessions, jobs, pids and their counts in one document. """
+
+    def get(self, *args):
+        self.preflight()
+
+        if (not self.api_key.is_admin() and
+                not self.api_key.can_manage_all()):
+            raise HTTPError(403)
+
+        m = self.settings.get('manager')
+        self.set_header('Content-Type', 'application/json')
+        self.write_cached("snapshot", m.snapshot)
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -
+#
+# This file is part of gaffer. See the NOTICE for more information.
+
+from tornado.web import HTTPError
+
+from .util import CorsHandlerWithAuth
+
+
+class StatsHandler(CorsHandlerWithAuth):
+    """ /stats
+
+    return the stats of the node aggregated per job and per session. Stats
+    are sampled in the background, the last sample is returned. """
+
+    def get(self, *args):
+        self.preflight()
+
+        if (not self.api_key.is_admin() and
+                not self.api_key.can_manage_all()):
+            raise HTTPError(403)
+
+        collector = self.settings.get('stats_collector')
+        if collector is None:
+            raise HTTPError(404)
+
+        self.set_header('Content-Type', 'application/json')
+        self.write(collector.body)
@@ -6,11 +6,15 @@ try:
     import httplib
 except ImportError:
     import http.client as httplib
+import hashlib
 import json
 
 import pyuv
 from tornado.web import RequestHandler, asynchronous, HTTPError
-from ..keys import DummyKey, Key, KeyNotFound
+
+from ...error import ProcessError
+from ..keys import DummyKey, KeyNotFound
+from ..tokens import InvalidToken
 from ..users import UserNotFound
 
 ACCESS_CONTROL_HEADERS = ['X-Requested-With',
@@ -25,6 +29,33 @@ CORS_HEADERS = {
 }
 
 
+class ResponseCache(object):
+    """ cache of JSON encoded response bodies. Entries are only valid for
+    one generation of the manager, the cache is emptied each time the
+    generation changes. """
+
+    def __init__(self):
+        self.generation = None
+        self._entries = {}
+
+    def get(self, generation, key, builder):
+        """ return the tuple (etag, body) for a key. The body is built by
+        calling ``builder`` if it isn't in the cache. """
+        if generation != self.generation:
+            self._entries = {}
+            self.generation = generation
+
+        try:
+            return self._entries[key]
+        except KeyError:
+            pass
+
+        body = json.dumps(builder())
+        etag = '"%s"' % hashlib.sha1(body.encode('utf-8')).hexdigest()
+        self._entries[key] = (etag, body)
+        return etag, body
+
+
 class CorsHandler(RequestHandler):
 
     @asynchronous
@@ -43,6 +74,28 @@ class CorsHandler(RequestHandler):
         for k, v in CORS_HEADERS.items():
             self.set_header(k, v)
 
+    def write_cached(self, key, builder):
+        """ write the JSON body returned by ``builder`` using the response
+        cache. The body is only built when the manager state changed, a
+        strong etag is set and the request is answered with a 304 if the
+        client already have the response. """
+        m = self.settings.get('manager')
+        cache = self.settings.get('response_cache')
+        if cache is None:
+            return self.write(json.dumps(builder()))
+
+        with m._lock:
+            etag, body = cache.get(m.generation, key, builder)
+
+        self.set_header('Etag', etag)
+        inm = self.request.headers.get('If-None-Match')
+        if inm is not None:
+            tags = [tag.strip() for tag in inm.split(",")]
+            if "*" in tags or etag in tags:
+                return self.set_status(304)
+
+        self.write(body)
+
     def get_error_html(self, status_code, **kwargs):
         self.set_header("Content-Type", "application/json")
 
@@ -69,6 +122,37 @@ class CorsHandler(RequestHandler):
 
 class CorsHandlerWithAuth(CorsHandler):
 
+    # key and user fetched before the request is executed
+    _key_result = None
+    _user_result = None
+
+    def _execute(self, transforms, *args, **kwargs):
+        # ``prepare`` can't be asynchronous. The key and its user are
+        # fetched first without blocking the loop then the request is
+        # executed.
+        api_key = self.request.headers.get('X-Api-Key', None)
+        if (api_key is None or not self.settings.get('require_key', False)
+                or 'X-Auth-Token' in self.request.headers):
+            return super(CorsHandlerWithAuth, self)._execute(transforms,
+                    *args, **kwargs)
+
+        execute = super(CorsHandlerWithAuth, self)._execute
+
+        def on_user(user_obj, error):
+            self._user_result = (user_obj, error)
+            execute(transforms, *args, **kwargs)
+
+        def on_key(key_obj, error):
+            self._key_result = (key_obj, error)
+            if error is not None:
+                return execute(transforms, *args, **kwargs)
+            self.settings['auth_mgr'].user_by_key_async(api_key, on_user)
+
+        try:
+            self.settings['key_mgr'].get_key_object_async(api_key, on_key)
+        except Exception as e:
+            on_key(None, e)
+
     def prepare(self):
         api_key = self.request.headers.get('X-Api-Key', None)
         require_key = self.settings.get('require_key', False)
@@ -79,16 +163,81 @@ class CorsHandlerWithAuth(CorsHandler):
 
         # if the key API is enable start to use it
         if require_key:
-            if api_key is not None:
+            token = self.request.headers.get('X-Auth-Token', None)
+            if token is not None:
+                # signed tokens are validated without any lookup
                 try:
-                    self.api_key = Key.load(key_mgr.get_key(api_key))
+                    payload, key_obj = self.auth_mgr.verify_token_key(token)
+                except InvalidToken:
+                    raise HTTPError(401)
+
+                if key_obj is None:
+                    raise HTTPError(403)
+                self.api_key = key_obj
+                self.key_username = payload.get("username")
+            elif api_key is not None:
+                try:
+                    self.api_key = self._fetched(self._key_result,
+                        key_mgr.get_key_object, api_key)
                 except KeyNotFound:
                     raise HTTPError(403, "key %s doesn't exist",api_key)
 
                 try:
-                    user_obj = self.auth_mgr.user_by_key(api_key)
+                    user_obj = self._fetched(self._user_result,
+                            self.auth_mgr.user_by_key, api_key)
                     self.key_username = user_obj["username"]
                 except UserNotFound:
                     pass
             else:
                 raise HTTPError(401)
+
+    def _fetched(self, result, fetch, *args):
+        if result is None:
+            return fetch(*args)
+
+        obj, error = result
+        if error is not None:
+            raise error
+        return obj
+
+
+def check_command_authz(manager, api_key, command):
+    """ check if a key can execute a controller command. Raise a
+    ``ProcessError`` if the permission is not granted """
+    if api_key.can_manage_all():
+        return
+
+    if (command.name in ("process_info", "process_stats", "stop_process",
+        "send", "kill",)):
+
+        # if not pid given return and handle the command error later
+        if not command.args:
+            return
+
+        # get the process instance
+        p = manager.get_process(command.args[0])
+
+        # we need write permission for 'send'
+        if command.name == "send" and api_key.can_write(p.name):
+            return
+
+        # else we need manage rights tp execute commands.
+        if api_key.can_manage(p.name):
+            return
+    elif command.name in ("sessions", "jobs", "pids",):
+        # we need manage_all permission for such commands
+        if api_key.can_manage_all():
+            return
+    elif command.name in ("load", "unload", "reload", "update",):
+        # we need to be an admin
+        if api_key.is_admin():
+            return
+    else:
+        if not command.args:
+            return
+
+        # only manager permission are needed.
+        if api_key.can_manage(command.args[0]):
+            return
+
+    raise ProcessError(403, "forbidden")
@@ -2,13 +2,17 @@
 #
 # This file is part of gaffer. See the NOTICE for more information.
 
-from collections import deque
+from collections import OrderedDict
+import fnmatch
 import os
 import json
+import re
 import sqlite3
+import time
 import uuid
 
 from ..events import EventEmitter
+from .db import SqliteExecutor, run_callback
 from .util import load_backend
 
 
@@ -28,6 +32,73 @@ class UnknownPermission(Exception):
     """ raised when the permission is not found """
 
 
+# permission levels. Each level implies the ones below: managing a job
+# allows to write to it and read from it.
+PERMISSION_LEVELS = {"read": 1, "write": 2, "manage": 3}
+
+
+class PermissionMatcher(object):
+    """ permissions of a key compiled to resolve the permission level
+    (read, write or manage) of a job or a session in one lookup.
+
+    A permission can be a session name, a job name (``session.job``), ``*``
+    or a glob pattern like ``payments.*`` or ``*.worker``. Results are
+    memoized per name.
+    """
+
+    MAX_MEMO = 1024
+
+    def __init__(self, permissions):
+        self.admin = permissions.get("admin", False)
+
+        # level given to all the jobs and sessions
+        self.all_level = 3 if self.admin else 0
+
+        self._names = {}
+        self._patterns = []
+        for permission, level in PERMISSION_LEVELS.items():
+            for name in permissions.get(permission, None) or []:
+                if name == "*":
+                    self.all_level = max(self.all_level, level)
+                elif any(c in name for c in "*?["):
+                    self._patterns.append((re.compile(fnmatch.translate(name)),
+                        level))
+                else:
+                    self._names[name] = max(self._names.get(name, 0), level)
+
+        # highest levels are checked first
+        self._patterns.sort(key=lambda p: p[1], reverse=True)
+        self._memo = {}
+
+    def level(self, what):
+        """ return the permission level for a job or a session """
+        try:
+            return self._memo[what]
+        except KeyError:
+            pass
+
+        level = self._resolve(what)
+        if len(self._memo) >= self.MAX_MEMO:
+            self._memo.clear()
+        self._memo[what] = level
+        return level
+
+    def _resolve(self, what):
+        level = max(self.all_level, self._names.get(what, 0))
+        if "." in what:
+            # we are testing a job, check the permissions on its session
+            session = what.split(".", 1)[0]
+            level = max(level, self._names.get(session, 0))
+
+        for pattern, plevel in self._patterns:
+            if plevel <= level:
+                break
+            if pattern.match(what):
+                level = plevel
+                break
+        return level
+
+
 class Key(object):
     """ instance representing a key """
 
@@ -41,6 +112,12 @@ class Key(object):
         self.write = permissions.get('write', None) or {}
         self.read = permissions.get('read', None) or {}
 
+        # compile the permissions once
+        self._matcher = PermissionMatcher(permissions)
+
+        # dict the key was loaded from
+        self.data = None
+
     def __str__(self):
         return "Key: %s" % self.api_key
 
@@ -52,7 +129,9 @@ class Key(object):
         key = obj['key']
         label = obj.get('label', "")
         permissions = obj.get("permissions", {})
-        return cls(key, label, permissions)
+        okey = cls(key, label, permissions)
+        okey.data = obj
+        return okey
 
     def dump(self):
         return {"key": self.api_key, "label": self.label, "permissions":
@@ -81,13 +160,13 @@ class Key(object):
         return self.permissions.get("create_user", False)
 
     def can_manage_all(self):
-        return '*' in self.manage or self.is_admin()
+        return self._matcher.all_level >= PERMISSION_LEVELS["manage"]
 
     def can_write_all(self):
-        return '*' in self.write or self.can_manage_all()
+        return self._matcher.all_level >= PERMISSION_LEVELS["write"]
 
     def can_read_all(self):
-        return '*' in self.read or self.can_write_all()
+        return self._matcher.all_level >= PERMISSION_LEVELS["read"]
 
     def can_manage(self, job_or_session):
         """ test if a user can manage a job or a session
@@ -103,44 +182,21 @@ class Key(object):
     def can_write(self, job_or_session):
         """ test if a user can write to a process for this job or all the jobs
         of the session """
-        if self.can_manage(job_or_session):
-            return True
-
         return self.can('write', job_or_session)
 
     def can_read(self, job_or_session):
         """ test if a user can read from a process for this job or all the jobs
         of the session """
-
-        if self.can_write(job_or_session):
-            return True
-
         return self.can('read', job_or_session)
 
     def can(self, permission, what):
         """ test the permission for a job or a session """
-        if not hasattr(self, permission):
-            raise UnknownPermission("%r does not exist")
-
-        # get all permissions
-        permissions = getattr(self, permission, {})
-
-        # check if we we have the permission on all resources
-        if '*' in permissions or self.is_admin():
-            return True
-
-        if "." in what:
-            # we are testing job possibilities. The try first to know if we
-            # have the permissions on the session
-            session = what.split(".")[0]
-            if session in permissions:
-                return True
-
-        # test the job permission
-        if what in getattr(self, permission, {}):
-            return True
+        try:
+            required = PERMISSION_LEVELS[permission]
+        except KeyError:
+            raise UnknownPermission("%r does not exist" % permission)
 
-        return False
+        return self._matcher.level(what) >= required
 
 
 class DummyKey(Key):
@@ -170,13 +226,84 @@ class DummyKey(Key):
         return True
 
 
+# marker used to cache the keys not found
+_NOT_FOUND = object()
+
+
+class KeyCache(object):
+    """ LRU cache of the `Key` objects loaded from the backend
+
+    At most ``max_size`` keys are kept, the least recently used key is
+    evicted first. Entries expire after ``ttl`` seconds (never if ``ttl`` is
+    0). Keys not found are cached too so a client retrying with a bad key
+    doesn't hit the backend on each request.
+    """
+
+    def __init__(self, max_size=1000, ttl=300.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+        # counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """ return the cached value, ``_NOT_FOUND`` for a cached miss or
+        None if the key isn't in the cache """
+        try:
+            value, expires = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+
+        if expires and expires < time.time():
+            self.misses += 1
+            return None
+
+        # put back the entry at the end, it's now the most recently used
+        self._entries[key] = (value, expires)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        if not self.max_size:
+            return
+
+        self._entries.pop(key, None)
+        while len(self._entries) >= self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+        expires = self.ttl and time.time() + self.ttl or 0
+        self._entries[key] = (value, expires)
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        return {"size": len(self._entries), "max_size": self.max_size,
+                "ttl": self.ttl, "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions}
+
+
 class KeyManager(object):
 
     def __init__(self, loop, cfg):
         self.loop = loop
         self.cfg = cfg
-        self._cache = {}
-        self._entries = deque()
+        self._cache = KeyCache(max_size=cfg.keys_cache_size,
+                ttl=cfg.keys_cache_ttl)
 
         # initialize the db backend
         if not cfg.keys_backend or cfg.keys_backend == "default":
@@ -213,8 +340,7 @@ class KeyManager(object):
         self._emitter.close()
 
         # empty the cache
-        self._entries.clear()
-        self._cache = {}
+        self._cache.clear()
 
     def all_keys(self, include_key=False):
         return self._backend.all_keys(include_key=include_key)
@@ -231,34 +357,105 @@ class KeyManager(object):
 
     def set_key(self, key, data, parent=None):
         self._backend.set_key(key, data, parent=parent)
+
+        # the key may have been cached as not found. Events are dispatched
+        # asynchronously so the cache is invalidated right now.
+        self._cache.invalidate(key)
         self._emitter.publish("set", self, key)
 
     def get_key(self, key):
-        if key in self._cache:
-            return self._cache[key]
+        return self.get_key_object(key).data
 
-        okey = self._backend.get_key(key)
+    def get_key_object(self, key):
+        """ return the `Key` object of a key. The objects are cached so the
+        permissions are compiled once. """
+        okey = self._cache.get(key)
+        if okey is _NOT_FOUND:
+            raise KeyNotFound()
+        elif okey is not None:
+            return okey
 
-        # do we need to clean the cache?
-        # we only keep last 1000 acceded keys in RAM
-        if len(self._cache) >= 1000:
-            to_remove = self._entries.popleft()
-            self._cache.pop(to_remove)
+        try:
+            okey = Key.load(self._backend.get_key(key))
+        except KeyNotFound:
+            self._cache.set(key, _NOT_FOUND)
+            raise
 
-        # enter last entry in the cache
-        self._cache[key] = okey
-        self._entries.append(key)
+        self._cache.set(key, okey)
         return okey
 
+    def get_key_async(self, key, callback):
+        """ like ``get_key`` but the result is passed to
+        ``callback(key, error)`` once the key has been fetched without
+        blocking the loop. """
+        def on_key(okey, error):
+            callback(okey.data if okey is not None else None, error)
+        self.get_key_object_async(key, on_key)
+
+    def get_key_object_async(self, key, callback):
+        """ like ``get_key_object`` but the `Key` object is passed to
+        ``callback(key, error)`` """
+        okey = self._cache.get(key)
+        if okey is _NOT_FOUND:
+            return callback(None, KeyNotFound())
+        elif okey is not None:
+            return callback(okey, None)
+
+        def on_key(obj, error):
+            okey = None
+            if error is None:
+                try:
+                    okey = Key.load(obj)
+                except InvalidKey as e:
+                    error = e
+                else:
+                    self._cache.set(key, okey)
+            elif isinstance(error, KeyNotFound):
+                self._cache.set(key, _NOT_FOUND)
+            callback(okey, error)
+
+        self._backend.get_key_async(key, on_key)
+
+    def set_key_async(self, key, data, callback, parent=None):
+        """ like ``set_key`` but ``callback(result, error)`` is called once
+        the key is stored. Writes done at the same time are committed
+        together. """
+        def on_set(result, error):
+            if error is None:
+                self._cache.invalidate(key)
+                self._emitter.publish("set", self, key)
+            callback(result, error)
+
+        self._backend.set_key_async(key, data, on_set, parent=parent)
+
     def delete_key(self, key):
         # remove the key and all sub keys from the cache if needed
-        self._delete_entry(key)
-
-        for subkey in self.all_subkeys(key):
-            self._delete_entry(subkey["key"])
+        subkeys = self.all_subkeys(key)
 
         # then delete the
         self._backend.delete_key(key)
+        self._key_deleted(key, subkeys)
+
+    def delete_key_async(self, key, callback):
+        """ like ``delete_key`` but ``callback(result, error)`` is called
+        once the key and its subkeys are deleted. """
+        def on_subkeys(subkeys, error):
+            if error is not None:
+                return callback(None, error)
+
+            def on_delete(result, error):
+                if error is None:
+                    self._key_deleted(key, subkeys)
+                callback(result, error)
+
+            self._backend.delete_key_async(key, on_delete)
+
+        self._backend.all_subkeys_async(key, on_subkeys)
+
+    def _key_deleted(self, key, subkeys):
+        self._cache.invalidate(key)
+        for subkey in subkeys:
+            self._cache.invalidate(subkey["key"])
         self._emitter.publish("delete", self, key)
 
     def has_key(self, key):
@@ -267,10 +464,9 @@ class KeyManager(object):
     def all_subkeys(self, key):
         return self._backend.all_subkeys(key)
 
-    def _delete_entry(self, key):
-        if key in self._cache:
-            self._entries.remove(key)
-            self._cache.pop(key)
+    def cache_stats(self):
+        """ return the size and the hit/miss counters of the keys cache """
+        return self._cache.stats()
 
 
 class KeyBackend(object):
@@ -298,24 +494,48 @@ class KeyBackend(object):
     def all_keys(self):
         raise NotImplementedError
 
-    def set_key(self, key, data):
+    def set_key(self, key, data, parent=None):
         raise NotImplementedError
 
+    def set_key_async(self, key, data, callback, parent=None):
+        """ store a key then call ``callback(result, error)``. By default
+        the sync method is used. """
+        run_callback(callback, self.set_key, key, data, parent)
+
     def get_key(self, key):
         raise NotImplementedError
 
+    def get_key_async(self, key, callback):
+        """ fetch a key then call ``callback(key, error)``. By default the
+        sync method is used. """
+        run_callback(callback, self.get_key, key)
+
     def delete_key(self, key):
         raise NotImplementedError
 
+    def delete_key_async(self, key, callback):
+        """ delete a key then call ``callback(result, error)``. By default
+        the sync method is used. """
+        run_callback(callback, self.delete_key, key)
+
     def has_key(self, key):
         raise NotImplementedError
 
     def all_subkeys(self, key):
         raise NotImplementedError
 
+    def all_subkeys_async(self, key, callback):
+        """ fetch the subkeys then call ``callback(subkeys, error)``. By
+        default the sync method is used. """
+        run_callback(callback, self.all_subkeys, key)
+
 
 class SqliteKeyBackend(KeyBackend):
-    """ sqlite backend to store API keys in gaffer """
+    """ sqlite backend to store API keys in gaffer
+
+    Queries are run in a dedicated thread (see `gaffer.gafferd.db`) so the
+    async methods don't block the loop.
+    """
 
 
     def __init__(self, loop, cfg):
@@ -326,59 +546,42 @@ class SqliteKeyBackend(KeyBackend):
         if self.dbname != ":memory:":
             self.dbname = os.path.join(cfg.config_dir, self.dbname)
 
-        # intitialize conn
-        self.conn = None
+        # intitialize the executor
+        self._db = None
 
     def open(self):
-        self.conn = sqlite3.connect(self.dbname)
-        with self.conn:
-            sql = """CREATE TABLE if not exists keys (key text primary key,
-            data text, parent text)"""
-            self.conn.execute(sql)
+        self._db = SqliteExecutor(self.loop, self.dbname, setup=self._setup)
+        self._db.open()
 
     def close(self):
-        self.conn.commit()
-        self.conn.close()
+        self._db.close()
 
     def all_keys(self, include_key=False):
-        with self.conn:
-            cur = self.conn.cursor()
-            rows = cur.execute("SELECT * FROM keys", [])
-            if include_key:
-                return [self._make_key(row) for row in rows]
-            else:
-                return [row[0] for row in rows]
+        return self._db.call(self._all_keys, include_key)
 
     def set_key(self, key, data, parent=None):
-        assert self.conn is not None
-        if isinstance(data, dict):
-            data = json.dumps(data)
+        assert self._db is not None
+        self._db.call_write(self._set_key, key, data, parent)
 
-        with self.conn:
-            cur = self.conn.cursor()
-            try:
-                cur.execute("INSERT INTO keys VALUES (?, ?, ?)", [key,
-                    data, parent])
-            except sqlite3.IntegrityError:
-                raise KeyConflict()
+    def set_key_async(self, key, data, callback, parent=None):
+        assert self._db is not None
+        self._db.submit_write(callback, self._set_key, key, data, parent)
 
     def get_key(self, key, subkeys=True):
-        assert self.conn is not None
+        assert self._db is not None
+        return self._db.call(self._get_key, key)
 
-        with self.conn:
-            cur = self.conn.cursor()
-            cur.execute("SELECT * FROM keys WHERE key=?", [key])
-            row = cur.fetchone()
-
-        if not row:
-            raise KeyNotFound()
-        return self._make_key(row)
+    def get_key_async(self, key, callback):
+        assert self._db is not None
+        self._db.submit(callback, self._get_key, key)
 
     def delete_key(self, key):
-        assert self.conn is not None
-        with self.conn:
-            self.conn.execute("DELETE FROM keys WHERE key=? OR parent=?",
-                    [key, key])
+        assert self._db is not None
+        self._db.call_write(self._delete_key, key)
+
+    def delete_key_async(self, key, callback):
+        assert self._db is not None
+        self._db.submit_write(callback, self._delete_key, key)
 
     def has_key(self, key):
         try:
@@ -388,10 +591,47 @@ class SqliteKeyBackend(KeyBackend):
         return True
 
     def all_subkeys(self, key):
-        with self.conn:
-            cur = self.conn.cursor()
-            rows = cur.execute("SELECT * FROM keys WHERE parent=?", [key])
+        return self._db.call(self._all_subkeys, key)
+
+    def all_subkeys_async(self, key, callback):
+        self._db.submit(callback, self._all_subkeys, key)
+
+    # functions executed in the db thread
+
+    def _setup(self, conn):
+        conn.execute("""CREATE TABLE if not exists keys (key text primary key,
+            data text, parent text)""")
+        conn.execute("""CREATE INDEX if not exists keys_parent ON
+            keys (parent)""")
+
+    def _all_keys(self, conn, include_key):
+        rows = conn.execute("SELECT * FROM keys")
+        if include_key:
             return [self._make_key(row) for row in rows]
+        return [row[0] for row in rows]
+
+    def _set_key(self, conn, key, data, parent):
+        if isinstance(data, dict):
+            data = json.dumps(data)
+
+        try:
+            conn.execute("INSERT INTO keys VALUES (?, ?, ?)", [key, data,
+                parent])
+        except sqlite3.IntegrityError:
+            raise KeyConflict()
+
+    def _get_key(self, conn, key):
+        row = conn.execute("SELECT * FROM keys WHERE key=?", [key]).fetchone()
+        if not row:
+            raise KeyNotFound()
+        return self._make_key(row)
+
+    def _delete_key(self, conn, key):
+        conn.execute("DELETE FROM keys WHERE key=? OR parent=?", [key, key])
+
+    def _all_subkeys(self, conn, key):
+        rows = conn.execute("SELECT * FROM keys WHERE parent=?", [key])
+        return [self._make_key(row) for row in rows]
 
     def _make_key(self, row):
         obj = json.loads(row[1])
@@ -2,6 +2,7 @@
 #
 # This file is part of gaffer. See the NOTICE for more information.
 
+from collections import OrderedDict
 import json
 import logging
 from threading import RLock
@@ -19,7 +20,7 @@ class Message(object):
         self.id = uuid.uuid4().hex
         self.msg = msg
         self.msg['msgid'] = self.id
-        self.callback = None
+        self.callback = callback
         self._result = None
 
     def __str__(self):
@@ -44,9 +45,23 @@ class Message(object):
 
 
 class LookupClient(WebSocket):
+    """ websocket client registering the node jobs and processes to a
+    lookupd server.
 
-    def __init__(self, loop, url, **kwargs):
+    When ``batch_window`` is set, registrations are queued for this number
+    of seconds and sent in one ``BATCH`` message acked once. A process
+    spawned and stopped in the same window isn't sent at all. At most
+    ``max_inflight`` batches are waiting for their ack at the same time.
+    """
+
+    def __init__(self, loop, url, batch_window=0, max_batch=500,
+            max_inflight=4, load_cb=None, **kwargs):
         loop = loop
+        self.address = url
+
+        # function returning the load summary of the jobs sent with the
+        # heartbeats
+        self.load_cb = load_cb
         self._lock = RLock()
 
         # initialize the heartbeart. It will PING the lookupd server to say
@@ -65,10 +80,20 @@ class LookupClient(WebSocket):
         # lookupd server
         self.messages = dict()
 
+        # batching
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.max_inflight = max_inflight
+        self._pending = OrderedDict()
+        self._inflight = 0
+        self._seq = 0
+        self._batch_timer = pyuv.Timer(loop)
+
         super(LookupClient, self).__init__(loop, url, **kwargs)
 
     def start(self, on_exit_cb=None):
-        # set the exit callabck
+        # set the exit callabck. It's called when the connection is lost
+        # or couldn't be established.
         self.exit_cb = on_exit_cb
 
         # already started, return
@@ -78,38 +103,115 @@ class LookupClient(WebSocket):
         self.active = True
 
     def close(self):
+        # send the queued registrations
+        if self.active and not self.closed:
+            self.flush()
+
         self._heartbeat.stop()
+        self._batch_timer.stop()
         self.closed = True
         self.active = False
         super(LookupClient, self).close()
 
-    def ping(self):
+    def ping(self, load=None):
         if self.closed:
             return
-        return self.write_message({"type": "PING"})
 
-    def identify(self, name, broadcast_address, version,
+        msg = {"type": "PING"}
+        if load is not None:
+            msg["load"] = load
+        return self.write_message(msg)
+
+    def identify(self, name, broadcast_address, version, resume=False,
             callback=None):
-        return self.write_message({"type": "IDENTIFY", "name": name,
-            "origin": broadcast_address, "version": version},
-            callback=callback)
+        """ identify the node. If ``resume`` is True and lookupd still has a
+        connection for this node, the new connection replaces it. """
+        msg = {"type": "IDENTIFY", "name": name, "origin": broadcast_address,
+                "version": version}
+        if resume:
+            msg["resume"] = True
+        return self.write_message(msg, callback=callback)
+
+    def snapshot(self, jobs, callback=None):
+        """ send all the jobs of the node and their pids (a dict
+        ``{job_name: [pid, ...]}``) in one message. lookupd adds and
+        removes what changed since it last knew the node. """
+
+        # the snapshot replaces the queued registrations
+        with self._lock:
+            self._batch_timer.stop()
+            pending = list(self._pending.values())
+            self._pending.clear()
+
+        for msg in pending:
+            msg.reply({"ok": True, "msgid": msg.id})
+
+        return self.write_message({"type": "SNAPSHOT", "jobs": jobs},
+                callback=callback)
 
     def add_job(self, job_name, callback=None):
-        return self.write_message({"type": "REGISTER_JOB",
+        return self.queue_message({"type": "REGISTER_JOB",
             "job_name": job_name}, callback=callback)
 
     def remove_job(self, job_name, callback=None):
-        return self.write_message({"type": "UNREGISTER_JOB",
+        return self.queue_message({"type": "UNREGISTER_JOB",
             "job_name": job_name}, callback=callback)
 
     def add_process(self, job_name, pid, callback=None):
-        return self.write_message({"type": "REGISTER_PROCESS",
+        return self.queue_message({"type": "REGISTER_PROCESS",
             "job_name": job_name, "pid": pid}, callback=callback)
 
     def remove_process(self, job_name, pid, callback=None):
-        return self.write_message({"type": "UNREGISTER_PROCESS",
+        return self.queue_message({"type": "UNREGISTER_PROCESS",
             "job_name": job_name, "pid": pid}, callback=callback)
 
+    def queue_message(self, message, callback=None):
+        """ queue a registration message until the end of the batch window.
+        Messages are sent immediately if there is no window. """
+        if not self.batch_window:
+            return self.write_message(message, callback=callback)
+
+        msg = Message(message, callback=callback)
+        with self._lock:
+            if message["type"] == "UNREGISTER_PROCESS":
+                key = ("REGISTER_PROCESS", message["job_name"],
+                        message["pid"])
+                registered = self._pending.pop(key, None)
+                if registered is not None:
+                    # the process has been spawned and stopped in this
+                    # window, nothing to send.
+                    registered.reply({"ok": True, "msgid": registered.id})
+                    msg.reply({"ok": True, "msgid": msg.id})
+                    return msg
+
+            if message["type"] in ("REGISTER_PROCESS", "UNREGISTER_PROCESS"):
+                key = (message["type"], message["job_name"], message["pid"])
+                if key in self._pending:
+                    # the process is already (un)registered in this window
+                    msg.reply({"ok": True, "msgid": msg.id})
+                    return msg
+            else:
+                self._seq += 1
+                key = (message["type"], message["job_name"], self._seq)
+
+            self._pending[key] = msg
+            if len(self._pending) >= self.max_batch:
+                self.flush()
+            elif not self._batch_timer.active:
+                self._batch_timer.start(lambda h: self.flush(),
+                        self.batch_window, 0.0)
+        return msg
+
+    def flush(self):
+        """ send the queued messages """
+        with self._lock:
+            self._batch_timer.stop()
+            while self._pending and self._inflight < self.max_inflight:
+                batch = []
+                while self._pending and len(batch) < self.max_batch:
+                    batch.append(self._pending.popitem(last=False)[1])
+                self._send_batch(batch)
+
     ### websocket methods
 
     def on_message(self, message):
@@ -121,7 +223,7 @@ class LookupClient(WebSocket):
 
         msgid = result.get('msgid')
         if not msgid:
-            LOGGER.error('invalid message: %r' % str(e))
+            LOGGER.error('invalid message: %r' % result)
             return
 
         try:
@@ -138,12 +240,16 @@ class LookupClient(WebSocket):
         self._heartbeat.unref()
 
     def on_close(self):
+        # was the connection closed by us?
+        closed = self.closed
+
         self.active = False
         self.closed = True
         self._heartbeat.stop()
+        self._batch_timer.stop()
 
-        # call exit the callback
-        if self.exit_cb is not None:
+        # call exit the callback if the connection has been lost
+        if not closed and self.exit_cb is not None:
             try:
                 self.exit_cb(self)
             except Exception:
@@ -152,8 +258,15 @@ class LookupClient(WebSocket):
 
     def on_heartbeat(self, h):
         # on heartbeat send a `PING` message to the channel
-        # it will maintain the connection open
-        self.ping()
+        # it will maintain the connection open. The load of the jobs is
+        # piggybacked on it.
+        load = None
+        if self.load_cb is not None:
+            try:
+                load = self.load_cb()
+            except Exception:
+                LOGGER.exception('exception getting the load summary')
+        self.ping(load=load)
 
     def write_message(self, message, callback=None):
         if isinstance(message, bytes):
@@ -161,10 +274,49 @@ class LookupClient(WebSocket):
             return
 
         msg = Message(message, callback=callback)
+        self._write(msg)
+        return msg
 
+    def _write(self, msg):
         # store the message to handle the reply
         with self._lock:
             self.messages[msg.id] = msg
 
         super(LookupClient, self).write_message(msg.to_json())
-        return msg
+
+    def _send_batch(self, batch):
+        if len(batch) == 1:
+            # no need to batch
+            return self._write(batch[0])
+
+        def on_reply(result):
+            with self._lock:
+                self._inflight -= 1
+
+            # dispatch the errors to the messages of the batch. If the
+            # batch itself failed all the messages failed.
+            errors = {}
+            for error in result.get("errors", []):
+                errors[error.get("index")] = error
+
+            for i, msg in enumerate(batch):
+                if "ok" in result:
+                    reply = errors.get(i, {"ok": True}).copy()
+                else:
+                    reply = result.copy()
+                reply["msgid"] = msg.id
+                msg.reply(reply)
+
+            # send the messages queued while we were waiting
+            if self._pending and not self.closed:
+                self.flush()
+
+        messages = []
+        for msg in batch:
+            submsg = msg.msg.copy()
+            submsg.pop("msgid", None)
+            messages.append(submsg)
+
+        self._inflight += 1
+        self._write(Message({"type": "BATCH", "messages": messages},
+            callback=on_reply))
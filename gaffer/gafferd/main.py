@@ -5,12 +5,12 @@
 usage: gafferd [--version] [-v|-vv] [-c CONFIG|--config=CONFIG]
                [-p PLUGINS_DIR|--plugin-dir=PLUGINS_DIR]
                [--daemon] [--pidfile=PIDFILE]
-               [--bind=ADDRESS] [--lookupd-address=LOOKUP]...
+               [--bind=ADDRESS]... [--lookupd-address=LOOKUP]...
                [--broadcast-address=ADDR]
                [--certfile=CERTFILE] [--keyfile=KEYFILE]
                [--cacert=CACERT]
                [--client-certfile=CERTFILE] [--client-keyfile=KEYFILE]
-               [--backlog=BACKLOG]
+               [--backlog=BACKLOG] [--reuseport]
                [--error-log=FILE] [--log-level=LEVEL]
                [--require-key]
                [--create-admin-user] [--username USER] [--password PASSWORD]
@@ -30,7 +30,9 @@ Options
     -p DIR --plugin-dir=DIR     plugin dir
     --daemon                    Start gaffer in daemon mode
     --pidfile=PIDFILE
-    --bind=ADDRESS              default HTTP binding (default: 0.0.0.0:5000)
+    --bind=ADDRESS              HTTP binding, can be repeated. Unix sockets
+                                are bound with unix:/path
+                                (default: 0.0.0.0:5000)
     --lookupd-address=LOOKUP    lookupd HTTP address
     --broadcast-address=ADDR    the address for this node. This is registered
                                 with gaffer_lookupd (defaults to OS hostname)
@@ -43,6 +45,7 @@ Options
     --client-keyfile=KEYFILE    SSL client key file
     --cacert=CACERT             SSL CA certificate
     --backlog=BACKLOG           default backlog (default: 128).
+    --reuseport                 set SO_REUSEPORT on the TCP bindings
     --error-log=FILE            logging file
     --log-level=LEVEL           logging level (critical, error warning, info,
                                 debug)
@@ -58,6 +61,9 @@ Options
 from getpass import getpass
 import os
 import logging
+import signal
+import socket
+import subprocess
 import sys
 import uuid
 
@@ -67,6 +73,8 @@ from .. import __version__
 from ..console_output import ConsoleOutput
 from ..docopt import docopt
 from ..error import ProcessError
+from ..fdholder import HAS_SCM_RIGHTS
+from ..journal import StateJournal
 from ..manager import Manager
 from ..pidfile import Pidfile
 from ..process import ProcessConfig
@@ -74,6 +82,8 @@ from ..sig_handler import SigHandler
 from ..util import daemonize, setproctitle_
 from ..webhooks import WebHooks
 from .config import ConfigError, Config
+from .handover import (Handover, HandoverError, send_handover, HANDOVER_ENV,
+        HANDOVER_TIMEOUT)
 from .http import HttpHandler
 from .keys import KeyManager
 from .plugins import PluginManager
@@ -106,6 +116,9 @@ class Server(object):
 
         self.cfg = Config(args, self.config_dir)
         self.plugins = []
+        self.pidfile = None
+        self.journal = None
+        self._reexec_handle = None
 
 
     def start(self, loop, manager):
@@ -113,10 +126,19 @@ class Server(object):
         # manager so we can manage the configuratino change
         self.plugin_manager.start_apps(self.cfg, loop, manager)
 
+        # hot re-exec
+        self._reexec_handle = pyuv.Signal(loop)
+        self._reexec_handle.start(self.handle_reexec, signal.SIGUSR2)
+        self._reexec_handle.unref()
+
     def stop(self):
         # stop all plugins apps
         self.plugin_manager.stop_apps()
 
+        if self._reexec_handle is not None:
+            self._reexec_handle.close()
+            self._reexec_handle = None
+
 
     def restart(self):
         logging.info("reload config")
@@ -140,6 +162,9 @@ class Server(object):
         for jobname, sessionid in jobs_removed:
             self.manager.unload(jobname, sessionid=sessionid)
 
+        # the sockets are needed by the jobs
+        self.load_sockets()
+
         # load or update job configs
         for name, sessionid, cmd, params in self.cfg.processes:
             if "start" in params:
@@ -163,12 +188,129 @@ class Server(object):
 
         # unregister hooks
         for event, url in webhooks_removed:
-            self.webhook_app.unregister(event, url)
+            self.webhook_app.unregister_hook(event, url)
 
         # restart plugins
         self.plugin_manager.restart_apps(self.cfg, self.manager.loop,
                 self.manager)
 
+    def handle_reexec(self, handle, signum):
+        logging.info("re-exec gafferd")
+        try:
+            self.reexec()
+        except Exception:
+            logging.error('Uncaught exception during the re-exec',
+                        exc_info=True)
+
+    def reexec(self):
+        """ start a new gafferd and hand it the listening sockets and the
+        processes. The current gafferd stops once the new one took over and
+        continues to run otherwise. Return True on success. """
+        if not HAS_SCM_RIGHTS:
+            logging.error("re-exec isn't supported on this platform")
+            return False
+
+        parent, child = socket.socketpair(socket.AF_UNIX,
+                socket.SOCK_SEQPACKET)
+        env = os.environ.copy()
+        env[HANDOVER_ENV] = str(child.fileno())
+        try:
+            proc = subprocess.Popen([sys.executable] + sys.argv, env=env,
+                    pass_fds=(child.fileno(),))
+        except OSError as e:
+            logging.error("failed to start the new gafferd: %s" % str(e))
+            parent.close()
+            return False
+        finally:
+            child.close()
+
+        # the loop is blocked until the new gafferd took over, so the state
+        # can't change meanwhile
+        state = self.manager.dump_state()
+        pipes = {}
+        for name, sock in self.manager.sockets.items():
+            pipes["socket:%s" % name] = sock.fds
+
+        for p in self.manager.list():
+            try:
+                pipes[p.os_pid] = p.stdio_fds
+            except pyuv.error.HandleError:
+                # the process exited, it will be respawned by the new
+                # gafferd
+                pass
+
+        # the new gafferd resumes the delivery of the webhooks from there
+        self.webhook_app.sync()
+
+        parent.settimeout(HANDOVER_TIMEOUT)
+        try:
+            send_handover(parent, state, self.http_handler.listeners, pipes)
+            ready = parent.recv(16) == b"ready"
+        except socket.error as e:
+            logging.error("handover failed: %s" % str(e))
+            ready = False
+        finally:
+            parent.close()
+
+        if not ready:
+            logging.error("the new gafferd failed to start, continue")
+            proc.kill()
+            return False
+
+        logging.info("gafferd %s took over, exit" % proc.pid)
+
+        # the sockets, the journal and the processes belong to the new
+        # gafferd now
+        self.http_handler.detach_listeners()
+        self.webhook_app.detach()
+        if self.journal is not None:
+            self.journal.detach()
+        self.pidfile = None
+        self.manager.stop(keep_processes=True)
+        return True
+
+    def load_sockets(self):
+        """ create the listening sockets of the config. The sockets restored
+        are only bound again if their settings changed """
+        names = set()
+        for name, settings in self.cfg.sockets:
+            names.add(name)
+            try:
+                current = self.manager.get_socket(name)
+            except ProcessError:
+                current = None
+
+            if current is not None:
+                if current.to_dict() == dict(settings, name=name):
+                    continue
+                self.manager.remove_socket(name)
+            self.manager.add_socket(name, **settings)
+
+        for name in list(self.manager.sockets):
+            if name not in names:
+                self.manager.remove_socket(name)
+
+    def load_jobs(self):
+        """ load the jobs of the config. The jobs restored from the journal
+        or the previous gafferd are only updated if their config changed """
+        for name, sessionid, cmd, params in self.cfg.processes:
+            if "start" in params:
+                start = params.pop("start")
+            else:
+                start = True
+
+            config = ProcessConfig(name, cmd, **params)
+            try:
+                current = self.manager.get("%s.%s" % (sessionid, name))
+            except ProcessError:
+                current = None
+
+            if current is None:
+                self.manager.load(config, sessionid=sessionid, start=start)
+            elif current.to_state() != config.to_state():
+                # the job has been restored but its config changed since
+                self.manager.update(config, sessionid=sessionid)
+
     def run(self):
         # load config
         self.cfg.load()
@@ -182,19 +324,33 @@ class Server(object):
             return self.list_admins()
 
 
-        # do we need to daemonize the daemon
-        if self.cfg.daemonize:
+        # receive the sockets and the processes of the previous gafferd
+        handover = None
+        handover_fd = os.environ.pop(HANDOVER_ENV, None)
+        if handover_fd is not None:
+            try:
+                handover = Handover.receive(int(handover_fd))
+            except HandoverError as e:
+                print("error: handover failed: %s" % str(e))
+                sys.exit(1)
+
+        # do we need to daemonize the daemon. The previous gafferd already
+        # did it.
+        if self.cfg.daemonize and handover is None:
             daemonize()
 
         # fix the process name
         setproctitle_("gafferd")
 
-        # setup the pidfile
-        pidfile = None
+        # setup the pidfile, the previous gafferd exits once we took over
         if self.cfg.pidfile:
-            pidfile = Pidfile(self.cfg.pidfile)
+            self.pidfile = Pidfile(self.cfg.pidfile)
+            replace = None
+            if handover is not None:
+                replace = os.getppid()
+
             try:
-                pidfile.create(os.getpid())
+                self.pidfile.create(os.getpid(), replace=replace)
             except RuntimeError as e:
                 print(str(e))
                 sys.exit(1)
@@ -209,15 +365,31 @@ class Server(object):
         self.manager = Manager()
 
         # initialize apps
-        self.http_handler = HttpHandler(self.cfg, self.plugin_manager)
-        self.webhook_app = WebHooks(hooks=self.cfg.webhooks)
+        listeners = None
+        if handover is not None:
+            listeners = handover.listeners
+        self.http_handler = HttpHandler(self.cfg, self.plugin_manager,
+                listeners=listeners)
+        self.webhook_app = WebHooks(hooks=self.cfg.webhooks,
+                batch_interval=self.cfg.webhooks_batch_interval,
+                max_retries=self.cfg.webhooks_max_retries,
+                max_queue=self.cfg.webhooks_max_queue,
+                timeout=self.cfg.webhooks_timeout,
+                outbox=self.cfg.webhooks_outbox,
+                outbox_max_size=(self.cfg.webhooks_outbox_max_size *
+                    1024 * 1024))
 
         # setup gaffer apps
         apps = [self,
-                SigHandler(),
+                SigHandler(keep_on_quit=self.cfg.state_journal is not None),
                 self.webhook_app,
                 self.http_handler]
 
+        if self.cfg.state_journal is not None:
+            self.journal = StateJournal(self.cfg.state_journal,
+                    holder=self.cfg.fd_holder)
+            apps.append(self.journal)
+
         # verbose mode
         if self.args["-v"] == 2:
             apps.append(ConsoleOutput(actions=['.']))
@@ -229,15 +401,18 @@ class Server(object):
         # really start the server
         self.manager.start(apps=apps)
 
-        # load job configs
-        for name, sessionid, cmd, params in self.cfg.processes:
-            if "start" in params:
-                start = params.pop("start")
-            else:
-                start = True
+        # adopt the processes left running by the previous gafferd
+        if handover is not None:
+            self.manager.restore(handover.state, handover.pipes)
+        elif self.journal is not None:
+            self.journal.restore()
 
-            config = ProcessConfig(name, cmd, **params)
-            self.manager.load(config, sessionid=sessionid, start=start)
+        # load the sockets and the job configs
+        self.load_sockets()
+        self.load_jobs()
+
+        if handover is not None:
+            handover.ready()
 
         # run the main loop
         try:
@@ -248,8 +423,8 @@ class Server(object):
             print("error: %s" % str(e))
             sys.exit(1)
         finally:
-            if pidfile is not None:
-                pidfile.unlink()
+            if self.pidfile is not None:
+                self.pidfile.unlink()
 
     def find_configdir(self):
         if self.args.get('--config') is not None:
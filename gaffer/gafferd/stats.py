@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -
+#
+# This file is part of gaffer. See the NOTICE for more information.
+
+from collections import deque
+from functools import partial
+import json
+import time
+
+import psutil
+import pyuv
+
+
+def _empty_rollup():
+    return {"processes": 0, "cpu": 0.0, "max_cpu": 0.0, "rss": 0,
+            "max_rss": 0, "restarts": 0}
+
+
+def _add_rollup(rollup, other):
+    rollup["processes"] += other["processes"]
+    rollup["cpu"] += other["cpu"]
+    rollup["max_cpu"] = max(rollup["max_cpu"], other["max_cpu"])
+    rollup["rss"] += other["rss"]
+    rollup["max_rss"] = max(rollup["max_rss"], other["max_rss"])
+    rollup["restarts"] += other["restarts"]
+
+
+def sample_process(pprocess):
+    """ return the tuple (cpu, rss) for a psutil process or None if the
+    process can't be read """
+    try:
+        cpu = pprocess.get_cpu_percent(interval=0)
+        rss = pprocess.get_memory_info()[0]
+    except (psutil.NoSuchProcess, psutil.AccessDenied):
+        return None
+    return cpu, rss
+
+
+class StatsCollector(object):
+    """ collect the stats of all the processes handled by the manager
+
+    Processes are sampled every ``interval`` seconds in the loop thread pool
+    and aggregated per job, per session and for the whole node. The last
+    aggregated stats are kept already encoded so they can be returned
+    without touching the processes.
+
+    Restarts are the number of unexpected exits of the processes of a job
+    during the last ``restart_window`` seconds. The processes stopped on
+    purpose (stop_process, stop_job, scale down, unload) are not counted.
+    """
+
+    def __init__(self, loop, manager, interval=5.0, restart_window=300.0):
+        self.loop = loop
+        self.manager = manager
+        self.interval = interval
+        self.restart_window = restart_window
+
+        self._timer = pyuv.Timer(loop)
+        self._sampling = False
+        self._exits = {}
+        # pids of the processes stopped on purpose
+        self._stopped = set()
+        self._stats = None
+        self._body = None
+
+        # set an empty stats document until the first sample is done
+        self._set_stats(self._aggregate([], {}, time.time()))
+
+    def start(self):
+        self.manager.events.subscribe("stop_process", self._on_stop)
+        self.manager.events.subscribe("reap", self._on_stop)
+        self.manager.events.subscribe("exit", self._on_exit)
+        self._timer.start(self._on_timer, 0.0, self.interval)
+        self._timer.unref()
+
+    def stop(self):
+        self.manager.events.unsubscribe("stop_process", self._on_stop)
+        self.manager.events.unsubscribe("reap", self._on_stop)
+        self.manager.events.unsubscribe("exit", self._on_exit)
+        self._timer.stop()
+
+    def close(self):
+        self.stop()
+        if not self._timer.closed:
+            self._timer.close()
+        self._exits = {}
+        self._stopped = set()
+
+    @property
+    def stats(self):
+        """ last aggregated stats """
+        return self._stats
+
+    @property
+    def body(self):
+        """ last aggregated stats encoded in JSON """
+        return self._body
+
+    def load_summary(self):
+        """ return a compact load summary per job sent to lookupd with the
+        heartbeats: number of processes, cpu, rss and restarts per
+        minute. """
+        window = self.restart_window / 60.0 or 1.0
+        summary = {}
+        for name, rollup in self._stats["jobs"].items():
+            summary[name] = {"processes": rollup["processes"],
+                    "cpu": round(rollup["cpu"], 1),
+                    "rss": rollup["rss"],
+                    "restart_rate": round(rollup["restarts"] / window, 3)}
+        return summary
+
+    def restarts(self, now=None):
+        """ return the number of restarts per job in the restart window """
+        now = now or time.time()
+        limit = now - self.restart_window
+
+        restarts = {}
+        for name in list(self._exits):
+            exits = self._exits[name]
+            while exits and exits[0] < limit:
+                exits.popleft()
+
+            if not exits:
+                del self._exits[name]
+            else:
+                restarts[name] = len(exits)
+        return restarts
+
+    def _on_stop(self, evtype, msg):
+        self._stopped.add(msg['pid'])
+
+    def _on_exit(self, evtype, msg):
+        # the process has been stopped on purpose
+        if msg['pid'] in self._stopped:
+            self._stopped.discard(msg['pid'])
+            return
+
+        # committed processes are not restarted
+        if msg.get('once', False):
+            return
+
+        name = msg['name']
+        if name not in self._exits:
+            self._exits[name] = deque()
+        self._exits[name].append(time.time())
+
+    def _on_timer(self, handle):
+        if self._sampling:
+            # the last sample is still running
+            return
+
+        # collect the processes of each jobs in the loop thread, they will
+        # be sampled in the thread pool.
+        jobs = []
+        with self.manager._lock:
+            for sessionid, session in self.manager._sessions.items():
+                for name, state in session.items():
+                    processes = list(state.running)
+                    processes.extend(list(state.running_out))
+                    pprocesses = [p._pprocess for p in processes
+                            if p._pprocess is not None]
+                    jobs.append((sessionid, state.name, state.numprocesses,
+                        pprocesses))
+
+        restarts = self.restarts()
+        self._sampling = True
+        self.loop.queue_work(partial(self._sample, jobs, restarts),
+                self._on_sampled)
+
+    def _sample(self, jobs, restarts):
+        self._set_stats(self._aggregate(jobs, restarts, time.time()))
+
+    def _on_sampled(self, *args):
+        self._sampling = False
+
+    def _set_stats(self, stats):
+        self._body = json.dumps(stats)
+        self._stats = stats
+
+    def _aggregate(self, jobs, restarts, sampled_at):
+        jobs_stats = {}
+        sessions = {}
+        node = _empty_rollup()
+        node["jobs"] = 0
+
+        for sessionid, name, numprocesses, pprocesses in jobs:
+            rollup = _empty_rollup()
+            rollup["sessionid"] = sessionid
+            rollup["max_processes"] = numprocesses
+            rollup["restarts"] = restarts.get(name, 0)
+
+            for pprocess in pprocesses:
+                sample = sample_process(pprocess)
+                if sample is None:
+                    continue
+
+                cpu, rss = sample
+                rollup["processes"] += 1
+                rollup["cpu"] += cpu
+                rollup["max_cpu"] = max(rollup["max_cpu"], cpu)
+                rollup["rss"] += rss
+                rollup["max_rss"] = max(rollup["max_rss"], rss)
+
+            jobs_stats[name] = rollup
+
+            # update the session stats
+            if sessionid not in sessions:
+                sessions[sessionid] = _empty_rollup()
+                sessions[sessionid]["jobs"] = 0
+            _add_rollup(sessions[sessionid], rollup)
+            sessions[sessionid]["jobs"] += 1
+
+            # update the node stats
+            _add_rollup(node, rollup)
+            node["jobs"] += 1
+
+        return {"sampled_at": sampled_at,
+                "interval": self.interval,
+                "restart_window": self.restart_window,
+                "jobs": jobs_stats,
+                "sessions": sessions,
+                "node": node}
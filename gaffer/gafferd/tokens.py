@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -
+#
+# This file is part of gaffer. See the NOTICE for more information.
+"""
+Short-lived tokens signed with HMAC-SHA256.
+
+A token is ``<payload>.<signature>`` where the payload is the url safe
+base64 encoding of a JSON object containing an ``exp`` timestamp. Tokens are
+validated without any lookup, they can't be revoked and expire after
+``ttl`` seconds.
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+
+import six
+
+
+class InvalidToken(Exception):
+    """ exception raised when a token is malformed, has a bad signature or
+    expired """
+
+
+def _to_bytes(s):
+    if isinstance(s, six.text_type):
+        return s.encode("utf-8")
+    return s
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=')
+
+
+def _b64decode(data):
+    return base64.urlsafe_b64decode(data + b'=' * (-len(data) % 4))
+
+
+if hasattr(hmac, "compare_digest"):
+    compare_digest = hmac.compare_digest
+else:
+    def compare_digest(a, b):
+        # constant time comparaison
+        if len(a) != len(b):
+            return False
+
+        rv = 0
+        for x, y in zip(bytearray(a), bytearray(b)):
+            rv |= x ^ y
+        return rv == 0
+
+
+class TokenSigner(object):
+    """ sign and validate tokens
+
+    Args:
+
+    - **secret**: key used to sign the tokens. When it's not set a random key
+      is generated and the tokens are only valid until gafferd restarts.
+    - **ttl**: lifetime of a token in seconds
+    """
+
+    def __init__(self, secret=None, ttl=300.0):
+        if secret is None:
+            secret = os.urandom(32)
+        self.secret = _to_bytes(secret)
+        self.ttl = ttl
+
+    def sign(self, payload):
+        """ return a token for the payload (a dict) and its expiration
+        timestamp """
+        payload = payload.copy()
+        payload["exp"] = int(time.time() + self.ttl)
+
+        data = _b64encode(json.dumps(payload).encode("utf-8"))
+        token = data + b"." + _b64encode(self._signature(data))
+        return token.decode("ascii"), payload["exp"]
+
+    def verify(self, token):
+        """ return the payload of a token. Raise `InvalidToken` if the token
+        isn't valid anymore """
+        try:
+            data, signature = _to_bytes(token).split(b".", 1)
+            signature = _b64decode(signature)
+        except (ValueError, TypeError):
+            raise InvalidToken("malformed token")
+
+        if not compare_digest(signature, self._signature(data)):
+            raise InvalidToken("bad signature")
+
+        try:
+            payload = json.loads(_b64decode(data).decode("utf-8"))
+        except (ValueError, TypeError):
+            raise InvalidToken("malformed token")
+
+        if payload.get("exp", 0) < time.time():
+            raise InvalidToken("token expired")
+        return payload
+
+    def _signature(self, data):
+        return hmac.new(self.secret, data, hashlib.sha256).digest()
@@ -2,15 +2,75 @@
 #
 # This file is part of gaffer. See the NOTICE for more information.
 
+import binascii
+import hashlib
 import json
+import logging
 import os
 import sqlite3
+import time
 import uuid
 
-from ..util import bytestring, ord_
-from .pbkdf2 import pbkdf2_hex
+from .db import SqliteExecutor, run_callback
+from .keys import InvalidKey, Key, KeyCache
+from .pbkdf2 import pbkdf2_bin
+from .tokens import TokenSigner, compare_digest
 from .util import load_backend
 
+LOGGER = logging.getLogger("gaffer")
+
+# algorithm used to hash the new passwords
+PASSWORD_ALGORITHM = "PBKDF2-SHA256"
+
+
+if hasattr(hashlib, "pbkdf2_hmac"):
+    def _pbkdf2(hash_name, password, salt, iterations, keylen):
+        return hashlib.pbkdf2_hmac(hash_name, password, salt, iterations,
+                keylen)
+else:
+    def _pbkdf2(hash_name, password, salt, iterations, keylen):
+        return pbkdf2_bin(password, salt, iterations, keylen,
+                getattr(hashlib, hash_name))
+
+
+# supported algorithms: name -> (hash function, key length). "PBKDF2-256"
+# is the legacy format, hashed with SHA1.
+_ALGORITHMS = {"PBKDF2-SHA256": ("sha256", 32),
+               "PBKDF2-256": ("sha1", 24)}
+
+
+def hash_password(password, iterations=100000, salt=None,
+        algorithm=PASSWORD_ALGORITHM):
+    """ hash a password. The result is stored as
+    ``algorithm$salt:iterations$hash`` """
+    salt = salt or uuid.uuid4().hex
+    hash_name, keylen = _ALGORITHMS[algorithm]
+    hashed = binascii.hexlify(_pbkdf2(hash_name, password.encode('utf-8'),
+        salt.encode('utf-8'), iterations, keylen)).decode('utf-8')
+    return "%s$%s:%s$%s" % (algorithm, salt, iterations, hashed)
+
+
+def check_password(password, hashed):
+    """ test a password against its hash """
+    try:
+        algorithm, infos, _ = hashed.split("$", 2)
+        salt, iterations = infos.split(":")
+        expected = hash_password(password, int(iterations), salt, algorithm)
+    except (ValueError, KeyError, AttributeError):
+        return False
+    return compare_digest(expected.encode('utf-8'), hashed.encode('utf-8'))
+
+
+def needs_rehash(hashed, iterations):
+    """ test if a password should be hashed again with the current
+    parameters """
+    try:
+        algorithm, infos, _ = hashed.split("$", 2)
+        return (algorithm != PASSWORD_ALGORITHM or
+                int(infos.split(":")[1]) < iterations)
+    except (ValueError, IndexError):
+        return True
+
 
 class UserNotFound(Exception):
     """ exception raised when a user doesn't exist"""
@@ -83,6 +143,16 @@ class AuthManager(object):
         else:
             self._backend = load_backend(cfg.keys_backend)
 
+        # number of PBKDF2 iterations used to hash the passwords
+        self.iterations = cfg.password_iterations
+
+        # sign the session tokens returned by /auth
+        self.tokens = TokenSigner(cfg.token_secret, cfg.token_ttl)
+
+        # payloads and key objects of the tokens already verified
+        self._tokens_cache = KeyCache(max_size=cfg.keys_cache_size,
+                ttl=cfg.token_ttl)
+
     def __enter__(self):
         self.open()
         return self
@@ -98,6 +168,7 @@ class AuthManager(object):
 
     def close(self):
         self._backend.close()
+        self._tokens_cache.clear()
 
     def all_users(self, include_user=False):
         return self._backend.all_users(include_user=include_user)
@@ -112,23 +183,87 @@ class AuthManager(object):
                 key=key, extra=extra)
 
     def authenticate(self, username, password):
-
         try:
             user = self._backend.get_user(username)
         except UserNotFound:
             return DummyUser()
 
-        _alg, infos, password_hash = user['password'].split("$", 3)
-        salt, iterations = infos.split(":")
-
-        password_hash1 =  bytestring(pbkdf2_hex(password.encode('utf-8'),
-            salt.encode('utf-8'), iterations=int(iterations)).decode('utf-8'))
-
-        if not self._check_password(password_hash, password_hash1):
+        if not check_password(password, user['password']):
             return DummyUser()
 
+        # the password was hashed with old parameters, upgrade it
+        if needs_rehash(user['password'], self.iterations):
+            self._backend.set_password(username,
+                    self._hash_password(password))
         return User.load(user)
 
+    def authenticate_async(self, username, password, callback):
+        """ like ``authenticate`` but the password is checked in the
+        thread pool and ``callback(user, error)`` is called with the
+        authenticated user or a `DummyUser` """
+
+        def on_user(user, error):
+            if isinstance(error, UserNotFound):
+                return callback(DummyUser(), None)
+            elif error is not None:
+                return callback(None, error)
+
+            result = {}
+
+            def check():
+                if not check_password(password, user['password']):
+                    return
+
+                result['user'] = User.load(user)
+                if needs_rehash(user['password'], self.iterations):
+                    result['password'] = self._hash_password(password)
+
+            def on_checked(*args):
+                if 'user' not in result:
+                    return callback(DummyUser(), None)
+
+                if 'password' in result:
+                    self._backend.set_password_async(username,
+                            result['password'], self._on_rehashed)
+                callback(result['user'], None)
+
+            self.loop.queue_work(check, on_checked)
+
+        self._backend.get_user_async(username, on_user)
+
+    def make_token(self, user, key=None):
+        """ return a signed token for a user and the key object of its API
+        key, and the token expiration timestamp. """
+        return self.tokens.sign({"username": user.username, "key": key})
+
+    def verify_token(self, token):
+        """ return the payload of a token or raise a
+        `gaffer.gafferd.tokens.InvalidToken` error """
+        return self.tokens.verify(token)
+
+    def verify_token_key(self, token):
+        """ like ``verify_token`` but return the payload and the `Key`
+        object of the key in the token, or None if there is no key. Tokens
+        are sent with each request so they are verified once and cached
+        until they expire. """
+        cached = self._tokens_cache.get(token)
+        if cached is not None:
+            payload, key_obj = cached
+            if payload.get("exp", 0) >= time.time():
+                return payload, key_obj
+            self._tokens_cache.invalidate(token)
+
+        payload = self.tokens.verify(token)
+        key_obj = None
+        if payload.get("key"):
+            try:
+                key_obj = Key.load(payload["key"])
+            except InvalidKey:
+                pass
+
+        self._tokens_cache.set(token, (payload, key_obj))
+        return payload, key_obj
+
     def get_user(self, username):
         return self._backend.get_user(username)
 
@@ -151,6 +286,11 @@ class AuthManager(object):
     def user_by_key(self, key):
         return self._backend.get_bykey(key)
 
+    def user_by_key_async(self, key, callback):
+        """ like ``user_by_key`` but the user is passed to
+        ``callback(user, error)`` without blocking the loop """
+        self._backend.get_bykey_async(key, callback)
+
     def user_by_type(self, user_type):
         return self._backend.get_bytype(user_type)
 
@@ -160,24 +300,12 @@ class AuthManager(object):
     def has_usertype(self, user_type):
         return self._backend.has_usertype(user_type)
 
-    def _check_password(self, a, b):
-        # compare password hashes lengths
-        if len(a) != len(b):
-            return False
-
-        # do a binary comparaison of password hashes
-        rv = 0
-        for x, y in zip(a, b):
-            rv |= ord(x) ^ ord(y)
-
-        return rv == 0
-
     def _hash_password(self, password):
-        # hash the password
-        salt = uuid.uuid4().hex
-        hashed_password =  bytestring(pbkdf2_hex(password.encode('utf-8'),
-                salt.encode('utf-8')).decode('utf-8'))
-        return "PBKDF2-256$%s:%s$%s" % (salt, 1000, hashed_password)
+        return hash_password(password, self.iterations)
+
+    def _on_rehashed(self, result, error):
+        if error is not None:
+            LOGGER.error("error while upgrading a password hash: %s" % error)
 
 
 class BaseAuthHandler(object):
@@ -199,6 +327,11 @@ class BaseAuthHandler(object):
     def get_user(self, username):
         raise NotImplementedError
 
+    def get_user_async(self, username, callback):
+        """ fetch a user then call ``callback(user, error)``. By default the
+        sync method is used. """
+        run_callback(callback, self.get_user, username)
+
     def update_user(self, username, password, user_type=0, key=None,
             extra=None):
         raise NotImplementedError
@@ -206,15 +339,25 @@ class BaseAuthHandler(object):
     def set_password(self, username, password):
         raise NotImplementedError
 
+    def set_password_async(self, username, password, callback):
+        """ change the password then call ``callback(result, error)``. By
+        default the sync method is used. """
+        run_callback(callback, self.set_password, username, password)
+
     def set_key(self, username, key):
         raise NotImplementedError
 
     def delete_user(self, username):
         raise NotImplementedError
 
-    def user_bykey(self, key):
+    def get_bykey(self, key):
         raise NotImplementedError
 
+    def get_bykey_async(self, key, callback):
+        """ fetch the user of a key then call ``callback(user, error)``. By
+        default the sync method is used. """
+        run_callback(callback, self.get_bykey, key)
+
     def users_bytype(self, username):
         raise NotImplementedError
 
@@ -236,7 +379,10 @@ class BaseAuthHandler(object):
 
 
 class SqliteAuthHandler(BaseAuthHandler):
-    """ SQLITE AUTH BACKEND FOR THE AUTHENTICATION API in gaffer """
+    """ SQLITE AUTH BACKEND FOR THE AUTHENTICATION API in gaffer
+
+    Queries are run in a dedicated thread (see `gaffer.gafferd.db`).
+    """
 
     def __init__(self, loop, cfg):
         super(SqliteAuthHandler, self).__init__(loop, cfg)
@@ -246,103 +392,64 @@ class SqliteAuthHandler(BaseAuthHandler):
         if self.dbname != ":memory:":
             self.dbname = os.path.join(cfg.config_dir, self.dbname)
 
-        # intitialize conn
-        self.conn = None
+        # intitialize the executor
+        self._db = None
 
     def open(self):
-        self.conn = sqlite3.connect(self.dbname)
-        with self.conn:
-            sql = """CREATE TABLE if not exists auth (user text primary key,
-            pwd text, user_type int, key text, extra text)"""
-            self.conn.execute(sql)
+        self._db = SqliteExecutor(self.loop, self.dbname, setup=self._setup)
+        self._db.open()
 
     def close(self):
-        self.conn.commit()
-        self.conn.close()
+        self._db.close()
 
     def all_users(self, include_user=False):
-        with self.conn:
-            cur = self.conn.cursor()
-            if include_user:
-                rows = cur.execute("SELECT * FROM auth")
-                return [self._make_user(row, False) for row in rows]
-            else:
-                rows = cur.execute("SELECT user FROM auth")
-                return [row[0] for row in rows]
+        return self._db.call(self._all_users, include_user)
 
     def create_user(self, username, password, user_type=0, key=None,
             extra=None):
-        assert self.conn is not None
-        with self.conn:
-            try:
-                self.conn.execute("INSERT INTO auth VALUES(?, ?, ?, ?, ?)",
-                        [username, password, user_type, key,
-                         json.dumps(extra or {})])
-            except sqlite3.IntegrityError:
-                raise UserConflict()
+        assert self._db is not None
+        self._db.call_write(self._create_user, username, password,
+                user_type, key, extra)
 
     def get_user(self, username):
-        assert self.conn is not None
-        with self.conn:
-            cur = self.conn.cursor()
-            cur.execute("SELECT * FROM auth where user=?", [username])
-            row = cur.fetchone()
+        assert self._db is not None
+        return self._db.call(self._get_user, username)
 
-        if not row:
-            raise UserNotFound()
-
-        return self._make_user(row)
+    def get_user_async(self, username, callback):
+        assert self._db is not None
+        self._db.submit(callback, self._get_user, username)
 
     def set_password(self, username, password):
-        with self.conn:
-            cur = self.conn.cursor()
-            cur.execute("UPDATE auth SET pwd=? WHERE user=?", [password,
-                username])
+        self._db.call_write(self._update, "pwd", username, password)
+
+    def set_password_async(self, username, password, callback):
+        self._db.submit_write(callback, self._update, "pwd", username,
+                password)
 
     def set_key(self, username, key):
-        with self.conn:
-            cur = self.conn.cursor()
-            cur.execute("UPDATE auth SET key=? WHERE user=?", [key,
-                username])
+        self._db.call_write(self._update, "key", username, key)
 
     def update_user(self, username, password, user_type=0, key=None,
             extra=None):
-        assert self.conn is not None
-
-        if not self.has_user(username):
-            raise UserNotFound()
-
-        with self.conn:
-            self.conn.execute("""UPDATE auth SET pwd=?, user_type=?,
-            key=?, extra=? WHERE user=?""", [password, user_type, key,
-                json.dumps(extra or {}), username])
+        assert self._db is not None
+        self._db.call_write(self._update_user, username, password,
+                user_type, key, extra)
 
     def delete_user(self, username):
-        assert self.conn is not None
-        with self.conn:
-            cur = self.conn.cursor()
-            cur.execute("DELETE FROM auth WHERE user=?", [username])
+        assert self._db is not None
+        self._db.call_write(self._delete_user, username)
 
     def get_bytype(self, user_type):
-        assert self.conn is not None
-        with self.conn:
-            cur = self.conn.cursor()
-            rows = cur.execute("SELECT * from auth WHERE user_type=?",
-                    [user_type])
-
-            return [self._make_user(row, False) for row in rows]
+        assert self._db is not None
+        return self._db.call(self._get_bytype, user_type)
 
     def get_bykey(self, key):
-        assert self.conn is not None
-        with self.conn:
-            cur = self.conn.cursor()
-            cur.execute("SELECT * from auth WHERE key=?", [key])
-            row = cur.fetchone()
-
-            if not row:
-                raise UserNotFound()
+        assert self._db is not None
+        return self._db.call(self._get_bykey, key)
 
-            return self._make_user(row)
+    def get_bykey_async(self, key, callback):
+        assert self._db is not None
+        self._db.submit(callback, self._get_bykey, key)
 
     def has_user(self, username):
         try:
@@ -352,13 +459,69 @@ class SqliteAuthHandler(BaseAuthHandler):
         return True
 
     def has_type(self, user_type):
-        with self.conn:
-            cur = self.conn.cursor()
-            cur.execute("SELECT * from auth WHERE user_type=?", [user_type])
+        return self._db.call(self._has_type, user_type)
+
+    # functions executed in the db thread
+
+    def _setup(self, conn):
+        conn.execute("""CREATE TABLE if not exists auth (user text primary key,
+            pwd text, user_type int, key text, extra text)""")
+        conn.execute("CREATE INDEX if not exists auth_key ON auth (key)")
+
+    def _all_users(self, conn, include_user):
+        if include_user:
+            rows = conn.execute("SELECT * FROM auth")
+            return [self._make_user(row, False) for row in rows]
+
+        rows = conn.execute("SELECT user FROM auth")
+        return [row[0] for row in rows]
+
+    def _create_user(self, conn, username, password, user_type, key, extra):
+        try:
+            conn.execute("INSERT INTO auth VALUES(?, ?, ?, ?, ?)",
+                    [username, password, user_type, key,
+                     json.dumps(extra or {})])
+        except sqlite3.IntegrityError:
+            raise UserConflict()
+
+    def _get_user(self, conn, username):
+        row = conn.execute("SELECT * FROM auth where user=?",
+                [username]).fetchone()
+        if not row:
+            raise UserNotFound()
+        return self._make_user(row)
+
+    def _update(self, conn, column, username, value):
+        # column is never given by the user
+        conn.execute("UPDATE auth SET %s=? WHERE user=?" % column, [value,
+            username])
+
+    def _update_user(self, conn, username, password, user_type, key, extra):
+        cur = conn.execute("""UPDATE auth SET pwd=?, user_type=?,
+            key=?, extra=? WHERE user=?""", [password, user_type, key,
+                json.dumps(extra or {}), username])
+        if not cur.rowcount:
+            raise UserNotFound()
+
+    def _delete_user(self, conn, username):
+        conn.execute("DELETE FROM auth WHERE user=?", [username])
+
+    def _get_bytype(self, conn, user_type):
+        rows = conn.execute("SELECT * from auth WHERE user_type=?",
+                [user_type])
+        return [self._make_user(row, False) for row in rows]
+
+    def _get_bykey(self, conn, key):
+        row = conn.execute("SELECT * from auth WHERE key=?",
+                [key]).fetchone()
+        if not row:
+            raise UserNotFound()
+        return self._make_user(row)
 
-            if not cur.fetchone():
-                return False
-            return True
+    def _has_type(self, conn, user_type):
+        row = conn.execute("SELECT user from auth WHERE user_type=?",
+                [user_type]).fetchone()
+        return row is not None
 
     def _make_user(self, row, include_password=True):
         user = json.loads(row[4]) or {}
@@ -34,6 +34,7 @@ Example of usage::
 
 from .base import (GafferNotFound, GafferConflict, GafferUnauthorized,
         GafferForbidden, HTTPClient, BaseClient)
+from .pool import KeepAliveHTTPClient
 from .process import Process
 from .job import Job
 from .server import Server
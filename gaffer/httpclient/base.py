@@ -8,6 +8,7 @@ import pyuv
 from tornado import httpclient
 
 from ..tornado_pyuv import IOLoop
+from .pool import KeepAliveHTTPClient
 from .util import make_uri
 
 class GafferNotFound(Exception):
@@ -46,6 +47,10 @@ class HTTPClient(object):
         self._response = None
         self._closed = False
 
+        # the idle connections are only kept between the requests when the
+        # client owns its loop, they would keep a shared loop running
+        self._owns_loop = loop is None
+
     def __del__(self):
         self.close()
 
@@ -70,53 +75,116 @@ class HTTPClient(object):
             self._io_loop.stop()
         self._async_client.fetch(request, callback, **kwargs)
         self._io_loop.start()
+        self._maybe_close_idle()
         response = self._response
         self._response = None
         response.rethrow()
         return response
 
+    def fetch_pipelined(self, requests):
+        """ Executes a list of requests, returning the list of
+        `HTTPResponse`. GET and HEAD requests are pipelined on the same
+        connection. The async client should support pipelining.
+
+        Errors are not raised, they are set on each response.
+        """
+        def callback(responses):
+            self._response = responses
+            self._io_loop.stop()
+        self._async_client.fetch_pipelined(requests, callback)
+        self._io_loop.start()
+        self._maybe_close_idle()
+        responses = self._response
+        self._response = None
+        return responses
+
+    def _maybe_close_idle(self):
+        if not self._owns_loop:
+            close_idle = getattr(self._async_client, "close_idle", None)
+            if close_idle is not None:
+                close_idle()
+
+
 class BaseClient(object):
     """ base resource object used to abstract request call and response
-    retrieving """
+    retrieving.
+
+    Connections are kept alive and reused between requests. At most
+    ``max_connections`` connections are opened on the node. """
 
-    def __init__(self, uri, loop=None, **options):
+    def __init__(self, uri, loop=None, max_connections=10, **options):
         self.loop = loop or pyuv.Loop.default_loop()
         self.uri = uri
         self.options = options
-        self.client = HTTPClient(loop=loop)
+        self.client = HTTPClient(async_client_class=KeepAliveHTTPClient,
+                loop=loop, max_connections=max_connections)
+
+    def close(self):
+        """ close all the connections opened to the node """
+        self.client.close()
 
     def request(self, method, path, headers=None, body=None, **params):
+        url, method, headers, body = self._prepare_request(method, path,
+                headers=headers, body=body, **params)
+
+        try:
+            resp = self.client.fetch(url, method=method, headers=headers,
+                    body=body, **self.options)
+        except httpclient.HTTPError as e:
+            resp = self._handle_error(method, e)
+        return resp
+
+    def request_many(self, requests, headers=None):
+        """ execute a list of requests ``(method, path)`` at once. GET and
+        HEAD requests are pipelined on the same connection. Return the list
+        of responses, errors are raised like in :meth:`request`. """
+        to_fetch = []
+        for method, path in requests:
+            url, method, req_headers, body = self._prepare_request(method,
+                    path, headers=(headers or {}).copy())
+            to_fetch.append(httpclient.HTTPRequest(url, method=method,
+                headers=req_headers, body=body, **self.options))
+
+        responses = []
+        for req, resp in zip(to_fetch,
+                self.client.fetch_pipelined(to_fetch)):
+            try:
+                resp.rethrow()
+            except httpclient.HTTPError as e:
+                resp = self._handle_error(req.method, e)
+            responses.append(resp)
+        return responses
+
+    def _prepare_request(self, method, path, headers=None, body=None,
+            **params):
         headers = headers or {}
         headers.update({"Accept": "application/json"})
         url = make_uri(self.uri, path, **params)
         method = method.upper()
         if (body is None) and method in ("POST", "PATCH", "PUT"):
             body = ""
-
-        try:
-            resp = self.client.fetch(url, method=method, headers=headers,
-                    body=body, **self.options)
-        except httpclient.HTTPError as e:
-            if method != "HEAD":
-                # only raise on non head method since we are using head to
-                # check status and so on.
-
-                if e.code == 404:
-                    raise GafferNotFound(self.json_body(e.response))
-                elif e.code == 409:
-                    raise GafferConflict(self.json_body(e.response))
-                elif e.code == 401:
-                    raise GafferUnauthorized(self.json_body(e.response))
-                elif e.code == 403:
-                    raise GafferForbidden(self.json_body(e.response))
-                else:
-                    raise
+        return url, method, headers, body
+
+    def _handle_error(self, method, e):
+        if method != "HEAD":
+            # only raise on non head method since we are using head to
+            # check status and so on.
+
+            if e.code == 404:
+                raise GafferNotFound(self.json_body(e.response))
+            elif e.code == 409:
+                raise GafferConflict(self.json_body(e.response))
+            elif e.code == 401:
+                raise GafferUnauthorized(self.json_body(e.response))
+            elif e.code == 403:
+                raise GafferForbidden(self.json_body(e.response))
             else:
-                if e.response is not None:
-                    resp = e.response
-                else:
-                    raise
-        return resp
+                raise
+        else:
+            if e.response is not None:
+                return e.response
+            else:
+                raise
 
     def json_body(self, resp):
         respbody = resp.body.decode('utf-8')
@@ -6,13 +6,22 @@ import json
 
 from ..process import ProcessConfig
 from ..util import parse_signal_value
+from .util import TTLCache
 
 class Job(object):
-    """ Job object. Represent a remote job"""
+    """ Job object. Represent a remote job
 
-    def __init__(self, server, config=None, sessionid=None):
+    Infos fetched from the node are kept ``cache_ttl`` seconds (default to
+    the server ``cache_ttl``). The cache is emptied each time an action is
+    done on the job.
+    """
+
+    def __init__(self, server, config=None, sessionid=None, cache_ttl=None):
         self.server = server
         self.sessionid = sessionid or 'default'
+        if cache_ttl is None:
+            cache_ttl = getattr(server, "cache_ttl", None)
+        self._cache = TTLCache(cache_ttl)
         if not isinstance(config, ProcessConfig):
             self.name = config
             self._config = None
@@ -38,11 +47,11 @@ class Job(object):
     @property
     def active(self):
         """ return True if the process is active """
-        resp = self.server.request("get", "/jobs/%s/%s/state" % (
-            self.sessionid, self.name))
-        if resp.body == b'1':
-            return True
-        return False
+        def fetch():
+            resp = self.server.request("get", "/jobs/%s/%s/state" % (
+                self.sessionid, self.name))
+            return resp.body == b'1'
+        return self._cache.get("active", fetch)
 
     @property
     def running(self):
@@ -66,16 +75,23 @@ class Job(object):
     @property
     def pids(self):
         """ return a list of running pids """
-        resp = self.server.request("get", "/jobs/%s/%s/pids" % (
-            self.sessionid, self.name))
-        result = self.server.json_body(resp)
-        return result['pids']
+        def fetch():
+            resp = self.server.request("get", "/jobs/%s/%s/pids" % (
+                self.sessionid, self.name))
+            return self.server.json_body(resp)['pids']
+        return self._cache.get("pids", fetch)
 
     def info(self):
         """ return the process info dict """
-        resp = self.server.request("get", "/jobs/%s/%s" % (self.sessionid,
-            self.name))
-        return self.server.json_body(resp)
+        def fetch():
+            resp = self.server.request("get", "/jobs/%s/%s" % (self.sessionid,
+                self.name))
+            return self.server.json_body(resp)
+        return self._cache.get("info", fetch)
+
+    def invalidate(self):
+        """ empty the cache of the job infos """
+        self._cache.clear()
 
     def stats(self):
         """ Return the template stats
@@ -87,23 +103,27 @@ class Job(object):
 
     def start(self):
         """ start the process if not started, spawn new processes """
+        self.invalidate()
         self.server.request("post", "/jobs/%s/%s/state" % (self.sessionid,
             self.name), body="1")
         return True
 
     def stop(self):
         """ stop the process """
+        self.invalidate()
         self.server.request("post", "/jobs/%s/%s/state" % (self.sessionid,
             self.name), body="0")
         return True
 
     def restart(self):
         """ restart the process """
+        self.invalidate()
         self.server.request("post", "/jobs/%s/%s/state" % (self.sessionid,
             self.name), body="2")
         return True
 
     def scale(self, num=1):
+        self.invalidate()
         body = json.dumps({"scale": num})
         resp = self.server.request("post", "/jobs/%s/%s/numprocesses" % (
             self.sessionid, self.name), body=body)
@@ -115,6 +135,7 @@ class Job(object):
         """ Like ``scale(1) but the process won't be kept alived at the end.
         It is also not handled uring scaling or reaping. """
 
+        self.invalidate()
         env = env or {}
         body = json.dumps({"graceful_timeout": graceful_timeout, "env": env})
         resp = self.server.request("post", "/jobs/%s/%s/commit" % (
@@ -129,6 +150,7 @@ class Job(object):
         # in the server.
         signum =  parse_signal_value(sig)
 
+        self.invalidate()
         body = json.dumps({"signal": signum})
         self.server.request("post", "/jobs/%s/%s/signal" % (self.sessionid,
             self.name), body=body)
@@ -50,6 +50,11 @@ class Keys(object):
     def delete_key(self, key):
         self.server.request("delete", "/keys/%s" % key)
 
+    def cache_stats(self):
+        """ get the size and the hit/miss counters of the node keys cache """
+        resp = self.server.request("get", "/keys/_cache")
+        return self.server.json_body(resp)
+
     def has_key(self, key):
         try:
             self.server.request("head", "/keys/%s" % key)
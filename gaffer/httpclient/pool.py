@@ -0,0 +1,537 @@
+# -*- coding: utf-8 -
+#
+# This file is part of gaffer. See the NOTICE for more information.
+"""
+Keep-alive HTTP client used by the gaffer HTTP clients.
+
+Connections are kept open and reused between requests in a pool per host.
+Idempotent requests can be pipelined on a single connection: all the
+requests are written at once and responses are read in order.
+"""
+
+from collections import deque
+from io import BytesIO
+import functools
+import logging
+import select
+import socket
+import ssl
+import time
+
+from tornado import httpclient, iostream
+from tornado.escape import native_str, utf8
+from tornado.httputil import HTTPHeaders
+try:
+    from tornado.simple_httpclient import (_DEFAULT_CA_CERTS,
+            match_hostname, CertificateError)
+except ImportError:
+    # moved to netutil in later tornado versions
+    from tornado.simple_httpclient import _DEFAULT_CA_CERTS
+    from tornado.netutil import (ssl_match_hostname as match_hostname,
+            SSLCertificateError as CertificateError)
+
+from ..util import urlparse, unquote
+
+LOGGER = logging.getLogger("gaffer")
+
+# methods that can be safely retried or pipelined
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+PIPELINE_METHODS = ("GET", "HEAD")
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def _connection_key(request):
+    url = urlparse(request.url)
+    if url.scheme == "http+unix":
+        # the host is the quoted path of the unix socket
+        return (url.scheme, unquote(url.netloc), None)
+
+    port = url.port or DEFAULT_PORTS.get(url.scheme, 80)
+    return (url.scheme, url.hostname, port)
+
+
+def _ssl_options(request):
+    options = {}
+    # verify the certificate of the server like the tornado client does
+    if getattr(request, "validate_cert", True):
+        options["cert_reqs"] = ssl.CERT_REQUIRED
+        options["ca_certs"] = _DEFAULT_CA_CERTS
+
+    if getattr(request, "ca_certs", None) is not None:
+        options["ca_certs"] = request.ca_certs
+    if getattr(request, "client_key", None) is not None:
+        options["keyfile"] = request.client_key
+    if getattr(request, "client_cert", None) is not None:
+        options["certfile"] = request.client_cert
+    return options
+
+
+class _PendingRequest(object):
+
+    def __init__(self, request, callback):
+        self.request = request
+        self.callback = callback
+        self.start_time = time.time()
+        self.attempts = 0
+
+        # sent on a connection already used and no response received yet
+        self.reused = False
+        self.answered = False
+
+
+class HTTPConnection(object):
+    """ a keep-alive connection to an HTTP server. Requests sent on the
+    connection are answered in order. """
+
+    def __init__(self, pool, key, ssl_options=None):
+        self.pool = pool
+        self.key = key
+        self.io_loop = pool.io_loop
+        self.scheme, self.host, self.port = key
+
+        self.pending = deque()
+        self.reused = False
+        self.closed = False
+        self.connected = False
+        self.idle_since = None
+        self._reading = False
+        self._timeout = None
+        self._chunks = None
+        self._validate_cert = (ssl_options or {}).get("cert_reqs") == \
+                ssl.CERT_REQUIRED
+
+        # the requests are written once the connection is established and
+        # the certificate of the server has been checked
+        self._outgoing = []
+
+        if self.scheme == "http+unix":
+            self.stream = iostream.IOStream(socket.socket(socket.AF_UNIX),
+                    io_loop=self.io_loop)
+        elif self.scheme == "https":
+            self.stream = iostream.SSLIOStream(socket.socket(),
+                    io_loop=self.io_loop, ssl_options=ssl_options or {})
+        else:
+            self.stream = iostream.IOStream(socket.socket(),
+                    io_loop=self.io_loop)
+        self.stream.set_close_callback(self._on_close)
+        if self.port is None:
+            self.stream.connect(self.host, self._on_connect)
+        else:
+            self.stream.connect((self.host, self.port), self._on_connect)
+
+    @property
+    def busy(self):
+        return len(self.pending) > 0
+
+    def send(self, pending):
+        """ write a request on the connection """
+        request = pending.request
+        url = urlparse(request.url)
+        path = url.path or "/"
+        if url.query:
+            path += "?%s" % url.query
+
+        headers = HTTPHeaders()
+        if request.headers:
+            for k, v in request.headers.items():
+                headers[k] = v
+
+        if "Host" not in headers:
+            if self.port is None:
+                headers["Host"] = "localhost"
+            elif self.port == DEFAULT_PORTS.get(self.scheme):
+                headers["Host"] = self.host
+            else:
+                headers["Host"] = "%s:%s" % (self.host, self.port)
+        headers["Connection"] = "keep-alive"
+
+        body = request.body
+        if body is not None:
+            body = utf8(body)
+            headers["Content-Length"] = str(len(body))
+
+        lines = ["%s %s HTTP/1.1" % (request.method, path)]
+        lines.extend(["%s: %s" % (k, v) for k, v in headers.items()])
+        data = utf8("\r\n".join(lines) + "\r\n\r\n")
+        if body:
+            data += body
+
+        pending.attempts += 1
+        pending.reused = self.reused
+        pending.answered = False
+        self.pending.append(pending)
+        if self.connected:
+            self.stream.write(data)
+        else:
+            self._outgoing.append(data)
+
+        if not self._reading:
+            self._read_response()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.stream.close()
+
+    def set_idle(self, idle):
+        """ an idle connection doesn't keep the loop of the caller
+        running """
+        self.idle_since = time.time() if idle else None
+        ref_handler = getattr(self.io_loop, "ref_handler", None)
+        if ref_handler is not None and self.stream.socket is not None:
+            ref_handler(self.stream.socket.fileno(), not idle)
+
+    def is_stale(self):
+        """ an idle connection is stale when the server closed it. The
+        loop of a blocking client isn't running between the requests, so
+        the close is only noticed by polling the socket. """
+        sock = self.stream.socket
+        if self.closed or sock is None:
+            return True
+
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (select.error, ValueError, socket.error):
+            return True
+        # nothing is expected from the server, it closed the connection
+        return len(readable) > 0
+
+    def _on_connect(self):
+        if self.scheme == "https" and self._validate_cert:
+            try:
+                match_hostname(self.stream.socket.getpeercert(), self.host)
+            except CertificateError as e:
+                self._fail_all(httpclient.HTTPError(599, str(e)),
+                        retry=False)
+                return
+
+        self.connected = True
+        outgoing, self._outgoing = self._outgoing, []
+        for data in outgoing:
+            self.stream.write(data)
+
+    def _read_response(self):
+        self._reading = True
+        self._set_timeout()
+        self.stream.read_until(b"\r\n\r\n", self._on_headers)
+
+    def _set_timeout(self):
+        self._clear_timeout()
+        request = self.pending[0].request
+        timeout = getattr(request, "request_timeout", None)
+        if timeout:
+            self._timeout = self.io_loop.add_timeout(time.time() + timeout,
+                    self._on_timeout)
+
+    def _clear_timeout(self):
+        if self._timeout is not None:
+            self.io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+
+    def _on_timeout(self):
+        self._timeout = None
+        self._fail_all(httpclient.HTTPError(599, "Timeout"), retry=False)
+
+    def _on_headers(self, data):
+        data = native_str(data.decode("latin1"))
+        first_line, _, header_data = data.partition("\n")
+        parts = first_line.split(None, 2)
+        self._version = parts[0]
+        self._code = int(parts[1])
+        self._headers = HTTPHeaders.parse(header_data)
+        self.pending[0].answered = True
+
+        method = self.pending[0].request.method
+        if (method == "HEAD" or self._code in (204, 304) or
+                100 <= self._code < 200):
+            self._on_body(b"")
+        elif self._headers.get("Transfer-Encoding", "").lower() == "chunked":
+            self._chunks = []
+            self.stream.read_until(b"\r\n", self._on_chunk_length)
+        elif "Content-Length" in self._headers:
+            self.stream.read_bytes(int(self._headers["Content-Length"]),
+                    self._on_body)
+        else:
+            # no length, the body ends with the connection
+            self._headers["Connection"] = "close"
+            self.stream.read_until_close(self._on_body)
+
+    def _on_chunk_length(self, data):
+        length = int(data.strip().split(b";")[0], 16)
+        if length == 0:
+            # we ignore the trailers
+            self.stream.read_until(b"\r\n", self._on_last_chunk)
+        else:
+            self.stream.read_bytes(length + 2, self._on_chunk_data)
+
+    def _on_chunk_data(self, data):
+        self._chunks.append(data[:-2])
+        self.stream.read_until(b"\r\n", self._on_chunk_length)
+
+    def _on_last_chunk(self, data):
+        body = b"".join(self._chunks)
+        self._chunks = None
+        self._on_body(body)
+
+    def _on_body(self, data):
+        self._clear_timeout()
+        pending = self.pending.popleft()
+
+        response = httpclient.HTTPResponse(pending.request, self._code,
+                headers=self._headers, buffer=BytesIO(data),
+                effective_url=pending.request.url,
+                request_time=time.time() - pending.start_time)
+
+        # can we keep the connection alive?
+        connection = self._headers.get("Connection", "").lower()
+        if self._version == "HTTP/1.0":
+            keep_alive = connection == "keep-alive"
+        else:
+            keep_alive = connection != "close"
+
+        if not keep_alive:
+            # the server will close the connection, others pending requests
+            # will be sent again on a new connection
+            self._reading = False
+            self._fail_all(httpclient.HTTPError(599, "Connection closed"))
+            self.close()
+        elif self.pending:
+            self._read_response()
+        else:
+            self._reading = False
+            self.pool.release(self)
+
+        self._run_callback(pending.callback, response)
+
+    def _on_close(self):
+        self.closed = True
+        self._clear_timeout()
+        self.pool.discard(self)
+
+        error = (getattr(self.stream, "error", None) or
+                httpclient.HTTPError(599, "Connection closed"))
+        self._fail_all(error)
+
+    def _fail_all(self, error, retry=True):
+        while self.pending:
+            pending = self.pending.popleft()
+
+            # the request can be safely sent again on a new connection. Any
+            # request can be sent again when the connection was reused and
+            # closed before answering, the server closed it while idle.
+            if (retry and pending.attempts < 2 and
+                    (pending.request.method in IDEMPOTENT_METHODS or
+                        (pending.reused and not pending.answered))):
+                self.pool.fetch_pending(pending)
+                continue
+
+            if not isinstance(error, httpclient.HTTPError):
+                error = httpclient.HTTPError(599, str(error))
+
+            response = httpclient.HTTPResponse(pending.request, 599,
+                    error=error, request_time=time.time() - pending.start_time)
+            self._run_callback(pending.callback, response)
+
+        if not self.closed:
+            self.close()
+
+    def _run_callback(self, callback, response):
+        try:
+            callback(response)
+        except Exception:
+            LOGGER.error("Uncaught exception in fetch callback",
+                    exc_info=True)
+
+
+class ConnectionPool(object):
+    """ pool of keep-alive connections per host
+
+    Args:
+
+    - **io_loop**: tornado IOLoop used by the connections
+    - **max_connections**: maximum number of connections opened per host.
+      Requests are queued when all connections are busy.
+    - **idle_timeout**: idle connections older than this number of seconds
+      are closed instead of being reused.
+    """
+
+    def __init__(self, io_loop, max_connections=10, idle_timeout=30.0):
+        self.io_loop = io_loop
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+
+        self._connections = {}
+        self._idle = {}
+        self._waiting = {}
+        self.closed = False
+
+    def fetch(self, request, callback):
+        """ fetch a request using a connection of the pool """
+        self.fetch_pending(_PendingRequest(request, callback))
+
+    def fetch_pipelined(self, requests, callback):
+        """ fetch a list of requests. GET and HEAD requests are pipelined
+        on the same connection, others are sent as usual. The callback
+        receive the list of responses in the order of the requests. """
+        if not requests:
+            return callback([])
+
+        responses = [None] * len(requests)
+        remaining = [len(requests)]
+
+        def on_response(i, response):
+            responses[i] = response
+            remaining[0] -= 1
+            if not remaining[0]:
+                callback(responses)
+
+        pipelined = []
+        for i, request in enumerate(requests):
+            pending = _PendingRequest(request,
+                    functools.partial(on_response, i))
+            if request.method in PIPELINE_METHODS:
+                pipelined.append(pending)
+            else:
+                self.fetch_pending(pending)
+
+        if pipelined:
+            conn = self._get_connection(_connection_key(pipelined[0].request),
+                    pipelined[0].request, force=True)
+            for pending in pipelined:
+                if _connection_key(pending.request) == conn.key:
+                    conn.send(pending)
+                else:
+                    self.fetch_pending(pending)
+
+    def fetch_pending(self, pending):
+        if self.closed:
+            # don't open new connections once the pool is closed, the
+            # requests failing on close aren't retried
+            response = httpclient.HTTPResponse(pending.request, 599,
+                    error=httpclient.HTTPError(599, "Client closed"),
+                    request_time=time.time() - pending.start_time)
+            self.io_loop.add_callback(functools.partial(pending.callback,
+                response))
+            return
+
+        key = _connection_key(pending.request)
+        conn = self._get_connection(key, pending.request)
+        if conn is None:
+            # all connections are busy, wait for one
+            self._waiting.setdefault(key, deque()).append(pending)
+            return
+        conn.send(pending)
+
+    def release(self, conn):
+        """ put back a connection in the pool once all its requests have
+        been answered """
+        if conn.closed:
+            return
+
+        waiting = self._waiting.get(conn.key)
+        if waiting:
+            conn.reused = True
+            conn.send(waiting.popleft())
+            return
+
+        conn.set_idle(True)
+        self._idle.setdefault(conn.key, deque()).append(conn)
+
+    def discard(self, conn):
+        """ remove a closed connection from the pool """
+        conns = self._connections.get(conn.key, [])
+        if conn in conns:
+            conns.remove(conn)
+
+        idle = self._idle.get(conn.key, [])
+        if conn in idle:
+            idle.remove(conn)
+
+        # a slot is available, start a connection for a waiting request
+        waiting = self._waiting.get(conn.key)
+        if waiting:
+            self.fetch_pending(waiting.popleft())
+
+    def close(self):
+        """ close all the connections """
+        self.closed = True
+        waiting, self._waiting = self._waiting, {}
+        for queue in waiting.values():
+            for pending in queue:
+                self.fetch_pending(pending)
+
+        for conns in list(self._connections.values()):
+            for conn in list(conns):
+                conn.close()
+
+        self._connections = {}
+        self._idle = {}
+
+    def close_idle(self):
+        """ close the idle connections """
+        idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def _get_connection(self, key, request, force=False):
+        # reuse the last idle connection
+        idle = self._idle.get(key)
+        now = time.time()
+        while idle:
+            conn = idle.pop()
+            if conn.closed:
+                continue
+
+            if (now - conn.idle_since > self.idle_timeout or
+                    conn.is_stale()):
+                conn.close()
+                continue
+
+            conn.reused = True
+            conn.set_idle(False)
+            return conn
+
+        conns = self._connections.setdefault(key, [])
+        if len(conns) >= self.max_connections and not force:
+            return None
+
+        conn = HTTPConnection(self, key, ssl_options=_ssl_options(request))
+        conns.append(conn)
+        return conn
+
+
+class KeepAliveHTTPClient(object):
+    """ non-blocking HTTP client reusing connections. It can be used in
+    place of tornado ``AsyncHTTPClient`` """
+
+    def __init__(self, io_loop, max_connections=10, idle_timeout=30.0,
+            **defaults):
+        self.io_loop = io_loop
+        self.defaults = defaults
+        self.pool = ConnectionPool(io_loop, max_connections=max_connections,
+                idle_timeout=idle_timeout)
+
+    def close(self):
+        self.pool.close()
+
+    def close_idle(self):
+        self.pool.close_idle()
+
+    def fetch(self, request, callback, **kwargs):
+        request = self._make_request(request, **kwargs)
+        self.pool.fetch(request, callback)
+
+    def fetch_pipelined(self, requests, callback):
+        """ fetch a list of requests, see
+        :meth:`ConnectionPool.fetch_pipelined` """
+        requests = [self._make_request(req) for req in requests]
+        self.pool.fetch_pipelined(requests, callback)
+
+    def _make_request(self, request, **kwargs):
+        if not isinstance(request, httpclient.HTTPRequest):
+            options = self.defaults.copy()
+            options.update(kwargs)
+            request = httpclient.HTTPRequest(url=request, **options)
+        return request
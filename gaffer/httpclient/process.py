@@ -6,14 +6,20 @@ import json
 
 from ..util import (is_ssl, parse_ssl_options, parse_signal_value)
 from .websocket import IOChannel
-from .util import make_uri
+from .util import make_uri, TTLCache
 
 class Process(object):
-    """ Process Id object. It represent a pid """
+    """ Process Id object. It represent a pid
 
-    def __init__(self, server, pid):
+    Stats and status fetched from the node are kept ``cache_ttl`` seconds
+    (default to the server ``cache_ttl``). """
+
+    def __init__(self, server, pid, cache_ttl=None):
         self.server = server
         self.pid = pid
+        if cache_ttl is None:
+            cache_ttl = getattr(server, "cache_ttl", None)
+        self._cache = TTLCache(cache_ttl)
 
         # get info
         resp = server.request("get", "/%s" % pid)
@@ -32,19 +38,21 @@ class Process(object):
     @property
     def active(self):
         """ return True if the process is active """
-        resp = self.server.request("head", "/%s" % self.pid)
-        if resp.code == 200:
-            return True
-        return False
+        def fetch():
+            resp = self.server.request("head", "/%s" % self.pid)
+            return resp.code == 200
+        return self._cache.get("active", fetch)
 
     @property
     def stats(self):
-        resp = self.server.request("get", "/%s/stats" % self.pid)
-        obj = self.server.json_body(resp)
-        return obj['stats']
+        def fetch():
+            resp = self.server.request("get", "/%s/stats" % self.pid)
+            return self.server.json_body(resp)['stats']
+        return self._cache.get("stats", fetch)
 
     def stop(self):
         """ stop the process """
+        self._cache.clear()
         self.server.request("delete", "/%s" % self.pid)
         return True
 
@@ -56,6 +64,7 @@ class Process(object):
         signum =  parse_signal_value(sig)
 
         # make the request
+        self._cache.clear()
         body = json.dumps({"signal": signum})
         headers = {"Content-Type": "application/json"}
         self.server.request("post", "/%s/signal" % self.pid, body=body,
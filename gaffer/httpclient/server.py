@@ -10,17 +10,24 @@ from ..util import is_ssl, parse_ssl_options
 from .base import  BaseClient
 from .process import Process
 from .job import Job
-from .util import make_uri
+from .util import make_uri, make_batch
 from .websocket import GafferSocket
 
 
 class Server(BaseClient):
     """ Server, main object to connect to a gaffer node. Most of the
-    calls are blocking. (but running in the loop) """
+    calls are blocking. (but running in the loop)
 
-    def __init__(self, uri, loop=None, api_key=None, **options):
+    ``cache_ttl`` is the number of seconds the `Job` and `Process` objects
+    returned by the server keep the informations fetched from the node. By
+    default nothing is cached. """
+
+    def __init__(self, uri, loop=None, api_key=None, cache_ttl=None,
+            **options):
         super(Server, self).__init__(uri, loop=loop, **options)
         self.api_key = api_key
+        self.auth_token = None
+        self.cache_ttl = cache_ttl
 
     def request(self, method, path, headers=None, body=None, **params):
         headers = headers or {}
@@ -32,6 +39,14 @@ class Server(BaseClient):
         return super(Server, self).request(method, path, headers=headers,
                 body=body, **params)
 
+    def request_many(self, requests, headers=None):
+        headers = headers or {}
+        # if we have an api key, pass it to the headers
+        if self.api_key is not None:
+            headers['X-Api-Key'] = self.api_key
+
+        return super(Server, self).request_many(requests, headers=headers)
+
     def authenticate(self, username, password):
         """ authenticate against a gafferd node to retrieve an api key """
         # set the basic auth header
@@ -42,8 +57,11 @@ class Server(BaseClient):
         # make the request
         resp = self.request("get", "/auth", headers=headers)
 
-        # set the server api key
-        self.api_key = self.json_body(resp)["api_key"]
+        # set the server api key. The signed token can be passed in the
+        # X-Auth-Token header until it expires.
+        obj = self.json_body(resp)
+        self.api_key = obj["api_key"]
+        self.auth_token = obj.get("token")
 
         # return the api key. useful for clients that store it for later.
         return self.api_key
@@ -78,12 +96,25 @@ class Server(BaseClient):
 
         return self.json_body(resp)["jobs"]
 
+    def snapshot(self):
+        """ get all sessions, jobs, pids and their counts at once """
+        resp = self.request("get", "/snapshot")
+        return self.json_body(resp)
+
     def jobs_walk(self, callback, sessionid=None):
         jobs = self.jobs(sessionid)
         for job in jobs:
             sessionid, name = self._parse_name(job)
             callback(self, Job(self, config=name, sessionid=sessionid))
 
+    def jobs_info(self, sessionid=None):
+        """ get the info of all jobs. Requests are pipelined on the same
+        connection """
+        jobs = self.jobs(sessionid)
+        requests = [("get", "/jobs/%s/%s" % self._parse_name(job))
+                for job in jobs]
+        return [self.json_body(resp) for resp in self.request_many(requests)]
+
     def job_exists(self, name):
         sessionid, name = self._parse_name(name)
         resp = self.request("head", "/jobs/%s/%s" % (sessionid, name))
@@ -149,6 +180,19 @@ class Server(BaseClient):
     def get_process(self, pid):
         return Process(server=self, pid=pid)
 
+    def batch(self, commands):
+        """ execute a list of commands in one request. A command is either a
+        dict ``{"name": ..., "args": [...], "kwargs": {...}}`` or a sequence
+        ``(name, arg1, arg2, ...)``. Commands are the one accepted by the
+        ``gaffer.controller.Controller``.
+
+        Return the list of results. Each result is a dict containing either
+        a `result` or an `error` key. """
+        headers = {"Content-Type": "application/json" }
+        body = json.dumps({"commands": make_batch(commands)})
+        resp = self.request("post", "/batch", body=body, headers=headers)
+        return self.json_body(resp)['results']
+
     def socket(self, heartbeat=None):
         """ return a direct websocket connection to gaffer """
         url0 =  make_uri(self.uri, '/channel/websocket')
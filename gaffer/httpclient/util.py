@@ -2,6 +2,8 @@
 #
 # This file is part of gaffer. See the NOTICE for more information.
 
+import time
+
 import six
 
 from ..util import quote, quote_plus
@@ -93,3 +95,53 @@ def make_uri(base, *args, **kwargs):
         retval.extend(['?', params_str])
 
     return ''.join(retval)
+
+
+def unix_uri(path):
+    """ return the uri used to connect to a node listening on the unix
+    socket ``path`` """
+    return "http+unix://%s" % quote(path, safe='')
+
+
+def make_batch(commands):
+    """ build the list of commands sent in a batch. A command can be a dict
+    containing the keys `name`, `args` and `kwargs` or a sequence
+    ``(name, arg1, arg2, ...)`` """
+    batch = []
+    for cmd in commands:
+        if isinstance(cmd, dict):
+            obj = {"name": cmd['name'], "args": list(cmd.get('args', ())),
+                    "kwargs": cmd.get('kwargs', {})}
+        else:
+            obj = {"name": cmd[0], "args": list(cmd[1:]), "kwargs": {}}
+        batch.append(obj)
+    return batch
+
+
+class TTLCache(object):
+    """ a small cache used to keep the responses of a remote resource for a
+    short time. Entries expire after ``ttl`` seconds. The cache is disabled
+    when ``ttl`` is 0 or None. """
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self._entries = {}
+
+    def get(self, key, fetch):
+        """ get the value for the key, the value is fetched by calling
+        ``fetch`` if it isn't in the cache or expired """
+        if not self.ttl:
+            return fetch()
+
+        now = time.time()
+        if key in self._entries:
+            value, expires = self._entries[key]
+            if expires > now:
+                return value
+
+        value = fetch()
+        self._entries[key] = (value, now + self.ttl)
+        return value
+
+    def clear(self):
+        self._entries = {}
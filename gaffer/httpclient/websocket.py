@@ -31,6 +31,7 @@ from ..events import EventEmitter
 from ..message import (Message, decode_frame, FRAME_ERROR_TYPE,
         FRAME_RESPONSE_TYPE, FRAME_MESSAGE_TYPE)
 from ..util import urlparse, ord_
+from .util import make_batch
 
 # The initial handshake over HTTP.
 WS_INIT = """\
@@ -118,6 +119,7 @@ class WebSocket(object):
 
     def start(self):
         # start the stream
+        self.stream.set_close_callback(self._on_stream_close)
         self.stream.connect((self.host, self.port), self._on_connect)
 
 
@@ -295,6 +297,13 @@ class WebSocket(object):
         if not self.client_terminated:
             self._receive_frame()
 
+    def _on_stream_close(self):
+        # the connection has been lost or couldn't be established
+        self._started = False
+        self.client_terminated = True
+        self.server_terminated = True
+        self._async_callback(self.on_close)()
+
     def _abort(self):
         """Instantly aborts the WebSocket connection by closing the socket"""
         self.client_terminated = True
@@ -530,6 +539,21 @@ class GafferSocket(WebSocket):
         # return the command object
         return cmd
 
+    def send_batch(self, commands):
+        """ send a list of commands in one message. The result of the
+        returned command is the list of results of each commands """
+        # register a new command
+        cmd = GafferCommand("batch", *make_batch(commands))
+        self.commands[cmd.identity] = cmd
+
+        # send the batch
+        data = {"identity": cmd.identity, "commands": cmd.args}
+        msg = {"event": "CMD_BATCH", "data": data}
+        self.write_message(json.dumps(msg))
+
+        # return the command object
+        return cmd
+
     def bind(self, event, callback):
         """ bind to a global event """
         self._emitter.subscribe(event, callback)
@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -
+#
+# This file is part of gaffer. See the NOTICE for more information.
+"""
+State journal, so gafferd can be restarted without restarting the processes
+it manages.
+
+The journal is a gaffer application writing the jobs and their processes
+(job configs, internal pid -> OS pid, session and number of processes) in a
+JSON file each time they change. On start the manager loads the jobs of the
+journal and adopts the processes still running, see
+:meth:`gaffer.manager.Manager.restore`.
+
+When a holder path is given, our ends of the stdio pipes of the processes
+are kept by a helper process (see :mod:`gaffer.fdholder`), so the outputs
+are still redirected after the adoption. The listening sockets of the
+manager are kept the same way, so the adopted processes and the new ones
+share them.
+
+A clean stop of the manager stops the processes and removes the journal. A
+manager stopped with ``keep_processes`` or a crash leave the processes
+running::
+
+    from gaffer.journal import StateJournal
+
+    journal = StateJournal("/var/lib/gaffer/state.json")
+    manager = Manager()
+    manager.start(apps=[journal])
+    journal.restore()
+"""
+
+import json
+import logging
+import os
+import socket
+import sys
+import tempfile
+import threading
+
+import pyuv
+
+from .error import ProcessNotFound
+from .fdholder import FdHolderClient, HAS_SCM_RIGHTS
+
+LOGGER = logging.getLogger("gaffer")
+
+# version of the journal format
+JOURNAL_VERSION = 1
+
+# events changing the journal
+JOURNAL_EVENTS = ("load", "unload", "update", "start", "stop", "spawn",
+        "adopt", "reap", "stop_process", "exit", "add_socket",
+        "remove_socket")
+
+
+class StateJournal(object):
+    """ gaffer application writing the state of the manager
+
+    Args:
+
+    - **path**: path of the journal
+    - **holder**: path of the unix socket of the holder of the stdio pipes,
+      the pipes are not kept when None
+    - **write_delay**: delay in seconds used to write the changes made
+      at the same time in one write
+    """
+
+    def __init__(self, path, holder=None, write_delay=0.05):
+        self.path = path
+        self.write_delay = write_delay
+
+        self.holder = None
+        if holder is not None:
+            if HAS_SCM_RIGHTS:
+                self.holder = FdHolderClient(holder)
+            else:
+                LOGGER.warning("JOURNAL: passing file descriptors isn't "
+                        "supported, the outputs of the adopted processes "
+                        "won't be redirected")
+
+        self._timer = None
+        self._writing = False
+
+        # sequence of the captures, a write never replaces the journal
+        # written from a newer capture
+        self._seq = 0
+        self._written_seq = 0
+        self._write_lock = threading.Lock()
+        self._dirty = False
+        self._detached = False
+        self.active = False
+
+    def start(self, loop, manager):
+        self.loop = loop
+        self.manager = manager
+        self._timer = pyuv.Timer(loop)
+        self.manager.events.subscribe(".", self._on_event)
+        self.active = True
+
+        if self.holder is not None:
+            # spawn the holder and wait for it now, so the requests done
+            # on the events don't block the loop
+            try:
+                self.holder.connect()
+            except socket.error as e:
+                LOGGER.error("JOURNAL: error connecting to the holder: %s" %
+                        str(e))
+
+    def stop(self):
+        if not self.active:
+            return
+        self.active = False
+        self.manager.events.unsubscribe(".", self._on_event)
+        self._timer.close()
+
+        if self._detached:
+            # the journal belongs to the new gafferd
+            pass
+        elif self.manager.keep_processes:
+            self._write(self._capture(), self._next_seq())
+        else:
+            # the processes have been stopped, there is nothing to adopt
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+            if self.holder is not None:
+                try:
+                    for key in self.holder.keys():
+                        if key.startswith("socket:"):
+                            self.holder.remove(key)
+                except socket.error:
+                    pass
+
+        if self.holder is not None:
+            self.holder.close()
+
+    def restart(self):
+        # the journal is written on each change
+        return
+
+    def detach(self):
+        """ stop writing the journal, another gafferd took over """
+        self._detached = True
+        self.manager.events.unsubscribe(".", self._on_event)
+
+    def load(self):
+        """ return the state saved in the journal or None """
+        if not os.path.exists(self.path):
+            return None
+
+        with open(self.path) as f:
+            try:
+                data = json.load(f)
+            except ValueError:
+                LOGGER.error("JOURNAL: invalid journal %r" % self.path)
+                return None
+
+        if data.get("version") != JOURNAL_VERSION:
+            return None
+        return data["state"]
+
+    def restore(self):
+        """ load the jobs of the journal in the manager and adopt their
+        processes. Return the OS pids of the processes adopted. """
+        state = self.load()
+        if state is None:
+            return []
+
+        fds = {}
+        if self.holder is not None:
+            try:
+                for job in state.get("jobs", []):
+                    for info in job["processes"]:
+                        os_pid = info["os_pid"]
+                        fds[os_pid] = self.holder.get(os_pid)
+
+                for settings in state.get("sockets", []):
+                    key = "socket:%s" % settings["name"]
+                    fds[key] = self.holder.get(key)
+            except socket.error as e:
+                LOGGER.error("JOURNAL: error getting the pipes: %s" % str(e))
+
+        adopted = self.manager.restore(state, fds)
+        LOGGER.info("JOURNAL: %s processes adopted" % len(adopted))
+
+        # close the pipes not used and forget the exited processes. The
+        # sockets restored are owned by the manager now.
+        for key, pipes in fds.items():
+            if key not in adopted and not self._is_socket(key):
+                for fd in pipes:
+                    os.close(fd)
+
+        if self.holder is not None:
+            try:
+                for key in self.holder.keys():
+                    if self._is_socket(key):
+                        continue
+                    if int(key) not in adopted:
+                        self.holder.remove(key)
+            except socket.error:
+                pass
+
+        self._schedule()
+        return adopted
+
+    ### private functions
+
+    def _is_socket(self, key):
+        return (isinstance(key, str) and key.startswith("socket:") and
+                key[7:] in self.manager.sockets)
+
+    def _capture(self):
+        return json.dumps({"version": JOURNAL_VERSION,
+            "state": self.manager.dump_state()})
+
+    def _next_seq(self):
+        self._seq += 1
+        return self._seq
+
+    def _write(self, data, seq):
+        # write the journal atomically. The final write done on stop can
+        # run while a write is still running in the thread pool, each one
+        # uses its own temporary file.
+        fd, tmp_path = tempfile.mkstemp(prefix=".%s." %
+                os.path.basename(self.path), suffix=".tmp",
+                dir=os.path.dirname(os.path.abspath(self.path)))
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+
+            with self._write_lock:
+                if seq < self._written_seq:
+                    # a newer state has already been written
+                    os.unlink(tmp_path)
+                    return
+                os.rename(tmp_path, self.path)
+                self._written_seq = seq
+        except Exception:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def _schedule(self):
+        if self._writing:
+            # written once the current write is done
+            self._dirty = True
+        elif not self._timer.active:
+            self._timer.start(self._on_timer, self.write_delay, 0.0)
+
+    def _on_timer(self, handle):
+        if not self.active or self._detached:
+            return
+
+        self._writing = True
+        self._dirty = False
+        data = self._capture()
+        seq = self._next_seq()
+
+        result = {}
+        def write():
+            try:
+                self._write(data, seq)
+            except Exception:
+                result['error'] = sys.exc_info()[1]
+
+        def on_written(*args):
+            self._writing = False
+            if 'error' in result:
+                LOGGER.error("JOURNAL: error writing the journal: %s" %
+                        str(result['error']))
+
+            if self._dirty and self.active:
+                self._schedule()
+
+        self.loop.queue_work(write, on_written)
+
+    def _on_event(self, evtype, msg):
+        if evtype not in JOURNAL_EVENTS:
+            return
+
+        if self.holder is not None:
+            if evtype == "spawn":
+                self._hold(msg)
+            elif evtype == "add_socket":
+                self._hold_socket(msg["name"])
+            elif evtype in ("exit", "remove_socket"):
+                if evtype == "exit":
+                    key = msg["os_pid"]
+                else:
+                    key = "socket:%s" % msg["name"]
+
+                try:
+                    self.holder.remove(key)
+                except socket.error as e:
+                    LOGGER.error("JOURNAL: error removing the pipes: %s" %
+                            str(e))
+
+        self._schedule()
+
+    def _hold(self, msg):
+        try:
+            p = self.manager.get_process(msg["pid"])
+            fds = p.stdio_fds
+        except (ProcessNotFound, pyuv.error.HandleError):
+            # the process already exited
+            return
+
+        if not fds:
+            return
+
+        try:
+            self.holder.put(p.os_pid, fds)
+        except socket.error as e:
+            LOGGER.error("JOURNAL: error keeping the pipes: %s" % str(e))
+
+    def _hold_socket(self, name):
+        try:
+            fds = self.manager.get_socket(name).fds
+        except ProcessNotFound:
+            # the socket has already been removed
+            return
+
+        try:
+            self.holder.put("socket:%s" % name, fds)
+        except socket.error as e:
+            LOGGER.error("JOURNAL: error keeping the socket %r: %s" % (name,
+                str(e)))
@@ -2,18 +2,26 @@
 #
 # This file is part of gaffer. See the NOTICE for more information.
 
+from collections import OrderedDict
 import json
+import logging
 import os
 import ssl
 import sys
+import time
 
 import pyuv
 
 from ..events import EventEmitter
 from ..httpclient.base import BaseClient
+from ..httpclient.pool import KeepAliveHTTPClient
 from ..httpclient.util import make_uri
 from ..httpclient.websocket import WebSocket
-from ..util import is_ssl, parse_ssl_options
+from ..tornado_pyuv import IOLoop
+from ..util import (backoff_delay, is_ssl, parse_ssl_options,
+        parse_job_name)
+
+LOGGER = logging.getLogger("gaffer")
 
 class LookupChannel(WebSocket):
 
@@ -28,9 +36,17 @@ class LookupChannel(WebSocket):
 
         self._heartbeat = pyuv.Timer(loop)
         self._emitter = EventEmitter(loop)
+        self.exit_cb = None
+        self.opened = False
 
         super(LookupChannel, self).__init__(loop, url, **kwargs)
 
+    def start(self, on_exit_cb=None):
+        # ``on_exit_cb`` is called with the channel when the connection is
+        # closed or couldn't be established
+        self.exit_cb = on_exit_cb
+        super(LookupChannel, self).start()
+
     def __str__(self):
         return "%s: %s" % (self.__class__.__name__, self.server.url)
 
@@ -53,6 +69,8 @@ class LookupChannel(WebSocket):
     ## websockets methods
 
     def on_open(self):
+        self.opened = True
+
         # start the heartbeat
         self._heartbeat.start(self.on_heartbeat, self.heartbeat_timeout,
                 self.heartbeat_timeout)
@@ -61,6 +79,8 @@ class LookupChannel(WebSocket):
     def on_close(self):
         self._heartbeat.stop()
         self._emitter.close()
+        if self.exit_cb is not None:
+            self.exit_cb(self)
 
     def on_message(self, message):
         try:
@@ -106,9 +126,16 @@ class LookupServer(BaseClient):
         resp = self.request("get", "/jobs")
         return self.json_body(resp)
 
-    def find_job(self, job_name):
-        """ find a job on this lookupd server """
-        resp = self.request("get", "/findJob", name=job_name)
+    def find_job(self, job_name, strategy=None, limit=None):
+        """ find a job on this lookupd server. The sources can be ranked
+        by ``strategy`` (least_loaded, p2c or round_robin) and limited to
+        ``limit`` sources. """
+        params = {"name": job_name}
+        if strategy is not None:
+            params["strategy"] = strategy
+        if limit:
+            params["limit"] = limit
+        resp = self.request("get", "/findJob", **params)
         return self.json_body(resp)
 
     def find_session(self, sessionid):
@@ -116,7 +143,7 @@ class LookupServer(BaseClient):
         resp = self.request("get", "/findSession", sessionid=sessionid)
         return self.json_body(resp)
 
-    def lookup(self, heartbeat=None):
+    def lookup(self, heartbeat=None, sessions=None, prefixes=None):
         """ return a direct websocket connection this node allowing you to
         listen on events.
 
@@ -128,9 +155,18 @@ class LookupServer(BaseClient):
         - remove_job
         - add_process
         - remove_process
+
+        The job events can be limited to some ``sessions`` or to the jobs
+        starting with one of the ``prefixes``.
         """
 
-        url0 = make_uri(self.uri, "/lookup/websocket")
+        params = {}
+        if sessions:
+            params["session"] = list(sessions)
+        if prefixes:
+            params["prefix"] = list(prefixes)
+
+        url0 = make_uri(self.uri, "/lookup/websocket", **params)
         url = "ws%s" % url0.split("http", 1)[1]
         options = {}
         if heartbeat and heartbeat is not None:
@@ -141,3 +177,236 @@ class LookupServer(BaseClient):
 
         channel = LookupChannel(self, url, **options)
         return channel
+
+
+class CachedLookup(object):
+    """ lookupd client answering ``find_job``, ``find_session`` and ``jobs``
+    from memory.
+
+    The jobs are loaded from ``/jobs`` then kept up to date with the events
+    of the ``/lookup`` channel. They are reloaded every ``max_staleness``
+    seconds and when the channel is lost, so an event missed can't be
+    served for longer than that. Until the first load, and when a
+    ``strategy`` is requested (the load of the nodes is only known by
+    lookupd), queries are sent to lookupd.
+
+    Args:
+
+    - **server**: the `LookupServer` to cache
+    - **max_staleness**: interval in seconds between the reloads
+    - **heartbeat**: heartbeat of the channel
+    """
+
+    def __init__(self, server, max_staleness=30.0, heartbeat=None):
+        self.server = server
+        self.loop = server.loop
+        self.max_staleness = max_staleness
+        self.heartbeat = heartbeat
+
+        # job_name -> {(node name, origin) -> source}
+        self._jobs = OrderedDict()
+        # (node name, origin) -> set(job_name)
+        self._nodes = {}
+
+        # events received while a load is in progress, they are applied
+        # once it's done
+        self._pending = None
+        self._http = None
+        self._channel = None
+        self._refresh_timer = pyuv.Timer(self.loop)
+
+        # the channel is reconnected with an exponential backoff
+        self._reconnect_timer = pyuv.Timer(self.loop)
+        self._attempts = 0
+
+        self.ready = False
+        self.loaded_at = None
+        self.started = False
+
+    def start(self):
+        if self.started:
+            return
+        self.started = True
+
+        self._http = KeepAliveHTTPClient(IOLoop(_loop=self.loop),
+                max_connections=1)
+        self._connect()
+        self.refresh()
+
+        self._refresh_timer.start(lambda h: self.refresh(),
+                self.max_staleness, self.max_staleness)
+        self._refresh_timer.unref()
+
+    def close(self):
+        if not self.started:
+            return
+        self.started = False
+
+        self._refresh_timer.stop()
+        self._reconnect_timer.stop()
+        if self._channel is not None:
+            channel, self._channel = self._channel, None
+            channel.close()
+        self._http.close()
+
+    def refresh(self):
+        """ reload the jobs from lookupd without blocking """
+        if self._pending is not None:
+            # already loading
+            return
+        self._pending = []
+
+        url = make_uri(self.server.uri, "/jobs")
+        self._http.fetch(url, self._on_jobs, method="GET",
+                headers={"Accept": "application/json"},
+                **self.server.options)
+
+    def find_job(self, job_name, strategy=None, limit=None):
+        """ find a job, see `LookupServer.find_job` """
+        if not self.ready or strategy is not None:
+            return self.server.find_job(job_name, strategy=strategy,
+                    limit=limit)
+
+        sources = [self._source(source) for source in
+                self._jobs.get(job_name, {}).values()]
+        if limit:
+            sources = sources[:limit]
+        return {"sources": sources}
+
+    def find_session(self, sessionid):
+        """ find all jobs for a session, see `LookupServer.find_session` """
+        if not self.ready:
+            return self.server.find_session(sessionid)
+
+        all_jobs = []
+        for job_name, sources in self._jobs.items():
+            if parse_job_name(job_name)[0] != sessionid:
+                continue
+            all_jobs.append({"name": job_name, "sources":
+                [self._source(source) for source in sources.values()]})
+        return {"nb_jobs": len(all_jobs), "jobs": all_jobs}
+
+    def jobs(self):
+        """ get all jobs, see `LookupServer.jobs` """
+        if not self.ready:
+            return self.server.jobs()
+
+        all_jobs = [{"name": job_name, "sources": [self._source(source)
+            for source in sources.values()]}
+            for job_name, sources in self._jobs.items()]
+        return {"nb_jobs": len(all_jobs), "jobs": all_jobs}
+
+    ### private functions
+
+    def _connect(self):
+        self._channel = self.server.lookup(heartbeat=self.heartbeat)
+        self._channel.bind_all(self._on_event)
+        self._channel.start(on_exit_cb=self._on_channel_exit)
+
+    def _on_channel_exit(self, channel):
+        if channel is not self._channel or not self.started:
+            return
+
+        self._channel = None
+
+        # the backoff restarts once the channel has been opened
+        if channel.opened:
+            self._attempts = 0
+        delay = backoff_delay(self._attempts)
+        self._attempts += 1
+
+        LOGGER.info("LOOKUP: channel to %r lost, reconnecting in %.2fs" % (
+            self.server.uri, delay))
+        self._reconnect_timer.start(self._on_reconnect, delay, 0.0)
+
+    def _on_reconnect(self, h):
+        if not self.started:
+            return
+
+        # events may have been missed, reload the jobs once reconnected
+        self._connect()
+        self.refresh()
+
+    def _on_jobs(self, response):
+        pending, self._pending = self._pending, None
+        if response.error is not None:
+            LOGGER.error("LOOKUP: error loading the jobs from %r: %s" % (
+                self.server.uri, str(response.error)))
+            return
+
+        try:
+            jobs = json.loads(response.body.decode('utf-8'))["jobs"]
+        except (ValueError, KeyError):
+            LOGGER.error("LOOKUP: invalid jobs from %r" % self.server.uri)
+            return
+
+        self._jobs = OrderedDict()
+        self._nodes = {}
+        for job in jobs:
+            for source in job["sources"]:
+                info = source["node_info"]
+                self._add_source(job["name"], info)["pids"].update(
+                        source["pids"])
+
+        # apply the events received during the load. The changes already
+        # in the response are applied again, without effect.
+        for event, msg in pending:
+            self._apply(event, msg)
+
+        self.ready = True
+        self.loaded_at = time.time()
+
+    def _on_event(self, event, msg):
+        if self._pending is not None:
+            self._pending.append((event, msg))
+            return
+        self._apply(event, msg)
+
+    def _apply(self, event, msg):
+        if event == "remove_node":
+            key = (msg["name"], msg["origin"])
+            for job_name in self._nodes.pop(key, ()):
+                self._remove_source(job_name, key)
+            return
+        elif event not in ("add_job", "remove_job", "add_process",
+                "remove_process"):
+            return
+
+        info = msg["node"]
+        job_name = msg["job_name"]
+        if event == "add_job":
+            self._add_source(job_name, info)
+        elif event == "remove_job":
+            key = (info["name"], info["origin"])
+            self._remove_source(job_name, key)
+            self._nodes.get(key, set()).discard(job_name)
+        elif event == "add_process":
+            self._add_source(job_name, info)["pids"].add(msg["pid"])
+        else:
+            source = self._jobs.get(job_name, {}).get((info["name"],
+                info["origin"]))
+            if source is not None:
+                source["pids"].discard(msg["pid"])
+
+    def _add_source(self, job_name, info):
+        key = (info["name"], info["origin"])
+        sources = self._jobs.setdefault(job_name, OrderedDict())
+        source = sources.get(key)
+        if source is None:
+            source = sources[key] = {"name": info["name"], "pids": set(),
+                    "node_info": info}
+            self._nodes.setdefault(key, set()).add(job_name)
+        return source
+
+    def _remove_source(self, job_name, key):
+        sources = self._jobs.get(job_name)
+        if sources is None:
+            return
+
+        sources.pop(key, None)
+        if not sources:
+            del self._jobs[job_name]
+
+    def _source(self, source):
+        return {"name": source["name"], "pids": list(source["pids"]),
+                "node_info": source["node_info"]}
@@ -0,0 +1,484 @@
+# -*- coding: utf-8 -
+#
+# This file is part of gaffer. See the NOTICE for more information.
+"""
+Replication of the registry between lookupd peers.
+
+Each lookupd replicates the nodes connected to it to its peers, so a node
+only has to register to one of them and every peer answers the queries
+from its own registry:
+
+- each change of a local node is pushed to the peers as a delta carrying
+  the sequence number of the node,
+- every ``sync_interval`` seconds a digest of the local nodes and their
+  sequence numbers is pushed. A peer removes the nodes missing from the
+  digest and asks the full state of the nodes it missed a delta for.
+
+A lookupd pushes its nodes on the websocket it opens to ``/peer`` on each
+peer. The nodes replicated from a peer are removed when it has been
+disconnected for more than ``3 * sync_interval`` seconds.
+"""
+
+import json
+import logging
+import uuid
+
+import pyuv
+from tornado import websocket
+
+from ..httpclient.util import make_uri
+from ..httpclient.websocket import WebSocket
+from ..util import backoff_delay, is_ssl
+from .registry import AlreadyRegistered, JobNotFound
+
+LOGGER = logging.getLogger("gaffer")
+
+# operations sent in the deltas
+DELTA_OPS = ("add_job", "remove_job", "add_process", "remove_process",
+        "remove_node")
+
+
+class ReplicaConn(object):
+    """ connection of a node replicated from a peer in the registry """
+
+    def __init__(self, cluster, peer, key):
+        self.cluster = cluster
+        self.peer = peer
+        self.key = key
+        self.seq = 0
+
+    def __str__(self):
+        return "replica: %s (%s)" % (self.key[0], self.peer)
+
+    def close(self):
+        # the node connected to this lookupd and replaced the replica
+        self.cluster._forget(self)
+
+
+class PeerLink(WebSocket):
+    """ websocket opened to a peer to push the local nodes """
+
+    def __init__(self, cluster, url, **kwargs):
+        self.cluster = cluster
+        self.address = url
+        self.opened = False
+        self.closed = False
+        super(PeerLink, self).__init__(cluster.loop, url, **kwargs)
+
+    def send(self, msg):
+        if not isinstance(msg, str):
+            msg = json.dumps(msg)
+        self.write_message(msg)
+
+    def close(self):
+        self.closed = True
+        self.opened = False
+        super(PeerLink, self).close()
+
+    def on_open(self):
+        self.opened = True
+        self.cluster._link_opened(self)
+
+    def on_message(self, message):
+        try:
+            msg = json.loads(message)
+        except ValueError:
+            return
+        self.cluster.handle_reply(self, msg)
+
+    def on_close(self):
+        self.opened = False
+        if not self.closed:
+            self.cluster._link_lost(self)
+
+
+class PeerWebSocket(websocket.WebSocketHandler):
+    """ /peer
+
+    websocket on which a peer pushes its nodes """
+
+    def open(self):
+        self.cluster = self.settings.get('cluster')
+        self.peer = None
+
+    def on_close(self):
+        self.cluster.peer_disconnected(self)
+
+    def on_message(self, message):
+        try:
+            msg = json.loads(message)
+        except ValueError:
+            return self.write_error(400, "invalid_json")
+        self.cluster.handle_message(self, msg)
+
+    def write_error(self, errno, reason):
+        self.write_message({"errno": errno, "reason": reason})
+
+    def write_message(self, msg):
+        if isinstance(msg, dict):
+            msg = json.dumps(msg)
+        super(PeerWebSocket, self).write_message(msg)
+
+
+class Cluster(object):
+    """ replicate a registry with the lookupd peers
+
+    Args:
+
+    - **loop**: the pyuv loop
+    - **registry**: the `Registry` to replicate
+    - **peers**: list of the peers addresses
+    - **name**: name of this lookupd in the cluster, unique by default
+    - **sync_interval**: interval in seconds between the digests
+    - **ssl_options**: ssl options used to connect to the ``https`` peers
+    """
+
+    def __init__(self, loop, registry, peers=None, name=None,
+            sync_interval=5.0, ssl_options=None):
+        self.loop = loop
+        self.registry = registry
+        self.name = name or uuid.uuid4().hex
+        self.sync_interval = sync_interval
+        self.grace = sync_interval * 3
+        self.ssl_options = ssl_options
+
+        self.peers = [self._peer_url(addr) for addr in peers or []]
+
+        # links opened to the peers: url -> PeerLink
+        self.links = {}
+        self._link_timers = {}
+        self._link_attempts = {}
+
+        # sequence numbers of the local nodes: (name, origin) -> seq
+        self._seqs = {}
+        # replicated nodes: peer -> {(name, origin) -> ReplicaConn}
+        self._replicas = {}
+        # connections opened by the peers: peer -> set(PeerWebSocket)
+        self._inbound = {}
+        self._expiry_timers = {}
+
+        self._sync_timer = pyuv.Timer(loop)
+        self.started = False
+
+    def start(self):
+        if self.started:
+            return
+        self.started = True
+
+        self.registry.bind_all(self._on_event)
+        for url in self.peers:
+            self._connect(url)
+
+        self._sync_timer.start(self._on_sync, self.sync_interval,
+                self.sync_interval)
+        self._sync_timer.unref()
+
+    def stop(self):
+        if not self.started:
+            return
+        self.started = False
+
+        self.registry.unbind_all(self._on_event)
+        self._sync_timer.stop()
+
+        timers = list(self._link_timers.values())
+        timers.extend(self._expiry_timers.values())
+        for timer in timers:
+            timer.close()
+        self._link_timers = {}
+        self._expiry_timers = {}
+
+        for link in list(self.links.values()):
+            link.close()
+        self.links = {}
+
+    def metrics(self):
+        replicas = sum(len(nodes) for nodes in self._replicas.values())
+        return {"name": self.name,
+                "links": dict((url, link.opened) for url, link in
+                    self.links.items()),
+                "connected_peers": sorted(peer for peer, conns in
+                    self._inbound.items() if conns),
+                "replicated_nodes": replicas}
+
+    def digest(self):
+        """ return the digest of the local nodes """
+        nodes = []
+        for node in self.registry.all_nodes():
+            if node.peer is not None or node.name is None:
+                continue
+            seq = self._seqs.get((node.name, node.origin), 0)
+            nodes.append([node.name, node.origin, seq, node.load])
+        return {"type": "DIGEST", "peer": self.name, "nodes": nodes}
+
+    def handle_message(self, conn, msg):
+        """ apply a message pushed by a peer on ``conn`` """
+        try:
+            mtype = msg["type"]
+            peer = msg["peer"]
+            if mtype == "HELLO":
+                self.peer_connected(conn, peer)
+            elif conn.peer != peer:
+                raise ValueError("HELLO expected")
+            elif mtype == "STATE":
+                self._apply_state(peer, msg)
+            elif mtype == "DELTA":
+                if self._apply_delta(peer, msg):
+                    self._resync(conn, [msg["node"]])
+            elif mtype == "DIGEST":
+                self._resync(conn, self._apply_digest(peer, msg["nodes"]))
+            else:
+                raise ValueError("invalid message type %r" % mtype)
+        except (KeyError, TypeError, ValueError) as e:
+            LOGGER.warning("PEER: invalid message from %r: %s" % (
+                getattr(conn, "peer", None), str(e)))
+            conn.write_error(400, "invalid_message")
+
+    def handle_reply(self, link, msg):
+        """ handle a message sent back by a peer on a link """
+        if msg.get("type") != "RESYNC":
+            return
+
+        for name, origin in msg.get("nodes", []):
+            node = self.registry.node_by_ident(name, origin)
+            if node is not None and node.peer is None:
+                link.send(self._state(node))
+
+    def peer_connected(self, conn, peer):
+        if peer == self.name:
+            # the lookupd is its own peer
+            conn.close()
+            return
+
+        conn.peer = peer
+        self._inbound.setdefault(peer, set()).add(conn)
+        timer = self._expiry_timers.pop(peer, None)
+        if timer is not None:
+            timer.close()
+
+    def peer_disconnected(self, conn):
+        peer = getattr(conn, "peer", None)
+        conns = self._inbound.get(peer)
+        if not conns:
+            return
+
+        conns.discard(conn)
+        if conns or not self.started or peer in self._expiry_timers:
+            return
+
+        # the peer will resend its digest if it reconnects in time
+        timer = self._expiry_timers[peer] = pyuv.Timer(self.loop)
+        def expire(h):
+            h.close()
+            if self._expiry_timers.get(peer) is not h:
+                return
+            del self._expiry_timers[peer]
+            if not self._inbound.get(peer):
+                self._inbound.pop(peer, None)
+                self._drop_peer(peer)
+        timer.start(expire, self.grace, 0.0)
+
+    ### private functions
+
+    def _peer_url(self, addr):
+        if addr.startswith("http"):
+            addr = addr.replace("http", "ws", 1)
+        elif "://" not in addr:
+            addr = "ws://%s" % addr
+        return make_uri(addr, "/peer")
+
+    def _connect(self, url):
+        self._link_timers.pop(url, None)
+
+        options = {}
+        if is_ssl(url):
+            options["ssl_options"] = self.ssl_options or {}
+        link = self.links[url] = PeerLink(self, url, **options)
+        link.start()
+
+    def _link_opened(self, link):
+        self._link_attempts.pop(link.address, None)
+        link.send({"type": "HELLO", "peer": self.name})
+        link.send(self.digest())
+
+    def _link_lost(self, link):
+        url = link.address
+        if self.links.get(url) is not link:
+            return
+        del self.links[url]
+
+        if not self.started:
+            return
+
+        # reconnect with an exponential backoff
+        attempt = self._link_attempts.get(url, 0)
+        self._link_attempts[url] = attempt + 1
+        delay = backoff_delay(attempt)
+
+        LOGGER.info("PEER: %r lost, reconnecting in %.2fs" % (url, delay))
+
+        timer = self._link_timers[url] = pyuv.Timer(self.loop)
+        def reconnect(h):
+            h.close()
+            if self._link_timers.get(url) is h:
+                self._connect(url)
+        timer.start(reconnect, delay, 0.0)
+
+    def _broadcast(self, msg):
+        # encode the message once for all the links
+        data = json.dumps(msg)
+        for link in self.links.values():
+            if link.opened:
+                link.send(data)
+
+    def _on_sync(self, handle):
+        if self.links:
+            self._broadcast(self.digest())
+
+    def _on_event(self, event, msg):
+        if isinstance(msg, dict):
+            node = msg.get("node")
+        else:
+            node = msg
+
+        # only the nodes connected to this lookupd are replicated
+        if node is None or node.peer is not None or node.name is None:
+            return
+
+        key = (node.name, node.origin)
+        if event == "identify":
+            self._seqs[key] = self._seqs.get(key, 0) + 1
+            self._broadcast(self._state(node))
+        elif event in DELTA_OPS:
+            if event == "remove_node":
+                # the node reconnected since
+                current = self.registry.node_by_ident(*key)
+                if current is not None and current is not node:
+                    return
+                seq = self._seqs.pop(key, 0) + 1
+            else:
+                seq = self._seqs[key] = self._seqs.get(key, 0) + 1
+
+            delta = {"type": "DELTA", "peer": self.name, "node": list(key),
+                    "seq": seq, "op": event}
+            if isinstance(msg, dict):
+                delta["job_name"] = msg["job_name"]
+                delta["pid"] = msg.get("pid")
+            self._broadcast(delta)
+
+    def _state(self, node):
+        jobs = {}
+        for session in node.sessions.values():
+            for job in session.values():
+                jobs[job.name] = job.pids
+
+        key = (node.name, node.origin)
+        return {"type": "STATE", "peer": self.name, "node": list(key),
+                "version": node.version, "seq": self._seqs.get(key, 0),
+                "jobs": jobs, "load": node.load}
+
+    def _resync(self, conn, nodes):
+        if nodes:
+            conn.write_message({"type": "RESYNC", "nodes": nodes})
+
+    def _apply_state(self, peer, msg):
+        key = tuple(msg["node"])
+        replicas = self._replicas.setdefault(peer, {})
+
+        conn = replicas.get(key)
+        if conn is None:
+            if self.registry.node_by_ident(*key) is not None:
+                # the node is connected to this lookupd or is still
+                # replicated from another peer
+                return
+
+            conn = ReplicaConn(self, peer, key)
+            self.registry.add_node(conn, peer=peer)
+            self.registry.identify(conn, key[0], key[1], msg["version"])
+            replicas[key] = conn
+
+        self.registry.sync_node(conn, msg["jobs"])
+        self.registry.get_node(conn).load = msg.get("load") or {}
+        conn.seq = msg["seq"]
+
+    def _apply_delta(self, peer, msg):
+        """ apply a delta, return True if the state of the node has to be
+        resent """
+        key = tuple(msg["node"])
+        op = msg["op"]
+        if op not in DELTA_OPS:
+            raise ValueError("invalid operation %r" % op)
+
+        conn = self._replicas.get(peer, {}).get(key)
+        if conn is None:
+            # the state of the node will be requested if we don't know it
+            return (op != "remove_node" and
+                    self.registry.node_by_ident(*key) is None)
+
+        if op == "remove_node":
+            self._remove_replica(conn)
+            return False
+
+        seq = msg["seq"]
+        if seq <= conn.seq:
+            # already in the state of the node
+            return False
+        elif seq != conn.seq + 1:
+            # a delta has been lost
+            return True
+        conn.seq = seq
+
+        job_name = msg["job_name"]
+        try:
+            if op == "add_job":
+                self.registry.add_job(conn, job_name)
+            elif op == "remove_job":
+                self.registry.remove_job(conn, job_name)
+            elif op == "add_process":
+                self.registry.add_process(conn, job_name, msg["pid"])
+            elif op == "remove_process":
+                self.registry.remove_process(conn, job_name, msg["pid"])
+        except (AlreadyRegistered, JobNotFound):
+            # the delta was already applied with the state of the node
+            pass
+        return False
+
+    def _apply_digest(self, peer, nodes):
+        """ apply a digest, return the nodes of which the state has to be
+        resent """
+        replicas = self._replicas.setdefault(peer, {})
+
+        seen = set()
+        missing = []
+        for name, origin, seq, load in nodes:
+            key = (name, origin)
+            seen.add(key)
+
+            conn = replicas.get(key)
+            if conn is None:
+                if self.registry.node_by_ident(name, origin) is None:
+                    missing.append([name, origin])
+            elif conn.seq != seq:
+                missing.append([name, origin])
+            else:
+                self.registry.get_node(conn).load = load or {}
+
+        # the nodes missing from the digest are gone
+        for key, conn in list(replicas.items()):
+            if key not in seen:
+                self._remove_replica(conn)
+        return missing
+
+    def _remove_replica(self, conn):
+        self._forget(conn)
+        self.registry.remove_node(conn)
+
+    def _forget(self, conn):
+        replicas = self._replicas.get(conn.peer, {})
+        if replicas.get(conn.key) is conn:
+            del replicas[conn.key]
+
+    def _drop_peer(self, peer):
+        LOGGER.info("PEER: %r expired, removing its nodes" % peer)
+        for conn in list(self._replicas.pop(peer, {}).values()):
+            self.registry.remove_node(conn)
@@ -3,27 +3,33 @@
 # This file is part of gaffer. See the NOTICE for more information.
 import json
 
-from tornado.web import Application
+from tornado.web import Application, HTTPError
 from tornado.httpserver import HTTPServer
 
 from gaffer import __version__
 from .. import sockjs
 from ..gafferd.http_handlers.util import CorsHandler
+from ..util import parse_job_name
 
 
+from .cluster import PeerWebSocket
 from .protocol import LookupWebSocket
-from .registry import Registry, JobNotFound
+from .registry import Registry, JobNotFound, UnknownStrategy
 
 
-def http_server(io_loop, listener, ssl_options=None, registration_db=None):
+def http_server(io_loop, listener, ssl_options=None, registration_db=None,
+        cluster=None):
 
     # initialize the registry
     registration_db = registration_db or Registry(loop=io_loop._loop)
 
-    # lookup routes
-    user_settings = { "registration_db": registration_db }
+    # lookup routes. Events are sent to the watchers by the fanout.
+    fanout = LookupFanout(registration_db)
+    user_settings = { "registration_db": registration_db,
+            "fanout": fanout }
     lookup_router = sockjs.SockJSRouter(LookupConnection, "/lookup",
             io_loop=io_loop, user_settings=user_settings)
+    fanout.router = lookup_router
 
     # initialize handlers
     handlers = [
@@ -36,10 +42,16 @@ def http_server(io_loop, listener, ssl_options=None, registration_db=None):
             (r'/jobs', JobsHandler),
             (r'/findJob', FindJobHandler),
             (r'/findSession', FindSessionHandler),
+            (r'/metrics', MetricsHandler),
             (r'/ws', LookupWebSocket)] + lookup_router.urls
 
+    # the peers push their nodes on /peer
+    if cluster is not None:
+        handlers.append((r'/peer', PeerWebSocket))
+
     # initialize the server
-    app = Application(handlers, registration_db=registration_db)
+    app = Application(handlers, registration_db=registration_db,
+            cluster=cluster)
     server = HTTPServer(app, io_loop=io_loop, ssl_options=ssl_options)
     server.add_sockets(listener)
     return server
@@ -68,27 +80,126 @@ class PingHandler(CorsHandler):
         self.write("OK")
 
 
-class LookupConnection(sockjs.SockJSConnection):
+class MetricsHandler(CorsHandler):
+    """ /metrics
 
-    def on_open(self, info):
-        self.db = self.session.server.settings.get('registration_db')
-        self.db.bind_all(self.on_event)
-
-    def on_close(self):
-        self.db.unbind_all(self.on_event)
+    return the number of nodes and the heartbeat and expiry counters, and
+    the state of the replication when lookupd has peers """
 
-    def on_event(self, event, message):
+    def get(self):
+        self.preflight()
+        db = self.settings.get('registration_db')
+        metrics = db.metrics()
+
+        cluster = self.settings.get('cluster')
+        if cluster is not None:
+            metrics["cluster"] = cluster.metrics()
+        self.write(metrics)
+
+
+def _decode_arguments(values):
+    return [v.decode('utf-8') if isinstance(v, bytes) else v
+            for v in values or []]
+
+
+class LookupFanout(object):
+    """ send the registry events to the watchers of /lookup
+
+    Each event is encoded once and the same frame is sent to all the
+    watchers interested in it. Watchers can only receive the jobs events of
+    some sessions (``?session=<sessionid>``) or of the jobs starting by a
+    prefix (``?prefix=<prefix>``). Node events are sent to all of them.
+    """
+
+    def __init__(self, registry, router=None):
+        self.registry = registry
+        self.router = router
+
+        # watchers without filter
+        self._all = set()
+        # sessionid -> set(watchers)
+        self._sessions = {}
+        # watchers filtering on a prefix
+        self._prefixed = set()
+
+        self.registry.bind_all(self._on_event)
+
+    def close(self):
+        self.registry.unbind_all(self._on_event)
+
+    def add(self, conn):
+        if not conn.sessions and not conn.prefixes:
+            self._all.add(conn)
+            return
+
+        for sessionid in conn.sessions:
+            self._sessions.setdefault(sessionid, set()).add(conn)
+        if conn.prefixes:
+            self._prefixed.add(conn)
+
+    def remove(self, conn):
+        self._all.discard(conn)
+        self._prefixed.discard(conn)
+        for sessionid in conn.sessions:
+            watchers = self._sessions.get(sessionid)
+            if watchers is None:
+                continue
+            watchers.discard(conn)
+            if not watchers:
+                del self._sessions[sessionid]
+
+    def watchers(self, job_name=None):
+        """ return the watchers of the events of a job, or of the node events
+        if ``job_name`` is None """
+        if job_name is None:
+            watchers = set(self._all)
+            watchers.update(self._prefixed)
+            for session_watchers in self._sessions.values():
+                watchers.update(session_watchers)
+            return watchers
+
+        sessionid, _ = parse_job_name(job_name)
+        watchers = self._all.union(self._sessions.get(sessionid, ()))
+        for conn in self._prefixed:
+            if job_name.startswith(conn.prefixes):
+                watchers.add(conn)
+        return watchers
+
+    def _on_event(self, event, message):
         if event in ('add_node', 'remove_node', 'identify', ):
             msg = message.infodict()
+            job_name = None
         else:
             msg = {}
             for k, v in message.items():
                 if k == "node":
                     v = v.infodict()
                 msg[k] = v
+            job_name = msg.get("job_name")
+
+        watchers = self.watchers(job_name)
+        if not watchers or self.router is None:
+            return
+
         # add event to the message
         msg['event'] = event
-        self.write_message(msg)
+        self.router.broadcast(watchers, json.dumps(msg))
+
+
+class LookupConnection(sockjs.SockJSConnection):
+
+    def on_open(self, info):
+        settings = self.session.server.settings
+        self.db = settings.get('registration_db')
+        self.fanout = settings.get('fanout')
+
+        # filters
+        self.sessions = set(_decode_arguments(info.arguments.get("session")))
+        self.prefixes = tuple(_decode_arguments(info.arguments.get("prefix")))
+        self.fanout.add(self)
+
+    def on_close(self):
+        self.fanout.remove(self)
 
     def write_message(self, msg):
         if isinstance(msg, dict):
@@ -158,16 +269,24 @@ class FindJobHandler(CorsHandler):
         db = self.settings.get('registration_db')
 
         job_name = self.get_argument("name")
+        strategy = self.get_argument("strategy", None)
+        try:
+            limit = int(self.get_argument("limit", 0))
+        except ValueError:
+            raise HTTPError(400)
+
         found = []
         try:
-            found = db.find_job(job_name)
+            found = db.find_job(job_name, strategy=strategy, limit=limit)
         except JobNotFound:
             pass
+        except UnknownStrategy:
+            raise HTTPError(400)
 
         jobs = []
         for job in found:
             jobs.append({"name": job.node.name, "pids": job.pids,
-                "node_info": job.node.infodict()})
+                "node_info": job.node.infodict(), "load": job.load})
 
         self.write({"sources": jobs})
 
@@ -6,7 +6,11 @@
 usage: gaffer_lookupd [--version] [-v] [--daemon] [--pidfile=PIDFILE]
                       [--bind=ADDRESS] [--backlog=BACKLOG]
                       [--certfile=CERTFILE] [--keyfile=KEYFILE]
-                      [--cacert=CACERT]
+                      [--cacert=CACERT] [--heartbeat=SECONDS]
+                      [--max-missed=N] [--name=NAME] [--peer=ADDR]...
+                      [--sync-interval=SECONDS] [--snapshot=PATH]
+                      [--snapshot-interval=SECONDS]
+                      [--stale-timeout=SECONDS]
 
 Options
 
@@ -20,6 +24,20 @@ Options
     --certfile=CERTFILE         SSL certificate file
     --keyfile=KEYFILE           SSL key file
     --cacert=CACERT             SSL CA certificate
+    --heartbeat=SECONDS         interval of the nodes heartbeats [default: 15]
+    --max-missed=N              number of missed heartbeats after which a
+                                node is expired, 0 to disable [default: 3]
+    --name=NAME                 name of this lookupd in the cluster, random
+                                by default
+    --peer=ADDR                 HTTP address of a lookupd peer to replicate
+                                the nodes with
+    --sync-interval=SECONDS     interval between the digests sent to the
+                                peers [default: 5]
+    --snapshot=PATH             file in which the registry is saved to be
+                                restored on restart
+    --snapshot-interval=SECONDS interval between the snapshots [default: 60]
+    --stale-timeout=SECONDS     time after which the restored nodes that
+                                didn't reconnect are removed [default: 60]
 """
 import os
 import sys
@@ -36,7 +54,10 @@ from ..pidfile import Pidfile
 from ..sig_handler import BaseSigHandler
 from ..util import bind_sockets, daemonize, setproctitle_
 
+from .cluster import Cluster
 from .http import http_server
+from .registry import Registry
+from .store import RegistryStore
 
 
 class LookupSigHandler(BaseSigHandler):
@@ -88,6 +109,31 @@ class LookupServer(object):
         if ssl_options:
             self.ssl_options = ssl_options
 
+        # nodes missing ``max_missed`` heartbeats are expired
+        try:
+            heartbeat = float(args.get("--heartbeat") or 15)
+            max_missed = int(args.get("--max-missed") or 3)
+        except ValueError:
+            raise RuntimeError("heartbeat and max-missed should be numbers")
+        self.node_timeout = heartbeat * max_missed or None
+
+        # peers with which the registry is replicated
+        self.peers = args.get("--peer") or []
+        try:
+            self.sync_interval = float(args.get("--sync-interval") or 5)
+        except ValueError:
+            raise RuntimeError("sync-interval should be a number")
+
+        # snapshots of the registry
+        self.snapshot_path = args.get("--snapshot")
+        try:
+            self.snapshot_interval = float(args.get("--snapshot-interval")
+                    or 60)
+            self.stale_timeout = float(args.get("--stale-timeout") or 60)
+        except ValueError:
+            raise RuntimeError("snapshot-interval and stale-timeout should "
+                    "be numbers")
+
         self.started = False
 
     def start(self):
@@ -115,10 +161,34 @@ class LookupServer(object):
                 raise RuntimeError('keyfile "%s" does not exist' %
                         self.ssl_options['keyfile'])
 
+        self.registry = Registry(self.loop, node_timeout=self.node_timeout)
+
+        # restore the registry saved before the restart. Nodes are
+        # served as stale until they reconnect.
+        self.store = None
+        if self.snapshot_path:
+            self.store = RegistryStore(self.loop, self.registry,
+                    self.snapshot_path,
+                    snapshot_interval=self.snapshot_interval,
+                    stale_timeout=self.stale_timeout)
+            self.store.load()
+            self.store.start()
+
+        self.cluster = None
+        if self.peers:
+            self.cluster = Cluster(self.loop, self.registry, self.peers,
+                    name=self.args.get("--name"),
+                    sync_interval=self.sync_interval,
+                    ssl_options=self.ssl_options)
+
         self.hserver = http_server(self.io_loop, listener,
-                ssl_options=self.ssl_options)
+                ssl_options=self.ssl_options, registration_db=self.registry,
+                cluster=self.cluster)
         self.hserver.start()
 
+        if self.cluster is not None:
+            self.cluster.start()
+
         self.started = True
 
     def run(self):
@@ -128,7 +198,12 @@ class LookupServer(object):
         self.loop.run()
 
     def stop(self):
+        if self.cluster is not None:
+            self.cluster.stop()
         self.hserver.stop()
+        if self.store is not None:
+            self.store.stop()
+        self.registry.close()
         self.io_loop.close()
         self.started = False
 
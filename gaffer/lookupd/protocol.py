@@ -16,6 +16,11 @@ class MessageError(ProcessError):
         self.msgid = msgid
 
 
+# messages that can be sent in a batch
+BATCHED_TYPES = ("REGISTER_JOB", "UNREGISTER_JOB", "REGISTER_PROCESS",
+        "UNREGISTER_PROCESS")
+
+
 class LookupMessage(object):
 
     def __init__(self, raw):
@@ -31,25 +36,56 @@ class LookupMessage(object):
         try:
             self.id = raw['msgid']
             self.type = raw['type']
-        except KeyError:
+        except (KeyError, TypeError):
             raise MessageError(msgid=self.id)
 
         # validate the message type
         if self.type not in ("REGISTER_JOB", "UNREGISTER_JOB",
-                "REGISTER_PROCESS", "UNREGISTER_PROCESS", "PING", "IDENTIFY"):
+                "REGISTER_PROCESS", "UNREGISTER_PROCESS", "PING", "IDENTIFY",
+                "BATCH", "SNAPSHOT"):
             raise MessageError("invalid_message_type")
 
         # validate message arguments
         try:
-            if self.type == "IDENTIFY":
-                self.args = (raw['name'], raw['origin'], raw['version'],)
+            if self.type == "PING":
+                self.args = (raw.get('load'),)
+            elif self.type == "IDENTIFY":
+                self.args = (raw['name'], raw['origin'], raw['version'],
+                        raw.get('resume', False),)
             if self.type in ("REGISTER_JOB", "UNREGISTER_JOB"):
                 self.args  = (raw['job_name'],)
             elif self.type in ("REGISTER_PROCESS", "UNREGISTER_PROCESS"):
                 self.args  = (raw['job_name'], raw['pid'],)
+            elif self.type == "BATCH":
+                self.args = (self.parse_batch(raw['messages']),)
+            elif self.type == "SNAPSHOT":
+                if not isinstance(raw['jobs'], dict):
+                    raise MessageError(msgid=self.id)
+                self.args = (raw['jobs'],)
         except KeyError:
             raise MessageError(msgid=self.id)
 
+    def parse_batch(self, messages):
+        """ parse the messages of a batch. Messages are identified by their
+        index in the batch. """
+        if not isinstance(messages, list):
+            raise MessageError(msgid=self.id)
+
+        parsed = []
+        for i, raw in enumerate(messages):
+            if not isinstance(raw, dict):
+                raise MessageError(msgid=self.id)
+
+            raw = dict(raw, msgid=i)
+            if raw.get("type") not in BATCHED_TYPES:
+                raise MessageError("invalid_message_type", msgid=self.id)
+
+            try:
+                parsed.append(LookupMessage(raw))
+            except MessageError as e:
+                raise MessageError(e.reason, msgid=self.id)
+        return parsed
+
     def __str__(self):
         return "%s: %s" % (self.__class__.__name__, self.id)
 
@@ -71,18 +107,48 @@ class LookupWebSocket(websocket.WebSocketHandler):
         try:
             msg_raw = json.loads(message)
         except ValueError as e:
-            self.write_error(400, "invalid_json")
+            return self.write_error(400, "invalid_json")
 
         try:
             msg = LookupMessage(msg_raw)
         except MessageError as e:
             return self.write_error(e.errno, e.reason, e.msgid)
 
+        if msg.type == "BATCH":
+            # the messages of a batch are acked at once, only the errors
+            # are returned with the index of the message in the batch.
+            errors = []
+            for submsg in msg.args[0]:
+                try:
+                    self.handle_message(db, submsg)
+                except ProcessError as e:
+                    errors.append({"index": submsg.id, "errno": e.errno,
+                        "reason": e.reason})
+
+            return self.write_message({"ok": True, "msgid": msg.id,
+                "errors": errors})
+
+        try:
+            self.handle_message(db, msg)
+        except ProcessError as e:
+            return self.write_error(e.errno, e.reason, msg.id)
+
+        self.write_message({"ok": True, "msgid": msg.id})
+
+    def handle_message(self, db, msg):
+        """ apply a message to the registry. Errors are raised as
+        ``ProcessError`` """
         try:
             if msg.type == "PING":
-                db.update(self)
+                db.update(self, *msg.args)
             elif msg.type == "IDENTIFY":
-                db.identify(self, *msg.args)
+                replaced = db.identify(self, *msg.args)
+                if replaced is not None:
+                    # the node reconnected before we noticed its old
+                    # connection was lost.
+                    replaced.conn.close()
+            elif msg.type == "SNAPSHOT":
+                db.sync_node(self, *msg.args)
             elif msg.type == "REGISTER_JOB":
                 db.add_job(self, *msg.args)
             elif msg.type == "UNREGISTER_JOB":
@@ -92,17 +158,15 @@ class LookupWebSocket(websocket.WebSocketHandler):
             elif msg.type == "UNREGISTER_PROCESS":
                 db.remove_process(self, *msg.args)
         except JobNotFound as e:
-            return self.write_error(404, str(e), msg.id)
+            raise ProcessError(404, str(e))
         except AlreadyRegistered as e:
-            return self.write_error(409, str(e), msg.id)
+            raise ProcessError(409, str(e))
         except NoIdent as e:
-            return self.write_error(404, str(e), msg.id)
+            raise ProcessError(404, str(e))
         except AlreadyIdentified as e:
-            return self.write_error(409, str(e), msg.id)
+            raise ProcessError(409, str(e))
         except IdentExists as e:
-            return self.write_error(409, str(e), msg.id)
-
-        self.write_message({"ok": True, "msgid": msg.id})
+            raise ProcessError(409, str(e))
 
     def write_error(self, errno, reason, msgid=None):
         msg = {"errno": errno, "reason": reason, "msgid": msgid}
@@ -3,6 +3,7 @@
 # This file is part of gaffer. See the NOTICE for more information.
 
 from collections import OrderedDict
+import random
 from threading import RLock
 import time
 
@@ -10,6 +11,7 @@ import pyuv
 
 from ..events import EventEmitter
 from ..util import parse_job_name
+from .wheel import TimerWheel
 
 
 class NoIdent(Exception):
@@ -28,6 +30,24 @@ class IdentExists(Exception):
 class AlreadyRegistered(Exception):
     """ exception raised when a job is alreay registered """
 
+class UnknownStrategy(Exception):
+    """ exception raised when a routing strategy doesn't exist """
+
+
+# strategies used to rank the sources of a job
+STRATEGIES = ("least_loaded", "p2c", "round_robin")
+
+
+def load_key(job):
+    """ sort key of a job by load. Jobs restarting often come last, then
+    the jobs using the more cpu and memory. Jobs without load come after
+    the others. """
+    load = job.load
+    if not load:
+        return (1, 0, 0, 0)
+    return (0, load.get("restart_rate", 0), load.get("cpu", 0),
+            load.get("rss", 0))
+
 
 class RemoteJob(object):
 
@@ -43,6 +63,11 @@ class RemoteJob(object):
     def pids(self):
         return list(self._pids)
 
+    @property
+    def load(self):
+        """ last load summary sent by the node for this job """
+        return self.node.load.get(self.name)
+
     def add(self, pid):
         self._pids.add(pid)
 
@@ -54,15 +79,25 @@ class RemoteJob(object):
 
 
 class GafferNode(object):
-    """ class to maintain jobs & process / nodes """
+    """ class to maintain jobs & process / nodes
+
+    ``peer`` is the name of the lookupd peer the node is connected to when
+    the node is replicated from another lookupd, None when it's connected
+    to this one. ``stale`` is True for the nodes restored from a snapshot
+    that didn't reconnect yet.
+    """
 
-    def __init__(self, conn):
+    def __init__(self, conn, peer=None, stale=False):
         self.conn = conn
+        self.peer = peer
+        self.stale = stale
         self.sessions = dict()
         self.update()
         self.name = None
         self.origin = None
         self.version = None
+        # load summary of the jobs sent with the heartbeats
+        self.load = {}
 
     def __str__(self):
         return "node: %s" % self.name
@@ -150,18 +185,53 @@ class GafferNode(object):
         return info
 
     def infodict(self):
-        return dict(name=self.name, origin=self.origin, version=self.version)
+        return dict(name=self.name, origin=self.origin, version=self.version,
+                stale=self.stale)
 
 
 class Registry(object):
+    """ registry of the nodes connected to lookupd and their jobs
 
-    def __init__(self, loop=None):
+    Jobs are indexed by name and session, and identified nodes by name and
+    (name, origin), so lookups don't have to scan all the nodes. The indexes
+    are updated with the nodes.
+    """
+
+    def __init__(self, loop=None, node_timeout=None):
         self.loop = loop or pyuv.Loop.default_loop()
         self.nodes = OrderedDict()
         self._emitter = EventEmitter(self.loop)
         self._lock = RLock()
 
+        # nodes not sending any message for ``node_timeout`` seconds are
+        # expired
+        self.node_timeout = node_timeout
+        self._wheel = None
+        if node_timeout:
+            self._wheel = TimerWheel(self.loop, self._expire_node,
+                    tick=min(1.0, node_timeout / 10.0))
+            self._wheel.start()
+
+        # counters returned by ``metrics``
+        self._heartbeats = 0
+        self._expired = 0
+        self._last_expiry = None
+
+        # job_name -> [RemoteJob]
+        self._jobs = OrderedDict()
+        # sessionid -> {job_name -> [RemoteJob]}, lists are shared with
+        # the jobs index
+        self._sessions = OrderedDict()
+        # job_name -> next index for the round robin routing
+        self._rr = {}
+        # (name, origin) -> node
+        self._idents = {}
+        # name -> [node]
+        self._names = {}
+
     def close(self):
+        if self._wheel is not None:
+            self._wheel.close()
         self._emitter.close()
 
     def bind(self, event, callback):
@@ -176,10 +246,13 @@ class Registry(object):
     def unbind_all(self, callback):
         self._emitter.unsubscribe(".", callback)
 
-    def add_node(self, conn):
-        """ register a connection. """
+    def add_node(self, conn, peer=None, stale=False):
+        """ register a connection. ``peer`` is set for the nodes replicated
+        from another lookupd, ``stale`` for the nodes restored from a
+        snapshot """
         with self._lock:
-            node = self.nodes[conn] = GafferNode(conn)
+            node = self.nodes[conn] = GafferNode(conn, peer=peer, stale=stale)
+            self._touch(conn)
             self._emitter.publish('add_node', node)
             return node
 
@@ -188,33 +261,109 @@ class Registry(object):
         with self._lock:
             try:
                 node = self.nodes.pop(conn)
-                node.sessions = {}
-                self._emitter.publish('remove_node', node)
             except KeyError:
-                pass
+                return
 
-    def identify(self, conn, name, origin, version):
-        """ identify a node """
+            if self._wheel is not None:
+                self._wheel.cancel(conn)
+
+            # remove the node and its jobs from the indexes
+            for jobs in node.sessions.values():
+                for job in jobs.values():
+                    self._unindex_job(job)
+
+            if node.name is not None:
+                self._idents.pop((node.name, node.origin), None)
+                nodes = self._names.get(node.name, [])
+                if node in nodes:
+                    nodes.remove(node)
+                if not nodes:
+                    self._names.pop(node.name, None)
+
+            node.sessions = {}
+            self._emitter.publish('remove_node', node)
+
+    def identify(self, conn, name, origin, version, resume=False):
+        """ identify a node
+
+        If ``resume`` is True and a node is already identified with this
+        identity on another connection, the node is moved to this
+        connection and its jobs are kept. The replaced node is returned.
+        A node replicated from a peer or restored from a snapshot is always
+        replaced by a node connected to this lookupd.
+        """
         with self._lock:
             # check if we already identified this node
             if self.nodes[conn].name is not None:
                 raise AlreadyIdentified()
 
+            node = self.nodes[conn]
+
             # check if we already identified a node with this identity
-            for _, node in self.nodes.items():
-                if node.name == name and node.origin == origin:
+            replaced = self._idents.get((name, origin))
+            if replaced is not None:
+                takeover = resume or (node.peer is None and not node.stale
+                        and (replaced.peer is not None or replaced.stale))
+                if not takeover:
                     raise IdentExists()
 
-            self.nodes[conn].identify(name, origin, version)
-            self._emitter.publish('identify', self.nodes[conn])
-
+                # take over the jobs of the old connection, it will be
+                # removed silently.
+                del self.nodes[replaced.conn]
+                if self._wheel is not None:
+                    self._wheel.cancel(replaced.conn)
+                self._names[name].remove(replaced)
+                node.sessions = replaced.sessions
+                for jobs in node.sessions.values():
+                    for job in jobs.values():
+                        job.node = node
+                replaced.sessions = {}
+
+            node.identify(name, origin, version)
+            self._idents[(name, origin)] = node
+            self._names.setdefault(name, []).append(node)
+            self._emitter.publish('identify', node)
+            return replaced
+
+    def sync_node(self, conn, jobs):
+        """ synchronize the jobs of a node with a snapshot
+        ``{job_name: [pid, ...]}``. Only the differences are applied and
+        published. """
+        with self._lock:
+            node = self._get_node(conn)
 
-    def update(self, conn):
+            # remove the jobs that are gone
+            for sessionid, session_jobs in list(node.sessions.items()):
+                for job in list(session_jobs.values()):
+                    if job.name not in jobs:
+                        self.remove_job(conn, job.name)
+
+            for job_name, pids in jobs.items():
+                try:
+                    job = node.get_job(job_name)
+                except JobNotFound:
+                    self.add_job(conn, job_name)
+                    job = node.get_job(job_name)
+
+                pids = set(pids)
+                for pid in set(job.pids) - pids:
+                    self.remove_process(conn, job_name, pid)
+                for pid in pids - set(job.pids):
+                    self.add_process(conn, job_name, pid)
+
+
+    def update(self, conn, load=None):
+        """ update the node on heartbeat. ``load`` is the load summary of
+        its jobs. """
         with self._lock:
             # we can update a non identified Node
             if not conn in self.nodes:
                 return
             self.nodes[conn].update()
+            if isinstance(load, dict):
+                self.nodes[conn].load = load
+            self._heartbeats += 1
+            self._touch(conn)
 
     def all_nodes(self):
         """ get all identified nodes """
@@ -222,6 +371,18 @@ class Registry(object):
             nodes = [node for _, node in self.nodes.items() if node is not None]
             return nodes
 
+    def metrics(self):
+        """ return the number of nodes and the heartbeat and expiry
+        counters """
+        with self._lock:
+            return {"nodes": len(self.nodes),
+                    "identified_nodes": len(self._idents),
+                    "jobs": len(self._jobs),
+                    "node_timeout": self.node_timeout,
+                    "heartbeats": self._heartbeats,
+                    "expired_nodes": self._expired,
+                    "last_expiry": self._last_expiry}
+
     def get_node(self, conn):
         """ get a node """
         with self._lock:
@@ -235,15 +396,13 @@ class Registry(object):
 
         with self._lock:
             sessions = OrderedDict()
-            for _, node in self.nodes.items():
-                # if the node isn't identified, continue
-                if node is None:
-                    continue
-
-                # if we filter by node, check if we can add the session
-                if with_node != '*' and node.name != with_node:
-                    continue
+            if with_node == '*':
+                for sessionid, jobs in self._sessions.items():
+                    sessions[sessionid] = OrderedDict((job_name, list(rjobs))
+                            for job_name, rjobs in jobs.items())
+                return sessions
 
+            for node in self._names.get(with_node, []):
                 for sessionid, jobs in node.sessions.items():
                     if not sessionid in sessions:
                         sessions[sessionid] = {}
@@ -258,76 +417,67 @@ class Registry(object):
     def find_session(self, sessionid):
         with self._lock:
             all_jobs = []
-            for _, node in self.nodes.items():
-                # if the node isn't identified, continue
-                if node is None:
-                    continue
-                for session, jobs in node.sessions.items():
-                    if sessionid == session:
-                        for _, job in jobs.items():
-                            all_jobs.append(job)
-                        break
+            for jobs in self._sessions.get(sessionid, {}).values():
+                all_jobs.extend(jobs)
             return all_jobs
 
     def node_by_name(self, name):
         """ get a node by its identity """
         with self._lock:
-            nodes = []
-            for node in self.nodes:
-                if node is None:
-                    continue
+            return list(self._names.get(name, []))
 
-                if node.name == name:
-                    nodes.append(node)
-            return nodes
+    def node_by_ident(self, name, origin):
+        """ get the node identified by (name, origin) or None """
+        with self._lock:
+            return self._idents.get((name, origin))
 
-    def find_job(self, job_name):
+    def find_job(self, job_name, strategy=None, limit=None):
         """ find a job in the registry, return a list of all remote job
-        possible for this ``sessionid.name`` """
-        sessionid, name = parse_job_name(job_name)
-        with self._lock:
-            jobs = []
-            for _, node in self.nodes.items():
-                # is not identified?
-                if node is None:
-                    continue
+        possible for this ``sessionid.name``
 
-                # does this node support this session?
-                if sessionid not in node.sessions:
-                    continue
+        The sources are ranked by ``strategy``:
 
-                # finally does this session support this job?
-                if name not in node.sessions[sessionid]:
-                    continue
+        - ``least_loaded``: the least loaded first
+        - ``p2c``: power of two choices, each source is the least loaded of
+          two sources picked randomly
+        - ``round_robin``: the first source changes on each call
 
-                jobs.append(node.sessions[sessionid][name])
+        At most ``limit`` sources are returned.
+        """
+        if strategy is not None and strategy not in STRATEGIES:
+            raise UnknownStrategy("%r is not a routing strategy" % strategy)
 
-            if not jobs:
+        with self._lock:
+            try:
+                jobs = list(self._jobs[job_name])
+            except KeyError:
                 raise JobNotFound()
-            return jobs
+
+            if strategy == "least_loaded":
+                jobs.sort(key=load_key)
+            elif strategy == "p2c":
+                jobs = self._p2c(jobs, limit)
+            elif strategy == "round_robin" and jobs:
+                start = self._rr.get(job_name, 0) % len(jobs)
+                self._rr[job_name] = start + 1
+                jobs = jobs[start:] + jobs[:start]
+
+        if limit:
+            jobs = jobs[:limit]
+        return jobs
 
     def jobs(self):
         """ return all remote jobs by their name """
         with self._lock:
-            all_jobs = OrderedDict()
-            for _, node in self.nodes.items():
-                # is not identified?
-                if node is None:
-                    continue
-
-                for sessionsid, jobs in node.sessions.items():
-                    for _, job in jobs.items():
-                        if job.name not in all_jobs:
-                            all_jobs[job.name] = []
-
-                        all_jobs[job.name].append(job)
-            return all_jobs
+            return OrderedDict((job_name, list(jobs))
+                    for job_name, jobs in self._jobs.items())
 
     def add_job(self, conn, job_name):
         """ add a job to the registry """
         with self._lock:
             node = self._get_node(conn)
             node.add_job(job_name)
+            self._index_job(node.get_job(job_name))
             event = {"node": self.nodes[conn], "job_name":  job_name}
             self._emitter.publish('add_job', event)
 
@@ -335,6 +485,10 @@ class Registry(object):
         """ remove a job from the registry """
         with self._lock:
             node = self._get_node(conn)
+            try:
+                self._unindex_job(node.get_job(job_name))
+            except JobNotFound:
+                pass
             node.remove_job(job_name)
             event = {"node": self.nodes[conn], "job_name":  job_name}
             self._emitter.publish('remove_job', event)
@@ -362,8 +516,75 @@ class Registry(object):
 
     ### private functions
 
+    def _p2c(self, jobs, limit=None):
+        ranked = []
+        jobs = list(jobs)
+        limit = limit or len(jobs)
+        while jobs and len(ranked) < limit:
+            if len(jobs) == 1:
+                ranked.append(jobs.pop())
+                break
+
+            i, j = random.sample(range(len(jobs)), 2)
+            if load_key(jobs[j]) < load_key(jobs[i]):
+                i = j
+            ranked.append(jobs.pop(i))
+        return ranked
+
+    def _touch(self, conn):
+        if self._wheel is None:
+            return
+
+        # replicated nodes are expired by their peer and the stale nodes
+        # by the store
+        node = self.nodes.get(conn)
+        if node is not None and node.peer is None and not node.stale:
+            self._wheel.schedule(conn, self.node_timeout)
+
+    def _expire_node(self, conn):
+        with self._lock:
+            if conn not in self.nodes:
+                return
+
+            self._expired += 1
+            self._last_expiry = time.time()
+            self.remove_node(conn)
+
+        # the connection is half dead, close it
+        close = getattr(conn, "close", None)
+        if close is not None:
+            try:
+                close()
+            except Exception:
+                pass
+
+    def _index_job(self, job):
+        jobs = self._jobs.get(job.name)
+        if jobs is None:
+            jobs = self._jobs[job.name] = []
+            sessionid, _ = parse_job_name(job.name)
+            self._sessions.setdefault(sessionid, OrderedDict())[job.name] = jobs
+        jobs.append(job)
+
+    def _unindex_job(self, job):
+        jobs = self._jobs.get(job.name, [])
+        if job in jobs:
+            jobs.remove(job)
+
+        if not jobs:
+            self._jobs.pop(job.name, None)
+            self._rr.pop(job.name, None)
+            sessionid, _ = parse_job_name(job.name)
+            session = self._sessions.get(sessionid, {})
+            session.pop(job.name, None)
+            if not session:
+                self._sessions.pop(sessionid, None)
+
     def _get_node(self, conn):
         node = self.nodes[conn]
         if node.name is None:
             raise NoIdent("need to send IDENTIFY message first")
+
+        # any message from the node proves it's alive
+        self._touch(conn)
         return node
@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -
+#
+# This file is part of gaffer. See the NOTICE for more information.
+"""
+Persistence of the registry, so a restarted lookupd can answer the queries
+before the nodes reconnect.
+
+The nodes connected to lookupd are written in a compact JSON snapshot every
+``snapshot_interval`` seconds. Changes made in between are appended to a
+delta log (``<path>.log``). Snapshots are written atomically in the thread
+pool: the log is first rotated to ``<path>.log.1`` which is removed once the
+snapshot is on the disk.
+
+On start the snapshot and the logs are replayed and the nodes are restored
+as ``stale``. A stale node is replaced by the node identifying with the same
+name and origin, which then only sends what changed. Stale nodes that
+didn't reconnect after ``stale_timeout`` seconds are removed.
+"""
+
+from collections import OrderedDict
+import json
+import logging
+import os
+import sys
+import time
+
+import pyuv
+
+LOGGER = logging.getLogger("gaffer")
+
+# version of the snapshot format
+SNAPSHOT_VERSION = 1
+
+
+class StaleConn(object):
+    """ connection of a node restored from a snapshot """
+
+    def __init__(self, key):
+        self.key = key
+
+    def __str__(self):
+        return "stale: %s" % self.key[0]
+
+    def close(self):
+        # the node reconnected
+        pass
+
+
+def replay(nodes, entry):
+    """ apply an entry of the log to the nodes ``{(name, origin): {"version":
+    version, "jobs": {job_name: set(pids)}}}`` """
+    key = tuple(entry["node"])
+    op = entry["op"]
+
+    if op == "identify":
+        node = nodes.setdefault(key, {"version": None, "jobs": {}})
+        node["version"] = entry["version"]
+        return
+    elif op == "remove_node":
+        nodes.pop(key, None)
+        return
+
+    node = nodes.get(key)
+    if node is None:
+        return
+
+    jobs = node["jobs"]
+    job_name = entry["job_name"]
+    if op == "add_job":
+        jobs.setdefault(job_name, set())
+    elif op == "remove_job":
+        jobs.pop(job_name, None)
+    elif op == "add_process":
+        jobs.setdefault(job_name, set()).add(entry["pid"])
+    elif op == "remove_process":
+        jobs.get(job_name, set()).discard(entry["pid"])
+
+
+class RegistryStore(object):
+    """ write the registry in snapshots and a delta log
+
+    Args:
+
+    - **loop**: the pyuv loop
+    - **registry**: the `Registry` to persist
+    - **path**: path of the snapshot
+    - **snapshot_interval**: interval in seconds between the snapshots
+    - **stale_timeout**: time in seconds after which the restored nodes that
+      didn't reconnect are removed
+    - **max_log**: number of entries of the log after which a snapshot is
+      written without waiting for the interval
+    """
+
+    def __init__(self, loop, registry, path, snapshot_interval=60.0,
+            stale_timeout=60.0, max_log=10000, flush_interval=1.0):
+        self.loop = loop
+        self.registry = registry
+        self.path = path
+        self.log_path = "%s.log" % path
+        self.rotated_path = "%s.log.1" % path
+        self.snapshot_interval = snapshot_interval
+        self.stale_timeout = stale_timeout
+        self.max_log = max_log
+        self.flush_interval = flush_interval
+
+        self._log = None
+        self._log_size = 0
+        self._writing = False
+        self._stale = set()
+
+        self._snapshot_timer = pyuv.Timer(loop)
+        self._flush_timer = pyuv.Timer(loop)
+        self._stale_timer = pyuv.Timer(loop)
+        self.started = False
+
+    def load(self):
+        """ restore the nodes of the last snapshot and its logs in the
+        registry as stale nodes. Return the number of nodes restored. """
+        nodes = OrderedDict()
+
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                try:
+                    data = json.load(f)
+                except ValueError:
+                    LOGGER.error("STORE: invalid snapshot %r" % self.path)
+                    data = {}
+
+            if data.get("version") == SNAPSHOT_VERSION:
+                for node in data.get("nodes", []):
+                    jobs = dict((job_name, set(pids)) for job_name, pids in
+                            node["jobs"].items())
+                    nodes[(node["name"], node["origin"])] = {
+                            "version": node["version"], "jobs": jobs}
+
+        for path in (self.rotated_path, self.log_path):
+            if not os.path.exists(path):
+                continue
+
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # the last entry was partially written
+                        break
+                    replay(nodes, entry)
+
+        for key, node in nodes.items():
+            if self.registry.node_by_ident(*key) is not None:
+                continue
+
+            conn = StaleConn(key)
+            self.registry.add_node(conn, stale=True)
+            self.registry.identify(conn, key[0], key[1], node["version"])
+            self.registry.sync_node(conn, dict((job_name, list(pids))
+                for job_name, pids in node["jobs"].items()))
+            self._stale.add(conn)
+
+        return len(nodes)
+
+    def start(self):
+        if self.started:
+            return
+        self.started = True
+
+        # fold the logs in a new snapshot
+        self._rotate()
+        self._write(self.path, self._capture())
+        self._remove_rotated()
+
+        self.registry.bind_all(self._on_event)
+
+        self._snapshot_timer.start(self._on_snapshot, self.snapshot_interval,
+                self.snapshot_interval)
+        self._snapshot_timer.unref()
+        self._flush_timer.start(self._on_flush, self.flush_interval,
+                self.flush_interval)
+        self._flush_timer.unref()
+
+        if self._stale:
+            self._stale_timer.start(self._expire_stale, self.stale_timeout,
+                    0.0)
+            self._stale_timer.unref()
+
+    def stop(self):
+        if not self.started:
+            return
+        self.started = False
+
+        self.registry.unbind_all(self._on_event)
+        self._snapshot_timer.close()
+        self._flush_timer.close()
+        self._stale_timer.close()
+
+        # write the last snapshot now, lookupd is stopping
+        if not self._writing:
+            self._rotate()
+            self._write(self.path, self._capture())
+            self._remove_rotated()
+        self._close_log()
+
+    def snapshot(self):
+        """ write a snapshot in the thread pool """
+        if self._writing:
+            return
+        self._writing = True
+
+        # the changes made from now are logged in a new log
+        self._rotate()
+        data = self._capture()
+
+        result = {}
+        def write():
+            try:
+                self._write(self.path, data)
+            except Exception:
+                result['error'] = sys.exc_info()[1]
+
+        def on_written(*args):
+            self._writing = False
+            if 'error' in result:
+                LOGGER.error("STORE: error writing the snapshot: %s" %
+                        str(result['error']))
+                return
+            self._remove_rotated()
+
+        self.loop.queue_work(write, on_written)
+
+    ### private functions
+
+    def _capture(self):
+        nodes = []
+        for node in self.registry.all_nodes():
+            if node.peer is not None or node.name is None:
+                continue
+
+            jobs = {}
+            for session in node.sessions.values():
+                for job in session.values():
+                    jobs[job.name] = job.pids
+
+            nodes.append({"name": node.name, "origin": node.origin,
+                "version": node.version, "jobs": jobs})
+
+        return json.dumps({"version": SNAPSHOT_VERSION,
+            "created": time.time(), "nodes": nodes}, separators=(',', ':'))
+
+    def _write(self, path, data):
+        # write the snapshot atomically
+        tmp_path = "%s.tmp" % path
+        with open(tmp_path, "w") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, path)
+
+    def _rotate(self):
+        # a log already rotated hasn't been folded in a snapshot, keep
+        # appending to it
+        self._close_log()
+        if os.path.exists(self.log_path):
+            if os.path.exists(self.rotated_path):
+                with open(self.rotated_path, "a") as rotated:
+                    with open(self.log_path) as f:
+                        rotated.write(f.read())
+                os.unlink(self.log_path)
+            else:
+                os.rename(self.log_path, self.rotated_path)
+        self._log_size = 0
+
+    def _remove_rotated(self):
+        try:
+            os.unlink(self.rotated_path)
+        except OSError:
+            pass
+
+    def _close_log(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    def _append(self, entry):
+        if self._log is None:
+            self._log = open(self.log_path, "a")
+
+        self._log.write(json.dumps(entry, separators=(',', ':')) + "\n")
+        self._log_size += 1
+        if self._log_size >= self.max_log:
+            self.snapshot()
+
+    def _on_event(self, event, msg):
+        if isinstance(msg, dict):
+            node = msg.get("node")
+        else:
+            node = msg
+
+        # only the nodes connected to this lookupd are persisted. The
+        # events of the restored nodes are already in the snapshot.
+        if (node is None or node.peer is not None or node.stale or
+                node.name is None):
+            return
+
+        key = [node.name, node.origin]
+        if event == "identify":
+            self._append({"op": event, "node": key,
+                "version": node.version})
+        elif event == "remove_node":
+            # the node reconnected since
+            current = self.registry.node_by_ident(node.name, node.origin)
+            if current is None or current is node:
+                self._append({"op": event, "node": key})
+        elif event in ("add_job", "remove_job"):
+            self._append({"op": event, "node": key,
+                "job_name": msg["job_name"]})
+        elif event in ("add_process", "remove_process"):
+            self._append({"op": event, "node": key,
+                "job_name": msg["job_name"], "pid": msg["pid"]})
+
+    def _on_flush(self, handle):
+        if self._log is not None:
+            self._log.flush()
+
+    def _on_snapshot(self, handle):
+        if self._log_size:
+            self.snapshot()
+
+    def _expire_stale(self, handle):
+        stale, self._stale = self._stale, set()
+
+        expired = 0
+        for conn in stale:
+            if conn not in self.registry.nodes:
+                # the node reconnected
+                continue
+
+            self.registry.remove_node(conn)
+            self._append({"op": "remove_node", "node": list(conn.key)})
+            expired += 1
+
+        if expired:
+            LOGGER.info("STORE: %s stale nodes expired" % expired)
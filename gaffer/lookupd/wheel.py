@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -
+#
+# This file is part of gaffer. See the NOTICE for more information.
+"""
+Hashed timer wheel used to expire the nodes that stopped sending
+heartbeats. One timer ticks for all the entries and refreshing an entry is
+O(1), so it scales to thousands of nodes.
+"""
+
+import math
+
+import pyuv
+
+
+class TimerWheel(object):
+    """ hashed timer wheel
+
+    Args:
+
+    - **loop**: the pyuv loop
+    - **callback**: function called with the key of each expired entry
+    - **tick**: resolution of the wheel in seconds
+    - **slots**: number of slots of the wheel. Entries scheduled further than
+      ``tick * slots`` seconds wait for more than one turn.
+    """
+
+    def __init__(self, loop, callback, tick=1.0, slots=512):
+        self.loop = loop
+        self.callback = callback
+        self.tick = tick
+        self.nslots = slots
+
+        # each slot maps a key to the number of turns left
+        self._slots = [dict() for _ in range(slots)]
+        # key -> slot index
+        self._entries = {}
+        self._cursor = 0
+
+        self._timer = pyuv.Timer(loop)
+        self._started = False
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def start(self):
+        if self._started:
+            return
+        self._started = True
+        self._timer.start(self._on_tick, self.tick, self.tick)
+        self._timer.unref()
+
+    def stop(self):
+        if not self._started:
+            return
+        self._started = False
+        self._timer.stop()
+
+    def close(self):
+        self.stop()
+        self._timer.close()
+        self._entries = {}
+        self._slots = [dict() for _ in range(self.nslots)]
+
+    def schedule(self, key, delay):
+        """ (re)schedule the expiry of a key in ``delay`` seconds """
+        self.cancel(key)
+
+        ticks = max(1, int(math.ceil(delay / self.tick)))
+        turns, offset = divmod(ticks, self.nslots)
+        if offset == 0:
+            # expire at the end of the previous turn
+            turns, offset = turns - 1, self.nslots
+
+        idx = (self._cursor + offset) % self.nslots
+        self._slots[idx][key] = turns
+        self._entries[key] = idx
+
+    def cancel(self, key):
+        """ remove a key from the wheel """
+        idx = self._entries.pop(key, None)
+        if idx is not None:
+            self._slots[idx].pop(key, None)
+
+    def _on_tick(self, handle):
+        self._cursor = (self._cursor + 1) % self.nslots
+        slot = self._slots[self._cursor]
+
+        expired = []
+        for key, turns in list(slot.items()):
+            if turns > 0:
+                slot[key] = turns - 1
+            else:
+                del slot[key]
+                del self._entries[key]
+                expired.append(key)
+
+        for key in expired:
+            self.callback(key)
@@ -17,11 +17,18 @@ import pyuv
 
 from .events import EventEmitter
 from .error import ProcessError, ProcessConflict, ProcessNotFound
+from .process import ProcessConfig, Zygote
 from .pubsub import Topic
+from .sockets import ListenSocket
 from .state import ProcessState, ProcessTracker
 from .sync import increment
 from .util import parse_signal_value
 
+# events changing the state returned by the read functions of the manager.
+# Each of these events increase the manager generation.
+GENERATION_EVENTS = ("load", "unload", "update", "start", "stop", "spawn",
+        "adopt", "reap", "stop_process", "exit", "flap")
+
 
 class Manager(object):
     """ Manager - maintain process alive
@@ -81,8 +88,10 @@ class Manager(object):
         self.started = False
         self._stop_ev = None
         self.max_process_id = 0
+        self.generation = 0
         self.processes = OrderedDict()
         self.running = OrderedDict()
+        self.sockets = OrderedDict()
         self._sessions = OrderedDict()
         self._topics = {}
         self._updates = deque()
@@ -90,6 +99,7 @@ class Manager(object):
 
         self.status = -1
         self.stop_cb = None
+        self.keep_processes = False
         self.restart_cb = None
         self._lock = RLock()
 
@@ -128,8 +138,12 @@ class Manager(object):
             raise RuntimeError("manager hasn't been started")
         self.loop.run()
 
-    def stop(self, callback=None):
-        """ stop the manager. This function is threadsafe """
+    def stop(self, callback=None, keep_processes=False):
+        """ stop the manager. This function is threadsafe
+
+        When ``keep_processes`` is True the processes are left running so
+        they can be adopted by the next manager (see :meth:`restore`).
+        """
 
         if not self.started:
             return
@@ -140,6 +154,7 @@ class Manager(object):
 
         # set the callback
         self.stop_cb = callback
+        self.keep_processes = keep_processes
 
         # update the status to stop and wake up the loop
         self.status = 1
@@ -223,6 +238,8 @@ class Manager(object):
         sessionid = self._sessionid(sessionid)
 
         with self._lock:
+            self._check_sockets(config)
+
             if sessionid in self._sessions:
                 # if the process already exists in this context raises a
                 # conflict.
@@ -295,6 +312,7 @@ class Manager(object):
             # reset the number of processes
             state = self._get_state(sessionid, name)
             state.reset()
+            self._bump_generation()
 
             # kill all the processes and let gaffer manage asynchronously the
             # reload
@@ -308,8 +326,10 @@ class Manager(object):
         sessionid = self._sessionid(sessionid)
 
         with self._lock:
+            self._check_sockets(config)
             state = self._get_state(sessionid, config.name)
             state.update(config, env=env)
+            self._bump_generation()
 
             if start:
                 # make sure we unstop the process
@@ -634,6 +654,132 @@ class Manager(object):
     def pids(self, name=None):
         return [p.pid for p in self.list(name=name)]
 
+    def snapshot(self):
+        """ return the sessions, jobs, pids and their counts in one dict.
+        The generation of the manager is returned with it so a client can
+        know if something changed since its last snapshot. """
+        with self._lock:
+            jobs = OrderedDict()
+            for sessionid, session in self._sessions.items():
+                for name, state in session.items():
+                    pids = state.pids
+                    jobs[state.name] = {"sessionid": sessionid,
+                            "name": name,
+                            "active": state.active,
+                            "running": len(pids),
+                            "running_out": len(state.running_out),
+                            "max_processes": state.numprocesses,
+                            "pids": pids}
+
+            pids = list(self.running)
+            return {"generation": self.generation,
+                    "sessions": list(self._sessions),
+                    "jobs": jobs,
+                    "pids": pids,
+                    "counts": {"sessions": len(self._sessions),
+                               "jobs": len(jobs),
+                               "pids": len(pids)}}
+
+    def dump_state(self):
+        """ return the jobs and their processes in a dict that can be
+        encoded in JSON and given to :meth:`restore` """
+        with self._lock:
+            jobs = []
+            for sessionid, session in self._sessions.items():
+                for name, state in session.items():
+                    processes = []
+                    for p in list(state.running) + list(state.running_out):
+                        processes.append({"pid": p.pid,
+                            "os_pid": p.os_pid,
+                            "create_time": p.create_time,
+                            "once": p.once})
+
+                    jobs.append({"sessionid": sessionid,
+                        "config": state.config.to_state(),
+                        "env": state.env,
+                        "numprocesses": state.numprocesses,
+                        "stopped": state.stopped,
+                        "processes": processes})
+
+            sockets = [sock.to_dict() for sock in self.sockets.values()]
+            return {"max_process_id": self.max_process_id, "jobs": jobs,
+                    "sockets": sockets}
+
+    def restore(self, state, fds=None):
+        """ load the jobs of a state returned by :meth:`dump_state` and adopt
+        their processes still running. Missing processes are spawned.
+
+        Args:
+
+        - **state**: the state dict
+        - **fds**: dict of the stdio pipes of the processes by OS pid (see
+          :meth:`gaffer.process.Process.adopt`) and of the listening sockets
+          by ``socket:<name>`` keys. Sockets not given are bound again.
+
+        Return the OS pids of the processes adopted.
+        """
+        fds = fds or {}
+        adopted = []
+
+        with self._lock:
+            self.max_process_id = max(self.max_process_id,
+                    state.get("max_process_id", 0))
+
+            # the sockets are needed to spawn the processes
+            for settings in state.get("sockets", []):
+                name = settings["name"]
+                if name in self.sockets:
+                    continue
+
+                sock_fds = fds.get("socket:%s" % name)
+                if sock_fds:
+                    sock = ListenSocket.from_fds(sock_fds, **settings)
+                else:
+                    sock = ListenSocket(**settings)
+                    sock.bind()
+                self.sockets[name] = sock
+
+            for job in state.get("jobs", []):
+                sessionid = job["sessionid"]
+                config = ProcessConfig.from_dict(job["config"])
+                session = self._sessions.get(sessionid)
+                if session is not None and config.name in session:
+                    # the job has already been loaded
+                    continue
+                elif session is None:
+                    session = self._sessions[sessionid] = OrderedDict()
+
+                pstate = ProcessState(config, sessionid, job.get("env"))
+                pstate.numprocesses = job["numprocesses"]
+                pstate.stopped = job["stopped"]
+                session[config.name] = pstate
+                self._publish("load", name=pstate.name)
+
+                for info in job["processes"]:
+                    p = pstate.make_process(self.loop, info["pid"],
+                            self._on_process_exit, sockets=self.sockets)
+                    if not p.adopt(info["os_pid"], info.get("create_time"),
+                            fds.get(info["os_pid"])):
+                        continue
+
+                    if info.get("once"):
+                        p.once = True
+                        pstate.running_out.append(p)
+                    else:
+                        pstate.queue(p)
+                    self.running[p.pid] = p
+                    adopted.append(p.os_pid)
+
+                    self._publish("adopt", name=p.name, pid=p.pid,
+                            os_pid=p.os_pid)
+                    self._publish("job.%s.adopt" % p.name, name=p.name,
+                            pid=p.pid, os_pid=p.os_pid)
+
+                # spawn the processes that exited meanwhile
+                self._manage_processes(pstate)
+
+        return adopted
+
     def manage(self, name):
         sessionid, name = self._parse_name(name)
         with self._lock:
@@ -660,6 +806,55 @@ class Manager(object):
                 p.unmonitor(listener)
 
 
+    # ------------- socket functions
+
+    def add_socket(self, name, addr=None, backlog=128, reuse_port=False,
+            unix_mode=0o600, sockets=None):
+        """ bind a listening socket that can be passed to the processes of
+        the jobs listing its name in their ``sockets`` setting. The socket is
+        created once and stays open while the processes are restarted.
+
+        Args:
+
+        - **name**: name of the socket
+        - **addr**: address to bind, ``host:port`` or ``unix:path``
+        - **backlog**: backlog of the socket
+        - **reuse_port**: set SO_REUSEPORT on the socket
+        - **unix_mode**: permissions of the unix socket file
+        - **sockets**: sockets already bound to use instead of binding
+          ``addr``
+        """
+        with self._lock:
+            if name in self.sockets:
+                raise ProcessConflict("socket_conflict")
+
+            sock = ListenSocket(name, addr, backlog=backlog,
+                    reuse_port=reuse_port, unix_mode=unix_mode,
+                    sockets=sockets)
+            sock.bind()
+            self.sockets[name] = sock
+            self._publish("add_socket", name=name)
+
+    def remove_socket(self, name):
+        """ close a listening socket. The processes using it keep their
+        copy until they are restarted. """
+        with self._lock:
+            try:
+                sock = self.sockets.pop(name)
+            except KeyError:
+                raise ProcessNotFound("socket_not_found")
+
+            sock.close()
+            self._publish("remove_socket", name=name)
+
+    def get_socket(self, name):
+        """ return a :class:`gaffer.sockets.ListenSocket` """
+        with self._lock:
+            try:
+                return self.sockets[name]
+            except KeyError:
+                raise ProcessNotFound("socket_not_found")
+
     # ------------- general purpose utilities
 
     def wakeup(self):
@@ -710,6 +905,11 @@ class Manager(object):
 
         return session[name]
 
+    def _check_sockets(self, config):
+        for name in config.get("sockets", []):
+            if name not in self.sockets:
+                raise ProcessNotFound("socket_not_found")
+
     def _get_pid(self, pid):
         try:
             return self.running[pid]
@@ -729,6 +929,12 @@ class Manager(object):
             for ctl in self.mapps:
                 ctl.stop()
 
+            # close the listening sockets. The unix sockets are still used
+            # when the processes are kept
+            for sock in self.sockets.values():
+                sock.close(unlink=not self.keep_processes)
+            self.sockets.clear()
+
             # we are now stopped
             self.started = False
 
@@ -751,8 +957,20 @@ class Manager(object):
 
         self.stopping = True
 
-        # stop all processes
         with self._lock:
+            if self.keep_processes:
+                # only close the handles, the processes continue to run
+                for p in self.running.values():
+                    p.release()
+
+                for sid in self._sessions:
+                    for state in self._sessions[sid].values():
+                        self._stop_zygote(state)
+
+                self._tracker.on_done(self._shutdown)
+                return
+
+            # stop all processes
             for sid in self._sessions:
                 for name, state in self._sessions[sid].items():
                     if not state.stopped:
@@ -826,6 +1044,26 @@ class Manager(object):
         if not state.stopped and state.flapping_timer is not None:
             state.flapping_timer.start()
 
+        # the zygote is started again with the new code on the next spawn
+        self._stop_zygote(state)
+
+    def _get_zygote(self, state):
+        """ return the zygote forking the processes of a job with
+        ``spawn_mode = "zygote"`` """
+        if (state.config.get("spawn_mode") != "zygote" or
+                state.config.get("shell")):
+            return None
+
+        if state.zygote is None:
+            state.zygote = Zygote(self.loop, state.name,
+                    preload=state.config.get("preload"))
+        return state.zygote
+
+    def _stop_zygote(self, state):
+        if state.zygote is not None:
+            state.zygote.stop()
+            state.zygote = None
+
     # ------------- functions that manage the process
 
     def _commit_process(self, state, graceful_timeout=10.0, env=None):
@@ -835,7 +1073,8 @@ class Manager(object):
         pid = self.get_process_id()
 
         # start process
-        p = state.make_process(self.loop, pid, self._on_process_exit)
+        p = state.make_process(self.loop, pid, self._on_process_exit,
+                sockets=self.sockets, zygote=self._get_zygote(state))
         p.spawn(once=True, graceful_timeout=graceful_timeout, env=env)
 
         # add the pid to external processes in the state
@@ -857,7 +1096,8 @@ class Manager(object):
         pid = self.get_process_id()
 
         # start process
-        p = state.make_process(self.loop, pid, self._on_process_exit)
+        p = state.make_process(self.loop, pid, self._on_process_exit,
+                sockets=self.sockets, zygote=self._get_zygote(state))
         p.spawn()
 
         # add the process to the running state
@@ -942,6 +1182,7 @@ class Manager(object):
                     # allows respawning
                     state.stopped = False
                     state._flapping_timer = None
+                    self._bump_generation()
 
                     # restart processes
                     self._restart_processes(state)
@@ -952,7 +1193,13 @@ class Manager(object):
             return False
         return True
 
+    def _bump_generation(self):
+        self.generation = increment(self.generation)
+
     def _publish(self, evtype, **ev):
+        if evtype in GENERATION_EVENTS:
+            self._bump_generation()
+
         event = {"event": evtype }
         event.update(ev)
         self.events.publish(evtype, event)
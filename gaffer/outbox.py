@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -
+#
+# This file is part of gaffer. See the NOTICE for more information.
+"""
+Durable outbox of the webhooks.
+
+Events are appended to segment files named after the sequence number of
+their first event. Each line is ``<event>\\t<json body>``. A cursor is kept
+for each URL: the sequence number of the first event not yet delivered. The
+cursors are written atomically in ``cursors.json``, so after a restart the
+delivery resumes from them. An event can be posted again if gafferd stopped
+before its cursor was written.
+
+The segments that all the cursors passed are removed. When the outbox grows
+over ``max_size`` the oldest segments are removed even if they haven't been
+delivered.
+"""
+
+import bisect
+from collections import OrderedDict
+import json
+import logging
+import os
+
+LOGGER = logging.getLogger("gaffer")
+
+# default size of a segment file
+SEGMENT_SIZE = 4 * 1024 * 1024
+
+# number of read positions remembered
+MAX_HINTS = 128
+
+
+class Outbox(object):
+    """ append-only log of events with a cursor per URL
+
+    Args:
+
+    - **path**: directory of the outbox
+    - **max_size**: maximum size in bytes of the segments kept on the disk
+    - **segment_size**: size in bytes after which a new segment is started
+    """
+
+    def __init__(self, path, max_size=256 * 1024 * 1024,
+            segment_size=SEGMENT_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.segment_size = segment_size
+        self.cursors_path = os.path.join(path, "cursors.json")
+
+        # [first sequence number, size] of each segment
+        self.segments = []
+        self.next_seq = 0
+        self.cursors = {}
+        self.dropped = 0
+
+        self._file = None
+        # next sequence number -> (segment, offset) of the previous reads
+        self._hints = OrderedDict()
+
+    @property
+    def first_seq(self):
+        """ sequence number of the oldest event kept """
+        if self.segments:
+            return self.segments[0][0]
+        return self.next_seq
+
+    @property
+    def size(self):
+        return sum(size for _, size in self.segments)
+
+    def open(self):
+        """ load the segments and the cursors """
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        for name in os.listdir(self.path):
+            first, ext = os.path.splitext(name)
+            if ext == ".seg" and first.isdigit():
+                size = os.path.getsize(os.path.join(self.path, name))
+                self.segments.append([int(first), size])
+        self.segments.sort()
+
+        if self.segments:
+            self._recover_last()
+
+        if os.path.exists(self.cursors_path):
+            with open(self.cursors_path) as f:
+                try:
+                    self.cursors = json.load(f)
+                except ValueError:
+                    LOGGER.error("OUTBOX: invalid cursors %r" %
+                            self.cursors_path)
+
+    def close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+    def append(self, event, body):
+        """ append an event encoded in JSON, return its sequence number """
+        if (self._file is None or not self.segments or
+                self.segments[-1][1] >= self.segment_size):
+            self._new_segment()
+
+        line = ("%s\t%s\n" % (event, body)).encode("utf-8")
+        self._file.write(line)
+        # visible to the readers and safe if gafferd crashes, the disk
+        # itself is synced by `sync`
+        self._file.flush()
+        self.segments[-1][1] += len(line)
+
+        seq = self.next_seq
+        self.next_seq += 1
+
+        if self.size > self.max_size:
+            self._drop_oldest()
+        return seq
+
+    def read(self, seq, limit):
+        """ return up to ``limit`` events ``(seq, event, body)`` starting at
+        ``seq`` """
+        seq = max(seq, self.first_seq)
+        firsts = [first for first, _ in self.segments]
+        idx = bisect.bisect_right(firsts, seq) - 1
+
+        records = []
+        while 0 <= idx < len(self.segments) and len(records) < limit:
+            first = self.segments[idx][0]
+            hint = self._hints.pop(seq, None)
+            if hint is not None and hint[0] == first:
+                current, offset = seq, hint[1]
+            else:
+                current, offset = first, 0
+
+            with open(self._segment_path(first), "rb") as f:
+                f.seek(offset)
+                while len(records) < limit:
+                    line = f.readline()
+                    if not line.endswith(b"\n"):
+                        break
+                    offset += len(line)
+                    if current >= seq:
+                        event, body = line[:-1].decode("utf-8").split("\t", 1)
+                        records.append((current, event, body))
+                    current += 1
+
+            seq = current
+            if len(records) < limit:
+                idx += 1
+            else:
+                # the next read continues from here
+                self._hints[seq] = (first, offset)
+                while len(self._hints) > MAX_HINTS:
+                    self._hints.popitem(last=False)
+
+        return records
+
+    def sync(self):
+        """ write the appended events to the disk """
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def save_cursors(self, cursors):
+        """ write the cursors atomically """
+        self.cursors = cursors
+        tmp_path = "%s.tmp" % self.cursors_path
+        with open(tmp_path, "w") as f:
+            json.dump(cursors, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.cursors_path)
+
+    def compact(self, cursor):
+        """ remove the segments whose events are all before ``cursor`` """
+        while len(self.segments) > 1 and self.segments[1][0] <= cursor:
+            self._remove_segment()
+
+    ### private functions
+
+    def _segment_path(self, first):
+        return os.path.join(self.path, "%020d.seg" % first)
+
+    def _recover_last(self):
+        # count the events of the last segment and remove an event
+        # partially written before a crash
+        first, size = self.segments[-1]
+        path = self._segment_path(first)
+        count = 0
+        offset = 0
+        with open(path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                count += 1
+                offset += len(line)
+
+        if offset < size:
+            with open(path, "r+b") as f:
+                f.truncate(offset)
+            self.segments[-1][1] = offset
+
+        self.next_seq = first + count
+        self._file = open(path, "ab")
+
+    def _new_segment(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+
+        self.segments.append([self.next_seq, 0])
+        self._file = open(self._segment_path(self.next_seq), "ab")
+
+    def _remove_segment(self):
+        first, _ = self.segments.pop(0)
+        try:
+            os.unlink(self._segment_path(first))
+        except OSError:
+            pass
+
+    def _drop_oldest(self):
+        while self.size > self.max_size and len(self.segments) > 1:
+            dropped = self.segments[1][0] - self.segments[0][0]
+            self._remove_segment()
+            self.dropped += dropped
+            LOGGER.warning("OUTBOX: full, %s events dropped" % dropped)
@@ -18,9 +18,11 @@ class Pidfile(object):
         self.fname = fname
         self.pid = None
 
-    def create(self, pid):
+    def create(self, pid, replace=None):
+        """ write the pid in the file. ``replace`` is the pid of a process
+        allowed to be still running, it is replaced by this one. """
         oldpid = self.validate()
-        if oldpid:
+        if oldpid and oldpid != replace:
             if oldpid == os.getpid():
                 return
             raise RuntimeError("Already running on PID %s " \
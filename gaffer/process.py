@@ -8,23 +8,42 @@ The process module wrap a process and IO redirection
 
 
 from datetime import timedelta
+import errno
 from functools import partial
+import json
+import logging
 import os
+import select
 import signal
 import shlex
+import socket
+import sys
+import time
 
 import pyuv
 import psutil
 from psutil import AccessDenied
 import six
 
+from .error import ProcessNotFound
 from .events import EventEmitter
+from .fdholder import send_fds, HAS_SCM_RIGHTS
+from .state import FlappingInfo
 from .util import (bytestring, getcwd, check_uid, check_gid,
         bytes2human, substitute_env, IS_WINDOWS)
 from .sync import atomic_read, increment, decrement
 
 pyuv.Process.disable_stdio_inheritance()
 
+LOGGER = logging.getLogger("gaffer")
+
+# script of the template process of the jobs with ``spawn_mode = "zygote"``
+ZYGOTE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        "zygote.py")
+
+# minimum delay in seconds between two starts of a zygote
+ZYGOTE_RESTART_DELAY = 5.0
+
 def get_process_stats(process=None, interval=0):
 
     """Return information about a process. (can be an pid or a Process object)
@@ -102,6 +121,10 @@ class RedirectIO(object):
     def stdio(self):
         return self._stdio
 
+    @property
+    def channels(self):
+        return list(self._channels)
+
     def subscribe(self, label, listener):
         self._emitter.subscribe(label, listener)
 
@@ -198,6 +221,378 @@ class Stream(RedirectStdin):
         self._emitter.publish('READ', msg)
 
 
+class PidWatcher(object):
+    """ handle watching a process that isn't a child of gafferd, like a
+    process adopted after a restart. It has the interface of
+    ``pyuv.Process`` used by :class:`Process`.
+
+    The exit is detected with a pidfd when the platform supports it,
+    otherwise the process is polled every ``interval`` seconds. The exit
+    status of the process can't be known, the exit callback receives None.
+    """
+
+    def __init__(self, loop, pprocess, exit_callback, interval=1.0):
+        self.loop = loop
+        self.pid = pprocess.pid
+        self.active = True
+        self.closed = False
+        self._pprocess = pprocess
+        self._exit_callback = exit_callback
+        self._pidfd = None
+        self._poll = None
+        self._timer = None
+
+        pidfd_open = getattr(os, "pidfd_open", None)
+        if pidfd_open is not None:
+            try:
+                self._pidfd = pidfd_open(self.pid)
+            except OSError:
+                pass
+
+        if self._pidfd is not None:
+            # the pidfd is readable once the process exited
+            self._poll = pyuv.Poll(loop, self._pidfd)
+            self._poll.start(pyuv.UV_READABLE, self._on_poll)
+        else:
+            self._timer = pyuv.Timer(loop)
+            self._timer.start(self._on_timer, interval, interval)
+
+    def kill(self, signum):
+        if self._pidfd is not None:
+            # signals sent through the pidfd can't reach a reused pid
+            signal.pidfd_send_signal(self._pidfd, signum)
+        else:
+            os.kill(self.pid, signum)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.active = False
+
+        if self._poll is not None:
+            self._poll.close()
+        if self._timer is not None:
+            self._timer.close()
+        if self._pidfd is not None:
+            os.close(self._pidfd)
+            self._pidfd = None
+
+    def _on_poll(self, handle, events, error):
+        self._exited()
+
+    def _on_timer(self, handle):
+        if not self._pprocess.is_running():
+            self._exited()
+
+    def _exited(self):
+        if not self.active:
+            return
+        self.active = False
+        self._exit_callback(self, None, None)
+
+
+def python_argv(cmd, args):
+    """ return the interpreter of a python command line and the arguments
+    given to it """
+    if os.path.basename(cmd).startswith("python"):
+        return cmd, list(args)
+    return sys.executable, [cmd] + list(args)
+
+
+class ZygoteChild(object):
+    """ handle of a process forked by a zygote. It has the interface of
+    ``pyuv.Process`` used by :class:`Process`.
+
+    The exit status is sent by the zygote. If the zygote exits first, the
+    process is watched like an adopted process.
+    """
+
+    def __init__(self, zygote, pid, exit_callback):
+        self.zygote = zygote
+        self.pid = pid
+        self.active = True
+        self.closed = False
+        self._exit_callback = exit_callback
+        self._watcher = None
+
+    def kill(self, signum):
+        if self._watcher is not None:
+            self._watcher.kill(signum)
+        else:
+            os.kill(self.pid, signum)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.active = False
+        self.zygote.children.pop(self.pid, None)
+
+        if self._watcher is not None:
+            self._watcher.close()
+
+    def exited(self, exit_status, term_signal):
+        if not self.active:
+            return
+        self.active = False
+        self._exit_callback(self, exit_status, term_signal)
+
+    def watch(self):
+        """ watch the process once the zygote exited """
+        if not self.active:
+            return
+
+        try:
+            pprocess = psutil.Process(self.pid)
+        except psutil.NoSuchProcess:
+            self.exited(None, None)
+            return
+
+        self._watcher = PidWatcher(self.zygote.loop, pprocess,
+                lambda handle, exit_status, term_signal: self.exited(None,
+                    None))
+
+
+class Zygote(object):
+    """ template process forking the processes of a job with ``spawn_mode =
+    "zygote"`` (see :mod:`gaffer.zygote`).
+
+    The zygote is started with the interpreter and the environment of the
+    first process spawned and imports the ``preload`` modules. Until it is
+    ready the processes are spawned normally.
+
+    Args:
+
+    - **loop**: main pyuv loop instance
+    - **name**: name of the job
+    - **preload**: list of the modules imported by the zygote
+    - **timeout**: time in seconds to wait for the zygote to fork a
+      process
+    """
+
+    def __init__(self, loop, name, preload=None, timeout=1.0):
+        self.loop = loop
+        self.name = name
+        self.preload = preload or []
+        self.timeout = timeout
+        self.ready = False
+        self.children = {}
+
+        self._process = None
+        self._sock = None
+        self._poll = None
+        self._flush_timer = None
+        self._last_id = 0
+        self._pending = []
+        self._started_at = 0
+
+    @property
+    def active(self):
+        return self._process is not None
+
+    @property
+    def os_pid(self):
+        if self._process is None:
+            return None
+        return self._process.pid
+
+    def start(self, process):
+        """ start the zygote with the command and the environment of
+        ``process`` """
+        if self.active or not HAS_SCM_RIGHTS:
+            return
+
+        if time.time() - self._started_at < ZYGOTE_RESTART_DELAY:
+            # the zygote just failed, don't start it again in a loop
+            return
+        self._started_at = time.time()
+
+        python, _ = python_argv(process.cmd, [])
+        ours, theirs = socket.socketpair(socket.AF_UNIX,
+                socket.SOCK_SEQPACKET)
+
+        # the errors of the zygote are logged with the ones of gafferd
+        kwargs = dict(file=python,
+                exit_callback=self._on_exit,
+                args=[ZYGOTE_SCRIPT, "3"] + list(self.preload),
+                env=process.env,
+                cwd=process.cwd,
+                stdio=[pyuv.StdIO(flags=pyuv.UV_IGNORE),
+                    pyuv.StdIO(fd=1, flags=pyuv.UV_INHERIT_FD),
+                    pyuv.StdIO(fd=2, flags=pyuv.UV_INHERIT_FD),
+                    pyuv.StdIO(fd=theirs.fileno(), flags=pyuv.UV_INHERIT_FD)])
+
+        flags = 0
+        if process.uid is not None:
+            kwargs['uid'] = process.uid
+            flags = pyuv.UV_PROCESS_SETUID
+
+        if process.gid is not None:
+            kwargs['gid'] = process.gid
+            flags = flags | pyuv.UV_PROCESS_SETGID
+
+        if flags:
+            kwargs['flags'] = flags
+
+        self._process = pyuv.Process(self.loop)
+        try:
+            self._process.spawn(**kwargs)
+        except pyuv.error.ProcessError as e:
+            LOGGER.error("ZYGOTE %s: failed to start: %s" % (self.name,
+                str(e)))
+            self._process.close()
+            self._process = None
+            ours.close()
+            return
+        finally:
+            theirs.close()
+
+        ours.setblocking(False)
+        self._sock = ours
+        self._poll = pyuv.Poll(self.loop, ours.fileno())
+        self._poll.start(pyuv.UV_READABLE, self._on_readable)
+        self._flush_timer = pyuv.Timer(self.loop)
+
+    def stop(self):
+        """ stop the zygote, the processes it forked continue to run """
+        self.ready = False
+        if self._sock is None:
+            return
+
+        # the zygote exits when the socket is closed
+        self._poll.close()
+        self._flush_timer.close()
+        self._sock.close()
+        self._sock = None
+
+    def fork(self, argv, env, cwd, uid, gid, stdio, fds, exit_callback):
+        """ ask the zygote to fork a process. Return a
+        :class:`ZygoteChild` or None if the process can't be forked.
+
+        Args:
+
+        - **argv**: the python command line without the interpreter
+        - **env**, **cwd**, **uid**, **gid**: environment of the process
+        - **stdio**: for each file descriptor of the process, the index in
+          ``fds`` of its file descriptor or None for ``/dev/null``
+        - **fds**: the file descriptors passed to the process
+        - **exit_callback**: function called with the handle, the exit
+          status and the signal once the process exited
+        """
+        if not self.ready:
+            return None
+
+        self._last_id += 1
+        msg = {"op": "fork", "id": self._last_id, "argv": argv, "env": env,
+                "cwd": cwd, "uid": uid, "gid": gid, "stdio": stdio}
+
+        try:
+            send_fds(self._sock, json.dumps(msg).encode("utf-8"), fds)
+            reply = self._wait_reply(self._last_id)
+        except (socket.error, ValueError) as e:
+            LOGGER.error("ZYGOTE %s: error forking a process: %s" % (
+                self.name, str(e)))
+            self.stop()
+            return None
+
+        if "pid" not in reply:
+            LOGGER.error("ZYGOTE %s: can't fork the process: %s" % (
+                self.name, reply.get("error")))
+            return None
+
+        child = self.children[reply["pid"]] = ZygoteChild(self,
+                reply["pid"], exit_callback)
+        return child
+
+    def _wait_reply(self, msg_id):
+        # the loop is blocked while the zygote forks the process, the other
+        # messages received meanwhile are handled after
+        deadline = time.time() + self.timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise socket.timeout("timeout")
+
+            readable, _, _ = select.select([self._sock], [], [], remaining)
+            if not readable:
+                continue
+
+            msg = self._recv()
+            if msg is None:
+                continue
+            elif msg.get("op") == "forked" and msg.get("id") == msg_id:
+                break
+            self._pending.append(msg)
+
+        if self._pending:
+            self._flush_timer.start(self._on_flush, 0.0, 0.0)
+        return msg
+
+    def _recv(self):
+        try:
+            data = self._sock.recv(65536)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return None
+            raise
+
+        if not data:
+            raise socket.error(errno.EPIPE, "zygote closed the connection")
+        return json.loads(data.decode("utf-8"))
+
+    def _dispatch(self, msg):
+        op = msg.get("op")
+        if op == "ready":
+            self.ready = True
+            LOGGER.info("ZYGOTE %s: ready" % self.name)
+        elif op == "exit":
+            child = self.children.pop(msg["pid"], None)
+            if child is not None:
+                child.exited(msg["exit_status"], msg["term_signal"])
+
+    def _on_flush(self, handle):
+        pending, self._pending = self._pending, []
+        for msg in pending:
+            self._dispatch(msg)
+
+    def _on_readable(self, handle, events, error):
+        while self._sock is not None:
+            try:
+                msg = self._recv()
+            except (socket.error, ValueError):
+                # the zygote exited, wait for its exit
+                self._poll.stop()
+                return
+
+            if msg is None:
+                return
+            self._dispatch(msg)
+
+    def _on_exit(self, handle, exit_status, term_signal):
+        # handle the exits sent before the zygote exited
+        if self._sock is not None:
+            self._on_readable(self._poll, pyuv.UV_READABLE, None)
+        self._on_flush(None)
+
+        if self.ready:
+            LOGGER.info("ZYGOTE %s: exited" % self.name)
+        else:
+            LOGGER.error("ZYGOTE %s: exited before being ready "
+                    "(exit_status: %s, term_signal: %s)" % (self.name,
+                        exit_status, term_signal))
+
+        self.stop()
+        handle.close()
+        self._process = None
+
+        # nobody will send the exit status of the processes anymore
+        children = list(self.children.values())
+        self.children.clear()
+        for child in children:
+            child.watch()
+
+
 class ProcessWatcher(object):
     """ object to retrieve process stats """
 
@@ -277,7 +672,8 @@ class ProcessConfig(object):
             "redirect_output": [],
             "redirect_input": False,
             "custom_streams": [],
-            "custom_channels": []}
+            "custom_channels": [],
+            "sockets": []}
 
     def __init__(self, name, cmd, **settings):
         """
@@ -322,6 +718,15 @@ class ProcessConfig(object):
         - **graceful_timeout**: graceful time before we send a  SIGKILL
           to the process (which definitely kill it). By default 30s.
           This is a time we let to a process to exit cleanly.
+        - **sockets**: list of names of the listening sockets of the manager
+          passed to the processes (see :mod:`gaffer.sockets`)
+        - **spawn_mode**: ``"exec"`` (the default) or ``"zygote"``. In
+          zygote mode the command must be a python script or ``python -m
+          module``, the processes are forked from a template process of the
+          job instead of starting a new interpreter (see
+          :mod:`gaffer.zygote`)
+        - **preload**: list of the modules imported by the template process
+          in zygote mode
 
         """
         self.name = name
@@ -331,7 +736,8 @@ class ProcessConfig(object):
     def __str__(self):
         return "process: %s" % self.name
 
-    def make_process(self, loop, pid, label, env=None, on_exit=None):
+    def make_process(self, loop, pid, label, env=None, on_exit=None,
+            sockets=None, zygote=None):
         """ create a Process object from the configuration
 
         Args:
@@ -341,6 +747,8 @@ class ProcessConfig(object):
         - **label**: the job label. Usually the process type.
           context. A context can be for example an application.
         - **on_exit**: callback called when the process exited.
+        - **sockets**: dict of the listening sockets of the manager by name
+        - **zygote**: the :class:`Zygote` of the job forking the process
 
         """
 
@@ -348,6 +756,12 @@ class ProcessConfig(object):
         for name, default in self.DEFAULT_PARAMS.items():
             params[name] = self.settings.get(name, default)
 
+        sockets = sockets or {}
+        try:
+            params['sockets'] = [sockets[name] for name in params['sockets']]
+        except KeyError:
+            raise ProcessNotFound("socket_not_found")
+
         os_env = self.settings.get('os_env', False)
         if os_env:
             env = params.get('env') or {}
@@ -358,6 +772,7 @@ class ProcessConfig(object):
             params['env'].update(env)
 
         params['on_exit_cb'] = on_exit
+        params['zygote'] = zygote
         return Process(loop, pid, label, self.cmd, **params)
 
     def __getitem__(self, key):
@@ -395,6 +810,19 @@ class ProcessConfig(object):
         d.update(self.settings)
         return d
 
+    def to_state(self):
+        """ return the config as a dict that can be encoded in JSON. Custom
+        channels can't be serialized and are removed. """
+        d = self.to_dict()
+        d.pop('custom_channels', None)
+
+        flapping = d.get('flapping')
+        if isinstance(flapping, FlappingInfo):
+            d['flapping'] = dict(attempts=flapping.attempts,
+                    window=flapping.window, retry_in=flapping.retry_in,
+                    max_retry=flapping.max_retry)
+        return d
+
     @classmethod
     def from_dict(cls, config):
         d = config.copy()
@@ -436,6 +864,11 @@ class Process(object):
       available through :attr:`streams` attribute.
     - **custom_channels**: list of additional channels that should be passed to
       process.
+    - **sockets**: list of listening sockets (:class:`gaffer.sockets.ListenSocket`)
+      inherited by the process. Their file descriptors are given in the
+      ``GAFFER_SOCKET_<NAME>`` environment variables.
+    - **zygote**: a :class:`Zygote` forking the process once it is ready.
+      The process is spawned normally otherwise.
 
     """
 
@@ -443,7 +876,7 @@ class Process(object):
     def __init__(self, loop, pid, name, cmd, args=None, env=None, uid=None,
             gid=None, cwd=None, detach=False, shell=False,
             redirect_output=[], redirect_input=False, custom_streams=[],
-            custom_channels=[], on_exit_cb=None):
+            custom_channels=[], sockets=[], zygote=None, on_exit_cb=None):
         self.loop = loop
         self.pid = pid
         self.name = name
@@ -490,6 +923,8 @@ class Process(object):
         self.redirect_input = redirect_input
         self.custom_streams = custom_streams
         self.custom_channels = custom_channels
+        self.sockets = sockets
+        self.zygote = zygote
 
         self._redirect_io = None
         self._redirect_in = None
@@ -500,6 +935,7 @@ class Process(object):
         self._pprocess = None
         self._process_watcher = None
         self._os_pid = None
+        self._create_time = None
         self._info = None
         self.stopped = False
         self.graceful_time = 0
@@ -530,6 +966,16 @@ class Process(object):
                     .format(channel)
             self._stdio.append(pyuv.StdIO(stream=channel,
                 flags=pyuv.UV_INHERIT_STREAM))
+        # pass the listening sockets, the manager keeps them open
+        if self.sockets:
+            self.env = self.env.copy()
+        for sock in self.sockets:
+            fds = []
+            for fd in sock.fds:
+                fds.append(str(len(self._stdio)))
+                self._stdio.append(pyuv.StdIO(fd=fd,
+                    flags=pyuv.UV_INHERIT_FD))
+            self.env[sock.env_name] = ",".join(fds)
 
     def spawn(self, once=False, graceful_timeout=None, env=None):
         """ spawn the process """
@@ -561,10 +1007,15 @@ class Process(object):
             flags = flags | pyuv.UV_PROCESS_DETACHED
 
         self.running = True
-        self._process = pyuv.Process(self.loop)
+        self._process = None
+        if self.zygote is not None:
+            self._process = self._fork()
 
-        # spawn the process
-        self._process.spawn(**kwargs)
+        if self._process is None:
+            self._process = pyuv.Process(self.loop)
+
+            # spawn the process
+            self._process.spawn(**kwargs)
         self._running = True
         self._os_pid = self._process.pid
         self._pprocess = psutil.Process(self._process.pid)
@@ -584,6 +1035,84 @@ class Process(object):
             stream.start()
 
 
+    def adopt(self, os_pid, create_time=None, fds=None):
+        """ adopt a process spawned by a previous gafferd instead of
+        spawning it. Return False if the process isn't running anymore.
+
+        Args:
+
+        - **os_pid**: the OS pid of the process
+        - **create_time**: the creation time of the process, used to check
+          the pid hasn't been reused
+        - **fds**: our ends of the stdio pipes of the process, in the order
+          of :attr:`stdio_fds`. The redirections are closed when they are
+          not given.
+        """
+        try:
+            pprocess = psutil.Process(os_pid)
+            if (create_time is not None and
+                    abs(pprocess.create_time() - create_time) > 1.0):
+                # the pid has been reused
+                return False
+        except psutil.NoSuchProcess:
+            return False
+
+        self.running = True
+        self._running = True
+        self._process = PidWatcher(self.loop, pprocess, self._exit_cb)
+        self._os_pid = os_pid
+        self._pprocess = pprocess
+        self._create_time = create_time
+
+        pipes = self._pipes()
+        if fds and len(fds) == len(pipes):
+            for pipe, fd in zip(pipes, fds):
+                pipe.open(fd)
+
+            self._redirect_io.start()
+            if self._redirect_in is not None:
+                self._redirect_in.start()
+            for stream in self.streams.values():
+                stream.start()
+        else:
+            for pipe in pipes:
+                pipe.close()
+        return True
+
+    def release(self):
+        """ close the handles of the process without stopping it, so it
+        keeps running after gafferd exits """
+        if self._redirect_io is not None:
+            self._redirect_io.stop(all_events=True)
+
+        if self._redirect_in is not None:
+            self._redirect_in.stop(all_events=True)
+
+        for custom_io in self.streams.values():
+            custom_io.stop(all_events=True)
+
+        if self._process_watcher is not None:
+            self._process_watcher.stop(all_events=True)
+
+        if self._process is not None and not self._process.closed:
+            self._process.close()
+
+    @property
+    def stdio_fds(self):
+        """ return the file descriptors of our ends of the stdio pipes: stdin
+        when it's redirected, the redirected outputs then the custom
+        streams """
+        return [pipe.fileno() for pipe in self._pipes()]
+
+    @property
+    def create_time(self):
+        if self._create_time is None and self._pprocess is not None:
+            try:
+                self._create_time = self._pprocess.create_time()
+            except psutil.NoSuchProcess:
+                pass
+        return self._create_time
+
     @property
     def active(self):
         return self._process.active
@@ -704,6 +1233,72 @@ class Process(object):
     def close(self):
         self._process.close()
 
+    def _fork(self):
+        """ fork the process from the zygote of its job. Return None when
+        the zygote isn't ready, the process is then spawned normally """
+        if not self.zygote.ready:
+            self.zygote.start(self)
+            return None
+
+        # the stdio of the process in the order of ``_setup_stdio``. Our
+        # ends of the pipes are opened once the process has been forked.
+        stdio = []
+        fds = []
+        pipes = []
+
+        def pass_fd(fd):
+            stdio.append(len(fds))
+            fds.append(fd)
+
+        def pass_pipe(channel):
+            ours, theirs = socket.socketpair()
+            pipes.append((channel, ours, theirs))
+            pass_fd(theirs.fileno())
+
+        if self._redirect_in is not None:
+            pass_pipe(self._redirect_in.channel)
+        else:
+            stdio.append(None)
+
+        channels = self._redirect_io.channels
+        for channel in channels:
+            pass_pipe(channel)
+        stdio.extend([None] * (RedirectIO.pipes_count - len(channels)))
+
+        for label in self.custom_streams:
+            pass_pipe(self.streams[label].channel)
+        for channel in self.custom_channels:
+            pass_fd(channel.fileno())
+        for sock in self.sockets:
+            for fd in sock.fds:
+                pass_fd(fd)
+
+        _, argv = python_argv(self.cmd, self.args)
+        try:
+            child = self.zygote.fork(argv, self.env, self.cwd, self.uid,
+                    self.gid, stdio, fds, self._exit_cb)
+        finally:
+            for _, _, theirs in pipes:
+                theirs.close()
+
+        if child is None:
+            for _, ours, _ in pipes:
+                ours.close()
+            return None
+
+        for channel, ours, _ in pipes:
+            channel.open(ours.detach())
+        return child
+
+    def _pipes(self):
+        pipes = []
+        if self._redirect_in is not None:
+            pipes.append(self._redirect_in.channel)
+        pipes.extend(self._redirect_io.channels)
+        for label in self.custom_streams:
+            pipes.append(self.streams[label].channel)
+        return pipes
+
     def _init_cpustats(self):
         try:
             get_process_stats(self._pprocess, 0.1)
@@ -50,14 +50,23 @@ class BaseSigHandler(object):
 
 
 class SigHandler(BaseSigHandler):
-    """ A simple gaffer application to handle signals """
+    """ A simple gaffer application to handle signals
+
+    When ``keep_on_quit`` is True, SIGQUIT stops the manager but leaves
+    the processes running so they can be adopted after a restart.
+    """
+
+    def __init__(self, keep_on_quit=False):
+        super(SigHandler, self).__init__()
+        self.keep_on_quit = keep_on_quit
 
     def start(self, loop, manager):
         self.manager = manager
         super(SigHandler, self).start(loop)
 
-    def handle_quit(self, handle, *args):
-        self.manager.stop()
+    def handle_quit(self, handle, signum):
+        keep_processes = self.keep_on_quit and signum == signal.SIGQUIT
+        self.manager.stop(keep_processes=keep_processes)
 
     def handle_reload(self, handle, *args):
         self.manager.restart()
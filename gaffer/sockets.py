@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -
+#
+# This file is part of gaffer. See the NOTICE for more information.
+"""
+Listening sockets owned by the manager and shared by the processes of the
+jobs referencing them in their ``sockets`` setting.
+
+The socket is bound once and passed to each process it spawns. The number
+of its file descriptor in the process is given in the
+``GAFFER_SOCKET_<NAME>`` environment variable, several numbers are
+separated by commas when the address is bound on more than one socket (IPv4
+and IPv6 for example). The processes share the same accept queue and the
+socket stays open while they are restarted.
+"""
+
+import os
+import re
+import socket
+
+from .util import bind_sockets
+
+
+def socket_env_name(name):
+    """ return the environment variable giving the file descriptors of the
+    socket ``name`` """
+    return "GAFFER_SOCKET_%s" % re.sub(r"[^A-Z0-9]", "_", name.upper())
+
+
+class ListenSocket(object):
+    """ a named listening socket
+
+    Args:
+
+    - **name**: name of the socket
+    - **addr**: address to bind, unix sockets are bound with ``unix:path``
+    - **backlog**: backlog of the socket
+    - **reuse_port**: set SO_REUSEPORT on TCP sockets
+    - **unix_mode**: permissions of the unix socket file
+    - **sockets**: sockets already bound for this address, for example
+      received from the previous gafferd
+    """
+
+    def __init__(self, name, addr, backlog=128, reuse_port=False,
+            unix_mode=0o600, sockets=None):
+        self.name = name
+        self.addr = addr
+        self.backlog = backlog
+        self.reuse_port = reuse_port
+        self.unix_mode = unix_mode
+        self.sockets = sockets
+
+    def __str__(self):
+        return "socket: %s" % self.name
+
+    def bind(self):
+        if self.sockets is None:
+            self.sockets = bind_sockets(self.addr, backlog=self.backlog,
+                    allows_unix_socket=True, reuse_port=self.reuse_port,
+                    unix_mode=self.unix_mode)
+
+    def close(self, unlink=True):
+        if self.sockets is None:
+            return
+
+        for sock in self.sockets:
+            if unlink and sock.family == socket.AF_UNIX:
+                try:
+                    os.unlink(sock.getsockname())
+                except OSError:
+                    pass
+            sock.close()
+        self.sockets = None
+
+    @property
+    def fds(self):
+        return [sock.fileno() for sock in self.sockets or []]
+
+    @property
+    def env_name(self):
+        return socket_env_name(self.name)
+
+    def to_dict(self):
+        return {"name": self.name, "addr": self.addr,
+                "backlog": self.backlog, "reuse_port": self.reuse_port,
+                "unix_mode": self.unix_mode}
+
+    @classmethod
+    def from_fds(cls, fds, **settings):
+        """ create a socket from file descriptors received from another
+        process """
+        sockets = [socket.socket(fileno=fd) for fd in fds]
+        for sock in sockets:
+            sock.setblocking(0)
+        return cls(sockets=sockets, **settings)
@@ -117,6 +117,7 @@ class ProcessState(object):
         self.running = deque()
         self.running_out = deque()
         self.stopped = False
+        self.zygote = None
         self.setup()
 
     def setup(self):
@@ -146,10 +147,10 @@ class ProcessState(object):
     def __str__(self):
         return "state: %s" % self.name
 
-    def make_process(self, loop, id, on_exit):
+    def make_process(self, loop, id, on_exit, sockets=None, zygote=None):
         """ create an OS process using this template """
         return self.config.make_process(loop, id, self.name, env=self.env,
-                on_exit=on_exit)
+                on_exit=on_exit, sockets=sockets, zygote=zygote)
 
     def __get_numprocesses(self):
         return atomic_read(self._numprocesses)
@@ -120,6 +120,18 @@ class IOLoop(object):
             poll_events |= pyuv.UV_WRITABLE
         poll.start(poll_events, self._handle_poll_events)
 
+    def ref_handler(self, fd, ref=True):
+        """ reference or unreference the handle watching ``fd``. An
+        unreferenced handle doesn't keep the loop running. """
+        items = self._handlers.get(fd)
+        if items is None:
+            return
+
+        if ref:
+            items[0].ref()
+        else:
+            items[0].unref()
+
     def remove_handler(self, fd):
         items = self._handlers.pop(fd, None)
         if items is not None:
@@ -4,6 +4,7 @@
 
 import os
 import platform
+import random
 import signal
 import socket
 import ssl
@@ -179,14 +180,26 @@ def is_ipv6(addr):
         return False
     return True
 
-def bind_sockets(addr, backlog=128, allows_unix_socket=False):
+def bind_sockets(addr, backlog=128, allows_unix_socket=False,
+        reuse_port=False, unix_mode=0o600):
+    """ bind the address and return the list of listening sockets.
+
+    Unix sockets are bound when the address starts with ``unix:`` and
+    ``allows_unix_socket`` is True, the socket file is created with the
+    permissions ``unix_mode``. When ``reuse_port`` is True ``SO_REUSEPORT``
+    is set on TCP sockets so several processes can listen on the same port.
+    """
     # initialize the socket
     addr = parse_address(addr)
     if isinstance(addr, six.string_types):
         if not allows_unix_socket:
             raise RuntimeError("unix addresses aren't supported")
 
-        sock = netutil.bind_unix_socket(addr)
+        sock = [netutil.bind_unix_socket(addr, mode=unix_mode,
+            backlog=backlog)]
+    elif reuse_port:
+        sock = _bind_reuseport_sockets(addr[1], address=addr[0],
+                backlog=backlog)
     elif is_ipv6(addr[0]):
         sock = netutil.bind_sockets(addr[1], address=addr[0],
                 family=socket.AF_INET6, backlog=backlog)
@@ -194,6 +207,54 @@ def bind_sockets(addr, backlog=128, allows_unix_socket=False):
         sock = netutil.bind_sockets(addr[1], backlog=backlog)
     return sock
 
+def bind_addresses(addresses, backlog=128, reuse_port=False,
+        unix_mode=0o600):
+    """ bind a list of addresses (or a string of addresses separated by
+    spaces or commas) and return the list of listening sockets """
+    if isinstance(addresses, six.string_types):
+        addresses = addresses.replace(",", " ").split()
+
+    sockets = []
+    try:
+        for addr in addresses:
+            sockets.extend(bind_sockets(addr, backlog=backlog,
+                allows_unix_socket=True, reuse_port=reuse_port,
+                unix_mode=unix_mode))
+    except Exception:
+        for sock in sockets:
+            sock.close()
+        raise
+    return sockets
+
+def _bind_reuseport_sockets(port, address=None, backlog=128):
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise RuntimeError("SO_REUSEPORT isn't supported on this platform")
+
+    if address in ("", "0.0.0.0"):
+        address = None
+
+    family = socket.AF_UNSPEC
+    if address is None:
+        family = socket.AF_INET
+    elif is_ipv6(address):
+        family = socket.AF_INET6
+
+    sockets = []
+    for res in set(socket.getaddrinfo(address, port, family,
+            socket.SOCK_STREAM, 0, socket.AI_PASSIVE)):
+        af, socktype, proto, canonname, sockaddr = res
+        sock = socket.socket(af, socktype, proto)
+        netutil.set_close_exec(sock.fileno())
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if af == socket.AF_INET6 and hasattr(socket, "IPPROTO_IPV6"):
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+        sock.setblocking(0)
+        sock.bind(sockaddr)
+        sock.listen(backlog)
+        sockets.append(sock)
+    return sockets
+
 def hostname():
     return socket.getfqdn(socket.gethostname())
 
@@ -286,6 +347,13 @@ def parse_job_name(name, default='default'):
 
     return appname, name
 
+def backoff_delay(attempt, min_delay=0.5, max_delay=30.0):
+    """ return the delay before the retry ``attempt`` (starting at 0) of an
+    exponential backoff. The delay is randomized so the clients don't retry
+    at the same time. """
+    return random.uniform(min_delay, min(max_delay,
+        min_delay * (2 ** attempt)))
+
 def is_ssl(url):
     return url.startswith("https") or url.startswith("wss")
 
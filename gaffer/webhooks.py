@@ -26,27 +26,272 @@ Or programatically::
 This gaffer application is started like other applications in the
 manager. All :doc:`events` are supported.
 
+Events are delivered asynchronously. Each URL has its own queue, so a slow
+endpoint doesn't delay the others, and connections are kept alive between
+the posts. When ``batch_interval`` is set, the events queued for an URL
+during this interval are posted together in a JSON array. A failed post is
+retried ``max_retries`` times with an exponential backoff.
+
+When ``outbox`` is set, the events are first appended to a durable outbox
+in this directory (see :mod:`gaffer.outbox`) and the delivery resumes where
+it stopped after a restart. Posts failing with a temporary error are then
+retried until they succeed, so the events are delivered at least once.
+
 
 The :mod:`webhooks` Module
 --------------------------
 
 """
-from functools import partial
+from collections import deque
 import json
+import logging
+import random
+import time
 
-from tornado.httpclient import HTTPError
+import pyuv
 
-from .httpclient import HTTPClient
+from .httpclient.pool import KeepAliveHTTPClient
+from .outbox import Outbox
 from .sync import atomic_read, increment, decrement
+from .tornado_pyuv import IOLoop
 
-class WebHooks(object):
-    """ webhook app """
+LOGGER = logging.getLogger("gaffer")
+
+RETRY_BACKOFF_MIN = 0.5
+RETRY_BACKOFF_MAX = 30.0
+
+# HTTP errors after which the post is retried, 599 is a connection error
+# or a timeout
+RETRY_CODES = (429, 599)
+
+# interval in seconds between the writes of the outbox cursors
+OUTBOX_SYNC_INTERVAL = 1.0
+
+
+class Endpoint(object):
+    """ queue of the events posted to an URL. One post is sent at a time.
+
+    With an outbox the queue holds ``(seq, body)`` and only the first
+    ``max_queue`` events are kept in memory, the following ones are read
+    from the outbox when the queue drains.
+    """
+
+    def __init__(self, hooks, url, cursor=None):
+        self.hooks = hooks
+        self.url = url
+        self.queue = deque()
+
+        # events before this sequence number are queued or delivered
+        self.scan = cursor
+
+        # events being posted or waiting for a retry
+        self._payload = None
+        self._sending = False
+        self._waiting = False
+        self._attempts = 0
+        self._timer = pyuv.Timer(hooks.loop)
+
+        # metrics
+        self.delivered = 0
+        self.failed = 0
+        self.dropped = 0
+        self.retries = 0
+        self.latency = None
+
+    def close(self):
+        self._timer.close()
+        self.queue.clear()
+        self._payload = None
+
+    @property
+    def cursor(self):
+        """ sequence number of the first event not delivered """
+        if self._payload:
+            return self._payload[0][0]
+        elif self.queue:
+            return self.queue[0][0]
+        return self.scan
+
+    def put(self, seq, body):
+        """ queue an event encoded in JSON, ``seq`` is its sequence number
+        in the outbox or None """
+        if seq is None:
+            if len(self.queue) >= self.hooks.max_queue:
+                # the endpoint doesn't follow, drop the oldest event
+                self.queue.popleft()
+                self.dropped += 1
+        elif seq != self.scan or len(self.queue) >= self.hooks.max_queue:
+            # the event stays in the outbox until the queue drains
+            self._fill()
+            self._maybe_send()
+            return
+        else:
+            self.scan = seq + 1
+
+        self.queue.append((seq, body))
+        self._maybe_send()
+
+    def skip(self, seq):
+        """ an event not posted to this URL has been added to the outbox """
+        if self.scan == seq:
+            self.scan = seq + 1
+
+    def metrics(self):
+        return {"queued": len(self.queue) + len(self._payload or ()),
+                "delivered": self.delivered,
+                "failed": self.failed,
+                "dropped": self.dropped,
+                "retries": self.retries,
+                "latency": self.latency}
+
+    def _maybe_send(self, flush=False):
+        if self._sending or self._waiting or not self.queue:
+            return
+
+        if (not flush and self.hooks.batch_interval and
+                len(self.queue) < self.hooks.max_batch):
+            # wait for more events
+            self._wait(self.hooks.batch_interval)
+            return
+        self._send()
+
+    def _wait(self, delay):
+        self._waiting = True
+        self._timer.start(self._on_timer, delay, 0.0)
+
+    def _on_timer(self, handle):
+        self._waiting = False
+        if self._payload is not None:
+            # retry
+            self._send()
+        else:
+            self._maybe_send(flush=True)
+
+    def _send(self):
+        if self._payload is None:
+            if self.hooks.batch_interval:
+                count = min(len(self.queue), self.hooks.max_batch)
+                self._payload = [self.queue.popleft() for _ in range(count)]
+            else:
+                self._payload = [self.queue.popleft()]
+
+        if self.hooks.batch_interval:
+            body = "[%s]" % ",".join(body for _, body in self._payload)
+        else:
+            body = self._payload[0][1]
+
+        self._sending = True
+        started = time.time()
+        def on_response(response):
+            self._on_response(response, time.time() - started)
+
+        self.hooks.client.fetch(self.url, on_response, method="POST",
+                headers={"Content-Type": "application/json"}, body=body,
+                request_timeout=self.hooks.timeout)
+
+    def _on_response(self, response, elapsed):
+        self._sending = False
+        if self._payload is None:
+            # the endpoint has been closed
+            return
+
+        # moving average of the latency
+        if self.latency is None:
+            self.latency = elapsed
+        else:
+            self.latency = 0.8 * self.latency + 0.2 * elapsed
+
+        error = response.error
+        # with an outbox, temporary errors are retried until the post
+        # succeeds
+        if error is None:
+            self.delivered += len(self._payload)
+        elif ((response.code in RETRY_CODES or response.code >= 500) and
+                (self._attempts < self.hooks.max_retries or
+                    self.hooks.outbox is not None)):
+            self._attempts += 1
+            self.retries += 1
+            delay = random.uniform(RETRY_BACKOFF_MIN, min(RETRY_BACKOFF_MAX,
+                RETRY_BACKOFF_MIN * (2 ** min(self._attempts, 16))))
+            self._wait(delay)
+            return
+        else:
+            LOGGER.warning("webhook %r failed: %s" % (self.url, str(error)))
+            self.failed += len(self._payload)
+
+        self._payload = None
+        self._attempts = 0
+
+        # events queued during the post already waited, send them now
+        self._fill()
+        self._maybe_send(flush=True)
+
+    def _fill(self):
+        # queue the events of the outbox not yet read
+        outbox = self.hooks.outbox
+        if outbox is None:
+            return
+
+        if self.scan < outbox.first_seq:
+            LOGGER.warning("webhook %r: events dropped from the outbox" %
+                    self.url)
+            self.scan = outbox.first_seq
+
+        while (self.scan < outbox.next_seq and
+                len(self.queue) < self.hooks.max_queue):
+            records = outbox.read(self.scan,
+                    self.hooks.max_queue - len(self.queue))
+            if not records:
+                break
 
-    def __init__(self, hooks=[]):
+            for seq, event, body in records:
+                if self.url in self.hooks.urls(event):
+                    self.queue.append((seq, body))
+                self.scan = seq + 1
+
+
+class WebHooks(object):
+    """ webhook app
+
+    Args:
+
+    - **hooks**: list of ``(event, url)``
+    - **batch_interval**: when set, events are posted in batches every
+      ``batch_interval`` seconds
+    - **max_batch**: maximum number of events in a batch
+    - **max_retries**: number of times a failed post is retried
+    - **max_queue**: maximum number of events queued for an URL, the oldest
+      events are dropped after
+    - **timeout**: timeout of a post in seconds
+    - **max_connections**: maximum number of connections opened to an host
+    - **outbox**: directory of the durable outbox, events are only kept in
+      memory when None
+    - **outbox_max_size**: maximum size in bytes of the outbox
+    """
+
+    def __init__(self, hooks=[], batch_interval=0, max_batch=100,
+            max_retries=3, max_queue=1000, timeout=10.0, max_connections=2,
+            outbox=None, outbox_max_size=256 * 1024 * 1024):
         self.events = {}
         self._refcount = 0
         self.active = False
 
+        self.batch_interval = batch_interval
+        self.max_batch = max_batch
+        self.max_retries = max_retries
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.max_connections = max_connections
+
+        # url -> Endpoint
+        self.endpoints = {}
+        self.client = None
+
+        self.outbox = None
+        if outbox is not None:
+            self.outbox = Outbox(outbox, max_size=outbox_max_size)
+        self._sync_timer = None
+
         # initialize hooks
         for event, url in hooks:
             if not event in self.events:
@@ -58,22 +303,90 @@ class WebHooks(object):
         """ start the webhook app """
         self.loop = loop
         self.manager = manager
+        self.client = KeepAliveHTTPClient(IOLoop(_loop=loop),
+                max_connections=self.max_connections)
+
+        if self.outbox is not None:
+            self.outbox.open()
+
+            # resume the delivery of the urls still registered
+            for url, cursor in self.outbox.cursors.items():
+                if any(url in urls for urls in self.events.values()):
+                    self._endpoint(url, cursor)._maybe_send()
+
+            self._sync_timer = pyuv.Timer(loop)
+            self._sync_timer.start(self._on_sync, OUTBOX_SYNC_INTERVAL,
+                    OUTBOX_SYNC_INTERVAL)
+            self._sync_timer.unref()
+
         self.maybe_start_monitor()
 
     def stop(self):
-        """ stop the webhook app, stop monitoring to events """
+        """ stop the webhook app, stop monitoring to events and close the
+        connections so the loop can exit """
         if self.active:
             self._stop_monitor()
 
+        if self._sync_timer is not None:
+            self._sync_timer.close()
+            self._sync_timer = None
+            self._on_sync(None)
+            self.outbox.close()
+
+        for endpoint in self.endpoints.values():
+            endpoint.close()
+        self.endpoints = {}
+
+        if self.client is not None:
+            self.client.close()
+
     def restart(self):
         self._stop_monitor()
         self._start_monitor()
 
     def close(self):
         self.stop()
-        self.events = []
+        self.events = {}
         self._refcount = 0
 
+    def sync(self):
+        """ write the cursors of the outbox now """
+        if self.outbox is not None and self._sync_timer is not None:
+            self._on_sync(None)
+
+    def detach(self):
+        """ stop delivering the events, another gafferd took over the
+        outbox """
+        if self.active:
+            self._stop_monitor()
+
+        # the cursors and the segments belong to the new gafferd, they are
+        # not written or compacted anymore
+        if self._sync_timer is not None:
+            self._sync_timer.close()
+            self._sync_timer = None
+            self.outbox.close()
+
+        for endpoint in self.endpoints.values():
+            endpoint.close()
+        self.endpoints = {}
+
+        if self.client is not None:
+            self.client.close()
+
+    def metrics(self):
+        """ return the queue depth, the delivery counters and the average
+        latency of each URL """
+        return dict((url, endpoint.metrics()) for url, endpoint in
+                self.endpoints.items())
+
+    def urls(self, event):
+        """ return the urls an event is posted to """
+        urls = self.events.get(event, set())
+        if "." in self.events:
+            urls = urls.union(self.events['.'])
+        return urls
+
     @property
     def refcount(self):
         return atomic_read(self._refcount)
@@ -98,6 +411,12 @@ class WebHooks(object):
         urls.remove(url)
         self.events[event] = urls
 
+        # the queued events of an url no longer used are dropped
+        if not any(url in urls for urls in self.events.values()):
+            endpoint = self.endpoints.pop(url, None)
+            if endpoint is not None:
+                endpoint.close()
+
         self.decref()
         self.maybe_stop_monitor()
 
@@ -121,33 +440,44 @@ class WebHooks(object):
         if not self.active:
             return
 
-        urls = set()
-        if event in self.events:
-            urls = self.events[event]
-
-        if "." in self.events:
-            urls = urls.union(self.events['.'])
-
+        urls = self.urls(event)
         if not urls:
             return
 
-        # queue the hook, it will be executed in a thread asap
-        callback = partial(self._post_hook, msg, urls)
-        self.loop.queue_work(callback)
-
-    def _post_hook(self, msg, urls):
+        # the event is encoded once for all the urls
         body = json.dumps(msg)
-        headers = { "Content-Length": str(len(body)),
-                    "Content-Type": "application/json" }
+        seq = None
+        if self.outbox is not None:
+            seq = self.outbox.append(event, body)
 
-        client = HTTPClient()
         for url in urls:
-            try:
-                client.fetch(url, method="POST", headers=headers,
-                        body=body)
-            except HTTPError:
-                # for now we ignore all http errors.
-                pass
+            self._endpoint(url, seq).put(seq, body)
+
+        if seq is not None:
+            for url, endpoint in self.endpoints.items():
+                if url not in urls:
+                    endpoint.skip(seq)
+
+    def _endpoint(self, url, cursor=None):
+        endpoint = self.endpoints.get(url)
+        if endpoint is None:
+            endpoint = self.endpoints[url] = Endpoint(self, url, cursor)
+            endpoint._fill()
+        return endpoint
+
+    def _on_sync(self, handle):
+        # write the cursors and remove the segments delivered to all urls
+        cursors = dict((url, endpoint.cursor) for url, endpoint in
+                self.endpoints.items())
+        try:
+            self.outbox.sync()
+            if cursors != self.outbox.cursors:
+                self.outbox.save_cursors(cursors)
+        except (IOError, OSError) as e:
+            LOGGER.error("OUTBOX: error writing the cursors: %s" % str(e))
+            return
+
+        self.outbox.compact(min(cursors.values() or [self.outbox.next_seq]))
 
     def _start_monitor(self):
         self.manager.events.subscribe(".", self._on_event)
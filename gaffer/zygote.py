@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -
+#
+# This file is part of gaffer. See the NOTICE for more information.
+"""
+Template process forking the processes of a job started with
+``spawn_mode = "zygote"``.
+
+The zygote is started once per job with the interpreter of the job. It
+imports the modules given on its command line, then forks a process each
+time the manager asks for one instead of executing a new interpreter, so
+the processes start with the modules already loaded.
+
+The manager talks to the zygote over an unix socket inherited on the file
+descriptor given as first argument. Each message is a JSON object:
+
+- ``{"op": "ready"}`` is sent by the zygote once the modules are imported
+- ``{"op": "fork", "id": id, "argv": argv, "env": env, "cwd": cwd, "uid":
+  uid, "gid": gid, "stdio": stdio}`` with the file descriptors of the
+  stdio of the process. ``stdio`` gives for each file descriptor of the
+  process the index of the file descriptor passed, or null for
+  ``/dev/null``. ``argv`` is the python command line without the
+  interpreter, a script or ``-m module`` followed by the arguments.
+- ``{"op": "forked", "id": id, "pid": pid}`` or ``{"op": "forked", "id":
+  id, "error": error}`` is the reply of the zygote
+- ``{"op": "exit", "pid": pid, "exit_status": status, "term_signal":
+  signum}`` is sent by the zygote when a process exited
+
+The zygote exits when the manager closes the socket, the processes it
+forked continue to run.
+
+This module is run as a script by the path of the file and only depends
+on the standard library, so it works with the interpreter of the job even
+if gaffer isn't installed for it. It needs python 3.3 or later.
+"""
+
+import atexit
+import fcntl
+import importlib
+import json
+import os
+import runpy
+import select
+import signal
+import socket
+import sys
+import threading
+import traceback
+
+try:
+    from .fdholder import send_fds, recv_fds
+except ImportError:
+    # run as a script, its directory is the gaffer package
+    from fdholder import send_fds, recv_fds
+
+MAX_MESSAGE = 262144
+
+# options of the interpreter ignored when the process is forked
+IGNORED_OPTIONS = ("-u", "-B", "-E", "-s", "-S", "-O", "-OO", "-b", "-bb")
+
+
+def parse_argv(argv):
+    """ return the module or the script to run and its arguments """
+    argv = list(argv)
+    while argv and argv[0] in IGNORED_OPTIONS:
+        argv.pop(0)
+
+    if not argv:
+        raise ValueError("no script to run")
+    elif argv[0] == "-m":
+        if len(argv) < 2:
+            raise ValueError("no module to run")
+        return True, argv[1], argv[2:]
+    elif argv[0].startswith("-"):
+        raise ValueError("unsupported option %r" % argv[0])
+    return False, argv[0], argv[1:]
+
+
+class Zygote(object):
+
+    def __init__(self, fd, preload):
+        self.sock = socket.socket(fileno=fd)
+        self.preload = preload
+
+    def run(self):
+        for name in self.preload:
+            importlib.import_module(name)
+
+        # SIGCHLD wakes up the loop so the processes exited are reaped
+        r, w = os.pipe()
+        for fd in (r, w):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                    fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        signal.set_wakeup_fd(w)
+
+        self.send({"op": "ready"})
+        while True:
+            readable, _, _ = select.select([self.sock, r], [], [])
+            if r in readable:
+                try:
+                    while os.read(r, 512):
+                        pass
+                except OSError:
+                    pass
+                self.reap()
+
+            if self.sock in readable:
+                data, fds = recv_fds(self.sock, MAX_MESSAGE)
+                if not data:
+                    # the manager exited
+                    for fd in fds:
+                        os.close(fd)
+                    break
+                self.handle(json.loads(data.decode("utf-8")), fds)
+
+    def send(self, msg):
+        send_fds(self.sock, json.dumps(msg).encode("utf-8"), None)
+
+    def handle(self, msg, fds):
+        if msg.get("op") != "fork":
+            for fd in fds:
+                os.close(fd)
+            return
+
+        reply = {"op": "forked", "id": msg["id"]}
+        try:
+            target = parse_argv(msg["argv"])
+
+            # the buffered outputs of the zygote mustn't be written twice
+            sys.stdout.flush()
+            sys.stderr.flush()
+
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    self.child(msg, fds, target)
+                finally:
+                    os._exit(1)
+            reply["pid"] = pid
+        except (OSError, ValueError) as e:
+            reply["error"] = str(e)
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+        self.send(reply)
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                # no more children
+                return
+
+            if pid == 0:
+                return
+
+            if os.WIFSIGNALED(status):
+                exit_status, term_signal = 0, os.WTERMSIG(status)
+            else:
+                exit_status, term_signal = os.WEXITSTATUS(status), 0
+
+            self.send({"op": "exit", "pid": pid, "exit_status": exit_status,
+                "term_signal": term_signal})
+
+    def child(self, msg, fds, target):
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+        # move the stdio above their final numbers before placing them so
+        # they can't overwrite each other
+        devnull = os.open(os.devnull, os.O_RDWR)
+        stdio = []
+        for index in msg["stdio"]:
+            fd = devnull if index is None else fds[index]
+            stdio.append(fcntl.fcntl(fd, fcntl.F_DUPFD, len(msg["stdio"])))
+
+        for target_fd, fd in enumerate(stdio):
+            os.dup2(fd, target_fd)
+        os.closerange(len(stdio), os.sysconf("SC_OPEN_MAX"))
+
+        if msg.get("gid") is not None:
+            os.setgid(msg["gid"])
+        if msg.get("uid") is not None:
+            os.setuid(msg["uid"])
+
+        if msg.get("cwd"):
+            os.chdir(msg["cwd"])
+        os.environ.clear()
+        os.environ.update(msg.get("env") or {})
+
+        is_module, name, args = target
+        code = 0
+        try:
+            if is_module:
+                sys.argv = [name] + args
+                sys.path[0] = os.getcwd()
+                runpy.run_module(name, run_name="__main__", alter_sys=True)
+            else:
+                sys.argv = [name] + args
+                sys.path[0] = os.path.dirname(os.path.abspath(name))
+                runpy.run_path(name, run_name="__main__")
+        except SystemExit as e:
+            if e.code is None:
+                code = 0
+            elif isinstance(e.code, int):
+                code = e.code
+            else:
+                sys.stderr.write("%s\n" % e.code)
+                code = 1
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            try:
+                # exit like the interpreter does: wait for the threads not
+                # daemonic then run the atexit handlers
+                threading._shutdown()
+                atexit._run_exitfuncs()
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(code)
+
+
+def run():
+    if len(sys.argv) < 2:
+        print("usage: zygote.py <fd> [module ...]")
+        sys.exit(1)
+
+    # the modules of the job are imported from its working directory
+    sys.path[0] = os.getcwd()
+
+    try:
+        Zygote(int(sys.argv[1]), sys.argv[2:]).run()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+
+import atexit
+import sys
+import threading
+import time
+
+def run(testfile):
+    done = []
+
+    def work():
+        time.sleep(0.2)
+        done.append(True)
+
+    def on_exit():
+        with open(testfile, 'a+') as f:
+            f.write("ATEXIT %s\n" % (done and "done" or "running"))
+            f.flush()
+
+    atexit.register(on_exit)
+
+    # the script returns while the thread is still running
+    threading.Thread(target=work).start()
+
+if __name__ == "__main__":
+    run(sys.argv[1])
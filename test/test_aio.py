@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -
+#
+# This file is part of gaffer. See the NOTICE for more information.
+
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+from gaffer import __version__
+from gaffer.manager import Manager
+from gaffer.gafferd.http import HttpHandler
+from gaffer.process import ProcessConfig
+
+from test_http import MockConfig
+from test_manager import dummy_cmd
+
+pytestmark = pytest.mark.skipif(sys.version_info < (3, 5),
+        reason="the asyncio client requires python 3.5")
+
+TEST_HOST = '127.0.0.1'
+TEST_PORT = (os.getpid() % 31000) + 2048
+
+TEST_URI = "%s:%s" % (TEST_HOST, TEST_PORT)
+
+
+def init(keys=None, api_key=None):
+    import asyncio
+    from gaffer.aio import Server
+
+    if keys is None:
+        http_handler = HttpHandler(MockConfig(bind=TEST_URI))
+    else:
+        http_handler = HttpHandler(MockConfig(bind=TEST_URI,
+            require_key=True, keys_dbname=":memory:",
+            auth_dbname=":memory:"))
+    m = Manager()
+    m.start(apps=[http_handler])
+
+    for key, permissions in (keys or {}).items():
+        http_handler.key_mgr.create_key(permissions, key=key)
+
+    testfile, cmd, args, wdir = dummy_cmd()
+    config = ProcessConfig("dummy", cmd, args=args, cwd=wdir)
+    m.load(config, start=False)
+
+    # the manager loop is running in its own thread while the asyncio loop
+    # is running in the main thread.
+    t = threading.Thread(target=m.run)
+    t.daemon = True
+    t.start()
+    time.sleep(0.2)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    s = Server("http://%s" % TEST_URI, api_key=api_key)
+    return m, t, loop, s
+
+
+def stop(m, t, loop, s):
+    s.close()
+    loop.close()
+    m.stop()
+    t.join()
+
+
+def test_server():
+    m, t, loop, s = init()
+
+    assert loop.run_until_complete(s.version()) == __version__
+    assert loop.run_until_complete(s.ping()) == True
+    assert loop.run_until_complete(s.jobs()) == ["default.dummy"]
+
+    job = loop.run_until_complete(s.get_job("dummy"))
+    assert loop.run_until_complete(job.active()) == False
+    loop.run_until_complete(job.start())
+    assert loop.run_until_complete(job.scale(1)) == 2
+    time.sleep(0.2)
+
+    pids = loop.run_until_complete(job.pids())
+    assert len(pids) == 2
+    infos = loop.run_until_complete(s.jobs_info())
+    assert infos[0]["name"] == "default.dummy"
+    assert infos[0]["running"] == 2
+
+    p = loop.run_until_complete(s.get_process(pids[0]))
+    assert p.name == "default.dummy"
+    assert loop.run_until_complete(p.active()) == True
+
+    # all the requests have been done on the same connection
+    assert len(s.pool._idle) == 1
+
+    stop(m, t, loop, s)
+
+
+def test_socket():
+    from gaffer.error import ProcessError
+
+    m, t, loop, s = init()
+
+    sock = loop.run_until_complete(s.socket())
+    events = loop.run_until_complete(sock.subscribe("EVENTS"))
+
+    result = loop.run_until_complete(sock.command("jobs"))
+    assert result == {"jobs": ["default.dummy"]}
+    with pytest.raises(ProcessError):
+        loop.run_until_complete(sock.command("info", "unknown"))
+
+    results = loop.run_until_complete(sock.batch([("start_job", "dummy")]))
+    assert results == [{"result": {"ok": True}}]
+
+    event = loop.run_until_complete(events.get())
+    assert event["event"] == "start"
+    assert event["name"] == "default.dummy"
+
+    loop.run_until_complete(events.close())
+    assert loop.run_until_complete(events.get()) is None
+
+    sock.close()
+    stop(m, t, loop, s)
+
+
+def test_socket_subscription_error():
+    from gaffer.aio.websocket import SubscriptionError
+
+    m, t, loop, s = init(keys={"reader": {"read": ["default.dummy"]}},
+            api_key="reader")
+
+    sock = loop.run_until_complete(s.socket())
+
+    # only managers can read the events
+    with pytest.raises(SubscriptionError):
+        loop.run_until_complete(sock.subscribe("EVENTS"))
+    assert "EVENTS" not in sock.subscriptions
+
+    # the next subscription gets its own answer
+    stats = loop.run_until_complete(sock.subscribe("STATS:default.dummy"))
+    assert stats.topic == "STATS:default.dummy"
+    assert sock._pending_subs == []
+
+    sock.close()
+    stop(m, t, loop, s)
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -
+#
+# This file is part of gaffer. See the NOTICE for more information.
+
+import os
+
+import pyuv
+
+# patch tornado IOLoop
+from gaffer.tornado_pyuv import IOLoop, install
+install()
+
+from gaffer.gafferd.lookup import LookupClient
+from gaffer.lookupd.cluster import Cluster
+from gaffer.lookupd.http import http_server
+from gaffer.lookupd.registry import Registry, JobNotFound
+from gaffer.util import bind_sockets
+
+import pytest
+
+TEST_HOST = '127.0.0.1'
+TEST_PORT1 = (os.getpid() % 31000) + 1025
+TEST_PORT2 = TEST_PORT1 + 1
+ADDR1 = "%s:%s" % (TEST_HOST, TEST_PORT1)
+ADDR2 = "%s:%s" % (TEST_HOST, TEST_PORT2)
+
+
+class FakePeerConn(object):
+
+    def __init__(self):
+        self.peer = None
+        self.messages = []
+
+    def write_message(self, msg):
+        self.messages.append(msg)
+
+    def write_error(self, errno, reason):
+        self.messages.append({"errno": errno, "reason": reason})
+
+    def close(self):
+        pass
+
+
+def test_cluster_apply():
+    loop = pyuv.Loop.default_loop()
+    r = Registry(loop)
+    cluster = Cluster(loop, r, name="local")
+    conn = FakePeerConn()
+
+    node = ["node1", "http://node1:5000"]
+    cluster.handle_message(conn, {"type": "HELLO", "peer": "p1"})
+    cluster.handle_message(conn, {"type": "STATE", "peer": "p1",
+        "node": node, "version": 1.0, "seq": 1,
+        "jobs": {"default.dummy": [1, 2]}, "load": {}})
+
+    jobs = r.find_job("default.dummy")
+    assert jobs[0].node.peer == "p1"
+    assert sorted(jobs[0].pids) == [1, 2]
+
+    cluster.handle_message(conn, {"type": "DELTA", "peer": "p1",
+        "node": node, "seq": 2, "op": "add_process",
+        "job_name": "default.dummy", "pid": 3})
+    assert sorted(r.find_job("default.dummy")[0].pids) == [1, 2, 3]
+    assert conn.messages == []
+
+    # a delta has been lost, the state of the node is requested
+    cluster.handle_message(conn, {"type": "DELTA", "peer": "p1",
+        "node": node, "seq": 4, "op": "remove_process",
+        "job_name": "default.dummy", "pid": 3})
+    assert conn.messages == [{"type": "RESYNC", "nodes": [node]}]
+    assert sorted(r.find_job("default.dummy")[0].pids) == [1, 2, 3]
+
+    # the digest removes the nodes the peer doesn't have anymore and
+    # requests the unknown ones
+    conn.messages = []
+    node2 = ["node2", "http://node2:5000"]
+    cluster.handle_message(conn, {"type": "DIGEST", "peer": "p1",
+        "nodes": [node2 + [1, {}]]})
+    assert conn.messages == [{"type": "RESYNC", "nodes": [node2]}]
+    with pytest.raises(JobNotFound):
+        r.find_job("default.dummy")
+    assert r.all_nodes() == []
+
+    # messages are only accepted after HELLO
+    conn2 = FakePeerConn()
+    cluster.handle_message(conn2, {"type": "DIGEST", "peer": "p2",
+        "nodes": []})
+    assert conn2.messages[0]["errno"] == 400
+    r.close()
+
+
+def test_cluster_replication():
+    loop = pyuv.Loop.default_loop()
+    io_loop = IOLoop(_loop=loop)
+
+    r1 = Registry(loop)
+    c1 = Cluster(loop, r1, [ADDR2], name="lookupd1", sync_interval=0.1)
+    server1 = http_server(io_loop, bind_sockets(ADDR1), registration_db=r1,
+            cluster=c1)
+
+    r2 = Registry(loop)
+    c2 = Cluster(loop, r2, [ADDR1], name="lookupd2", sync_interval=0.1)
+    server2 = http_server(io_loop, bind_sockets(ADDR2), registration_db=r2,
+            cluster=c2)
+
+    for server, cluster in ((server1, c1), (server2, c2)):
+        server.start()
+        cluster.start()
+
+    # the node only registers to the first lookupd
+    client = LookupClient(loop, "ws://%s/ws" % ADDR1)
+    client.start()
+    client.identify("node1", "http://node1:5000", 1.0)
+    client.add_job("default.dummy")
+    client.add_process("default.dummy", 1)
+
+    found = []
+    def check(h):
+        try:
+            found.extend(r2.find_job("default.dummy"))
+        except JobNotFound:
+            pass
+        client.close()
+
+    t0 = pyuv.Timer(loop)
+    t0.start(check, 0.5, 0.0)
+
+    def stop(h):
+        h.close()
+        t0.close()
+        for server, cluster in ((server1, c1), (server2, c2)):
+            cluster.stop()
+            server.stop()
+        io_loop.close()
+
+    t = pyuv.Timer(loop)
+    t.start(stop, 1.0, 0.0)
+    loop.run()
+
+    assert len(found) == 1
+    assert found[0].node.name == "node1"
+    assert found[0].node.peer == "lookupd1"
+    assert found[0].pids == [1]
+
+    # the node is removed from the second lookupd once it disconnected
+    assert r1.all_nodes() == []
+    assert r2.all_nodes() == []
+    r1.close()
+    r2.close()
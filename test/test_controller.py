@@ -4,10 +4,11 @@
 import signal
 import time
 
+import pytest
 import pyuv
 
 from gaffer.error import ProcessError, CommandError, CommandNotFound
-from gaffer.controller import Controller, Command
+from gaffer.controller import Controller, Command, BatchCommand
 from gaffer.manager import Manager
 from gaffer.process import ProcessConfig
 
@@ -478,3 +479,36 @@ def test_process_commit():
     m.run()
 
     assert cmd.result["pid"] == 1
+
+
+def test_batch():
+    m, ctl, conf = init()
+
+    config = conf.to_dict()
+    cmds = [BatchCommand("load", [config], {"start": False}),
+            BatchCommand("scale", ["dummy", 2]),
+            BatchCommand("info", ["unknown"]),
+            BatchCommand("jobs")]
+    ctl.process_batch(cmds)
+
+    m.stop()
+    m.run()
+
+    assert cmds[0].to_dict() == {"result": {"ok": True}}
+    assert cmds[1].to_dict() == {"result": {"numprocesses": 3}}
+    assert cmds[2].to_dict() == {"error": {"errno": 404,
+        "reason": "not_found"}}
+    assert cmds[3].to_dict() == {"result": {"jobs": ["default.dummy"]}}
+
+
+def test_batch_command_from_dict():
+    cmd = BatchCommand.from_dict({"name": "scale", "args": ["dummy", 1]})
+    assert cmd.name == "scale"
+    assert cmd.args == ["dummy", 1]
+    assert cmd.kwargs == {}
+
+    with pytest.raises(CommandError):
+        BatchCommand.from_dict({"args": ["dummy"]})
+
+    with pytest.raises(CommandError):
+        BatchCommand.from_dict({"name": "info", "args": "dummy"})
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -
+#
+# This file is part of gaffer. See the NOTICE for more information.
+
+import os
+import socket
+
+from gaffer.gafferd.handover import Handover, send_handover
+
+
+def test_handover():
+    parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(8)
+    port = listener.getsockname()[1]
+    r, w = os.pipe()
+
+    state = {"max_process_id": 1, "jobs": [{"sessionid": "default",
+        "processes": [{"pid": 1, "os_pid": 42}]}] * 1000}
+    send_handover(parent, state, {"127.0.0.1:0": [listener]}, {42: [r, w]})
+    listener.close()
+
+    handover = Handover.receive(os.dup(child.fileno()))
+    assert handover.state == state
+
+    # the listening socket and the pipe are still usable
+    [sock] = handover.listeners["127.0.0.1:0"]
+    assert sock.getsockname()[1] == port
+    client = socket.create_connection(("127.0.0.1", port))
+    sock.setblocking(1)
+    conn, _ = sock.accept()
+
+    pipe_r, pipe_w = handover.pipes[42]
+    os.write(pipe_w, b"hello")
+    assert os.read(r, 5) == b"hello"
+
+    handover.ready()
+    assert parent.recv(16) == b"ready"
+
+    for s in (conn, client, sock, parent, child):
+        s.close()
+    for fd in (r, w, pipe_r, pipe_w):
+        os.close(fd)
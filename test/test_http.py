@@ -3,16 +3,24 @@
 # This file is part of gaffer. See the NOTICE for more information.
 
 import os
+import socket
+import stat
+import tempfile
+import threading
 import time
 
 import pytest
 import pyuv
+from tornado import httpclient
 
 from gaffer import __version__
 from gaffer.manager import Manager
 from gaffer.gafferd.http import HttpHandler
 from gaffer.httpclient import (Server, Job, Process,
         GafferNotFound, GafferConflict)
+from gaffer.httpclient.base import HTTPClient
+from gaffer.httpclient.pool import KeepAliveHTTPClient
+from gaffer.httpclient.util import unix_uri
 from gaffer.process import ProcessConfig
 
 from test_manager import dummy_cmd
@@ -32,16 +40,30 @@ class MockConfig(object):
     def set_defaults(self):
         self.webhooks = []
         self.processes = []
+        self.sockets = []
         self.ssl_options = None
         self.client_ssl_options = {}
         self.bind = "0.0.0.0:5000"
         self.lookupd_addresses = []
+        self.lookupd_batch_window = 0.05
         self.broadcast_address = None
         self.backlog = 128
+        self.reuseport = False
+        self.unix_socket_mode = 0o600
         self.daemonize = False
         self.pidfile = None
         self.logfile = None
         self.loglevel = "info"
+        self.stats_interval = 0.1
+        self.stats_restart_window = 300.0
+        self.webhooks_batch_interval = 0
+        self.webhooks_max_retries = 3
+        self.webhooks_max_queue = 1000
+        self.webhooks_timeout = 10.0
+        self.webhooks_outbox = None
+        self.webhooks_outbox_max_size = 256
+        self.state_journal = None
+        self.fd_holder = None
 
         # auth(z) API
         self.require_key = False
@@ -49,6 +71,11 @@ class MockConfig(object):
         self.keys_backend = "default"
         self.auth_dbname = None
         self.keys_dbname = None
+        self.keys_cache_size = 1000
+        self.keys_cache_ttl = 300.0
+        self.password_iterations = 100000
+        self.token_secret = None
+        self.token_ttl = 300.0
 
 def start_manager():
     http_handler = HttpHandler(MockConfig(bind=TEST_URI))
@@ -372,5 +399,239 @@ def test_job_commit():
     m.stop()
     m.run()
 
+def test_snapshot():
+    m, s = init()
+
+    testfile, cmd, args, wdir = dummy_cmd()
+    config = ProcessConfig("dummy", cmd, args=args, cwd=wdir)
+    m.load(config)
+    time.sleep(0.2)
+
+    snapshot = s.snapshot()
+
+    m.stop()
+    m.run()
+
+    assert snapshot["sessions"] == ["default"]
+    assert list(snapshot["jobs"]) == ["default.dummy"]
+    assert snapshot["pids"] == [1]
+    assert snapshot["counts"] == {"sessions": 1, "jobs": 1, "pids": 1}
+
+
+def test_etag():
+    m, s = init()
+
+    testfile, cmd, args, wdir = dummy_cmd()
+    config = ProcessConfig("dummy", cmd, args=args, cwd=wdir)
+    m.load(config, start=False)
+    time.sleep(0.2)
+
+    resp = s.request("get", "/jobs")
+    etag = resp.headers["Etag"]
+    assert s.request("get", "/jobs").headers["Etag"] == etag
+
+    with pytest.raises(httpclient.HTTPError) as excinfo:
+        s.request("get", "/jobs", headers={"If-None-Match": etag})
+    assert excinfo.value.code == 304
+
+    # the etag change once the manager state change
+    m.unload("dummy")
+    resp = s.request("get", "/jobs", headers={"If-None-Match": etag})
+    assert resp.headers["Etag"] != etag
+    assert s.json_body(resp) == {"jobs": []}
+
+    m.stop()
+    m.run()
+
+
+def test_node_stats():
+    m, s = init()
+
+    testfile, cmd, args, wdir = dummy_cmd()
+    config = ProcessConfig("dummy", cmd, args=args, cwd=wdir,
+            numprocesses=2)
+    m.load(config)
+
+    results = []
+    def get_stats(handle):
+        results.append(s.json_body(s.request("get", "/stats")))
+        m.stop()
+
+    t = pyuv.Timer(m.loop)
+    t.start(get_stats, 0.4, 0.0)
+    m.run()
+
+    stats = results[0]
+    assert list(stats["jobs"]) == ["default.dummy"]
+    assert stats["jobs"]["default.dummy"]["processes"] == 2
+    assert stats["sessions"]["default"]["processes"] == 2
+    assert stats["node"]["processes"] == 2
+    assert stats["node"]["jobs"] == 1
+
+
+def test_batch():
+    m, s = init()
+
+    testfile, cmd, args, wdir = dummy_cmd()
+    config = ProcessConfig("dummy", cmd, args=args, cwd=wdir)
+    m.load(config, start=False)
+    time.sleep(0.2)
+
+    results = s.batch([("start_job", "dummy"),
+                       {"name": "scale", "args": ["dummy", 1]},
+                       ("info", "unknown"),
+                       ("nocommand",)])
+    time.sleep(0.2)
+
+    assert len(results) == 4
+    assert results[0] == {"result": {"ok": True}}
+    assert results[1] == {"result": {"numprocesses": 2}}
+    assert results[2]["error"]["errno"] == 404
+    assert results[3]["error"] == {"errno": 404,
+            "reason": "command_not_found"}
+    assert len(m.pids()) == 2
+
+    m.stop()
+    m.run()
+
+
+def test_keep_alive():
+    m, s = init()
+
+    assert s.version == __version__
+    assert s.version == __version__
+
+    # both requests have been sent on the same connection
+    pool = s.client._async_client.pool
+    assert sum(len(conns) for conns in pool._connections.values()) == 1
+
+    m.stop()
+    m.run()
+
+
+def test_keep_alive_closed_idle():
+    # the server closes each connection once the response is sent, without
+    # telling the client it won't be kept alive
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind((TEST_HOST, 0))
+    listener.listen(5)
+    port = listener.getsockname()[1]
+
+    methods = []
+    closed = threading.Event()
+    def serve():
+        for i in range(2):
+            conn, _ = listener.accept()
+            data = b""
+            while b"\r\n\r\n" not in data:
+                data += conn.recv(4096)
+            methods.append(data.split(b" ", 1)[0])
+            conn.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+            conn.close()
+            closed.set()
+
+    t = threading.Thread(target=serve)
+    t.daemon = True
+    t.start()
+
+    client = HTTPClient(async_client_class=KeepAliveHTTPClient)
+    url = "http://%s:%s/" % (TEST_HOST, port)
+    assert client.fetch(url).body == b"ok"
+    closed.wait(1.0)
+
+    # the POST isn't sent on the connection closed while idle
+    resp = client.fetch(url, method="POST", body="{}")
+    assert resp.body == b"ok"
+    assert methods == [b"GET", b"POST"]
+
+    client.close()
+    listener.close()
+    t.join(1.0)
+
+
+def test_request_many():
+    m, s = init()
+
+    testfile, cmd, args, wdir = dummy_cmd()
+    for name in ("a", "b", "c"):
+        config = ProcessConfig(name, cmd, args=args, cwd=wdir)
+        m.load(config, start=False)
+    time.sleep(0.2)
+
+    infos = s.jobs_info()
+    assert [info["name"] for info in infos] == ["default.a", "default.b",
+            "default.c"]
+
+    resps = s.request_many([("get", "/version"), ("head", "/jobs/default/a"),
+        ("head", "/jobs/default/nojob")])
+    assert [resp.code for resp in resps] == [200, 200, 404]
+
+    with pytest.raises(GafferNotFound):
+        s.request_many([("get", "/version"), ("get", "/jobs/default/nojob")])
+
+    m.stop()
+    m.run()
+
+
+def test_job_cache():
+    m = start_manager()
+    s = Server("http://%s:%s" % (TEST_HOST, TEST_PORT), loop=m.loop,
+            cache_ttl=10.0)
+
+    testfile, cmd, args, wdir = dummy_cmd()
+    config = ProcessConfig("dummy", cmd, args=args, cwd=wdir)
+    m.load(config, start=False)
+    time.sleep(0.2)
+
+    job = s.get_job("dummy")
+    assert job.numprocesses == 1
+    m.scale("dummy", 1)
+    # the info are cached
+    assert job.numprocesses == 1
+
+    # an action on the job empty the cache
+    job.scale(1)
+    assert job.numprocesses == 3
+
+    m.stop()
+    m.run()
+
+
+def test_unix_socket():
+    path = os.path.join(tempfile.mkdtemp(), "gafferd.sock")
+    http_handler = HttpHandler(MockConfig(bind=[TEST_URI, "unix:%s" % path],
+        unix_socket_mode=0o660))
+    m = Manager()
+    m.start(apps=[http_handler])
+    time.sleep(0.2)
+
+    assert http_handler.port == TEST_PORT
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o660
+
+    s = Server(unix_uri(path), loop=m.loop)
+    assert s.version == __version__
+    assert s.jobs() == []
+    assert get_server(m.loop).version == __version__
+
+    m.stop()
+    m.run()
+    assert not os.path.exists(path)
+
+
+@pytest.mark.skipif(not hasattr(socket, "SO_REUSEPORT"),
+        reason="SO_REUSEPORT isn't supported")
+def test_reuseport():
+    m = Manager()
+    handlers = [HttpHandler(MockConfig(bind=TEST_URI, reuseport=True))
+            for _ in range(2)]
+    m.start(apps=handlers)
+    time.sleep(0.2)
+
+    assert handlers[0].port == handlers[1].port == TEST_PORT
+    assert get_server(m.loop).version == __version__
+
+    m.stop()
+    m.run()
+
 if __name__ == "__main__":
     test_simple_job()
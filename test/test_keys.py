@@ -2,11 +2,14 @@
 #
 # This file is part of gaffer. See the NOTICE for more information.
 
+import time
+
 import pyuv
 import pytest
 
 from gaffer.gafferd.keys import (KeyNotFound, KeyConflict, InvalidKey,
-        UnknownPermission, Key, DummyKey, KeyManager, SqliteKeyBackend)
+        UnknownPermission, Key, DummyKey, KeyCache, KeyManager,
+        SqliteKeyBackend)
 
 from test_http import MockConfig
 
@@ -58,8 +61,6 @@ def test_key_manager():
         assert key == {"key": "test", "permission": {}}
         assert len(h._cache) == 1
         assert "test" in h._cache
-        assert len(h._entries) == 1
-        assert list(h._entries) == ["test"]
 
 
         key = h.delete_key("test")
@@ -81,13 +82,10 @@ def test_key_manager():
         assert len(h._cache) == 2
         assert "test" in h._cache
         assert "test1" in h._cache
-        assert len(h._entries) == 2
-        assert list(h._entries) == ["test", "test1"]
 
         # make sure keys are deleted from the cache
         h.delete_key("test")
         assert len(h._cache) == 0
-        assert len(h._entries) == 0
 
         with pytest.raises(KeyNotFound):
             key = h.get_key("test")
@@ -96,6 +94,81 @@ def test_key_manager():
             key = h.get_key("test1")
 
 
+def test_key_cache():
+    cache = KeyCache(max_size=2, ttl=0)
+    cache.set("a", 1)
+    cache.set("b", 2)
+
+    # "a" is now the most recently used
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert "a" in cache
+    assert "b" not in cache
+    assert cache.get("b") is None
+
+    cache.invalidate("a")
+    assert cache.get("a") is None
+    assert cache.stats() == {"size": 1, "max_size": 2, "ttl": 0, "hits": 1,
+            "misses": 2, "evictions": 1}
+
+    cache = KeyCache(max_size=2, ttl=0.1)
+    cache.set("a", 1)
+    assert cache.get("a") == 1
+    time.sleep(0.2)
+    assert cache.get("a") is None
+
+
+def test_key_manager_negative_cache():
+    conf = test_config()
+    loop = pyuv.Loop.default_loop()
+
+    with KeyManager(loop, conf) as h:
+        with pytest.raises(KeyNotFound):
+            h.get_key("test")
+
+        # the miss is cached
+        assert "test" in h._cache
+        with pytest.raises(KeyNotFound):
+            h.get_key("test")
+        assert h.cache_stats()["hits"] == 1
+        assert h.cache_stats()["misses"] == 1
+
+        # and invalidated once the key is created
+        h.set_key("test", {"permission": {}})
+        assert h.get_key("test") == {"key": "test", "permission": {}}
+
+
+def test_key_manager_async():
+    conf = test_config()
+    loop = pyuv.Loop.default_loop()
+    results = []
+
+    def on_result(result, error):
+        results.append((result, error))
+        if len(results) == 4:
+            timer.stop()
+
+    # the db callbacks don't keep the loop alive
+    timer = pyuv.Timer(loop)
+    timer.start(lambda h: h.stop(), 1.0, 0.0)
+
+    with KeyManager(loop, conf) as h:
+        h.set_key_async("test", {"permission": {}}, on_result)
+        h.set_key_async("test", {"permission": {}}, on_result)
+        h.get_key_async("test", on_result)
+        h.delete_key_async("test", on_result)
+        loop.run()
+
+        assert len(results) == 4
+        assert results[0] == (None, None)
+        assert isinstance(results[1][1], KeyConflict)
+        assert results[2] == ({"key": "test", "permission": {}}, None)
+        assert results[3] == (None, None)
+
+        with pytest.raises(KeyNotFound):
+            h.get_key("test")
+
+
 def test_create_key():
     conf = test_config()
     loop = pyuv.Loop.default_loop()
@@ -587,3 +660,40 @@ def test_mix():
         assert key.can_manage("test1") == False
         assert key.can_manage("test1.test") == False
 
+
+
+def test_glob_permissions():
+    key = Key.load({"key": "test", "permissions": {
+        "manage": ["payments.*"], "write": ["*.worker"], "read": ["test"]}})
+
+    assert key.can_manage("payments.api") == True
+    assert key.can_manage("payments") == False
+    assert key.can_read("payments") == False
+    assert key.can_manage("test.worker") == False
+    assert key.can_write("test.worker") == True
+    assert key.can_read("other.worker") == True
+    assert key.can_write("test.api") == False
+    assert key.can_read("test.api") == True
+    assert key.can_read("other.api") == False
+
+    with pytest.raises(UnknownPermission):
+        key.can("unknown", "test")
+
+
+def test_key_manager_key_object():
+    conf = test_config()
+    loop = pyuv.Loop.default_loop()
+
+    with KeyManager(loop, conf) as h:
+        h.create_key({"admin": True}, key="test")
+
+        # the compiled key is cached
+        key = h.get_key_object("test")
+        assert isinstance(key, Key)
+        assert key.is_admin() == True
+        assert h.get_key_object("test") is key
+        assert h.get_key("test") == {"key": "test",
+                "permissions": {"admin": True}}
+
+        with pytest.raises(KeyNotFound):
+            h.get_key_object("test1")
@@ -2,6 +2,7 @@
 #
 # This file is part of gaffer. See the NOTICE for more information.
 import copy
+import json
 import os
 import time
 
@@ -16,8 +17,8 @@ install()
 from gaffer.gafferd.http import HttpHandler
 from gaffer.gafferd.lookup import LookupClient
 from gaffer.httpclient import GafferNotFound
-from gaffer.lookupd.client import LookupServer
-from gaffer.lookupd.http import http_server
+from gaffer.lookupd.client import LookupServer, CachedLookup
+from gaffer.lookupd.http import http_server, LookupFanout
 from gaffer.lookupd.registry import (RemoteJob, GafferNode, Registry,
         NoIdent, JobNotFound, AlreadyIdentified, IdentExists,
         AlreadyRegistered)
@@ -262,7 +263,7 @@ def test_registry_remove_process():
 
 def test_registry_events():
     loop = pyuv.Loop.default_loop()
-    async = pyuv.Async(loop, lambda h: h.stop())
+    async_h = pyuv.Async(loop, lambda h: h.stop())
 
     r = Registry(loop)
     emitted = []
@@ -282,7 +283,7 @@ def test_registry_events():
     r.remove_node(c1)
 
     t = pyuv.Timer(loop)
-    t.start(lambda h: async.close(), 0.2, 0.0)
+    t.start(lambda h: async_h.close(), 0.2, 0.0)
     loop.run()
 
     assert len(emitted) == 7
@@ -417,11 +418,12 @@ def test_lookup_manager():
     m.stop(stop_server)
     loop.run()
 
-    assert len(emitted) == 7
+    # the process has been spawned and stopped in the same batch window, it
+    # is never registered.
+    assert len(emitted) == 5
     actions = [line[0] for line in emitted]
-    assert list(actions) == ['add_node', 'identify', 'add_job', 'add_process',
-            'remove_process', 'remove_job', 'remove_node']
-
+    assert list(actions) == ['add_node', 'identify', 'add_job', 'remove_job',
+            'remove_node']
 
     assert isinstance(emitted[0][1], GafferNode)
     assert isinstance(emitted[1][1], GafferNode)
@@ -429,19 +431,60 @@ def test_lookup_manager():
     assert "job_name" in emitted[2][1]
     assert emitted[2][1]['job_name'] == "default.dummy"
     assert isinstance(emitted[3][1], dict)
-    assert "job_name" in emitted[3][1]
     assert emitted[3][1]['job_name'] == "default.dummy"
-    assert "pid" in emitted[3][1]
+    assert isinstance(emitted[4][1], GafferNode)
+    assert emitted[4][1].sessions == {}
+
+def test_lookup_batch():
+    loop = pyuv.Loop.default_loop()
+    r = Registry(loop)
+    sock = bind_sockets(LOOKUPD_ADDR)
+    io_loop = IOLoop(_loop=loop)
+    server = http_server(io_loop, sock, registration_db=r)
+    server.start()
+
+    emitted = []
+    def cb(event, message):
+        emitted.append((event, message))
+
+    r.bind_all(cb)
+
+    client = LookupClient(loop, "ws://%s/ws" % LOOKUPD_ADDR,
+            batch_window=0.1)
+    client.start()
+
+    messages = []
+    messages.append(client.identify("c1", "broadcast", 1.0))
+    messages.append(client.add_job("a.job1"))
+    messages.append(client.add_process("a.job1", 1))
+    messages.append(client.add_process("a.job1", 2))
+    messages.append(client.remove_process("a.job1", 2))
+    messages.append(client.add_process("a.unknown", 3))
+
+    # the batch has not been sent yet
+    assert len(client._pending) == 3
+
+    t0 = pyuv.Timer(loop)
+    t0.start(lambda h: client.close(), 0.4, 0.0)
+
+    def stop(h):
+        h.close()
+        server.stop()
+        io_loop.close()
+
+    t = pyuv.Timer(loop)
+    t.start(stop, 0.6, 0.0)
+    loop.run()
+
+    results = [msg.result() for msg in messages]
+    assert ["ok" in result for result in results] == [True, True, True,
+            True, True, False]
+    assert results[5]["errno"] == 404
+
+    actions = [line[0] for line in emitted]
+    assert actions == ['add_node', 'identify', 'add_job', 'add_process',
+            'remove_node']
     assert emitted[3][1]['pid'] == 1
-    assert isinstance(emitted[4][1], dict)
-    assert "job_name" in emitted[4][1]
-    assert emitted[4][1]['job_name'] == "default.dummy"
-    assert "pid" in emitted[4][1]
-    assert emitted[4][1]['pid'] == 1
-    assert isinstance(emitted[5][1], dict)
-    assert emitted[5][1]['job_name'] == "default.dummy"
-    assert isinstance(emitted[6][1], GafferNode)
-    assert emitted[6][1].sessions == {}
 
 def test_lookup_client():
     # intiallize the lookupd server
@@ -562,8 +605,9 @@ def test_lookup_client_events():
     channel.bind_all(cb)
     channel.start()
 
+    # the registrations aren't batched so each event is received
     http_handler = HttpHandler(MockConfig(bind=GAFFERD_ADDR,
-        lookupd_addresses=[lookup_address]))
+        lookupd_addresses=[lookup_address], lookupd_batch_window=0))
     m = Manager(loop=loop)
     t = pyuv.Timer(loop)
     t0 = pyuv.Timer(loop)
@@ -596,5 +640,109 @@ def test_lookup_client_events():
     assert list(actions) == ['add_node', 'identify', 'add_job', 'add_process',
             'remove_process', 'remove_job', 'remove_node']
 
+def test_cached_lookup():
+    loop = pyuv.Loop.default_loop()
+    r = Registry(loop)
+    sock = bind_sockets(LOOKUPD_ADDR)
+    io_loop = IOLoop(_loop=loop)
+    server = http_server(io_loop, sock, registration_db=r)
+    server.start()
+
+    client = LookupClient(loop, "ws://%s/ws" % LOOKUPD_ADDR)
+    client.start()
+    client.identify("c1", "broadcast", 1.0)
+    client.add_job("a.job1")
+    client.add_process("a.job1", 1)
+
+    cache = CachedLookup(LookupServer("http://%s" % LOOKUPD_ADDR, loop))
+    cache.start()
+
+    results = []
+    def on_loaded(h):
+        results.append(cache.find_job("a.job1"))
+        client.add_process("a.job1", 2)
+        client.add_job("a.job2")
+
+    def on_changed(h):
+        results.append(cache.find_job("a.job1"))
+        results.append(cache.find_session("a"))
+        client.close()
+
+    def on_closed(h):
+        results.append(cache.find_job("a.job1"))
+
+    def stop(h):
+        h.close()
+        cache.close()
+        server.stop()
+        io_loop.close()
+
+    timers = []
+    for cb, delay in ((on_loaded, 0.3), (on_changed, 0.6), (on_closed, 0.9),
+            (stop, 1.0)):
+        t = pyuv.Timer(loop)
+        t.start(cb, delay, 0.0)
+        timers.append(t)
+    loop.run()
+
+    assert cache.ready
+    assert len(results) == 4
+    assert [source["pids"] for source in results[0]["sources"]] == [[1]]
+    assert results[0]["sources"][0]["node_info"]["name"] == "c1"
+    assert sorted(results[1]["sources"][0]["pids"]) == [1, 2]
+    assert sorted(job["name"] for job in results[2]["jobs"]) == ["a.job1",
+            "a.job2"]
+    # the node is gone
+    assert results[3] == {"sources": []}
+
+
+def test_lookup_fanout():
+    loop = pyuv.Loop.default_loop()
+    r = Registry(loop)
+
+    class Watcher(object):
+        def __init__(self, sessions=(), prefixes=()):
+            self.sessions = set(sessions)
+            self.prefixes = tuple(prefixes)
+
+    sent = []
+    class Router(object):
+        def broadcast(self, clients, msg):
+            sent.append((set(clients), msg))
+
+    fanout = LookupFanout(r, Router())
+    w_all = Watcher()
+    w_session = Watcher(sessions=["a"])
+    w_prefix = Watcher(prefixes=["b.web"])
+    for w in (w_all, w_session, w_prefix):
+        fanout.add(w)
+
+    r.add_node("c1")
+    r.identify("c1", "node1", "http://node1:5000", 1.0)
+    r.add_job("c1", "a.job1")
+    r.add_job("c1", "b.web1")
+    r.add_job("c1", "b.worker")
+
+    r.add_process("c1", "a.job1", 1)
+
+    t = pyuv.Timer(loop)
+    t.start(lambda h: h.close(), 0.1, 0.0)
+    loop.run()
+
+    # each event is encoded once and only sent to the watchers
+    # interested
+    assert all(isinstance(msg, str) for _, msg in sent)
+    assert [clients for clients, _ in sent] == [
+            set([w_all, w_session, w_prefix]),
+            set([w_all, w_session, w_prefix]),
+            set([w_all, w_session]), set([w_all, w_prefix]), set([w_all]),
+            set([w_all, w_session])]
+    assert json.loads(sent[2][1])["job_name"] == "a.job1"
+
+    fanout.remove(w_session)
+    assert fanout.watchers("a.job1") == set([w_all])
+    fanout.close()
+
+
 if __name__ == "__main__":
     test_lookup_client_events()
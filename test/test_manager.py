@@ -4,12 +4,14 @@
 
 from collections import deque
 from functools import partial
+import json
 import os
 import signal
 import sys
 import time
 from tempfile import mkstemp
 
+import psutil
 import pyuv
 import pytest
 
@@ -605,5 +607,202 @@ def test_process_commit():
     assert "exit_status" in msg
     assert msg['once'] == True
 
+def test_generation():
+    m = Manager()
+    m.start()
+    testfile, cmd, args, wdir = dummy_cmd()
+    config = ProcessConfig("dummy", cmd, args=args, cwd=wdir)
+
+    gens = [m.generation]
+    m.load(config, start=False)
+    gens.append(m.generation)
+    m.jobs()
+    m.pids()
+    gens.append(m.generation)
+    m.start_job("dummy")
+    gens.append(m.generation)
+    m.stop_job("dummy")
+    gens.append(m.generation)
+    m.unload("dummy")
+    gens.append(m.generation)
+
+    m.stop()
+    m.run()
+
+    assert gens[0] < gens[1]
+    assert gens[1] == gens[2]
+    assert gens[2] < gens[3]
+    assert gens[3] < gens[4]
+    assert gens[4] < gens[5]
+
+
+def test_snapshot():
+    m = Manager()
+    m.start()
+    testfile, cmd, args, wdir = dummy_cmd()
+    config = ProcessConfig("dummy", cmd, args=args, cwd=wdir,
+            numprocesses=2)
+    m.load(config)
+    m.load(config, sessionid="ga", start=False)
+
+    snapshot = m.snapshot()
+
+    m.stop()
+    m.run()
+
+    assert snapshot["generation"] > 0
+    assert snapshot["sessions"] == ["default", "ga"]
+    assert list(snapshot["jobs"]) == ["default.dummy", "ga.dummy"]
+    assert snapshot["pids"] == [1, 2]
+    assert snapshot["counts"] == {"sessions": 2, "jobs": 2, "pids": 2}
+
+    job = snapshot["jobs"]["default.dummy"]
+    assert job["active"] == True
+    assert job["running"] == 2
+    assert job["max_processes"] == 2
+    assert job["pids"] == [1, 2]
+    assert snapshot["jobs"]["ga.dummy"]["running"] == 0
+
+def test_restore():
+    m = Manager()
+    m.start()
+    testfile, cmd, args, wdir = dummy_cmd()
+    config = ProcessConfig("dummy", cmd, args=args, cwd=wdir,
+            numprocesses=2)
+    m.load(config)
+    os_pids = [p.os_pid for p in m.list()]
+    state = json.loads(json.dumps(m.dump_state()))
+
+    # let the processes start before leaving them
+    time.sleep(0.5)
+
+    # the processes are left running
+    m.stop(keep_processes=True)
+    m.run()
+
+    m = Manager()
+    m.start()
+    assert sorted(m.restore(state)) == sorted(os_pids)
+    assert m.pids("dummy") == [1, 2]
+    assert [p.os_pid for p in m.list()] == os_pids
+
+    # new processes get the next ids
+    m.scale("dummy", 1)
+    assert m.pids("dummy") == [1, 2, 3]
+    time.sleep(0.5)
+
+    m.stop()
+    m.run()
+
+    with open(testfile, 'r') as f:
+        res = f.read()
+        assert res.count('START') == 3
+        assert res.count('STOP') == 3
+
+def test_sockets(tmpdir):
+    path = str(tmpdir.join("web.sock"))
+    m = Manager()
+    m.start()
+    m.add_socket("web", "unix:%s" % path)
+    fds = m.get_socket("web").fds
+    assert os.path.exists(path)
+
+    testfile, cmd, args, wdir = dummy_cmd()
+    config = ProcessConfig("dummy", cmd, args=args, cwd=wdir,
+            numprocesses=2, sockets=["web"])
+    m.load(config)
+
+    # the socket is passed after stdin, stdout and stderr
+    for p in m.list():
+        assert p.env["GAFFER_SOCKET_WEB"] == "3"
+
+    # the socket stays open while the processes are restarted
+    m.reload("dummy")
+    assert m.get_socket("web").fds == fds
+
+    with pytest.raises(ProcessNotFound):
+        m.load(ProcessConfig("other", cmd, sockets=["admin"]))
+
+    # the socket is closed and its file removed once the manager stopped
+    results = []
+    def on_stop(m):
+        results.append((m.sockets, os.path.exists(path)))
+
+    m.stop(on_stop)
+    m.run()
+    assert results == [({}, False)]
+
+def test_zygote():
+    m = Manager()
+    m.start()
+    testfile, cmd, args, wdir = dummy_cmd()
+    config = ProcessConfig("dummy", cmd, args=args, cwd=wdir,
+            spawn_mode="zygote", preload=["json"])
+
+    # the first process is spawned normally while the zygote starts
+    m.load(config)
+    state = m._get_locked_state("dummy")
+    assert state.zygote is not None
+    results = []
+
+    def cb(handle):
+        zygote = state.zygote
+        results.append(zygote.ready)
+
+        # then the processes are forked by the zygote
+        m.scale("dummy", 1)
+        p = state.running[-1]
+        results.append(psutil.Process(p.os_pid).ppid() == zygote.os_pid)
+
+        # let the forked process install its signal handlers
+        t1.start(lambda h: m.stop(), 0.5, 0.0)
+
+    t = pyuv.Timer(m.loop)
+    t1 = pyuv.Timer(m.loop)
+    t.start(cb, 1.0, 0.0)
+    m.run()
+
+    assert results == [True, True]
+    with open(testfile, 'r') as f:
+        res = f.read()
+        assert res.count('START') == 2
+        assert res.count('STOP') == 2
+
+
+def test_zygote_exit():
+    fd, testfile = mkstemp()
+    os.close(fd)
+    wdir = os.path.dirname(__file__)
+    config = ProcessConfig("atexit", sys.executable,
+            args=["-u", "./proc_atexit.py", testfile], cwd=wdir,
+            spawn_mode="zygote")
+
+    # the processes exit and are restarted, forked by the zygote once it's
+    # ready
+    m = Manager()
+    m.start()
+    m.load(config)
+    state = m._get_locked_state("atexit")
+    results = []
+
+    def cb(handle):
+        results.append(state.zygote.ready)
+        t1.start(lambda h: m.stop(), 1.0, 0.0)
+
+    t = pyuv.Timer(m.loop)
+    t1 = pyuv.Timer(m.loop)
+    t.start(cb, 1.0, 0.0)
+    m.run()
+
+    assert results == [True]
+    with open(testfile, 'r') as f:
+        lines = f.read().splitlines()
+
+    # the forked processes waited for their thread then ran the atexit
+    # handlers like the processes executed
+    assert len(lines) >= 3
+    assert set(lines) == set(["ATEXIT done"])
+
+
 if __name__ == "__main__":
     test_sessions()
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -
+#
+# This file is part of gaffer. See the NOTICE for more information.
+
+import json
+import os
+
+from gaffer.outbox import Outbox
+
+
+def test_outbox(tmpdir):
+    path = str(tmpdir.join("outbox"))
+    outbox = Outbox(path, segment_size=100)
+    outbox.open()
+
+    for i in range(10):
+        seq = outbox.append("spawn", json.dumps({"pid": i}))
+        assert seq == i
+    assert len(outbox.segments) > 1
+
+    records = outbox.read(3, 4)
+    assert [seq for seq, _, _ in records] == [3, 4, 5, 6]
+    assert records[0][1] == "spawn"
+    assert json.loads(records[0][2]) == {"pid": 3}
+    # the next read continues from the previous one
+    assert [seq for seq, _, _ in outbox.read(7, 10)] == [7, 8, 9]
+
+    outbox.save_cursors({"http://a": 6, "http://b": 8})
+    outbox.compact(6)
+    assert outbox.first_seq <= 6
+    assert outbox.read(0, 1)[0][0] == outbox.first_seq
+    first_seq = outbox.first_seq
+
+    # simulate a crash in the middle of an append
+    outbox.close()
+    segments = [name for name in os.listdir(path) if name.endswith(".seg")]
+    last = sorted(segments)[-1]
+    with open(os.path.join(path, last), "ab") as f:
+        f.write(b"exit\t{\"pi")
+
+    outbox = Outbox(path, segment_size=100)
+    outbox.open()
+    assert outbox.cursors == {"http://a": 6, "http://b": 8}
+    assert outbox.first_seq == first_seq
+    assert outbox.next_seq == 10
+    assert outbox.append("exit", "{}") == 10
+    assert outbox.read(10, 1) == [(10, "exit", "{}")]
+
+    # the oldest segments are dropped when the outbox is full
+    outbox.max_size = 200
+    for i in range(10):
+        outbox.append("spawn", json.dumps({"pid": i}))
+    assert outbox.size <= 200
+    assert outbox.dropped > 0
+    assert outbox.read(0, 1)[0][0] == outbox.first_seq
+    outbox.close()
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -
+#
+# This file is part of gaffer. See the NOTICE for more information.
+
+import pyuv
+import pytest
+
+from gaffer.lookupd.registry import (Registry, IdentExists, JobNotFound,
+        UnknownStrategy)
+from gaffer.lookupd.store import RegistryStore
+from gaffer.lookupd.wheel import TimerWheel
+
+
+def test_registry_indexes():
+    loop = pyuv.Loop.default_loop()
+    r = Registry(loop)
+
+    r.add_node("c1")
+    r.add_node("c2")
+    r.identify("c1", "node1", "http://node1:5000", 1.0)
+    r.identify("c2", "node2", "http://node2:5000", 1.0)
+
+    r.add_node("c3")
+    with pytest.raises(IdentExists):
+        r.identify("c3", "node1", "http://node1:5000", 1.0)
+
+    node1 = r.get_node("c1")
+    assert r.node_by_name("node1") == [node1]
+    assert r.node_by_ident("node1", "http://node1:5000") is node1
+
+    r.add_job("c1", "default.dummy")
+    r.add_job("c2", "default.dummy")
+    r.add_job("c2", "test.worker")
+
+    assert [j.node.name for j in r.find_job("default.dummy")] == ["node1",
+            "node2"]
+    assert len(r.find_session("default")) == 2
+    assert list(r.jobs()) == ["default.dummy", "test.worker"]
+    assert list(r.sessions()) == ["default", "test"]
+    assert list(r.sessions("node1")) == ["default"]
+
+    r.remove_job("c2", "test.worker")
+    with pytest.raises(JobNotFound):
+        r.find_job("test.worker")
+    assert r.find_session("test") == []
+
+    # removing the node removes its jobs and its identity
+    r.remove_node("c1")
+    assert [j.node.name for j in r.find_job("default.dummy")] == ["node2"]
+    assert r.node_by_name("node1") == []
+    assert r.node_by_ident("node1", "http://node1:5000") is None
+
+    r.remove_node("c2")
+    assert r.jobs() == {}
+    assert r.sessions() == {}
+    r.close()
+
+
+def test_registry_resume_and_sync():
+    loop = pyuv.Loop.default_loop()
+    r = Registry(loop)
+
+    emitted = []
+    r.bind_all(lambda event, msg: emitted.append(event))
+
+    r.add_node("c1")
+    r.identify("c1", "node1", "http://node1:5000", 1.0)
+    r.sync_node("c1", {"default.dummy": [1, 2], "default.other": []})
+    assert sorted(r.find_job("default.dummy")[0].pids) == [1, 2]
+
+    # the node reconnects before its old connection is closed
+    r.add_node("c2")
+    with pytest.raises(IdentExists):
+        r.identify("c2", "node1", "http://node1:5000", 1.0)
+    replaced = r.identify("c2", "node1", "http://node1:5000", 1.0,
+            resume=True)
+    assert replaced.conn == "c1"
+    assert r.node_by_name("node1") == [r.get_node("c2")]
+    assert r.find_job("default.dummy")[0].node is r.get_node("c2")
+
+    # only the differences are applied
+    r.sync_node("c2", {"default.dummy": [2, 3], "default.new": [4]})
+    assert sorted(r.find_job("default.dummy")[0].pids) == [2, 3]
+    assert r.find_job("default.new")[0].pids == [4]
+    with pytest.raises(JobNotFound):
+        r.find_job("default.other")
+
+    # the old connection is gone
+    r.remove_node("c1")
+    assert len(r.find_job("default.dummy")) == 1
+    r.close()
+
+
+def test_timer_wheel():
+    loop = pyuv.Loop.default_loop()
+    expired = []
+
+    wheel = TimerWheel(loop, expired.append, tick=0.05, slots=4)
+    wheel.start()
+    wheel.schedule("a", 0.1)
+    # more than one turn of the wheel
+    wheel.schedule("b", 0.5)
+    wheel.schedule("c", 0.1)
+    wheel.cancel("c")
+
+    t = pyuv.Timer(loop)
+    t.start(lambda h: wheel.close(), 0.8, 0.0)
+    loop.run()
+
+    assert expired == ["a", "b"]
+
+
+def test_registry_expiry():
+    loop = pyuv.Loop.default_loop()
+    r = Registry(loop, node_timeout=0.2)
+
+    r.add_node("c1")
+    r.identify("c1", "node1", "http://node1:5000", 1.0)
+    r.add_node("c2")
+    r.identify("c2", "node2", "http://node2:5000", 1.0)
+    r.add_job("c1", "default.dummy")
+
+    # only the second node sends heartbeats
+    heartbeat = pyuv.Timer(loop)
+    heartbeat.start(lambda h: r.update("c2"), 0.05, 0.05)
+
+    def stop(h):
+        heartbeat.close()
+        h.close()
+
+    t = pyuv.Timer(loop)
+    t.start(stop, 0.5, 0.0)
+    loop.run()
+
+    assert [node.name for node in r.all_nodes()] == ["node2"]
+    with pytest.raises(JobNotFound):
+        r.find_job("default.dummy")
+
+    metrics = r.metrics()
+    assert metrics["nodes"] == 1
+    assert metrics["expired_nodes"] == 1
+    assert metrics["heartbeats"] > 0
+    r.close()
+
+
+def test_find_job_strategies():
+    loop = pyuv.Loop.default_loop()
+    r = Registry(loop)
+
+    for i, load in enumerate([{"cpu": 80.0, "restart_rate": 0},
+            {"cpu": 10.0, "restart_rate": 0}, {"cpu": 0.0, "restart_rate": 2},
+            None]):
+        conn = "c%s" % i
+        r.add_node(conn)
+        r.identify(conn, "node%s" % i, "http://node%s:5000" % i, 1.0)
+        r.add_job(conn, "default.dummy")
+        if load is not None:
+            r.update(conn, {"default.dummy": load})
+
+    def names(jobs):
+        return [job.node.name for job in jobs]
+
+    assert names(r.find_job("default.dummy")) == ["node0", "node1", "node2",
+            "node3"]
+    assert names(r.find_job("default.dummy", "least_loaded")) == ["node1",
+            "node0", "node2", "node3"]
+    assert names(r.find_job("default.dummy", "least_loaded", limit=1)) == [
+            "node1"]
+    assert r.find_job("default.dummy", "least_loaded")[0].load == {
+            "cpu": 10.0, "restart_rate": 0}
+
+    # each call starts with the next source
+    assert names(r.find_job("default.dummy", "round_robin", 2)) == ["node0",
+            "node1"]
+    assert names(r.find_job("default.dummy", "round_robin", 2)) == ["node1",
+            "node2"]
+
+    ranked = names(r.find_job("default.dummy", "p2c"))
+    assert sorted(ranked) == ["node0", "node1", "node2", "node3"]
+    # the most loaded source can't be picked first
+    assert ranked[0] != "node3"
+
+    with pytest.raises(UnknownStrategy):
+        r.find_job("default.dummy", "random")
+    r.close()
+
+
+def test_registry_store(tmpdir):
+    loop = pyuv.Loop.default_loop()
+    path = str(tmpdir.join("registry.json"))
+
+    r = Registry(loop)
+    store = RegistryStore(loop, r, path)
+    assert store.load() == 0
+    store.start()
+
+    r.add_node("c1")
+    r.identify("c1", "node1", "http://node1:5000", 1.0)
+    r.add_job("c1", "default.dummy")
+    r.add_process("c1", "default.dummy", 1)
+    r.add_node("c2")
+    r.identify("c2", "node2", "http://node2:5000", 1.0)
+
+    # wait for the changes to be logged then simulate a crash
+    t = pyuv.Timer(loop)
+    t.start(lambda h: h.close(), 0.1, 0.0)
+    loop.run()
+    store._on_flush(None)
+    r.close()
+
+    r = Registry(loop)
+    store = RegistryStore(loop, r, path, stale_timeout=0.2)
+    assert store.load() == 2
+
+    # the restored nodes are served as stale
+    jobs = r.find_job("default.dummy")
+    assert jobs[0].pids == [1]
+    assert jobs[0].node.infodict()["stale"] is True
+    store.start()
+
+    # the first node reconnects and replaces its stale node
+    r.add_node("c3")
+    r.identify("c3", "node1", "http://node1:5000", 1.0)
+    jobs = r.find_job("default.dummy")
+    assert jobs[0].node.conn == "c3"
+    assert jobs[0].node.stale is False
+
+    # the second node never reconnects
+    t = pyuv.Timer(loop)
+    t.start(lambda h: h.close(), 0.4, 0.0)
+    loop.run()
+
+    assert [node.name for node in r.all_nodes()] == ["node1"]
+    store.stop()
+    r.close()
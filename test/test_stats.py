@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -
+#
+# This file is part of gaffer. See the NOTICE for more information.
+
+import pyuv
+
+from gaffer.gafferd.stats import StatsCollector
+from gaffer.manager import Manager
+from gaffer.process import ProcessConfig
+
+from test_manager import dummy_cmd, crash_cmd
+
+
+def test_collect():
+    m = Manager()
+    m.start()
+    collector = StatsCollector(m.loop, m, interval=0.1)
+    collector.start()
+
+    testfile, cmd, args, wdir = dummy_cmd()
+    m.load(ProcessConfig("a", cmd, args=args, cwd=wdir, numprocesses=2))
+    m.load(ProcessConfig("b", cmd, args=args, cwd=wdir), sessionid="ga")
+
+    def stop(handle):
+        collector.close()
+        m.stop()
+
+    t = pyuv.Timer(m.loop)
+    t.start(stop, 0.5, 0.0)
+    m.run()
+
+    stats = collector.stats
+    assert sorted(stats["jobs"]) == ["default.a", "ga.b"]
+    assert sorted(stats["sessions"]) == ["default", "ga"]
+
+    job = stats["jobs"]["default.a"]
+    assert job["sessionid"] == "default"
+    assert job["processes"] == 2
+    assert job["max_processes"] == 2
+    assert job["rss"] > 0
+    assert job["max_rss"] <= job["rss"]
+    assert job["restarts"] == 0
+
+    assert stats["sessions"]["ga"]["processes"] == 1
+    assert stats["sessions"]["ga"]["jobs"] == 1
+    assert stats["node"]["processes"] == 3
+    assert stats["node"]["jobs"] == 2
+    assert stats["node"]["rss"] == (job["rss"] +
+            stats["jobs"]["ga.b"]["rss"])
+
+
+def test_restarts():
+    m = Manager()
+    m.start()
+    collector = StatsCollector(m.loop, m, interval=0.1)
+    collector.start()
+
+    cmd, args, wdir = crash_cmd()
+    m.load(ProcessConfig("crashing", cmd, args=args, cwd=wdir))
+
+    def stop(handle):
+        m.stop_job("crashing")
+        collector.close()
+        m.stop()
+
+    t = pyuv.Timer(m.loop)
+    t.start(stop, 0.8, 0.0)
+    m.run()
+
+    assert collector.restarts()["default.crashing"] >= 1
+    assert collector.stats["jobs"]["default.crashing"]["restarts"] >= 1
+
+
+def test_restarts_stopped():
+    m = Manager()
+    m.start()
+    collector = StatsCollector(m.loop, m, interval=0.1)
+    collector.start()
+
+    testfile, cmd, args, wdir = dummy_cmd()
+    m.load(ProcessConfig("dummy", cmd, args=args, cwd=wdir, numprocesses=3))
+
+    # processes stopped on purpose are not restarts
+    def scale(handle):
+        m.stop_process(1)
+        m.scale("dummy", -1)
+        t.start(unload, 0.3, 0.0)
+
+    def unload(handle):
+        m.unload("dummy")
+        t.start(stop, 0.3, 0.0)
+
+    def stop(handle):
+        collector.close()
+        m.stop()
+
+    t = pyuv.Timer(m.loop)
+    t.start(scale, 0.3, 0.0)
+    m.run()
+
+    assert collector.restarts() == {}
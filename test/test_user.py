@@ -5,8 +5,10 @@
 import pyuv
 import pytest
 
+from gaffer.gafferd.tokens import TokenSigner, InvalidToken
 from gaffer.gafferd.users import (AuthManager, User, DummyUser,
-        SqliteAuthHandler, UserConflict, UserNotFound)
+        SqliteAuthHandler, UserConflict, UserNotFound, hash_password,
+        check_password)
 
 from test_http import MockConfig
 
@@ -100,3 +102,46 @@ def test_authenticate():
         assert isinstance(user1, DummyUser)
         assert user1.is_authenticated() == False
         assert user1.is_anonymous() == True
+
+
+def test_password_rehash():
+    conf = test_config()
+    loop = pyuv.Loop.default_loop()
+
+    with AuthManager(loop, conf) as auth:
+        # password stored with the legacy parameters
+        legacy = hash_password("test", 1000, algorithm="PBKDF2-256")
+        assert legacy.startswith("PBKDF2-256$")
+        assert check_password("test", legacy) == True
+        auth._backend.create_user("test", legacy)
+
+        user = auth.authenticate("test", "test")
+        assert user.is_authenticated() == True
+
+        # the hash has been upgraded on login
+        password = auth.get_user("test")["password"]
+        assert password.startswith("PBKDF2-SHA256$")
+        assert password.split("$")[1].endswith(":%s" %
+                conf.password_iterations)
+        assert auth.authenticate("test", "test").is_authenticated() == True
+
+
+def test_tokens():
+    signer = TokenSigner("secret", ttl=300)
+    token, expires = signer.sign({"username": "test"})
+    payload = signer.verify(token)
+    assert payload["username"] == "test"
+    assert payload["exp"] == expires
+
+    with pytest.raises(InvalidToken):
+        TokenSigner("other").verify(token)
+
+    with pytest.raises(InvalidToken):
+        signer.verify(token[:-2])
+
+    with pytest.raises(InvalidToken):
+        signer.verify("garbage")
+
+    expired, _ = TokenSigner("secret", ttl=-1).sign({"username": "test"})
+    with pytest.raises(InvalidToken):
+        signer.verify(expired)
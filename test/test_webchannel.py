@@ -155,6 +155,35 @@ def test_simple_job():
     assert cmd1.result()["jobs"][0] == "default.dummy"
 
 
+def test_batch():
+    m, s, socket = init()
+
+    testfile, cmd, args, wdir = dummy_cmd()
+    config = ProcessConfig("dummy", cmd, args=args, cwd=wdir)
+
+    cmd0 = socket.send_batch([
+        {"name": "load", "args": [config.to_dict()],
+            "kwargs": {"start": False}},
+        ("jobs",),
+        ("info", "unknown")])
+
+    def stop(h):
+        h.close()
+        socket.close()
+        m.stop()
+
+    t = pyuv.Timer(m.loop)
+    t.start(stop, 0.4, 0.0)
+    m.run()
+
+    assert cmd0.error() == None
+    results = cmd0.result()
+    assert len(results) == 3
+    assert results[0] == {"result": {"ok": True}}
+    assert results[1] == {"result": {"jobs": ["default.dummy"]}}
+    assert results[2]["error"]["errno"] == 404
+
+
 def test_remove_job():
     m, s, socket = init()
     testfile, cmd, args, wdir = dummy_cmd()
@@ -29,10 +29,23 @@ class TestHandler(RequestHandler):
         received.append((obj['event'], obj['name']))
         self.write("ok")
 
+class BatchHandler(RequestHandler):
+    def post(self, *args):
+        received = self.settings.get('received')
+        # the first post fails
+        if not received:
+            received.append(None)
+            self.set_status(503)
+            return
+
+        received.append(json.loads(self.request.body.decode('utf-8')))
+        self.write("ok")
+
 def get_server(loop, received):
     io_loop = IOLoop(_loop=loop)
 
     test_handlers = [
+            (r'/batch', BatchHandler),
             (r'/([^/]+)', TestHandler)
     ]
 
@@ -86,3 +99,37 @@ def test_manager_hooks():
     assert ('job.default.dummy.spawn', 'default.dummy') in emitted
     assert ('job.default.dummy.stop', 'default.dummy') in emitted
     assert ('job.default.dummy.exit', 'default.dummy') in emitted
+
+def test_hooks_batch_retry():
+    received = []
+    loop = pyuv.Loop.default_loop()
+    s = get_server(loop, received)
+    s.start()
+
+    hooks = WebHooks([("test", make_uri("/batch"))], batch_interval=0.1)
+    m = Manager(loop=loop)
+    m.start(apps=[hooks])
+
+    for i in range(3):
+        m.events.publish("test", {"event": "test", "name": "job%s" % i})
+
+    metrics = []
+    def stop(h):
+        h.close()
+        metrics.append(hooks.metrics()[make_uri("/batch")])
+        hooks.close()
+        m.stop(lambda manager: s.stop())
+
+    t = pyuv.Timer(loop)
+    t.start(stop, 2.0, 0.0)
+    m.run()
+
+    # the batch has been posted again after the error
+    assert received[0] is None
+    assert [[e["name"] for e in batch] for batch in received[1:]] == [
+            ["job0", "job1", "job2"]]
+
+    metrics = metrics[0]
+    assert metrics["delivered"] == 3
+    assert metrics["retries"] == 1
+    assert metrics["queued"] == 0